@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+"""
+One audio session per process, shared by every menu action
+
+    session = get_session()
+    session.devices()                             # listed once, refresh=True probes again
+    with session.detector(gate=True) as detector:  # planned once per configuration
+        detector.start_stream(device)
+        ...
+
+PortAudio stays initialized for as long as the session is open, instead of being
+initialized and terminated with every detector.
+"""
+import formant_detector
+
+# Input device the programs capture from until another one is selected
+DEFAULT_DEVICE = 7
+
+
+class AudioSession:
+    """
+    Keeps PortAudio initialized, caches the device list and keeps idle detectors by
+    configuration, so starting and stopping a stream does not allocate and plan again.
+    """
+
+    def __init__(self):
+        self._session = formant_detector.AudioSession()
+        self._idle = {}
+
+    def close(self):
+        self._idle.clear()
+        self._session.close()
+
+    @property
+    def is_open(self):
+        return self._session.is_open
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def devices(self, refresh=False):
+        """Every device as a dict, see formant_detector.audio_devices()"""
+        return self._session.devices(refresh)
+
+    def input_devices(self, refresh=False):
+        return [device for device in self.devices(refresh) if device["max_input_channels"] > 0]
+
+    def device(self, index):
+        """The device with this index, None if there is none"""
+        return next((device for device in self.devices() if device["index"] == index), None)
+
+    def detector(self, **config):
+        """
+        Context manager lending a FormantDetector with these settings. On return its stream
+        is stopped, its model unloaded and its frames dropped, and it is kept for the next
+        use of the same settings. A detector whose stream failed to stop is not kept.
+        """
+        return _Lease(self, tuple(sorted(config.items())))
+
+    def idle_detectors(self):
+        return sum(len(detectors) for detectors in self._idle.values())
+
+    def _acquire(self, key):
+        idle = self._idle.get(key)
+        if idle:
+            return idle.pop()
+        return formant_detector.FormantDetector(**dict(key))
+
+    def _release(self, key, detector):
+        try:
+            detector.stop_stream()
+        finally:
+            detector.load_model(None)
+            detector.drain()
+        self._idle.setdefault(key, []).append(detector)
+
+
+class _Lease:
+    def __init__(self, session, key):
+        self._session = session
+        self._key = key
+        self._detector = None
+
+    def __enter__(self):
+        self._detector = self._session._acquire(self._key)
+        return self._detector
+
+    def __exit__(self, *exc):
+        detector, self._detector = self._detector, None
+        try:
+            self._session._release(self._key, detector)
+        except Exception:
+            # The error that ended the block matters more than a failed release
+            if exc[0] is None:
+                raise
+
+
+_session = None
+
+
+def get_session():
+    """The process's session, opened on first use"""
+    global _session
+    if _session is None or not _session.is_open:
+        _session = AudioSession()
+    return _session
+
+
+def close_session():
+    """Closes the process's session, if one was opened"""
+    global _session
+    if _session is not None:
+        _session.close()
+        _session = None
+
+
+def format_devices(devices):
+    lines = []
+    for device in devices:
+        default = " (default input)" if device["default_input"] else ""
+        lines.append(f"Device {device['index']}: {device['name']}{default}")
+        lines.append(f"   host API: {device['host_api']}")
+        lines.append(f"   input channels: {device['max_input_channels']}, "
+                     f"output channels: {device['max_output_channels']}, "
+                     f"default sample rate: {device['default_sample_rate']:.0f} Hz")
+    return "\n".join(lines)
@@ -2,14 +2,20 @@
 """
 Real-time formant detection test
 """
-import formant_detector
+import numpy as np
 import time
 
-from sklearn.model_selection import train_test_split
-
 from enum import Enum
 
-deviceInput = 7
+from audio_session import DEFAULT_DEVICE, close_session, format_devices, get_session
+from vowel_models import BACKENDS, LookupTable, VowelModel
+from evaluation import evaluate, format_report
+from training_store import TrainingStore, read_header
+
+deviceInput = DEFAULT_DEVICE
+# Voice-activity gate of the capturing detectors: silent and unvoiced frames are not
+# analyzed, so they never become training examples or predictions
+VOICE_GATE = True
 
 class Vowel(Enum):
     A = 1
@@ -23,26 +29,25 @@ feature_cols = ['formant1', 'formant2']
 def test_realtime_formants():
     print("Starting real-time formant detection...")
     
-    detector = formant_detector.FormantDetector()
-    
-    try:
-        # Start audio capture
-        detector.start_stream(deviceInput)  # Use device 7 (pulse) for input
-        print("Listening for formants... Speak into your microphone!")
-        print("Press Ctrl+C to stop")
-        
-        # Monitor for formants
-        for i in range(100):  # Run for about 10 seconds
-            formants = detector.get_formants()
-            if formants[0] > 0 and formants[1] > 0:  # Valid formants detected
-                print(f"F1: {formants[0]:.0f} Hz, F2: {formants[1]:.0f} Hz")
-            time.sleep(0.1)  # Check every 100ms
-            
-    except KeyboardInterrupt:
-        print("\nStopping detection...")
-    finally:
-        detector.stop_stream()
-        print("Detection stopped.")
+    with get_session().detector(gate=VOICE_GATE) as detector:
+        try:
+            # Start audio capture
+            detector.start_stream(deviceInput)  # Use device 7 (pulse) for input
+            print("Listening for formants... Speak into your microphone!")
+            print("Press Ctrl+C to stop")
+
+            # Monitor for formants, waking up as soon as each frame is analyzed
+            end_time = time.monotonic() + 10  # Run for about 10 seconds
+            while time.monotonic() < end_time:
+                frame = detector.wait_next(timeout=0.5)
+                if frame is not None and frame['f1'] > 0 and frame['f2'] > 0:  # Valid formants detected
+                    print(f"F1: {frame['f1']:.0f} Hz, F2: {frame['f2']:.0f} Hz")
+
+        except KeyboardInterrupt:
+            print("\nStopping detection...")
+        finally:
+            detector.stop_stream()
+            print("Detection stopped.")
 
 def print_audio_devices():
     """Display available audio input devices"""
@@ -50,10 +55,9 @@ def print_audio_devices():
     print("AVAILABLE AUDIO DEVICES")
     print("="*50)
     
-    detector = formant_detector.FormantDetector()
     try:
-        detector.print_devices()
-        print("\nNote: Look for devices with maxInputChannels > 0 for microphone input")
+        print(format_devices(get_session().devices()))
+        print("\nNote: Look for devices with input channels for microphone input")
         print(f"Current selected device: {deviceInput}")
         print("Use option 10 to change the audio device")
     except Exception as e:
@@ -67,13 +71,13 @@ def select_audio_device():
     print("SELECT AUDIO INPUT DEVICE")
     print("="*50)
     
-    # First show available devices
-    detector = formant_detector.FormantDetector()
+    # First show available devices, probing again for any plugged in since
+    session = get_session()
     try:
         print("Available devices:")
-        detector.print_devices()
+        print(format_devices(session.devices(refresh=True)))
         print(f"\nCurrent device: {deviceInput}")
-        print("Note: Choose a device with maxInputChannels > 0")
+        print("Note: Choose a device with input channels")
         
         while True:
             try:
@@ -83,15 +87,18 @@ def select_audio_device():
                     print("Device selection cancelled.")
                     return
                 
-                if new_device < 0:
-                    print("Please enter a valid device number (0 or higher)")
+                device = session.device(new_device)
+                if device is None:
+                    print("Please enter one of the device numbers above")
+                    continue
+                if device["max_input_channels"] == 0:
+                    print(f"{device['name']} has no input channels, choose another device")
                     continue
                 
                 # Test if the device works by trying to initialize it
                 print(f"Testing device {new_device}...")
-                test_detector = formant_detector.FormantDetector()
-                test_detector.start_stream(new_device)
-                test_detector.stop_stream()
+                with session.detector() as test_detector:
+                    test_detector.start_stream(new_device)
                 
                 # If we get here, the device works
                 deviceInput = new_device
@@ -108,22 +115,31 @@ def select_audio_device():
     except Exception as e:
         print(f"Error getting device list: {e}")
 
-vowel_a_training_examples = []
-vowel_e_training_examples = []
-vowel_i_training_examples = []
-vowel_o_training_examples = []
-vowel_u_training_examples = []
+# Every training example collected or loaded in this session, labelled with its
+# Vowel value. Examples collected now are tagged with this session id.
+training_store = TrainingStore()
+session_id = int(time.time()) & 0xFFFFFFFF
+# (path, count) of the store file the examples were last saved to or loaded from. Saving
+# there again only appends what was collected since, until examples are cleared.
+saved_store = None
 
+# Binary store files, saved training data in other files is read as CSV
+STORE_EXTENSION = ".vrt"
+TRAINING_FILE = "vowel_training_data" + STORE_EXTENSION
+# What the default file was called before the binary store, read when there is no store yet
+LEGACY_TRAINING_FILE = "vowel_training_data.txt"
+# Lookup table compiled from the model, saved next to the training data file
+TABLE_EXTENSION = ".table.npz"
 
-def get_vowel_fornants_training_examples():
-    detector = formant_detector.FormantDetector()
 
+def get_vowel_fornants_training_examples():
     vowel_training_examples = []
 
-    for i in range(50):
-        formants = detector.get_formants()
-        if formants[0] > 0 and formants[1] > 0:
-            vowel_training_examples.append(formants)
+    with get_session().detector() as detector:
+        for i in range(50):
+            formants = detector.get_formants()
+            if formants[0] > 0 and formants[1] > 0:
+                vowel_training_examples.append(formants)
 
     return vowel_training_examples
 
@@ -135,199 +151,205 @@ def train_vowel(vowel_index):
     print(f"Training for vowel: {vowel_name}")
     print("Say the vowel sound repeatedly. Press Ctrl+C when done.")
     
-    detector = formant_detector.FormantDetector()
     training_examples = []
     
-    try:
-        detector.start_stream(deviceInput)
-        
-        # Collect training data
-        while True:
-            formants = detector.get_formants()
-            if formants[0] > 0 and formants[1] > 0:  # Valid formants
-                training_examples.append([formants[0], formants[1]])
-                print(f"Collected: F1={formants[0]:.0f} Hz, F2={formants[1]:.0f} Hz (Total: {len(training_examples)})")
-            time.sleep(0.1)
-            
-    except KeyboardInterrupt:
-        print(f"\nFinished training for vowel {vowel_name}. Collected {len(training_examples)} examples.")
-    finally:
-        detector.stop_stream()
-    
-    # Store in appropriate global array
-    if vowel_index == 1:
-        vowel_a_training_examples.extend(training_examples)
-    elif vowel_index == 2:
-        vowel_e_training_examples.extend(training_examples)
-    elif vowel_index == 3:
-        vowel_i_training_examples.extend(training_examples)
-    elif vowel_index == 4:
-        vowel_o_training_examples.extend(training_examples)
-    elif vowel_index == 5:
-        vowel_u_training_examples.extend(training_examples)
+    with get_session().detector(gate=VOICE_GATE) as detector:
+        try:
+            detector.start_stream(deviceInput)
+
+            # Collect training data, every analyzed frame as it arrives
+            while True:
+                frame = detector.wait_next(timeout=0.5)
+                if frame is not None and frame['f1'] > 0 and frame['f2'] > 0:  # Valid formants
+                    training_examples.append([float(frame['f1']), float(frame['f2'])])
+                    print(f"Collected: F1={frame['f1']:.0f} Hz, F2={frame['f2']:.0f} Hz (Total: {len(training_examples)})")
+
+        except KeyboardInterrupt:
+            print(f"\nFinished training for vowel {vowel_name}. Collected {len(training_examples)} examples.")
+        finally:
+            detector.stop_stream()
+    
+    # Store with the vowel's label
+    if 1 <= vowel_index <= 5 and training_examples:
+        training_store.extend(training_examples, vowel_index, session=session_id)
+        vowel_model.invalidate()
     
     return training_examples
 
+def training_matrix():
+    """All training examples as an (n, 2) array of [F1, F2] and their vowel labels"""
+    return training_store.features(), training_store.label_names()
+
+# Fitted on first use, refitted only after train_vowel, clear_vowel_training_data or
+# load_training_data change the training data (call vowel_model.invalidate() after
+# changing training_store any other way)
+vowel_model = VowelModel(training_matrix, backend="knn", n_neighbors=3)
+
 def likelyhood_vowel(formants):
     """Predict the most likely vowel based on formant frequencies"""
-    from sklearn.neighbors import KNeighborsClassifier
-    import numpy as np
-    
-    # Collect all training data
-    all_training_data = []
-    all_labels = []
-    
-    # Add training examples with labels
-    for example in vowel_a_training_examples:
-        all_training_data.append(example)
-        all_labels.append('A')
-    
-    for example in vowel_e_training_examples:
-        all_training_data.append(example)
-        all_labels.append('E')
-        
-    for example in vowel_i_training_examples:
-        all_training_data.append(example)
-        all_labels.append('I')
-        
-    for example in vowel_o_training_examples:
-        all_training_data.append(example)
-        all_labels.append('O')
-        
-    for example in vowel_u_training_examples:
-        all_training_data.append(example)
-        all_labels.append('U')
-    
-    if len(all_training_data) < 5:
+    try:
+        return vowel_model.predict(formants)
+    except ValueError:
         return "Not enough training data"
+
+def predict_many(frames):
+    """Predict the vowel of every frame drained from a detector, returns (labels, probabilities)"""
+    return vowel_model.predict_many(frames)
+
+def select_classifier_backend():
+    """Let the user choose the classifier used for recognition"""
+    print("\n" + "="*50)
+    print("SELECT CLASSIFIER BACKEND")
+    print("="*50)
     
-    # Train classifier
-    classifier = KNeighborsClassifier(n_neighbors=3)
-    classifier.fit(all_training_data, all_labels)
+    names = list(BACKENDS)
+    for i, name in enumerate(names, 1):
+        description = BACKENDS[name].__doc__.strip().splitlines()[0]
+        current = " (current)" if name == vowel_model.backend else ""
+        print(f"{i}. {name}{current}: {description}")
     
-    # Predict
-    prediction = classifier.predict([formants])
-    probabilities = classifier.predict_proba([formants])
+    try:
+        choice = int(input("\nWhich backend? "))
+    except ValueError:
+        print("Please enter a valid number!")
+        return
+    if not 1 <= choice <= len(names):
+        print("Invalid choice!")
+        return
     
-    return prediction[0], max(probabilities[0])
+    params = {"n_neighbors": 3} if names[choice - 1] == "knn" else {}
+    vowel_model.set_backend(names[choice - 1], **params)
+    print(f"✓ Classifier backend changed to: {vowel_model.backend}")
+
+def compile_lookup_table():
+    """Bake the current model into a lookup table, used for predictions until the training data changes"""
+    start = time.perf_counter()
+    try:
+        table = vowel_model.compile_table()
+    except ValueError as e:
+        print(f"Cannot compile a lookup table: {e}")
+        return None
+    cells = table.labels.shape[0]
+    print(f"✓ Compiled the {table.backend} model into a {cells}x{cells} table of "
+          f"{table.cell_hz:.0f} Hz cells in {time.perf_counter() - start:.2f} s")
+    return table
+
+def lookup_table_path(filepath):
+    """The lookup table saved alongside a training data file"""
+    import os
+    
+    return os.path.splitext(filepath)[0] + TABLE_EXTENSION
 
 def clear_vowel_training_data(vowel_index):
     """Clear training data for a specific vowel"""
-    global vowel_a_training_examples, vowel_e_training_examples
-    global vowel_i_training_examples, vowel_o_training_examples, vowel_u_training_examples
-    
+    global saved_store
     vowel_names = {1: 'A', 2: 'E', 3: 'I', 4: 'O', 5: 'U', 6: 'ALL'}
     vowel_name = vowel_names.get(vowel_index, 'Unknown')
     
-    if vowel_index == 1:
-        count = len(vowel_a_training_examples)
-        vowel_a_training_examples.clear()
-    elif vowel_index == 2:
-        count = len(vowel_e_training_examples)
-        vowel_e_training_examples.clear()
-    elif vowel_index == 3:
-        count = len(vowel_i_training_examples)
-        vowel_i_training_examples.clear()
-    elif vowel_index == 4:
-        count = len(vowel_o_training_examples)
-        vowel_o_training_examples.clear()
-    elif vowel_index == 5:
-        count = len(vowel_u_training_examples)
-        vowel_u_training_examples.clear()
+    if 1 <= vowel_index <= 5:
+        count = training_store.clear(vowel_index)
     elif vowel_index == 6:  # Clear all
-        count = (len(vowel_a_training_examples) + len(vowel_e_training_examples) + 
-                len(vowel_i_training_examples) + len(vowel_o_training_examples) + 
-                len(vowel_u_training_examples))
-        vowel_a_training_examples.clear()
-        vowel_e_training_examples.clear()
-        vowel_i_training_examples.clear()
-        vowel_o_training_examples.clear()
-        vowel_u_training_examples.clear()
+        count = training_store.clear()
     else:
         print("Invalid vowel index!")
         return
+    vowel_model.invalidate()
+    saved_store = None
     
     print(f"Cleared {count} training examples for vowel: {vowel_name}")
 
-def save_training_data(filename="vowel_training_data.txt"):
-    """Save all training data to a file"""
+def training_data_path(filename):
+    """Where a training data file is kept, in the app_data directory"""
     import os
     
-    # Create app_data directory if it doesn't exist
     data_dir = os.path.join(os.path.dirname(__file__), "app_data")
     os.makedirs(data_dir, exist_ok=True)
+    return os.path.join(data_dir, filename)
+
+def save_training_data(filename=TRAINING_FILE):
+    """Save all training data to a file, as a binary store or as CSV for other extensions"""
+    import os
+    global saved_store
     
     # Full path to the file
-    filepath = os.path.join(data_dir, filename)
+    filepath = training_data_path(filename)
     
     try:
-        with open(filepath, 'w') as f:
-            f.write("# Vowel Training Data\n")
-            f.write("# Format: vowel,f1,f2\n")
-            
-            for example in vowel_a_training_examples:
-                f.write(f"A,{example[0]},{example[1]}\n")
-            for example in vowel_e_training_examples:
-                f.write(f"E,{example[0]},{example[1]}\n")
-            for example in vowel_i_training_examples:
-                f.write(f"I,{example[0]},{example[1]}\n")
-            for example in vowel_o_training_examples:
-                f.write(f"O,{example[0]},{example[1]}\n")
-            for example in vowel_u_training_examples:
-                f.write(f"U,{example[0]},{example[1]}\n")
-        
-        total_examples = (len(vowel_a_training_examples) + len(vowel_e_training_examples) + 
-                         len(vowel_i_training_examples) + len(vowel_o_training_examples) + 
-                         len(vowel_u_training_examples))
-        print(f"Saved {total_examples} training examples to {filepath}")
+        if not filepath.endswith(STORE_EXTENSION):
+            training_store.export_csv(filepath)
+            print(f"Saved {len(training_store)} training examples to {filepath}")
+        elif saved_store is not None and saved_store[0] == filepath and os.path.exists(filepath) \
+                and read_header(filepath)["count"] == saved_store[1]:
+            # The file holds the first examples of the store, only the new ones are written
+            training_store.append_to_file(filepath, start=saved_store[1])
+            print(f"Appended {len(training_store) - saved_store[1]} training examples to {filepath}")
+        else:
+            training_store.save(filepath)
+            print(f"Saved {len(training_store)} training examples to {filepath}")
+        if filepath.endswith(STORE_EXTENSION):
+            saved_store = (filepath, len(training_store))
     except Exception as e:
         print(f"Error saving training data: {e}")
+        return
+    
+    # Save the compiled model too, so loading needs no fitting
+    try:
+        table = vowel_model.table if vowel_model.table is not None else vowel_model.compile_table()
+        table.save(lookup_table_path(filepath))
+        print(f"Saved the {table.backend} lookup table to {lookup_table_path(filepath)}")
+    except ValueError:
+        pass
+    except Exception as e:
+        print(f"Error saving the lookup table: {e}")
 
-def load_training_data(filename="vowel_training_data.txt"):
-    """Load training data from a file"""
+def load_training_data(filename=TRAINING_FILE):
+    """Load training data from a binary store (memory-mapped) or a CSV file, and its lookup table"""
     import os
-    global vowel_a_training_examples, vowel_e_training_examples
-    global vowel_i_training_examples, vowel_o_training_examples, vowel_u_training_examples
+    global training_store, saved_store
     
     # Look in app_data directory
-    data_dir = os.path.join(os.path.dirname(__file__), "app_data")
-    filepath = os.path.join(data_dir, filename)
+    filepath = training_data_path(filename)
+    if filename == TRAINING_FILE and not os.path.exists(filepath):
+        legacy = training_data_path(LEGACY_TRAINING_FILE)
+        if os.path.exists(legacy):
+            print(f"No {TRAINING_FILE} yet, importing {legacy}")
+            filepath = legacy
     
     try:
-        # Clear existing data
-        clear_vowel_training_data(6)  # Clear all
-        
-        with open(filepath, 'r') as f:
-            for line in f:
-                line = line.strip()
-                if line.startswith('#') or not line:
-                    continue
-                
-                parts = line.split(',')
-                if len(parts) == 3:
-                    vowel, f1, f2 = parts[0], float(parts[1]), float(parts[2])
-                    
-                    if vowel == 'A':
-                        vowel_a_training_examples.append([f1, f2])
-                    elif vowel == 'E':
-                        vowel_e_training_examples.append([f1, f2])
-                    elif vowel == 'I':
-                        vowel_i_training_examples.append([f1, f2])
-                    elif vowel == 'O':
-                        vowel_o_training_examples.append([f1, f2])
-                    elif vowel == 'U':
-                        vowel_u_training_examples.append([f1, f2])
+        if filepath.endswith(STORE_EXTENSION):
+            loaded = TrainingStore.load(filepath)
+        else:
+            loaded = TrainingStore.import_csv(filepath)
         
-        total_examples = (len(vowel_a_training_examples) + len(vowel_e_training_examples) + 
-                         len(vowel_i_training_examples) + len(vowel_o_training_examples) + 
-                         len(vowel_u_training_examples))
-        print(f"Loaded {total_examples} training examples from {filepath}")
+        # Replace the existing data
+        training_store = loaded
+        saved_store = (filepath, len(loaded)) if filepath.endswith(STORE_EXTENSION) else None
+        print(f"Loaded {len(training_store)} training examples from {filepath}")
         
     except FileNotFoundError:
         print(f"Training data file {filepath} not found.")
         print(f"Note: Files are stored in the 'app_data' directory")
+        return
     except Exception as e:
         print(f"Error loading training data: {e}")
+        return
+    finally:
+        vowel_model.invalidate()
+    
+    # A table saved with the same data predicts without fitting the model
+    table_path = lookup_table_path(filepath)
+    if not os.path.exists(table_path):
+        return
+    try:
+        table = LookupTable.load(table_path)
+        if table.examples != len(training_store):
+            print(f"Lookup table {table_path} is out of date, the model will be refitted")
+        else:
+            vowel_model.set_backend(table.backend, **table.params)
+            vowel_model.use_table(table)
+            print(f"Using the {table.backend} lookup table from {table_path}")
+    except Exception as e:
+        print(f"Error loading the lookup table: {e}")
 
 def list_saved_training_data():
     """List all saved training data files"""
@@ -340,7 +362,7 @@ def list_saved_training_data():
         return
     
     try:
-        files = [f for f in os.listdir(data_dir) if f.endswith('.txt')]
+        files = sorted(f for f in os.listdir(data_dir) if f.endswith(('.txt', STORE_EXTENSION)))
         
         if not files:
             print("No training data files found in app_data directory.")
@@ -358,12 +380,17 @@ def list_saved_training_data():
                     import time
                     mod_time = time.strftime('%Y-%m-%d %H:%M', time.localtime(stat.st_mtime))
                     
-                    # Try to count lines quickly
-                    with open(filepath, 'r') as f:
-                        line_count = sum(1 for line in f if line.strip() and not line.startswith('#'))
+                    if filename.endswith(STORE_EXTENSION):
+                        # The header holds the counts, the records are not read
+                        header = read_header(filepath)
+                        examples = f"{header['count']} (" + ", ".join(
+                            f"{vowel}: {count}" for vowel, count in header['label_counts'].items()) + ")"
+                    else:
+                        with open(filepath, 'r') as f:
+                            examples = "~" + str(sum(1 for line in f if line.strip() and not line.startswith('#')))
                     
                     print(f"{i:2d}. {filename}")
-                    print(f"     Size: {size_kb:.1f} KB | Examples: ~{line_count} | Modified: {mod_time}")
+                    print(f"     Size: {size_kb:.1f} KB | Examples: {examples} | Modified: {mod_time}")
                     
                 except Exception as e:
                     print(f"{i:2d}. {filename} (error reading details: {e})")
@@ -375,40 +402,9 @@ def list_saved_training_data():
 
 def test_model_accuracy():
     """Test the accuracy of the current model using cross-validation"""
-    from sklearn.model_selection import cross_val_score
-    from sklearn.neighbors import KNeighborsClassifier
-    import numpy as np
-    
     # Collect all training data
-    all_training_data = []
-    all_labels = []
-    
-    vowel_counts = {}
-    
-    for example in vowel_a_training_examples:
-        all_training_data.append(example)
-        all_labels.append('A')
-    vowel_counts['A'] = len(vowel_a_training_examples)
-    
-    for example in vowel_e_training_examples:
-        all_training_data.append(example)
-        all_labels.append('E')
-    vowel_counts['E'] = len(vowel_e_training_examples)
-        
-    for example in vowel_i_training_examples:
-        all_training_data.append(example)
-        all_labels.append('I')
-    vowel_counts['I'] = len(vowel_i_training_examples)
-        
-    for example in vowel_o_training_examples:
-        all_training_data.append(example)
-        all_labels.append('O')
-    vowel_counts['O'] = len(vowel_o_training_examples)
-        
-    for example in vowel_u_training_examples:
-        all_training_data.append(example)
-        all_labels.append('U')
-    vowel_counts['U'] = len(vowel_u_training_examples)
+    all_training_data, all_labels = training_matrix()
+    vowel_counts = training_store.counts()
     
     if len(all_training_data) < 15:
         print("Need at least 15 total examples for accuracy testing!")
@@ -424,19 +420,25 @@ def test_model_accuracy():
             print(f"  {vowel}: {count} examples")
     print(f"  Total: {len(all_training_data)} examples")
     
-    # Test with different K values
-    print("\nAccuracy with different K values:")
-    for k in [1, 3, 5, 7]:
-        if k < len(all_training_data):
-            classifier = KNeighborsClassifier(n_neighbors=k)
-            try:
-                # 5-fold cross validation
-                scores = cross_val_score(classifier, all_training_data, all_labels, cv=min(5, len(all_training_data)//2))
-                avg_accuracy = scores.mean()
-                std_accuracy = scores.std()
-                print(f"  K={k}: {avg_accuracy:.1%} (+/- {std_accuracy*2:.1%})")
-            except Exception as e:
-                print(f"  K={k}: Could not test ({e})")
+    # Every backend and K value on the same stratified folds
+    folds = min(5, len(all_training_data)//2)
+    print(f"\nAccuracy of the classifier backends (current: {vowel_model.backend}):")
+    try:
+        report = evaluate(all_training_data, all_labels, folds=folds)
+        print(format_report(report))
+    except Exception as e:
+        print(f"  Could not test ({e})")
+    
+    # Held-out sessions show how well the model carries over to a new recording
+    sessions = np.unique(training_store.sessions)
+    if len(sessions) > 1:
+        print("\nAccuracy on unseen sessions:")
+        try:
+            report = evaluate(all_training_data, all_labels, folds=min(folds, len(sessions)),
+                              strategy="speaker", groups=training_store.sessions)
+            print(format_report(report, confusion=False))
+        except Exception as e:
+            print(f"  Could not test ({e})")
     
     # Recommendations
     print("\nRecommendations:")
@@ -464,38 +466,46 @@ def realtime_vowel_prediction():
     print("Starting realtime vowel prediction")
     
     # Check if we have training data
-    total_training = (len(vowel_a_training_examples) + len(vowel_e_training_examples) + 
-                     len(vowel_i_training_examples) + len(vowel_o_training_examples) + 
-                     len(vowel_u_training_examples))
+    total_training = len(training_store)
     
     if total_training < 10:
         print("Not enough training data! Please train some vowels first.")
         return
 
-    detector = formant_detector.FormantDetector()
+    with get_session().detector(gate=VOICE_GATE) as detector:
+        # Classify on the detector's analysis thread instead of per frame in Python
+        try:
+            detector.load_model(vowel_model.native_model())
+            labels = detector.vowel_labels
+        except ValueError as e:
+            print(f"Prediction error: {e}")
+            return
 
-    try:
-        # Start audio capture
-        detector.start_stream(deviceInput)
-        print("Listening for vowels... Speak into your microphone!")
-        print("Press Ctrl+C to stop")
-        
-        # Monitor for formants and predict vowels
-        for i in range(100):
-            formants = detector.get_formants()
-            if formants[0] > 0 and formants[1] > 0:  # Valid formants detected
-                try:
-                    predicted_vowel, confidence = likelyhood_vowel(formants)
-                    print(f"F1: {formants[0]:.0f} Hz, F2: {formants[1]:.0f} Hz -> Vowel: {predicted_vowel} (confidence: {confidence:.2f})")
-                except Exception as e:
-                    print(f"F1: {formants[0]:.0f} Hz, F2: {formants[1]:.0f} Hz -> Prediction error: {e}")
-            time.sleep(0.1)
-            
-    except KeyboardInterrupt:
-        print("\nStopping prediction...")
-    finally:
-        detector.stop_stream()
-        print("Prediction stopped.")
+        try:
+            # Start audio capture
+            detector.start_stream(deviceInput)
+            print("Listening for vowels... Speak into your microphone!")
+            print("Press Ctrl+C to stop")
+
+            # Monitor for formants and predict vowels
+            end_time = time.monotonic() + 10
+            while time.monotonic() < end_time:
+                frame = detector.wait_next(timeout=0.5)
+                if frame is None:
+                    continue
+
+                # Frames arrive labelled by the analysis thread
+                frames = np.concatenate((np.array([frame]), detector.drain()))
+                frames = frames[frames['vowel'] >= 0]  # Valid formants detected
+                for frame in frames:
+                    predicted_vowel = labels[frame['vowel']]
+                    print(f"F1: {frame['f1']:.0f} Hz, F2: {frame['f2']:.0f} Hz -> Vowel: {predicted_vowel} (confidence: {frame['confidence']:.2f})")
+
+        except KeyboardInterrupt:
+            print("\nStopping prediction...")
+        finally:
+            detector.stop_stream()
+            print("Prediction stopped.")
 
 
 def main():
@@ -528,24 +538,23 @@ def main():
         print("13. Save training data to file")
         print("14. Load training data from file")
         print("15. List saved training data files")
-        print("\n16. Exit")
+        print("\nCLASSIFIER:")
+        print(f"16. Select classifier backend (current: {vowel_model.backend})")
+        table = "compiled" if vowel_model.table is not None else "not compiled"
+        print(f"17. Compile the model into a lookup table ({table})")
+        print("\n18. Exit")
         
         print("\nTraining data collected:")
-        print(f"  A: {len(vowel_a_training_examples)} examples")
-        print(f"  E: {len(vowel_e_training_examples)} examples")
-        print(f"  I: {len(vowel_i_training_examples)} examples")
-        print(f"  O: {len(vowel_o_training_examples)} examples")
-        print(f"  U: {len(vowel_u_training_examples)} examples")
-        total_examples = (len(vowel_a_training_examples) + len(vowel_e_training_examples) + 
-                         len(vowel_i_training_examples) + len(vowel_o_training_examples) + 
-                         len(vowel_u_training_examples))
+        for vowel, count in training_store.counts().items():
+            print(f"  {vowel}: {count} examples")
+        total_examples = len(training_store)
         print(f"  Total: {total_examples} examples")
         
         try:
             user_input = int(input("\nEnter your choice: "))
             
-            if user_input < 1 or user_input > 16:
-                print("Please specify a valid index (1-16)! Try again.")
+            if user_input < 1 or user_input > 18:
+                print("Please specify a valid index (1-18)! Try again.")
             elif 1 <= user_input <= 5:
                 train_vowel(user_input)
             elif user_input == 6:
@@ -587,6 +596,10 @@ def main():
             elif user_input == 15:
                 list_saved_training_data()
             elif user_input == 16:
+                select_classifier_backend()
+            elif user_input == 17:
+                compile_lookup_table()
+            elif user_input == 18:
                 print("Exiting!")
                 exit_var = True
                 
@@ -596,5 +609,7 @@ def main():
             print("\nGoodbye!")
             exit_var = True
 
+    close_session()
+
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,282 @@
+"""
+Cross-validation of the classifier backends, spread over a process pool.
+
+Every (backend, hyperparameters, fold) combination is one job. The knn candidates
+of a fold share one job: the neighbours of the test examples are looked up once for
+the largest k and every smaller k votes over the first k of them.
+"""
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from vowel_models import make_backend
+
+K_VALUES = (1, 3, 5, 7)
+STRATEGIES = ("stratified", "speaker", "shuffle")
+
+# Below this many examples the pool costs more to start than the jobs take
+PARALLEL_MIN_EXAMPLES = 2000
+
+
+def make_folds(labels, folds=5, strategy="stratified", groups=None, seed=0):
+    """
+    Test indices of every fold.
+
+    stratified keeps the share of every vowel the same in every fold, speaker keeps
+    all examples of one group (a speaker or session id per example) in the same fold
+    and shuffle splits at random.
+    """
+    labels = np.asarray(labels)
+    rng = np.random.default_rng(seed)
+    if strategy not in STRATEGIES:
+        raise ValueError(f"Unknown fold strategy {strategy!r}, expected one of {', '.join(STRATEGIES)}")
+    if folds < 2 or folds > len(labels):
+        raise ValueError(f"Cannot split {len(labels)} examples into {folds} folds")
+
+    if strategy == "shuffle":
+        return [np.sort(test) for test in np.array_split(rng.permutation(len(labels)), folds)]
+
+    if strategy == "stratified":
+        # Deal every vowel's examples round-robin, continuing where the last vowel stopped
+        assignment = np.empty(len(labels), dtype=np.intp)
+        offset = 0
+        for label in np.unique(labels):
+            members = rng.permutation(np.flatnonzero(labels == label))
+            assignment[members] = (offset + np.arange(len(members))) % folds
+            offset += len(members)
+        return [np.flatnonzero(assignment == fold) for fold in range(folds)]
+
+    if groups is None:
+        raise ValueError("Speaker folds need a group per example")
+    groups = np.asarray(groups)
+    if len(groups) != len(labels):
+        raise ValueError(f"{len(groups)} groups for {len(labels)} examples")
+    names, index, sizes = np.unique(groups, return_inverse=True, return_counts=True)
+    if len(names) < folds:
+        raise ValueError(f"Cannot split {len(names)} speakers into {folds} folds")
+
+    # Largest groups first, each into the fold with the fewest examples so far
+    totals = np.zeros(folds, dtype=np.int64)
+    fold_of_group = np.empty(len(names), dtype=np.intp)
+    for group in np.argsort(-sizes, kind="stable"):
+        fold = int(np.argmin(totals))
+        fold_of_group[group] = fold
+        totals[fold] += sizes[group]
+    assignment = fold_of_group[index]
+    return [np.flatnonzero(assignment == fold) for fold in range(folds)]
+
+
+def default_candidates(max_neighbors=None):
+    """(backend, params) pairs evaluated when none are given: knn for K_VALUES and the other backends"""
+    candidates = [("knn", {"n_neighbors": k}) for k in K_VALUES
+                  if max_neighbors is None or k <= max_neighbors]
+    candidates += [("centroid", {}), ("gaussian", {})]
+    return candidates
+
+
+def candidate_name(backend, params):
+    if not params:
+        return backend
+    return f"{backend} " + " ".join(f"{key}={value}" for key, value in sorted(params.items()))
+
+
+# Worker side. The data is sent to every worker once, the jobs only carry indices.
+
+_features = None
+_labels = None
+_folds = None
+
+
+def _init_worker(features, labels, folds):
+    global _features, _labels, _folds
+    _features, _labels, _folds = features, labels, folds
+
+
+def _split(fold):
+    test = _folds[fold]
+    train = np.ones(len(_labels), dtype=bool)
+    train[test] = False
+    return np.flatnonzero(train), test
+
+
+def _fit_predict(backend, params, fold):
+    """One candidate on one fold: (predicted labels, fit seconds, predict seconds)"""
+    train, test = _split(fold)
+    start = time.perf_counter()
+    model = make_backend(backend, **params).fit(_features[train], _labels[train])
+    fitted = time.perf_counter()
+    predicted = model.predict(_features[test])
+    return predicted, fitted - start, time.perf_counter() - fitted
+
+
+def _knn_predict(k_values, algorithm, fold):
+    """
+    Every knn candidate on one fold from one neighbour lookup. Votes are counted over
+    the first k neighbours, ties go to the first vowel in sorted order as in
+    KNeighborsClassifier. Returns a list of (predicted labels, fit seconds, predict
+    seconds), the lookup time is split evenly between the k values.
+    """
+    from sklearn.neighbors import NearestNeighbors
+
+    train, test = _split(fold)
+    start = time.perf_counter()
+    classes, train_index = np.unique(_labels[train], return_inverse=True)
+    neighbors = NearestNeighbors(n_neighbors=max(k_values), algorithm=algorithm).fit(_features[train])
+    fitted = time.perf_counter()
+    _, graph = neighbors.kneighbors(_features[test])
+    neighbor_classes = train_index[graph]
+    looked_up = time.perf_counter()
+
+    results = []
+    share = (fitted - start) / len(k_values), (looked_up - fitted) / len(k_values)
+    for k in k_values:
+        vote_start = time.perf_counter()
+        votes = np.zeros((len(test), len(classes)), dtype=np.int32)
+        rows = np.repeat(np.arange(len(test)), k)
+        np.add.at(votes, (rows, neighbor_classes[:, :k].ravel()), 1)
+        predicted = classes[np.argmax(votes, axis=1)]
+        results.append((predicted, share[0], share[1] + time.perf_counter() - vote_start))
+    return results
+
+
+def _run_job(job):
+    kind, fold, payload = job
+    if kind == "knn":
+        return _knn_predict(*payload, fold)
+    return [_fit_predict(*payload, fold)]
+
+
+def _summary(backend, params, classes, labels, folds, outcomes):
+    """Report entry of one candidate from its per-fold (predicted, fit, predict) outcomes"""
+    index = {label: i for i, label in enumerate(classes)}
+    confusion = np.zeros((len(classes), len(classes)), dtype=np.int64)
+    fold_accuracies = []
+    for test, (predicted, _, _) in zip(folds, outcomes):
+        truth = labels[test]
+        fold_accuracies.append(float(np.mean(predicted == truth)))
+        np.add.at(confusion, ([index[label] for label in truth], [index[label] for label in predicted]), 1)
+
+    totals = confusion.sum(axis=1)
+    return {
+        "name": candidate_name(backend, params),
+        "backend": backend,
+        "params": dict(params),
+        "accuracy": float(np.trace(confusion) / confusion.sum()),
+        "fold_mean": float(np.mean(fold_accuracies)),
+        "fold_std": float(np.std(fold_accuracies)),
+        "fold_accuracies": fold_accuracies,
+        "confusion": confusion,
+        "recall": {str(label): float(confusion[i, i] / totals[i]) if totals[i] else None
+                   for i, label in enumerate(classes)},
+        "fit_seconds": float(sum(outcome[1] for outcome in outcomes)),
+        "predict_seconds": float(sum(outcome[2] for outcome in outcomes)),
+    }
+
+
+def evaluate(features, labels, candidates=None, folds=5, strategy="stratified", groups=None,
+             seed=0, workers=None):
+    """
+    Cross-validated accuracy of every candidate on the same folds.
+
+    candidates is a list of (backend, params) pairs, default_candidates() when None.
+    workers is the size of the process pool, 1 runs every job here, None uses all
+    cores once there are PARALLEL_MIN_EXAMPLES examples.
+
+    Returns a dict with the folds and the timing of the whole run, and under
+    "results" one entry per candidate (best accuracy first) with its accuracy over
+    all test examples, the mean and standard deviation over the folds, the
+    confusion matrix (rows are the true vowels in the order of "classes"), the
+    recall per vowel and the time spent fitting and predicting.
+    """
+    start = time.perf_counter()
+    features = np.asarray(features, dtype=np.float64).reshape(-1, 2)
+    labels = np.asarray(labels)
+    if len(features) != len(labels):
+        raise ValueError(f"{len(features)} examples for {len(labels)} labels")
+
+    test_folds = make_folds(labels, folds, strategy, groups, seed)
+    smallest_train = len(labels) - max(len(test) for test in test_folds)
+    if candidates is None:
+        candidates = default_candidates(max_neighbors=smallest_train)
+    candidates = [(backend, dict(params)) for backend, params in candidates]
+    for backend, params in candidates:
+        make_backend(backend, **params)
+        if backend == "knn" and params.get("n_neighbors", 3) > smallest_train:
+            raise ValueError(f"{candidate_name(backend, params)} needs more than the "
+                             f"{smallest_train} training examples of the smallest fold")
+
+    # knn candidates sharing an algorithm share their neighbour lookups
+    knn_groups = {}
+    others = []
+    for position, (backend, params) in enumerate(candidates):
+        if backend == "knn" and set(params) <= {"n_neighbors", "algorithm"}:
+            algorithm = params.get("algorithm", "kd_tree")
+            knn_groups.setdefault(algorithm, []).append((position, params.get("n_neighbors", 3)))
+        else:
+            others.append(position)
+
+    jobs = []
+    owners = []
+    for fold in range(len(test_folds)):
+        for algorithm, members in knn_groups.items():
+            jobs.append(("knn", fold, ([k for _, k in members], algorithm)))
+            owners.append([position for position, _ in members])
+        for position in others:
+            jobs.append(("fit", fold, candidates[position]))
+            owners.append([position])
+
+    if workers is None:
+        workers = (os.cpu_count() or 1) if len(features) >= PARALLEL_MIN_EXAMPLES else 1
+    workers = max(1, min(workers, len(jobs)))
+    if workers == 1:
+        _init_worker(features, labels, test_folds)
+        try:
+            outputs = [_run_job(job) for job in jobs]
+        finally:
+            _init_worker(None, None, None)
+    else:
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                                 initargs=(features, labels, test_folds)) as pool:
+            outputs = list(pool.map(_run_job, jobs))
+
+    outcomes = [[None] * len(test_folds) for _ in candidates]
+    for (_, fold, _), positions, results in zip(jobs, owners, outputs):
+        for position, result in zip(positions, results):
+            outcomes[position][fold] = result
+
+    classes = np.unique(labels)
+    results = [_summary(backend, params, classes, labels, test_folds, outcomes[position])
+               for position, (backend, params) in enumerate(candidates)]
+    results.sort(key=lambda result: -result["accuracy"])
+    return {
+        "strategy": strategy,
+        "folds": len(test_folds),
+        "examples": len(labels),
+        "classes": [str(label) for label in classes],
+        "workers": workers,
+        "jobs": len(jobs),
+        "seconds": time.perf_counter() - start,
+        "results": results,
+    }
+
+
+def format_report(report, confusion=True):
+    """Readable text of a report from evaluate(), with the confusion matrix of the best candidate"""
+    lines = [f"{report['examples']} examples, {report['folds']} {report['strategy']} folds, "
+             f"{report['jobs']} jobs on {report['workers']} worker(s) in {report['seconds']:.2f} s"]
+    for result in report["results"]:
+        lines.append(f"  {result['name']:<24} {result['accuracy']:.1%} (+/- {result['fold_std'] * 2:.1%})"
+                     f"  fit {result['fit_seconds'] * 1e3:.1f} ms, predict {result['predict_seconds'] * 1e3:.1f} ms")
+
+    if confusion and report["results"]:
+        best = report["results"][0]
+        classes = report["classes"]
+        lines.append(f"\nConfusion matrix of {best['name']} (rows: true vowel, columns: predicted):")
+        lines.append("      " + "".join(f"{label:>6}" for label in classes) + "  recall")
+        for label, row in zip(classes, best["confusion"]):
+            recall = best["recall"][label]
+            lines.append(f"  {label:<4}" + "".join(f"{count:>6}" for count in row)
+                         + (f"  {recall:.1%}" if recall is not None else "  -"))
+    return "\n".join(lines)
@@ -0,0 +1,496 @@
+#!/usr/bin/env python3
+"""
+Local streaming service: one detector, any number of subscribers
+
+    python app/formant_service.py --device 4 --tcp 127.0.0.1:8765 --unix /tmp/vrecog.sock
+
+Every frame (formants, level, voicing and the vowel of the loaded model) and every
+change of the recognized vowel is sent to every connected client over TCP, a Unix
+socket or a WebSocket, in one of two protocols:
+
+json    one JSON object per line: {"type": "hello" | "frame" | "vowel" | "labels" |
+        "dropped", ...}. Over a WebSocket, one text message per batch of lines.
+binary  length-prefixed messages: uint32 body length, uint8 type, body. HELLO and
+        LABELS bodies are JSON, FRAMES a packed array of WIRE_DTYPE records, VOWEL
+        one VOWEL_DTYPE record and DROPPED the uint64 total of frames this client
+        lost. Over a WebSocket, one binary message per batch.
+
+Frames waiting for a client are written in one batch per write. A client that
+falls more than max_pending frames behind loses frames: the oldest batches with
+policy "drop", everything but the newest frame with policy "conflate". Vowel and
+label messages are kept in order. Only a client more than max_pending of them behind
+loses them, down to the newest labels and the newest vowel.
+"""
+import argparse
+import asyncio
+import base64
+import collections
+import hashlib
+import json
+import os
+import struct
+
+import numpy as np
+
+import formant_detector
+from audio_session import DEFAULT_DEVICE
+
+PROTOCOL_VERSION = 1
+PROTOCOLS = ("json", "binary")
+POLICIES = ("drop", "conflate")
+
+# Binary message types
+HELLO, FRAMES, VOWEL, LABELS, DROPPED = 1, 2, 3, 4, 5
+MESSAGE_HEADER = struct.Struct("<IB")
+
+WIRE_DTYPE = np.dtype([
+    ('index', '<u8'),
+    ('time', '<f8'),
+    ('f1', '<f4'),
+    ('f2', '<f4'),
+    ('magnitude', '<f4'),
+    ('level', '<f4'),
+    ('confidence', '<f4'),
+    ('vowel', '<i2'),
+    ('voiced', 'u1'),
+    ('channel', 'u1'),
+])
+VOWEL_DTYPE = np.dtype([('time', '<f8'), ('index', '<u8'), ('vowel', '<i2'), ('confidence', '<f4')])
+
+WEBSOCKET_GUID = b"258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+
+
+def _message(kind, body):
+    return MESSAGE_HEADER.pack(len(body), kind) + body
+
+
+def _json_line(message):
+    return (json.dumps(message, separators=(",", ":")) + "\n").encode()
+
+
+class Batch:
+    """Frames drained together, encoded at most once per protocol however many clients get them"""
+
+    def __init__(self, frames, labels):
+        self.frames = frames
+        self.labels = labels
+        self._encoded = {}
+
+    def __len__(self):
+        return len(self.frames)
+
+    def latest(self):
+        return Batch(self.frames[-1:], self.labels)
+
+    def encode(self, protocol):
+        if protocol not in self._encoded:
+            self._encoded[protocol] = (self._encode_json() if protocol == "json" else self._encode_binary())
+        return self._encoded[protocol]
+
+    def _encode_json(self):
+        lines = []
+        for f1, f2, magnitude, time, index, vowel, confidence, level, voiced, channel in self.frames.tolist():
+            lines.append(_json_line({
+                "type": "frame", "index": index, "time": time, "channel": channel, "f1": f1, "f2": f2,
+                "magnitude": magnitude, "level": round(level, 2), "voiced": voiced,
+                "vowel": self.labels[vowel] if vowel >= 0 else None, "confidence": round(confidence, 4),
+            }))
+        return b"".join(lines)
+
+    def _encode_binary(self):
+        records = np.zeros(len(self.frames), dtype=WIRE_DTYPE)
+        for name in ('index', 'time', 'f1', 'f2', 'magnitude', 'level', 'confidence', 'vowel', 'voiced', 'channel'):
+            records[name] = self.frames[name]
+        return _message(FRAMES, records.tobytes())
+
+
+def encode_event(protocol, event):
+    """vowel and labels events, which every client gets"""
+    if protocol == "json":
+        return _json_line(event)
+    if event["type"] == "labels":
+        return _message(LABELS, json.dumps(event["labels"]).encode())
+    record = np.zeros(1, dtype=VOWEL_DTYPE)
+    record['time'], record['index'] = event["time"], event["index"]
+    record['vowel'], record['confidence'] = event["vowel_index"], event["confidence"]
+    return _message(VOWEL, record.tobytes())
+
+
+class Subscriber:
+    """
+    One connected client: what is waiting to be written to it and a task writing it.
+    send(data) writes one batch and waits until the transport took it.
+    """
+
+    def __init__(self, send, protocol, max_pending, policy):
+        self.send = send
+        self.protocol = protocol
+        self.max_pending = max_pending
+        self.policy = policy
+        self.batches = collections.deque()
+        self.events = []
+        self.pending = 0
+        self.dropped = 0
+        self.sent = 0
+        self._reported = 0
+        self._ready = asyncio.Event()
+
+    def push(self, batch, events=()):
+        if len(batch):
+            self.batches.append(batch)
+            self.pending += len(batch)
+        self.events.extend(events)
+        if len(self.events) > self.max_pending:
+            # Binary clients decode vowel indices with the last labels they got: those stay,
+            # and a vowel recognized before them is stale
+            kept = {}
+            for event in self.events:
+                if event["type"] == "labels":
+                    kept.clear()
+                kept[event["type"]] = event
+            self.events = list(kept.values())
+        if self.pending > self.max_pending:
+            if self.policy == "conflate":
+                newest = self.batches[-1].latest()
+                self.dropped += self.pending - 1
+                self.batches.clear()
+                self.batches.append(newest)
+                self.pending = 1
+            else:
+                while self.pending > self.max_pending:
+                    oldest = self.batches.popleft()
+                    self.pending -= len(oldest)
+                    self.dropped += len(oldest)
+        self._ready.set()
+
+    def take(self):
+        """Everything pending as one chunk of bytes, b"" when nothing is"""
+        parts = []
+        if self.dropped != self._reported:
+            self._reported = self.dropped
+            parts.append(encode_event(self.protocol, {"type": "dropped", "frames": self.dropped})
+                         if self.protocol == "json" else _message(DROPPED, struct.pack("<Q", self.dropped)))
+        parts.extend(encode_event(self.protocol, event) for event in self.events)
+        parts.extend(batch.encode(self.protocol) for batch in self.batches)
+        self.sent += self.pending
+        self.events.clear()
+        self.batches.clear()
+        self.pending = 0
+        return b"".join(parts)
+
+    async def run(self, batch_interval, closing):
+        while not closing.is_set():
+            await self._ready.wait()
+            self._ready.clear()
+            data = self.take()
+            if data:
+                await self.send(data)
+            if batch_interval > 0:
+                await asyncio.sleep(batch_interval)
+
+    def wake(self):
+        self._ready.set()
+
+
+class FormantService:
+    """
+    Publishes the frames of a running detector to every subscriber. Listen on any
+    number of addresses, start the detector's stream, then await run(): it returns
+    once the stream has ended and every subscriber got what was left.
+    """
+
+    def __init__(self, detector, max_pending=256, policy="drop", batch_interval=0.0):
+        if policy not in POLICIES:
+            raise ValueError(f"Unknown policy {policy!r}, expected one of {', '.join(POLICIES)}")
+        if max_pending < 1:
+            raise ValueError("max_pending must be at least 1")
+        self.detector = detector
+        self.max_pending = max_pending
+        self.policy = policy
+        self.batch_interval = batch_interval
+        self.subscribers = set()
+        self.servers = []
+        self.frames = 0
+        self._labels = []
+        self._vowel = None
+        self._tasks = set()
+        self._closing = asyncio.Event()
+
+    # Listeners
+
+    async def listen_tcp(self, host="127.0.0.1", port=8765, protocol="json"):
+        """Returns the (host, port) actually bound, port 0 picks a free one"""
+        server = await asyncio.start_server(self._stream_handler(protocol), host, port)
+        self.servers.append(server)
+        return server.sockets[0].getsockname()[:2]
+
+    async def listen_unix(self, path, protocol="json"):
+        if os.path.exists(path):
+            os.unlink(path)
+        server = await asyncio.start_unix_server(self._stream_handler(protocol), path)
+        self.servers.append(server)
+        return path
+
+    async def listen_websocket(self, host="127.0.0.1", port=8766, protocol="json"):
+        """Returns the (host, port) actually bound, any path is accepted"""
+        _check_protocol(protocol)
+
+        async def handler(reader, writer):
+            if not await _websocket_handshake(reader, writer):
+                writer.close()
+                return
+            opcode = 0x1 if protocol == "json" else 0x2
+
+            async def send(data):
+                writer.write(_websocket_frame(opcode, data))
+                await writer.drain()
+
+            await self._serve(reader, writer, protocol, send, _websocket_reader(reader, writer))
+
+        server = await asyncio.start_server(handler, host, port)
+        self.servers.append(server)
+        return server.sockets[0].getsockname()[:2]
+
+    def _stream_handler(self, protocol):
+        _check_protocol(protocol)
+
+        async def handler(reader, writer):
+            async def send(data):
+                writer.write(data)
+                await writer.drain()
+
+            await self._serve(reader, writer, protocol, send, _until_eof(reader))
+        return handler
+
+    async def _serve(self, reader, writer, protocol, send, receiving):
+        subscriber = Subscriber(send, protocol, self.max_pending, self.policy)
+        self._tasks.add(asyncio.current_task())
+        try:
+            await send(self._hello(protocol))
+            self.subscribers.add(subscriber)
+            sending = asyncio.ensure_future(subscriber.run(self.batch_interval, self._closing))
+            receiving = asyncio.ensure_future(receiving)
+            done, pending = await asyncio.wait((sending, receiving), return_when=asyncio.FIRST_COMPLETED)
+            for task in pending:
+                task.cancel()
+            failures = [task.exception() for task in done if task.exception() is not None]
+            if sending in done and not failures:
+                # The service is closing, flush what is left
+                data = subscriber.take()
+                if data:
+                    await send(data)
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            self.subscribers.discard(subscriber)
+            self._tasks.discard(asyncio.current_task())
+            writer.close()
+
+    def _hello(self, protocol):
+        hello = {
+            "type": "hello",
+            "protocol": protocol,
+            "version": PROTOCOL_VERSION,
+            "config": self.detector.get_config(),
+            "labels": self.detector.vowel_labels,
+        }
+        if protocol == "json":
+            return _json_line(hello)
+        hello["record"] = [[name, WIRE_DTYPE.fields[name][0].str] for name in WIRE_DTYPE.names]
+        return _message(HELLO, json.dumps(hello).encode())
+
+    # Publishing
+
+    def publish(self, frames):
+        """Fans one drained batch out to every subscriber"""
+        events = []
+        labels = self.detector.vowel_labels
+        if labels != self._labels:
+            self._labels = labels
+            self._vowel = None
+            events.append({"type": "labels", "labels": labels})
+
+        # A vowel event whenever the recognized vowel changes
+        for index in np.flatnonzero(frames['vowel'] >= 0):
+            frame = frames[index]
+            vowel = int(frame['vowel'])
+            if vowel != self._vowel:
+                self._vowel = vowel
+                events.append({"type": "vowel", "time": float(frame['time']), "index": int(frame['index']),
+                               "vowel": labels[vowel], "vowel_index": vowel,
+                               "confidence": float(frame['confidence'])})
+
+        batch = Batch(frames, labels)
+        self.frames += len(frames)
+        for subscriber in self.subscribers:
+            subscriber.push(batch, events)
+
+    async def run(self):
+        """Drains the detector until its stream ends, then closes every subscriber"""
+        loop = asyncio.get_running_loop()
+        readable = asyncio.Event()
+        fd = self.detector.notify_fd()
+
+        def on_readable():
+            self.detector.clear_notification()
+            readable.set()
+
+        loop.add_reader(fd, on_readable)
+        try:
+            while True:
+                readable.clear()
+                frames = self.detector.drain()
+                if len(frames):
+                    self.publish(frames)
+                    continue
+                if not self.detector.is_streaming():
+                    frames = self.detector.drain()
+                    if len(frames):
+                        self.publish(frames)
+                    break
+                try:
+                    await asyncio.wait_for(readable.wait(), timeout=0.5)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            loop.remove_reader(fd)
+            await self.close()
+
+    async def close(self, timeout=5.0):
+        """Stops listening and waits up to timeout seconds for subscribers to get what is left"""
+        self._closing.set()
+        for subscriber in list(self.subscribers):
+            subscriber.wake()
+        if self._tasks:
+            await asyncio.wait(list(self._tasks), timeout=timeout)
+        for server in self.servers:
+            server.close()
+        for server in self.servers:
+            await server.wait_closed()
+        self.servers = []
+
+    def stats(self):
+        return {
+            "subscribers": len(self.subscribers),
+            "frames": self.frames,
+            "pending": sum(s.pending for s in self.subscribers),
+            "dropped": sum(s.dropped for s in self.subscribers),
+        }
+
+
+def _check_protocol(protocol):
+    if protocol not in PROTOCOLS:
+        raise ValueError(f"Unknown protocol {protocol!r}, expected one of {', '.join(PROTOCOLS)}")
+
+
+async def _until_eof(reader):
+    while await reader.read(4096):
+        pass
+
+
+# WebSocket (RFC 6455), just enough to push messages to browsers and dashboards
+
+async def _websocket_handshake(reader, writer):
+    request = await reader.readuntil(b"\r\n\r\n")
+    headers = {}
+    for line in request.decode("latin-1").split("\r\n")[1:]:
+        name, _, value = line.partition(":")
+        headers[name.strip().lower()] = value.strip()
+    key = headers.get("sec-websocket-key")
+    if key is None or "websocket" not in headers.get("upgrade", "").lower():
+        writer.write(b"HTTP/1.1 400 Bad Request\r\nContent-Length: 0\r\n\r\n")
+        return False
+    accept = base64.b64encode(hashlib.sha1(key.encode() + WEBSOCKET_GUID).digest()).decode()
+    writer.write(("HTTP/1.1 101 Switching Protocols\r\nUpgrade: websocket\r\nConnection: Upgrade\r\n"
+                  f"Sec-WebSocket-Accept: {accept}\r\n\r\n").encode())
+    await writer.drain()
+    return True
+
+
+def _websocket_frame(opcode, payload):
+    length = len(payload)
+    if length < 126:
+        header = struct.pack("!BB", 0x80 | opcode, length)
+    elif length < 1 << 16:
+        header = struct.pack("!BBH", 0x80 | opcode, 126, length)
+    else:
+        header = struct.pack("!BBQ", 0x80 | opcode, 127, length)
+    return header + payload
+
+
+async def _websocket_reader(reader, writer):
+    """Answers pings and returns on close, client messages are ignored"""
+    while True:
+        first, second = await reader.readexactly(2)
+        length = second & 0x7F
+        if length == 126:
+            length, = struct.unpack("!H", await reader.readexactly(2))
+        elif length == 127:
+            length, = struct.unpack("!Q", await reader.readexactly(8))
+        mask = await reader.readexactly(4) if second & 0x80 else b"\0\0\0\0"
+        payload = bytes(b ^ mask[i % 4] for i, b in enumerate(await reader.readexactly(length)))
+        opcode = first & 0x0F
+        if opcode == 0x8:
+            writer.write(_websocket_frame(0x8, payload[:2]))
+            return
+        if opcode == 0x9:
+            writer.write(_websocket_frame(0xA, payload))
+
+
+def _address(text):
+    host, _, port = text.rpartition(":")
+    return host or "127.0.0.1", int(port)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--device", type=int, default=DEFAULT_DEVICE, help="PortAudio input device")
+    parser.add_argument("--file", help="analyze a WAV file instead of a device")
+    parser.add_argument("--hop", type=int, default=1024)
+    parser.add_argument("--tcp", action="append", default=[], metavar="HOST:PORT")
+    parser.add_argument("--unix", action="append", default=[], metavar="PATH")
+    parser.add_argument("--websocket", action="append", default=[], metavar="HOST:PORT")
+    parser.add_argument("--protocol", choices=PROTOCOLS, default="json")
+    parser.add_argument("--policy", choices=POLICIES, default="drop",
+                        help="what a client that falls behind loses")
+    parser.add_argument("--max-pending", type=int, default=256, help="frames a client may fall behind")
+    parser.add_argument("--batch-interval", type=float, default=0.0,
+                        help="seconds to wait between writes to a client, to batch more frames")
+    parser.add_argument("--no-gate", action="store_true", help="analyze silent frames too")
+    parser.add_argument("--training", help="training data file of the vowel program, classifies every frame")
+    args = parser.parse_args(argv)
+    if not (args.tcp or args.unix or args.websocket):
+        args.tcp = ["127.0.0.1:8765"]
+
+    detector = formant_detector.FormantDetector(gate=not args.no_gate)
+    if args.training:
+        import classification
+        classification.load_training_data(args.training)
+        detector.load_model(classification.vowel_model.native_model())
+
+    async def serve():
+        service = FormantService(detector, args.max_pending, args.policy, args.batch_interval)
+        for address in args.tcp:
+            print("Listening on tcp://%s:%d" % await service.listen_tcp(*_address(address), args.protocol))
+        for path in args.unix:
+            print("Listening on unix:" + await service.listen_unix(path, args.protocol))
+        for address in args.websocket:
+            print("Listening on ws://%s:%d" % await service.listen_websocket(*_address(address), args.protocol))
+
+        if args.file:
+            detector.start_stream(source=formant_detector.FileSource(args.file, realtime=True), hop=args.hop)
+        else:
+            detector.start_stream(args.device, hop=args.hop)
+        try:
+            await service.run()
+        finally:
+            detector.stop_stream()
+
+    try:
+        asyncio.run(serve())
+    except KeyboardInterrupt:
+        print("\nService stopped.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,337 @@
+#!/usr/bin/env python3
+"""
+Headless training from a directory of labelled recordings
+
+    corpus/A/*.wav, corpus/E/*.wav, ...  (corpus/A/speaker1/*.wav for one session per speaker)
+    python app/ingest.py corpus --output corpus.vrt
+
+Every file is analyzed offline with formant_detector.extract on a process pool and its
+voiced [F1, F2] frames become training examples of the vowel of its directory, saved as
+a training store in app_data like save_training_data does.
+
+The features of every file are cached in app_data/feature_cache under the hash of its
+content and of the analysis parameters, so ingesting the corpus again only analyzes the
+files that were added or changed. A manifest of file sizes and modification times skips
+hashing the files that have not changed either.
+"""
+import argparse
+import hashlib
+import json
+import os
+import struct
+import time
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from training_store import VOWELS, TrainingStore
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "app_data")
+CACHE_DIR = os.path.join(DATA_DIR, "feature_cache")
+EXTENSIONS = (".wav",)
+# Bumped when the features of a file would change for the same parameters
+FEATURE_VERSION = 1
+
+# Below this many files to analyze the pool costs more to start than the files take
+PARALLEL_MIN_FILES = 8
+
+
+def read_wav(data, channel=0):
+    """(sample rate, float32 samples of one channel) from the bytes of a PCM or float WAV file"""
+    if data[:4] != b"RIFF" or data[8:12] != b"WAVE":
+        raise ValueError("not a WAV file")
+    position = 12
+    fmt = None
+    while position + 8 <= len(data):
+        chunk, size = struct.unpack_from("<4sI", data, position)
+        body = position + 8
+        if chunk == b"fmt " and size >= 16:
+            tag, channels, rate, _, _, bits = struct.unpack_from("<HHIIHH", data, body)
+            if tag == 0xFFFE and size >= 26:
+                # WAVE_FORMAT_EXTENSIBLE, the sub-format GUID starts with the actual tag
+                tag = struct.unpack_from("<H", data, body + 24)[0]
+            fmt = (tag, channels, rate, bits // 8)
+        elif chunk == b"data":
+            if fmt is None:
+                raise ValueError("no fmt chunk before the samples")
+            end = len(data) if size == 0xFFFFFFFF else min(len(data), body + size)
+            return fmt[2], _decode(data[body:end], *fmt, channel)
+        position = body + size + (size & 1)
+    raise ValueError("no data chunk")
+
+
+def _decode(data, tag, channels, rate, width, channel):
+    # Scaled like the detector's FileSource, so gate thresholds mean the same
+    if channels <= 0 or channel >= channels:
+        raise ValueError(f"no channel {channel}")
+    count = len(data) // (width * channels) * channels
+    if tag == 3 and width in (4, 8):
+        samples = np.frombuffer(data, dtype=f"<f{width}", count=count).astype(np.float32)
+    elif tag == 1 and width == 1:
+        samples = (np.frombuffer(data, dtype=np.uint8, count=count).astype(np.float32) - 128) / 128
+    elif tag == 1 and width in (2, 4):
+        samples = np.frombuffer(data, dtype=f"<i{width}", count=count) / np.float32(2 ** (8 * width - 1))
+    elif tag == 1 and width == 3:
+        triples = np.frombuffer(data, dtype=np.uint8, count=3 * count).reshape(-1, 3).astype(np.int32)
+        values = (triples[:, 0] << 8 | triples[:, 1] << 16 | triples[:, 2] << 24) >> 8
+        samples = values / np.float32(2 ** 23)
+    else:
+        raise ValueError(f"unsupported WAV encoding (format {tag}, {8 * width} bits)")
+    return np.ascontiguousarray(samples.reshape(-1, channels)[:, channel], dtype=np.float32)
+
+
+def find_corpus(root):
+    """
+    (path, vowel, session) of every recording under root, sorted, and the directories
+    skipped for not being named after a vowel. The session is the crc32 of the
+    subdirectory below the vowel's directory, 0 for files directly in it.
+    """
+    files = []
+    skipped = []
+    for name in sorted(os.listdir(root)):
+        directory = os.path.join(root, name)
+        if not os.path.isdir(directory):
+            continue
+        if name.upper() not in VOWELS:
+            skipped.append(directory)
+            continue
+        for parent, subdirectories, names in os.walk(directory):
+            subdirectories.sort()
+            relative = os.path.relpath(parent, directory)
+            session = 0 if relative == "." else zlib.crc32(relative.encode())
+            for filename in sorted(names):
+                if filename.lower().endswith(EXTENSIONS):
+                    files.append((os.path.join(parent, filename), name.upper(), session))
+    return files, skipped
+
+
+def analysis_parameters(hop=None, **config):
+    """The detector settings that decide the features, as extract() will use them"""
+    import formant_detector
+
+    parameters = formant_detector.analysis_config(**config)
+    parameters.pop("planning")
+    parameters.pop("wisdom_file")
+    parameters["hop"] = parameters["frame_size"] if hop is None else hop
+    parameters["feature_version"] = FEATURE_VERSION
+    return parameters
+
+
+class FeatureCache:
+    """
+    Features of a file by content hash, one .npy file each, in a directory per set of
+    analysis parameters. The manifest maps a path to its size, modification time and
+    content hash, so unchanged files are not read to be hashed again.
+    """
+
+    def __init__(self, directory, parameters, manifest=True):
+        self.directory = directory
+        self.parameters = parameters
+        key = hashlib.sha256(json.dumps(parameters, sort_keys=True).encode()).hexdigest()[:16]
+        self.features_dir = os.path.join(directory, key)
+        self.manifest_path = os.path.join(directory, "manifest.json")
+        os.makedirs(self.features_dir, exist_ok=True)
+        parameters_path = os.path.join(self.features_dir, "parameters.json")
+        if not os.path.exists(parameters_path):
+            _write_atomically(parameters_path, json.dumps(parameters, indent=2, sort_keys=True).encode())
+        self.manifest = {}
+        if manifest:
+            try:
+                with open(self.manifest_path) as f:
+                    self.manifest = json.load(f)
+            except (FileNotFoundError, ValueError):
+                pass
+
+    def path(self, digest):
+        return os.path.join(self.features_dir, digest[:2], digest + ".npy")
+
+    def get(self, digest):
+        try:
+            return np.load(self.path(digest))
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def put(self, digest, features):
+        path = self.path(digest)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temporary = f"{path}.tmp{os.getpid()}"
+        with open(temporary, "wb") as f:
+            np.save(f, features)
+        os.replace(temporary, path)
+
+    def known_digest(self, path, stat):
+        """The content hash of path from the manifest, None if it changed since"""
+        entry = self.manifest.get(os.path.abspath(path))
+        if entry is not None and entry[:2] == [stat.st_size, stat.st_mtime_ns]:
+            return entry[2]
+        return None
+
+    def remember(self, path, stat, digest):
+        self.manifest[os.path.abspath(path)] = [stat.st_size, stat.st_mtime_ns, digest]
+
+    def forget_missing(self, root, paths):
+        """Drops the entries of files under root other than paths, those that were removed"""
+        prefix = os.path.join(os.path.abspath(root), "")
+        keep = {os.path.abspath(path) for path in paths}
+        for path in [path for path in self.manifest if path.startswith(prefix) and path not in keep]:
+            del self.manifest[path]
+
+    def save_manifest(self):
+        _write_atomically(self.manifest_path, json.dumps(self.manifest).encode())
+
+
+def _write_atomically(path, data):
+    temporary = f"{path}.tmp{os.getpid()}"
+    with open(temporary, "wb") as f:
+        f.write(data)
+    os.replace(temporary, path)
+
+
+# Set in every worker process by _init_worker
+_cache = None
+_config = None
+
+
+def _init_worker(cache_directory, parameters, config):
+    global _cache, _config
+    # Workers only look features up, the parent keeps the manifest
+    _cache = None if cache_directory is None else FeatureCache(cache_directory, parameters, manifest=False)
+    _config = config
+
+
+def _analyze(path):
+    """(content hash, voiced [F1, F2] features, whether they came from the cache) of one file"""
+    import formant_detector
+
+    with open(path, "rb") as f:
+        data = f.read()
+    digest = hashlib.sha256(data).hexdigest()
+    features = _cache.get(digest)
+    if features is not None:
+        return digest, features, True
+
+    sample_rate, samples = read_wav(data)
+    parameters = _cache.parameters
+    if sample_rate != parameters["sample_rate"]:
+        raise ValueError(f"sampled at {sample_rate} Hz, the detector expects {parameters['sample_rate']:.0f} Hz")
+    formants = formant_detector.extract(samples, hop=parameters["hop"], threads=1, **_config)
+    features = formants[(formants[:, 0] > 0) & (formants[:, 1] > 0)].astype(np.float32)
+    _cache.put(digest, features)
+    return digest, features, False
+
+
+def _run_job(path):
+    try:
+        return _analyze(path)
+    except (OSError, ValueError) as e:
+        return None, None, str(e)
+
+
+def ingest(root, hop=None, workers=None, cache_directory=CACHE_DIR, **config):
+    """
+    Analyze every recording of a corpus, reusing cached features. Returns the training
+    store, with an example per voiced frame, and a report dict (files, analyzed, cached,
+    failed as {path: error}, skipped directories, workers, seconds).
+    config are FormantDetector settings, gate defaults to True like the app's captures.
+    """
+    start = time.perf_counter()
+    config.setdefault("gate", True)
+    parameters = analysis_parameters(hop, **config)
+    cache = FeatureCache(cache_directory, parameters)
+    files, skipped = find_corpus(root)
+
+    # Files unchanged since the last run come straight from the cache
+    features = [None] * len(files)
+    stats = [os.stat(path) for path, _, _ in files]
+    pending = []
+    for position, ((path, _, _), stat) in enumerate(zip(files, stats)):
+        digest = cache.known_digest(path, stat)
+        cached = None if digest is None else cache.get(digest)
+        if cached is None:
+            pending.append(position)
+        else:
+            features[position] = cached
+
+    if workers is None:
+        workers = (os.cpu_count() or 1) if len(pending) >= PARALLEL_MIN_FILES else 1
+    workers = max(1, min(workers, len(pending)))
+    paths = [files[position][0] for position in pending]
+    if workers == 1:
+        _init_worker(cache_directory, parameters, config)
+        try:
+            outputs = [_run_job(path) for path in paths]
+        finally:
+            _init_worker(None, None, None)
+    else:
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                                 initargs=(cache_directory, parameters, config)) as pool:
+            outputs = list(pool.map(_run_job, paths, chunksize=max(1, len(paths) // (workers * 8))))
+
+    failed = {}
+    analyzed = 0
+    for position, (digest, result, status) in zip(pending, outputs):
+        path = files[position][0]
+        if digest is None:
+            failed[path] = status
+            continue
+        features[position] = result
+        analyzed += not status
+        cache.remember(path, stats[position], digest)
+    cache.forget_missing(root, [path for path, _, _ in files])
+    cache.save_manifest()
+
+    store = TrainingStore(capacity=max(1, sum(len(f) for f in features if f is not None)))
+    for (path, vowel, session), stat, examples in zip(files, stats, features):
+        if examples is not None and len(examples):
+            store.extend(examples, vowel, stat.st_mtime, session)
+
+    report = {
+        "files": len(files),
+        "analyzed": analyzed,
+        "cached": len(files) - analyzed - len(failed),
+        "failed": failed,
+        "skipped": skipped,
+        "examples": len(store),
+        "workers": workers,
+        "seconds": time.perf_counter() - start,
+    }
+    return store, report
+
+
+def format_report(report, counts):
+    lines = [f"{report['files']} files: {report['analyzed']} analyzed, {report['cached']} from the cache, "
+             f"{len(report['failed'])} failed, on {report['workers']} worker(s) in {report['seconds']:.2f} s",
+             f"{report['examples']} examples (" + ", ".join(f"{vowel}: {count}" for vowel, count in counts.items()) + ")"]
+    for path, error in report["failed"].items():
+        lines.append(f"  failed {path}: {error}")
+    for directory in report["skipped"]:
+        lines.append(f"  skipped {directory}, not named after a vowel ({', '.join(VOWELS)})")
+    return "\n".join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Train from a directory of recordings labelled by vowel")
+    parser.add_argument("corpus", help="directory with a subdirectory per vowel (A, E, I, O, U) of WAV files")
+    parser.add_argument("--output", default="corpus.vrt", help="training data file written to app_data")
+    parser.add_argument("--workers", type=int, help="processes analyzing files, all cores by default")
+    parser.add_argument("--hop", type=int, help="samples between frames, frame_size by default")
+    parser.add_argument("--no-gate", action="store_true", help="keep unvoiced and silent frames")
+    parser.add_argument("--cache", default=CACHE_DIR, help="feature cache directory")
+    args = parser.parse_args(argv)
+
+    store, report = ingest(args.corpus, hop=args.hop, workers=args.workers, cache_directory=args.cache,
+                           gate=not args.no_gate)
+    os.makedirs(DATA_DIR, exist_ok=True)
+    output = os.path.join(DATA_DIR, args.output)
+    store.save(output)
+    # A lookup table saved with earlier data would not match the new examples
+    table = os.path.splitext(output)[0] + ".table.npz"
+    if os.path.exists(table):
+        os.remove(table)
+    print(format_report(report, store.counts()))
+    print(f"Saved {len(store)} training examples to {output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,184 @@
+#!/usr/bin/env python3
+"""
+Reads capture recordings written by FormantDetector.start_recording
+
+    detector.start_recording("captures/today")                   # in the detecting process
+    python app/recording.py captures/today                       # list the segments
+    python app/recording.py captures/today --at 12.5 --seconds 2 --replay
+
+Only NumPy is needed to read, formant_detector to replay.
+"""
+import argparse
+import json
+import os
+
+import numpy as np
+
+MAGIC = b"VRREC"
+VERSION = 1
+HEADER_SIZE = 128
+HEADER_DTYPE = np.dtype([
+    ('magic', 'S8'),
+    ('version', '<u4'),
+    ('frame_record_size', '<u4'),
+    ('sample_rate', '<f8'),
+    ('frame_size', '<u4'),
+    ('decimation', '<u4'),
+    ('hop', '<u4'),
+    ('complete', '<u4'),
+    ('segment', '<u8'),
+    ('first_sample', '<u8'),
+    ('start_time', '<f8'),
+    ('sample_capacity', '<u8'),
+    ('frame_capacity', '<u8'),
+    ('frames_offset', '<u8'),
+    ('samples', '<u8'),
+    ('frames', '<u8'),
+])
+# The detector's FormantFrame, as returned by FormantDetector.drain()
+FRAME_FIELDS = {
+    'names': ['f1', 'f2', 'magnitude', 'time', 'index', 'vowel', 'confidence', 'level', 'voiced', 'channel'],
+    'formats': ['<f8', '<f8', '<f8', '<f8', '<u8', '<i4', '<f4', '<f4', '?', '<u2'],
+    'offsets': [0, 8, 16, 24, 32, 40, 44, 48, 52, 54],
+}
+
+
+class Segment:
+    """One segment file, mapped read-only. Counts are read when it is opened."""
+
+    def __init__(self, path):
+        self.path = path
+        self._map = np.memmap(path, dtype=np.uint8, mode="r")
+        header = self._map[:HEADER_DTYPE.itemsize].view(HEADER_DTYPE)[0]
+        if header['magic'] != MAGIC or header['version'] != VERSION:
+            raise ValueError(f"{path} is not a capture segment (version {VERSION})")
+        self.number = int(header['segment'])
+        self.sample_rate = float(header['sample_rate'])
+        self.hop = int(header['hop'])
+        self.first_sample = int(header['first_sample'])
+        self.start_time = float(header['start_time'])
+        self.complete = bool(header['complete'])
+        count = int(header['samples'])
+        self.samples = self._map[HEADER_SIZE:HEADER_SIZE + 4 * count].view('<f4')
+        offset = int(header['frames_offset'])
+        frame_dtype = np.dtype(dict(FRAME_FIELDS, itemsize=int(header['frame_record_size'])))
+        self.frames = self._map[offset:offset + frame_dtype.itemsize * int(header['frames'])].view(frame_dtype)
+
+    @property
+    def end_time(self):
+        return self.start_time + len(self.samples) / self.sample_rate
+
+
+class Recording:
+    """
+    The segments of a recording directory, oldest first, as listed by its index.json.
+    Segments rotated away since the index was written are left out.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        with open(os.path.join(directory, "index.json")) as f:
+            self.index = json.load(f)
+        self.sample_rate = self.index["sample_rate"]
+        self.segments = []
+        for entry in self.index["segments"]:
+            path = os.path.join(directory, entry["file"])
+            if os.path.exists(path):
+                self.segments.append(Segment(path))
+
+    def segment_at(self, time):
+        """The segment holding the sample at a stream time, None in a gap or outside the recording"""
+        starts = [segment.start_time for segment in self.segments]
+        position = np.searchsorted(starts, time, side="right") - 1
+        if position >= 0 and time < self.segments[position].end_time:
+            return self.segments[position]
+        return None
+
+    def samples(self, start=None, end=None):
+        """(stream time of the first sample, float32 samples) from start to end, gaps left out"""
+        parts = []
+        first = None
+        for segment in self.segments:
+            begin, stop = self._range(segment, start, end)
+            if begin < stop:
+                first = segment.start_time + begin / segment.sample_rate if first is None else first
+                parts.append(segment.samples[begin:stop])
+        return first, np.concatenate(parts) if parts else np.zeros(0, dtype=np.float32)
+
+    def frames(self, start=None, end=None):
+        """The recorded frames with a time from start to end, as FormantDetector.drain() returns them"""
+        if not self.segments:
+            return np.zeros(0, dtype=np.dtype(FRAME_FIELDS))
+        frames = np.concatenate([segment.frames for segment in self.segments])
+        keep = np.ones(len(frames), dtype=bool)
+        if start is not None:
+            keep &= frames['time'] >= start
+        if end is not None:
+            keep &= frames['time'] < end
+        return frames[keep]
+
+    def source(self, start=None, end=None, realtime=False):
+        """A RecordingSource replaying from start to end"""
+        import formant_detector
+        return formant_detector.RecordingSource(self.directory, start=start, end=end, realtime=realtime)
+
+    @staticmethod
+    def _range(segment, start, end):
+        count = len(segment.samples)
+
+        def at(time):
+            return int(np.clip(np.ceil((time - segment.start_time) * segment.sample_rate - 1e-6), 0, count))
+
+        return (0 if start is None else at(start)), (count if end is None else at(end))
+
+
+def replay(recording, start=None, end=None, **config):
+    """
+    Analyzes the input again with the recorded sample rate, frame size, decimation and
+    hop, and any other detector settings in config: (recorded frames, replayed frames)
+    from start to end. Both are the same when config matches the recording detector's.
+    """
+    import formant_detector
+
+    settings = {key: recording.index[key] for key in ("sample_rate", "frame_size", "decimation")}
+    detector = formant_detector.FormantDetector(**dict(settings, **config))
+    first = (start is not None and recording.segment_at(start)) or recording.segments[0]
+    detector.start_stream(source=recording.source(start, end), hop=first.hop)
+    replayed = []
+    while (frame := detector.wait_next(timeout=5.0)) is not None:
+        replayed.append(frame)
+        replayed.extend(detector.drain())
+    detector.stop_stream()
+
+    replayed = np.array(replayed, dtype=detector.drain().dtype)
+    if not len(replayed):
+        return recording.frames(start, end)[:0], replayed
+    return recording.frames(replayed['time'][0] - 1e-6, replayed['time'][-1] + 1e-6), replayed
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Segments of a capture recording, and their replay")
+    parser.add_argument("directory", help="directory given to FormantDetector.start_recording")
+    parser.add_argument("--at", type=float, help="stream time to start from, in seconds")
+    parser.add_argument("--seconds", type=float, help="how much to replay")
+    parser.add_argument("--replay", action="store_true",
+                        help="analyze the input again and compare with the recorded frames")
+    args = parser.parse_args(argv)
+
+    recording = Recording(args.directory)
+    for segment in recording.segments:
+        print(f"{os.path.basename(segment.path)}  {segment.start_time:9.3f} - {segment.end_time:9.3f} s  "
+              f"{len(segment.samples):>9} samples  {len(segment.frames):>6} frames"
+              + ("" if segment.complete else "  (recording)"))
+
+    if args.replay:
+        end = None if args.seconds is None else (args.at or recording.segments[0].start_time) + args.seconds
+        recorded, replayed = replay(recording, args.at, end)
+        same = len(recorded) == len(replayed) and np.array_equal(recorded['f1'], replayed['f1']) \
+            and np.array_equal(recorded['f2'], replayed['f2'])
+        print(f"Replayed {len(replayed)} frames, {'identical to' if same else 'different from'} "
+              f"the {len(recorded)} recorded")
+
+
+if __name__ == "__main__":
+    main()
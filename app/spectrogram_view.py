@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+"""
+Reads the shared-memory spectrogram of a running detector, in another process
+
+    detector.start_spectrogram("vrecog")          # in the detecting process
+    python app/spectrogram_view.py vrecog         # anywhere else on the machine
+
+Only NumPy is needed to read, matplotlib to show it.
+"""
+import argparse
+import mmap
+import os
+
+import numpy as np
+
+SHM_DIR = "/dev/shm"
+MAGIC = b"VRSPEC"
+VERSION = 1
+HEADER_SIZE = 64
+HEADER_DTYPE = np.dtype([
+    ('magic', 'S8'),
+    ('version', '<u4'),
+    ('bins', '<u4'),
+    ('capacity', '<u4'),
+    ('row_size', '<u4'),
+    ('sample_rate', '<f8'),
+    ('first_hz', '<f8'),
+    ('bin_hz', '<f8'),
+    ('rows', '<u8'),
+])
+ROWS_OFFSET = HEADER_DTYPE.fields['rows'][1]
+
+
+class SpectrogramReader:
+    """
+    Read-only mapping of a spectrogram written by FormantDetector.start_spectrogram.
+
+    The writer never waits for readers: rows are copied out and then checked against
+    the row counter, rows overwritten in the meantime are left out.
+    """
+
+    def __init__(self, name):
+        path = os.path.join(SHM_DIR, name.lstrip("/"))
+        with open(path, "rb") as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        # A copy, a view would keep the mapping from closing
+        header = np.frombuffer(self._map, dtype=HEADER_DTYPE, count=1).copy()[0]
+        if header['magic'] != MAGIC or header['version'] != VERSION:
+            self.close()
+            raise ValueError(f"{path} is not a spectrogram (version {VERSION})")
+
+        self.name = name
+        self.bins = int(header['bins'])
+        self.capacity = int(header['capacity'])
+        self.sample_rate = float(header['sample_rate'])
+        self.frequencies = header['first_hz'] + header['bin_hz'] * np.arange(self.bins)
+        self._row_dtype = np.dtype({
+            'names': ['time', 'index', 'magnitudes'],
+            'formats': ['<f8', '<u8', ('<f4', (self.bins,))],
+            'offsets': [0, 8, 16],
+            'itemsize': int(header['row_size']),
+        })
+        self._counter = np.frombuffer(self._map, dtype='<u8', count=1, offset=ROWS_OFFSET)
+        self._rows = np.frombuffer(self._map, dtype=self._row_dtype, count=self.capacity, offset=HEADER_SIZE)
+
+    def close(self):
+        self._counter = self._rows = None
+        self._map.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def rows_written(self):
+        return int(self._counter[0])
+
+    def latest(self, count=None):
+        """
+        The newest rows, oldest first: (times, frame indices, (n, bins) magnitudes).
+        Frames the detector's gate skipped are rows of zeros.
+        """
+        count = self.capacity - 1 if count is None else min(count, self.capacity - 1)
+        end = self.rows_written()
+        start = max(0, end - count)
+        rows = self._rows[np.arange(start, end) % self.capacity].copy()
+
+        # The writer may have moved on while copying, its current slot may be torn
+        written = self.rows_written()
+        valid = np.arange(start, end) > written - self.capacity
+        rows = rows[valid]
+        return rows['time'], rows['index'], rows['magnitudes']
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Live view of a detector's shared-memory spectrogram")
+    parser.add_argument("name", help="name given to FormantDetector.start_spectrogram")
+    parser.add_argument("--rows", type=int, default=200, help="frames shown")
+    parser.add_argument("--interval", type=float, default=0.05, help="seconds between redraws")
+    args = parser.parse_args(argv)
+
+    import matplotlib.pyplot as plt
+    from matplotlib.animation import FuncAnimation
+
+    reader = SpectrogramReader(args.name)
+    figure, axes = plt.subplots()
+    image = axes.imshow(np.zeros((reader.bins, args.rows)), origin="lower", aspect="auto",
+                        extent=(0, args.rows, reader.frequencies[0], reader.frequencies[-1]))
+    axes.set_xlabel("frame")
+    axes.set_ylabel("Hz")
+    axes.set_title(f"Spectrogram {args.name}")
+
+    def update(_):
+        _, _, magnitudes = reader.latest(args.rows)
+        shown = np.zeros((reader.bins, args.rows))
+        if len(magnitudes):
+            shown[:, args.rows - len(magnitudes):] = magnitudes.T
+            image.set_clim(0, max(float(magnitudes.max()), 1e-9))
+        image.set_data(shown)
+        return (image,)
+
+    animation = FuncAnimation(figure, update, interval=args.interval * 1000, cache_frame_data=False)
+    try:
+        plt.show()
+    finally:
+        del animation
+        reader.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,273 @@
+"""
+Growable NumPy store of labelled formant examples with a binary, memory-mappable file format
+"""
+import os
+import time
+
+import numpy as np
+
+# Label codes follow the Vowel enum of the app, 0 is unlabelled
+VOWELS = "AEIOU"
+LABEL_NAMES = np.array([""] + list(VOWELS))
+MAX_LABELS = 8
+
+# One example per record. The fields are read as columns, strided views into the
+# records, so a memory-mapped file is used without copying it.
+RECORD_DTYPE = np.dtype({
+    'names': ['timestamp', 'f1', 'f2', 'session', 'label'],
+    'formats': ['<f8', '<f4', '<f4', '<u4', 'u1'],
+    'offsets': [0, 8, 12, 16, 20],
+    'itemsize': 24,
+})
+
+# File layout: a fixed-size header, then count records. The header keeps the number
+# of records and the count per label, so a file can be summarised without reading
+# the records. Appends write the records first and the header last, a crash in
+# between leaves the file at its previous count.
+MAGIC = b"VRTRAIN\0"
+FORMAT_VERSION = 1
+HEADER_SIZE = 128
+HEADER_DTYPE = np.dtype([
+    ('magic', 'S8'),
+    ('version', '<u4'),
+    ('record_size', '<u4'),
+    ('count', '<u8'),
+    ('label_counts', '<u8', (MAX_LABELS,)),
+])
+
+
+def label_code(label):
+    """Label code of a vowel name ('A') or Vowel enum value (1)"""
+    if isinstance(label, str):
+        if label not in VOWELS:
+            raise ValueError(f"Unknown vowel {label!r}")
+        return VOWELS.index(label) + 1
+    code = int(getattr(label, "value", label))
+    if not 0 <= code <= len(VOWELS):
+        raise ValueError(f"Unknown vowel index {code}")
+    return code
+
+
+def read_header(path):
+    """The header of a store file as a dict: count and label_counts (by vowel name)"""
+    with open(path, "rb") as f:
+        data = f.read(HEADER_SIZE)
+    if len(data) < HEADER_DTYPE.itemsize:
+        raise ValueError(f"{path} is not a training store file")
+    header = np.frombuffer(data[:HEADER_DTYPE.itemsize], dtype=HEADER_DTYPE)[0]
+    if header['magic'] != MAGIC.rstrip(b"\0") or header['version'] != FORMAT_VERSION:
+        raise ValueError(f"{path} is not a training store file (version {FORMAT_VERSION})")
+    if header['record_size'] != RECORD_DTYPE.itemsize:
+        raise ValueError(f"{path} has {header['record_size']} byte records, expected {RECORD_DTYPE.itemsize}")
+    return {
+        "count": int(header['count']),
+        "label_counts": {vowel: int(header['label_counts'][code]) for code, vowel in enumerate(VOWELS, 1)},
+    }
+
+
+def _header_bytes(count, label_counts):
+    header = np.zeros(1, dtype=HEADER_DTYPE)
+    header['magic'] = MAGIC
+    header['version'] = FORMAT_VERSION
+    header['record_size'] = RECORD_DTYPE.itemsize
+    header['count'] = count
+    header['label_counts'] = label_counts
+    return header.tobytes().ljust(HEADER_SIZE, b"\0")
+
+
+def _label_counts(records):
+    return np.bincount(records['label'], minlength=MAX_LABELS)[:MAX_LABELS]
+
+
+class TrainingStore:
+    """
+    Labelled [F1, F2] examples with a timestamp and a speaker/session id.
+
+    Records live in one structured array that grows by doubling. load() memory-maps
+    a file, the mapping is only copied once the store is modified.
+    """
+
+    def __init__(self, capacity=1024):
+        self._records = np.zeros(capacity, dtype=RECORD_DTYPE)
+        self._count = 0
+
+    def __len__(self):
+        return self._count
+
+    @property
+    def records(self):
+        """All examples as a structured array (timestamp, f1, f2, session, label)"""
+        return self._records[:self._count]
+
+    @property
+    def f1(self):
+        return self.records['f1']
+
+    @property
+    def f2(self):
+        return self.records['f2']
+
+    @property
+    def labels(self):
+        return self.records['label']
+
+    @property
+    def timestamps(self):
+        return self.records['timestamp']
+
+    @property
+    def sessions(self):
+        return self.records['session']
+
+    def _reserve(self, count):
+        needed = self._count + count
+        writable = isinstance(self._records, np.ndarray) and not isinstance(self._records, np.memmap)
+        if writable and needed <= len(self._records):
+            return
+        capacity = max(needed, 2 * len(self._records), 1024)
+        records = np.zeros(capacity, dtype=RECORD_DTYPE)
+        records[:self._count] = self._records[:self._count]
+        self._records = records
+
+    def extend(self, features, label, timestamps=None, session=0):
+        """Append (n, 2) [F1, F2] examples of one vowel"""
+        features = np.asarray(features, dtype=np.float32).reshape(-1, 2)
+        count = len(features)
+        self._reserve(count)
+        new = self._records[self._count:self._count + count]
+        new['f1'] = features[:, 0]
+        new['f2'] = features[:, 1]
+        new['label'] = label_code(label)
+        new['timestamp'] = time.time() if timestamps is None else timestamps
+        new['session'] = session
+        self._count += count
+
+    def append(self, f1, f2, label, timestamp=None, session=0):
+        self.extend([[f1, f2]], label, None if timestamp is None else [timestamp], session)
+
+    def extend_records(self, records):
+        """Append records of another store"""
+        count = len(records)
+        self._reserve(count)
+        self._records[self._count:self._count + count] = records
+        self._count += count
+
+    def clear(self, label=None):
+        """Remove every example, or only those of one vowel. Returns how many were removed"""
+        if label is None:
+            removed = self._count
+            self._records = np.zeros(1024, dtype=RECORD_DTYPE)
+            self._count = 0
+            return removed
+
+        keep = self.records[self.labels != label_code(label)]
+        removed = self._count - len(keep)
+        if removed:
+            self._records = np.zeros(max(len(keep), 1024), dtype=RECORD_DTYPE)
+            self._records[:len(keep)] = keep
+            self._count = len(keep)
+        return removed
+
+    def count(self, label=None):
+        if label is None:
+            return self._count
+        return int(np.count_nonzero(self.labels == label_code(label)))
+
+    def counts(self):
+        """Examples per vowel name"""
+        counts = np.bincount(self.labels, minlength=MAX_LABELS)
+        return {vowel: int(counts[code]) for code, vowel in enumerate(VOWELS, 1)}
+
+    def features(self, label=None):
+        """(n, 2) float64 array of [F1, F2], all examples or those of one vowel"""
+        records = self.records if label is None else self.records[self.labels == label_code(label)]
+        return np.column_stack((records['f1'], records['f2'])).astype(np.float64)
+
+    def label_names(self):
+        """Vowel name of every example"""
+        return LABEL_NAMES[self.labels]
+
+    # Binary files
+
+    def save(self, path):
+        """Write every example to path, replacing it atomically"""
+        temporary = f"{path}.tmp{os.getpid()}"
+        with open(temporary, "wb") as f:
+            f.write(_header_bytes(self._count, _label_counts(self.records)))
+            f.write(np.ascontiguousarray(self.records).tobytes())
+        os.replace(temporary, path)
+
+    def append_to_file(self, path, start=0):
+        """Append the examples from index start on to path, creating it if needed"""
+        new = np.ascontiguousarray(self.records[start:])
+        if not os.path.exists(path):
+            TrainingStore._from_records(new).save(path)
+            return
+
+        header = read_header(path)
+        label_counts = np.zeros(MAX_LABELS, dtype=np.uint64)
+        for code, vowel in enumerate(VOWELS, 1):
+            label_counts[code] = header["label_counts"][vowel]
+        label_counts += _label_counts(new).astype(np.uint64)
+
+        with open(path, "r+b") as f:
+            f.seek(HEADER_SIZE + header["count"] * RECORD_DTYPE.itemsize)
+            f.write(new.tobytes())
+            f.truncate()
+            f.flush()
+            os.fsync(f.fileno())
+            f.seek(0)
+            f.write(_header_bytes(header["count"] + len(new), label_counts))
+
+    @classmethod
+    def _from_records(cls, records):
+        store = cls(capacity=max(len(records), 1))
+        store._records[:len(records)] = records
+        store._count = len(records)
+        return store
+
+    @classmethod
+    def load(cls, path, mmap=True):
+        """Open a file written by save(). With mmap the records are mapped, not read"""
+        header = read_header(path)
+        store = cls(capacity=1)
+        if header["count"] == 0:
+            return store
+        if mmap:
+            store._records = np.memmap(path, dtype=RECORD_DTYPE, mode="r", offset=HEADER_SIZE,
+                                       shape=(header["count"],))
+        else:
+            store._records = np.fromfile(path, dtype=RECORD_DTYPE, count=header["count"], offset=HEADER_SIZE)
+        store._count = header["count"]
+        return store
+
+    # CSV, the format of the original training data files
+
+    def export_csv(self, path):
+        """Write the examples as vowel,f1,f2 lines"""
+        with open(path, "w") as f:
+            f.write("# Vowel Training Data\n")
+            f.write("# Format: vowel,f1,f2\n")
+            for name, f1, f2 in zip(self.label_names(), self.f1, self.f2):
+                f.write(f"{name},{f1},{f2}\n")
+
+    @classmethod
+    def import_csv(cls, path, session=0):
+        """Read vowel,f1,f2 lines, skipping comments and lines with unknown vowels"""
+        examples = {vowel: [] for vowel in VOWELS}
+        with open(path) as f:
+            for line in f:
+                line = line.strip()
+                if line.startswith('#') or not line:
+                    continue
+                parts = line.split(',')
+                if len(parts) == 3 and parts[0] in examples:
+                    examples[parts[0]].append((float(parts[1]), float(parts[2])))
+
+        # CSV files have no timestamps, use the time the file was written
+        timestamp = os.path.getmtime(path)
+        store = cls(capacity=max(sum(len(rows) for rows in examples.values()), 1))
+        for vowel, rows in examples.items():
+            if rows:
+                store.extend(rows, vowel, timestamp, session)
+        return store
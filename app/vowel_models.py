@@ -0,0 +1,372 @@
+"""
+Vowel classifier backends and a model that is fitted once and reused until the
+training data changes
+"""
+import json
+
+import numpy as np
+
+MIN_TRAINING_EXAMPLES = 5
+
+
+def formant_matrix(frames):
+    """(n, 2) float array of [F1, F2] from drained frames, an (n, 2) array or one [F1, F2] pair"""
+    frames = np.asarray(frames)
+    if frames.dtype.names is not None:
+        return np.column_stack((frames['f1'], frames['f2'])).astype(np.float64)
+    return np.asarray(frames, dtype=np.float64).reshape(-1, 2)
+
+
+class ClassifierBackend:
+    """
+    Base of the classifier backends. A backend is fitted on an (n, 2) array of
+    [F1, F2] and its labels, then predicts probabilities for a whole batch of frames
+    at once. Hyperparameters are the names in params, read and changed with
+    get_params/set_params. Only the knn backend needs scikit-learn.
+    """
+
+    name = None
+    params = ()
+
+    def __init__(self, **params):
+        for key in self.params:
+            setattr(self, key, params.pop(key, getattr(type(self), key)))
+        if params:
+            raise TypeError(f"Unknown parameters for the {self.name} backend: {', '.join(params)}")
+
+    def get_params(self, deep=True):
+        return {key: getattr(self, key) for key in self.params}
+
+    def set_params(self, **params):
+        for key, value in params.items():
+            if key not in self.params:
+                raise ValueError(f"Unknown parameter {key} for the {self.name} backend")
+            setattr(self, key, value)
+        return self
+
+    def fit(self, features, labels):
+        raise NotImplementedError
+
+    def predict_proba(self, features):
+        """(n, n_classes) probabilities, columns in the order of classes_"""
+        raise NotImplementedError
+
+    def predict(self, features):
+        return self.classes_[np.argmax(self.predict_proba(features), axis=1)]
+
+    def score(self, features, labels):
+        return float(np.mean(self.predict(features) == np.asarray(labels)))
+
+    def native_model(self):
+        """
+        The fitted backend as a formant_detector.VowelClassifier for
+        FormantDetector.load_model. Backends without a closed form are compiled into
+        a LookupTable first.
+        """
+        return LookupTable.compile(self).native_model()
+
+
+class KNNBackend(ClassifierBackend):
+    """k nearest neighbours, answered from a KD-tree built once at fit time"""
+
+    name = "knn"
+    params = ("n_neighbors", "algorithm")
+    n_neighbors = 3
+    algorithm = "kd_tree"
+
+    def fit(self, features, labels):
+        from sklearn.neighbors import KNeighborsClassifier
+
+        self.classifier = KNeighborsClassifier(n_neighbors=self.n_neighbors, algorithm=self.algorithm)
+        self.classifier.fit(features, labels)
+        self.classes_ = self.classifier.classes_
+        return self
+
+    def predict_proba(self, features):
+        return self.classifier.predict_proba(features)
+
+
+def _softmax(scores):
+    scores = scores - scores.max(axis=1, keepdims=True)
+    weights = np.exp(scores)
+    return weights / weights.sum(axis=1, keepdims=True)
+
+
+class CentroidBackend(ClassifierBackend):
+    """
+    Nearest class mean. Probabilities assume an isotropic spread around every mean,
+    with the variance pooled over all classes.
+    """
+
+    name = "centroid"
+    params = ("scale",)
+    scale = "pooled"
+
+    def fit(self, features, labels):
+        features = np.asarray(features, dtype=np.float64)
+        labels = np.asarray(labels)
+        self.classes_, index = np.unique(labels, return_inverse=True)
+        self.centroids_ = np.array([features[index == k].mean(axis=0) for k in range(len(self.classes_))])
+        if self.scale == "pooled":
+            residuals = features - self.centroids_[index]
+            self.variance_ = max(float(np.mean(residuals ** 2)), 1.0)
+        else:
+            self.variance_ = float(self.scale) ** 2
+        return self
+
+    def predict_proba(self, features):
+        features = np.asarray(features, dtype=np.float64)
+        distances = ((features[:, None, :] - self.centroids_[None, :, :]) ** 2).sum(axis=2)
+        return _softmax(-0.5 * distances / self.variance_)
+
+    def native_model(self):
+        import formant_detector
+
+        return formant_detector.VowelClassifier.centroid([str(c) for c in self.classes_], self.centroids_,
+                                                         self.variance_)
+
+
+class GaussianBackend(ClassifierBackend):
+    """
+    One full-covariance Gaussian per vowel with class priors from the training
+    counts. variance_floor (Hz^2) keeps vowels with few, nearly identical examples
+    from collapsing to a point.
+    """
+
+    name = "gaussian"
+    params = ("variance_floor", "priors")
+    variance_floor = 100.0
+    priors = "counts"
+
+    def fit(self, features, labels):
+        features = np.asarray(features, dtype=np.float64)
+        labels = np.asarray(labels)
+        self.classes_, index, counts = np.unique(labels, return_inverse=True, return_counts=True)
+
+        self.means_ = np.empty((len(self.classes_), 2))
+        self.precisions_ = np.empty((len(self.classes_), 2, 2))
+        self.offsets_ = np.empty(len(self.classes_))
+        log_priors = np.log(counts / counts.sum()) if self.priors == "counts" else np.zeros(len(self.classes_))
+
+        for k in range(len(self.classes_)):
+            members = features[index == k]
+            covariance = np.cov(members, rowvar=False) if len(members) > 1 else np.zeros((2, 2))
+            covariance = covariance + np.eye(2) * self.variance_floor
+            self.means_[k] = members.mean(axis=0)
+            self.precisions_[k] = np.linalg.inv(covariance)
+            self.offsets_[k] = log_priors[k] - 0.5 * np.log(np.linalg.det(covariance))
+        return self
+
+    def predict_proba(self, features):
+        features = np.asarray(features, dtype=np.float64)
+        deltas = features[:, None, :] - self.means_[None, :, :]
+        mahalanobis = np.einsum('nki,kij,nkj->nk', deltas, self.precisions_, deltas)
+        return _softmax(self.offsets_[None, :] - 0.5 * mahalanobis)
+
+    def native_model(self):
+        import formant_detector
+
+        return formant_detector.VowelClassifier.gaussian([str(c) for c in self.classes_], self.means_,
+                                                         self.precisions_, self.offsets_)
+
+
+BACKENDS = {backend.name: backend for backend in (KNNBackend, CentroidBackend, GaussianBackend)}
+
+
+def make_backend(name, **params):
+    """A new, unfitted backend by name (see BACKENDS)"""
+    if name not in BACKENDS:
+        raise ValueError(f"Unknown classifier backend {name!r}, expected one of {', '.join(BACKENDS)}")
+    return BACKENDS[name](**params)
+
+
+# The detector only reports peaks in this band, see SPEECH_FREQ_START/END in formant_module.h
+TABLE_MIN_HZ = 300.0
+TABLE_MAX_HZ = 3200.0
+TABLE_CELL_HZ = 10.0
+TABLE_FORMAT_VERSION = 1
+
+
+class LookupTable:
+    """
+    A fitted backend baked into a grid over F1 x F2: the most likely vowel and its
+    probability at the centre of every cell. Prediction is one array index per frame,
+    frames outside the grid take the nearest edge cell. Needs only NumPy, so a saved
+    table classifies without scikit-learn.
+    """
+
+    def __init__(self, classes, labels, confidences, min_hz=TABLE_MIN_HZ, cell_hz=TABLE_CELL_HZ,
+                 backend=None, params=None, examples=0):
+        self.classes = np.asarray(classes)
+        self.labels = np.asarray(labels, dtype=np.uint8)
+        self.confidences = np.asarray(confidences, dtype=np.float32)
+        self.min_hz = float(min_hz)
+        self.cell_hz = float(cell_hz)
+        self.backend = backend
+        self.params = dict(params or {})
+        self.examples = int(examples)
+
+    @classmethod
+    def compile(cls, classifier, min_hz=TABLE_MIN_HZ, max_hz=TABLE_MAX_HZ, cell_hz=TABLE_CELL_HZ, **metadata):
+        """Evaluate a fitted backend at every cell centre, metadata is kept with the table"""
+        if len(classifier.classes_) > 255:
+            raise ValueError("A lookup table holds at most 255 classes")
+        cells = int(np.ceil((max_hz - min_hz) / cell_hz))
+        centres = min_hz + (np.arange(cells) + 0.5) * cell_hz
+        f1, f2 = np.meshgrid(centres, centres, indexing="ij")
+        probabilities = classifier.predict_proba(np.column_stack((f1.ravel(), f2.ravel())))
+        best = np.argmax(probabilities, axis=1)
+        return cls(classifier.classes_, best.reshape(cells, cells),
+                   probabilities[np.arange(len(best)), best].reshape(cells, cells),
+                   min_hz, cell_hz, **metadata)
+
+    @property
+    def max_hz(self):
+        return self.min_hz + self.labels.shape[0] * self.cell_hz
+
+    def cells(self, features):
+        """Row and column of the cell of every [F1, F2]"""
+        features = formant_matrix(features)
+        index = ((features - self.min_hz) / self.cell_hz).astype(np.intp)
+        np.clip(index, 0, self.labels.shape[0] - 1, out=index)
+        return index[:, 0], index[:, 1]
+
+    def predict_many(self, frames):
+        """Most likely vowel and its probability for every frame, like VowelModel.predict_many"""
+        rows, columns = self.cells(frames)
+        return self.classes[self.labels[rows, columns]], self.confidences[rows, columns]
+
+    def predict(self, formants):
+        labels, confidences = self.predict_many(formants)
+        return labels[0], confidences[0]
+
+    def native_model(self):
+        """The table as a formant_detector.VowelClassifier for FormantDetector.load_model"""
+        import formant_detector
+
+        return formant_detector.VowelClassifier.grid([str(c) for c in self.classes], self.labels,
+                                                     self.confidences, self.min_hz, self.cell_hz)
+
+    def save(self, path):
+        """Write the table as an .npz file, readable without pickle"""
+        with open(path, "wb") as f:
+            np.savez(f, version=TABLE_FORMAT_VERSION, classes=self.classes.astype(str), labels=self.labels,
+                     confidences=self.confidences, min_hz=self.min_hz, cell_hz=self.cell_hz,
+                     backend=str(self.backend or ""), params=json.dumps(self.params), examples=self.examples)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path, allow_pickle=False) as data:
+            if int(data["version"]) != TABLE_FORMAT_VERSION:
+                raise ValueError(f"{path} is not a lookup table (version {TABLE_FORMAT_VERSION})")
+            return cls(data["classes"], data["labels"], data["confidences"], float(data["min_hz"]),
+                       float(data["cell_hz"]), str(data["backend"]), json.loads(str(data["params"])),
+                       int(data["examples"]))
+
+
+class VowelModel:
+    """
+    Keeps the fitted classifier and the training matrix between predictions.
+
+    training_data is called to get (features, labels) when the model is next used
+    after invalidate(), so the cost of fitting is paid once per change of the
+    training data instead of once per frame. backend names one of BACKENDS, params
+    are passed to it.
+    """
+
+    def __init__(self, training_data, backend="knn", **params):
+        self.training_data = training_data
+        make_backend(backend, **params)
+        self.backend = backend
+        self.params = params
+        self.features = None
+        self.labels = None
+        self.classifier = None
+        self.table = None
+        self.fits = 0
+
+    def invalidate(self):
+        """Drop the fitted model and its lookup table, the next prediction refits"""
+        self.features = None
+        self.labels = None
+        self.classifier = None
+        self.table = None
+
+    def set_backend(self, backend, **params):
+        """Switch to another backend, the next prediction fits it"""
+        make_backend(backend, **params)
+        self.backend = backend
+        self.params = params
+        self.invalidate()
+
+    def is_fitted(self):
+        return self.classifier is not None
+
+    def fit(self):
+        """Fit on the current training data. Returns False when there are too few examples"""
+        features, labels = self.training_data()
+        self.features = np.asarray(features, dtype=np.float64).reshape(-1, 2)
+        self.labels = np.asarray(labels)
+        self.classifier = None
+        if len(self.features) < MIN_TRAINING_EXAMPLES:
+            return False
+
+        self.classifier = make_backend(self.backend, **self.params)
+        self.classifier.fit(self.features, self.labels)
+        self.fits += 1
+        return True
+
+    def compile_table(self, cell_hz=TABLE_CELL_HZ):
+        """
+        Bake the fitted model into a LookupTable and predict from it until the
+        training data or the backend changes. Raises ValueError when there is not
+        enough training data.
+        """
+        self._ensure_fitted()
+        self.table = LookupTable.compile(self.classifier, cell_hz=cell_hz, backend=self.backend,
+                                         params=self.params, examples=len(self.features))
+        return self.table
+
+    def use_table(self, table):
+        """Predict from a compiled table (for example a saved one) instead of fitting"""
+        self.table = table
+
+    def native_model(self):
+        """
+        The model as a formant_detector.VowelClassifier, so detectors label frames on
+        their analysis thread. Uses the lookup table when one is compiled. Raises
+        ValueError when there is not enough training data.
+        """
+        if self.table is not None:
+            return self.table.native_model()
+        self._ensure_fitted()
+        return self.classifier.native_model()
+
+    def _ensure_fitted(self):
+        if self.classifier is None and not self.fit():
+            raise ValueError("Not enough training data")
+
+    def predict_many(self, frames):
+        """
+        Most likely vowel and its probability for every frame.
+
+        frames can be the structured array returned by FormantDetector.drain() or an
+        (n, 2) array of [F1, F2]. Returns an array of labels and an array of
+        probabilities. Uses the lookup table when one is compiled. Raises ValueError
+        when there is not enough training data.
+        """
+        if self.table is not None:
+            return self.table.predict_many(frames)
+        features = formant_matrix(frames)
+        self._ensure_fitted()
+        if len(features) == 0:
+            return np.empty(0, dtype=self.labels.dtype), np.empty(0)
+
+        probabilities = self.classifier.predict_proba(features)
+        best = np.argmax(probabilities, axis=1)
+        return self.classifier.classes_[best], probabilities[np.arange(len(best)), best]
+
+    def predict(self, formants):
+        """Most likely vowel and its probability for one [F1, F2] pair"""
+        labels, probabilities = self.predict_many(formants)
+        return labels[0], probabilities[0]
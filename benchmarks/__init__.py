@@ -0,0 +1,5 @@
+"""
+Benchmarks of the formant detector and the vowel classifier.
+
+Run with python -m benchmarks, see python -m benchmarks --help.
+"""
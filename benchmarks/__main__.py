@@ -0,0 +1,97 @@
+"""
+Runs the benchmark suite and writes the results as JSON
+
+    python -m benchmarks --output results.json
+"""
+import argparse
+import datetime
+import json
+import os
+import platform
+import sys
+
+import numpy as np
+
+import formant_detector
+
+from . import suite
+from . import synth
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m benchmarks", description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--output", "-o", help="write the JSON results here instead of stdout")
+    parser.add_argument("--frame-size", type=int, default=4096)
+    parser.add_argument("--hop", type=int, default=1024)
+    parser.add_argument("--segment", type=float, default=0.5, help="seconds per synthesized vowel")
+    parser.add_argument("--repeats", type=int, default=4, help="vowel sequence repetitions in the test signal")
+    parser.add_argument("--threads", type=int, default=0, help="threads of the parallel offline run, 0 = all cores")
+    parser.add_argument("--training-sizes", default="50,200,1000,5000",
+                        help="comma separated training set sizes for the classifier latency")
+    parser.add_argument("--calls", type=int, default=200, help="likelyhood_vowel calls per training set size")
+    parser.add_argument("--backends", help="comma separated classifier backends to time, all by default")
+    parser.add_argument("--skip-classifier", action="store_true", help="leave out the classifier latency")
+    parser.add_argument("--quick", action="store_true", help="small signal and training sets, for smoke tests")
+    parser.add_argument("--seed", type=int, default=0)
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.quick:
+        args.repeats = 1
+        args.training_sizes = "50,200"
+        args.calls = 20
+
+    samples, segments = synth.synthesize_sequence(list(synth.VOWEL_FORMANTS) * args.repeats,
+                                                  segment_duration=args.segment, seed=args.seed)
+    print(f"Test signal: {len(segments)} vowels, {len(samples) / synth.SAMPLE_RATE:.1f} s", file=sys.stderr)
+
+    results = {
+        "meta": {
+            "timestamp": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "machine": platform.machine(),
+            "cpu_count": os.cpu_count(),
+            "numpy": np.__version__,
+            "module": getattr(formant_detector, "__file__", None),
+        },
+        "config": {
+            "sample_rate": synth.SAMPLE_RATE,
+            "frame_size": args.frame_size,
+            "hop": args.hop,
+            "signal_seconds": len(samples) / synth.SAMPLE_RATE,
+            "seed": args.seed,
+        },
+    }
+
+    print("Measuring per-frame latency...", file=sys.stderr)
+    results["frame_latency"] = suite.frame_latency(samples, args.frame_size)
+    print("Measuring offline throughput...", file=sys.stderr)
+    results["offline"] = [
+        suite.offline_throughput(samples, args.frame_size, args.hop, threads=1),
+        suite.offline_throughput(samples, args.frame_size, args.hop, threads=args.threads),
+    ]
+    print("Measuring live throughput...", file=sys.stderr)
+    results["live"] = suite.live_throughput(samples, args.frame_size, args.hop)
+    print("Measuring formant accuracy...", file=sys.stderr)
+    results["accuracy"] = suite.formant_accuracy(samples, segments, args.frame_size, args.hop)
+
+    if not args.skip_classifier:
+        print("Measuring classifier latency...", file=sys.stderr)
+        sizes = [int(size) for size in args.training_sizes.split(",") if size]
+        backends = args.backends.split(",") if args.backends else None
+        results["classifier"] = suite.classifier_latency(sizes, args.calls, backends, seed=args.seed)
+
+    text = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+        print(f"Results written to {args.output}", file=sys.stderr)
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,157 @@
+"""
+Speed and accuracy measurements of the formant pipeline and the vowel classifier
+"""
+import contextlib
+import io
+import os
+import sys
+import time
+
+import numpy as np
+
+import formant_detector
+
+from . import synth
+
+APP_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "app")
+
+
+def percentiles(values):
+    """p50/p99/mean/max of a list of durations in seconds, reported in microseconds"""
+    values = np.asarray(values) * 1e6
+    return {
+        "p50_us": float(np.percentile(values, 50)),
+        "p99_us": float(np.percentile(values, 99)),
+        "mean_us": float(np.mean(values)),
+        "max_us": float(np.max(values)),
+    }
+
+
+def frame_latency(samples, frame_size, repeats=1):
+    """Time to analyze one frame, measured per call of extract on a single frame"""
+    frames = [samples[i:i + frame_size] for i in range(0, len(samples) - frame_size + 1, frame_size)]
+    # The first call creates the FFTW plan, keep it out of the numbers
+    formant_detector.extract(frames[0], frame_size=frame_size)
+
+    durations = []
+    for _ in range(repeats):
+        for frame in frames:
+            start = time.perf_counter()
+            formant_detector.extract(frame, frame_size=frame_size)
+            durations.append(time.perf_counter() - start)
+
+    result = percentiles(durations)
+    result["frames"] = len(durations)
+    return result
+
+
+def offline_throughput(samples, frame_size, hop, threads):
+    """Frames per second of extract over the whole signal"""
+    formant_detector.extract(samples[:frame_size], frame_size=frame_size)
+    start = time.perf_counter()
+    formants = formant_detector.extract(samples, hop=hop, threads=threads, frame_size=frame_size)
+    elapsed = time.perf_counter() - start
+    return {
+        "threads": threads,
+        "frames": len(formants),
+        "seconds": elapsed,
+        "frames_per_second": len(formants) / elapsed,
+        "realtime_factor": len(samples) / synth.SAMPLE_RATE / elapsed,
+    }
+
+
+def live_throughput(samples, frame_size, hop):
+    """Frames per second through the live path: sample ring, analysis thread and frame history"""
+    detector = formant_detector.FormantDetector(frame_size=frame_size)
+    frames = 0
+    start = time.perf_counter()
+    detector.start_stream(source=formant_detector.BufferSource(samples), hop=hop)
+    try:
+        while detector.wait_next(timeout=5.0) is not None:
+            frames += 1 + len(detector.drain())
+    finally:
+        detector.stop_stream()
+    elapsed = time.perf_counter() - start
+
+    stats = detector.get_stats()
+    return {
+        "frames": frames,
+        "seconds": elapsed,
+        "frames_per_second": frames / elapsed,
+        "realtime_factor": len(samples) / synth.SAMPLE_RATE / elapsed,
+        "dropped_frames": stats["dropped_frames"],
+        "dropped_samples": stats["dropped_samples"],
+    }
+
+
+def formant_accuracy(samples, segments, frame_size, hop):
+    """Detected F1/F2 against the synthesizer's targets, per vowel and overall"""
+    formants = formant_detector.extract(samples, hop=hop, frame_size=frame_size)
+    labels, target1, target2 = synth.frame_targets(segments, len(formants), hop, frame_size)
+    labels = np.array([label if label is not None else "" for label in labels])
+
+    def summary(mask):
+        detected = mask & (formants[:, 0] > 0)
+        error1 = np.abs(formants[detected, 0] - target1[detected])
+        error2 = np.abs(formants[detected, 1] - target2[detected])
+        return {
+            "frames": int(mask.sum()),
+            "detection_rate": float(detected.sum() / mask.sum()) if mask.any() else 0.0,
+            "f1_mae_hz": float(error1.mean()) if len(error1) else None,
+            "f2_mae_hz": float(error2.mean()) if len(error2) else None,
+            "f1_median_error_hz": float(np.median(error1)) if len(error1) else None,
+            "f2_median_error_hz": float(np.median(error2)) if len(error2) else None,
+        }
+
+    result = {"overall": summary(labels != "")}
+    for vowel in sorted(set(labels) - {""}):
+        result[vowel] = summary(labels == vowel)
+    return result
+
+
+def classifier_latency(sizes, calls, backends=None, seed=0):
+    """likelyhood_vowel time per call as the training data grows, for every classifier backend"""
+    if APP_DIR not in sys.path:
+        sys.path.insert(0, APP_DIR)
+    import classification
+
+    rng = np.random.default_rng(seed)
+    queries = [[float(f1), float(f2)] for f1, f2 in
+               rng.normal(loc=(600, 1400), scale=(200, 500), size=(calls, 2))]
+
+    def clear():
+        with contextlib.redirect_stdout(io.StringIO()):
+            classification.clear_vowel_training_data(6)
+
+    backends = list(classification.BACKENDS) if backends is None else backends
+    previous = (classification.vowel_model.backend, classification.vowel_model.params)
+    results = []
+    for backend, size in ((backend, size) for backend in backends for size in sizes):
+        classification.vowel_model.set_backend(backend)
+        clear()
+        for i, vowel in enumerate("AEIOU"):
+            f1, f2 = synth.VOWEL_FORMANTS[vowel][:2]
+            count = size // 5 + (i < size % 5)
+            classification.training_store.extend(rng.normal((f1, f2), (f1 * 0.1, f2 * 0.1), size=(count, 2)), vowel)
+        classification.vowel_model.invalidate()
+
+        # First prediction after new training data may pay for fitting, report it apart
+        start = time.perf_counter()
+        classification.likelyhood_vowel(queries[0])
+        first = time.perf_counter() - start
+
+        durations = []
+        for query in queries:
+            start = time.perf_counter()
+            classification.likelyhood_vowel(query)
+            durations.append(time.perf_counter() - start)
+
+        result = percentiles(durations)
+        result["backend"] = backend
+        result["training_examples"] = size
+        result["first_call_us"] = first * 1e6
+        results.append(result)
+
+    clear()
+    classification.vowel_model.set_backend(previous[0], **previous[1])
+    return results
@@ -0,0 +1,130 @@
+"""
+Source-filter vowel synthesizer with known formant targets
+"""
+import numpy as np
+
+SAMPLE_RATE = 44100
+
+# Average adult male formants (Peterson & Barney) for the vowels the app trains,
+# F1..F4 in Hz
+VOWEL_FORMANTS = {
+    'A': (730, 1090, 2440, 3400),
+    'E': (530, 1840, 2480, 3500),
+    'I': (270, 2290, 3010, 3700),
+    'O': (570, 840, 2410, 3300),
+    'U': (300, 870, 2240, 3300),
+}
+
+FORMANT_BANDWIDTHS = (60, 90, 120, 150)
+
+
+def glottal_pulses(num_samples, sample_rate=SAMPLE_RATE, f0=120.0, jitter=0.01, shimmer=0.05, rng=None):
+    """Rosenberg glottal flow pulses, each period and amplitude perturbed by jitter/shimmer"""
+    rng = np.random.default_rng() if rng is None else rng
+    source = np.zeros(num_samples)
+    position = 0.0
+
+    while position < num_samples:
+        period = max(sample_rate / f0 * (1.0 + jitter * rng.standard_normal()), 2.0)
+        opening = int(0.4 * period)
+        closing = int(0.16 * period)
+        amplitude = 1.0 + shimmer * rng.standard_normal()
+
+        start = int(position)
+        n = np.arange(opening + closing)
+        pulse = np.where(n < opening,
+                         0.5 * (1.0 - np.cos(np.pi * n / max(opening, 1))),
+                         np.cos(0.5 * np.pi * (n - opening) / max(closing, 1)))
+        end = min(start + len(pulse), num_samples)
+        source[start:end] += amplitude * pulse[:end - start]
+        position += period
+
+    return source
+
+
+def resonator(signal, frequency, bandwidth, sample_rate=SAMPLE_RATE):
+    """Klatt second order resonator with unity gain at DC"""
+    c = -np.exp(-2.0 * np.pi * bandwidth / sample_rate)
+    b = 2.0 * np.exp(-np.pi * bandwidth / sample_rate) * np.cos(2.0 * np.pi * frequency / sample_rate)
+    a = 1.0 - b - c
+    # y[n] = a x[n] + b y[n-1] + c y[n-2], on Python floats: much faster than indexing arrays
+    output = []
+    previous = before = 0.0
+    for x in (a * signal).tolist():
+        previous, before = x + b * previous + c * before, previous
+        output.append(previous)
+    return np.array(output)
+
+
+def synthesize_vowel(vowel, duration=1.0, sample_rate=SAMPLE_RATE, f0=120.0, jitter=0.01,
+                     shimmer=0.05, snr_db=30.0, level_db=-12.0, seed=None):
+    """
+    One sustained vowel as float32 samples.
+
+    vowel is a key of VOWEL_FORMANTS or a tuple of formant frequencies. The glottal
+    pulse train is filtered by a cascade of formant resonators, differentiated for
+    the lip radiation, scaled to level_db (peak, dBFS) and mixed with white noise
+    snr_db below the voiced signal.
+    """
+    rng = np.random.default_rng(seed)
+    formants = VOWEL_FORMANTS[vowel] if isinstance(vowel, str) else tuple(vowel)
+    num_samples = int(duration * sample_rate)
+
+    voiced = glottal_pulses(num_samples, sample_rate, f0, jitter, shimmer, rng)
+    for frequency, bandwidth in zip(formants, FORMANT_BANDWIDTHS):
+        voiced = resonator(voiced, frequency, bandwidth, sample_rate)
+    voiced = np.diff(voiced, prepend=0.0)
+
+    peak = np.max(np.abs(voiced))
+    if peak > 0:
+        voiced *= 10.0 ** (level_db / 20.0) / peak
+
+    noise_power = np.mean(voiced ** 2) / 10.0 ** (snr_db / 10.0)
+    noise = rng.standard_normal(num_samples) * np.sqrt(noise_power)
+    return (voiced + noise).astype(np.float32)
+
+
+def synthesize_sequence(vowels, segment_duration=0.5, sample_rate=SAMPLE_RATE, level_range_db=(-30.0, -6.0),
+                        seed=None, **kwargs):
+    """
+    The vowels one after another with a random level per segment.
+
+    Returns the samples and a list of (vowel, start, end, f1, f2) segments, start and
+    end in samples. Other keyword arguments go to synthesize_vowel.
+    """
+    rng = np.random.default_rng(seed)
+    parts = []
+    segments = []
+    start = 0
+
+    for vowel in vowels:
+        level = rng.uniform(*level_range_db)
+        samples = synthesize_vowel(vowel, segment_duration, sample_rate, level_db=level,
+                                   seed=int(rng.integers(2 ** 32)), **kwargs)
+        formants = VOWEL_FORMANTS[vowel] if isinstance(vowel, str) else tuple(vowel)
+        segments.append((vowel, start, start + len(samples), formants[0], formants[1]))
+        parts.append(samples)
+        start += len(samples)
+
+    return np.concatenate(parts) if parts else np.zeros(0, dtype=np.float32), segments
+
+
+def frame_targets(segments, num_frames, hop, frame_size):
+    """
+    Ground truth per analysis frame: vowel labels and target F1/F2.
+
+    Frames overlapping two segments get label None and NaN targets.
+    """
+    labels = [None] * num_frames
+    f1 = np.full(num_frames, np.nan)
+    f2 = np.full(num_frames, np.nan)
+
+    for vowel, start, end, target1, target2 in segments:
+        first = -(-start // hop)
+        last = (end - frame_size) // hop
+        for frame in range(first, min(last + 1, num_frames)):
+            labels[frame] = vowel
+            f1[frame] = target1
+            f2[frame] = target2
+
+    return labels, f1, f2
@@ -21,6 +21,32 @@
 #include <vector>
 #include <numeric>
 #include <algorithm>
+#include <atomic>
+#include <mutex>
+#include <thread>
+#include <cstdint>
+#include <chrono>
+#include <stdexcept>
+#include <string>
+#include <map>
+#include <tuple>
+#include <optional>
+#include <memory>
+#include <exception>
+#include <condition_variable>
+#include <deque>
+#include <cstdarg>
+#include <cerrno>
+
+#include <poll.h>
+#include <fcntl.h>
+#include <unistd.h>
+#include <sys/stat.h>
+#include <sys/mman.h>
+#include <dirent.h>
+#ifdef __linux__
+#include <sys/eventfd.h>
+#endif
 
 #include <python3.12/Python.h>
 #include <fftw3.h>
@@ -33,9 +59,12 @@
 //
 // ---------------------------------------------------------------------------------
 
+// Defaults of AnalysisConfig, every detector can override them at runtime
 #define SAMPLE_RATE 44100.0
 #define FRAMES_PER_BUFFER 4096
 #define NUM_CHANNELS 1
+// Channels one detector analyzes together from one stream
+#define MAX_STREAM_CHANNELS 64
 
 #define SPECTRO_FREQ_START 20
 #define SPECTRO_FREQ_END 20000
@@ -45,12 +74,87 @@
 
 #define FORMANT_ACCURACY 150
 
+#define SPEECH_FREQ_START 300
+#define SPEECH_FREQ_END 3200
+#define STRONG_PEAK_RATIO 0.7
+// Finest zoomed analysis, in bins per FFT bin
+#define MAX_ZOOM 64
+
+#define EXTRACT_BATCH_FRAMES 32
+
+// Defaults of the voice-activity gate (AnalysisConfig::gate)
+#define GATE_OPEN_DB -45.0
+#define GATE_CLOSE_DB -55.0
+#define GATE_MAX_ZERO_CROSSINGS 3000.0
+#define GATE_HANGOVER_FRAMES 2
+// Pitch range searched for the harmonicity, in Hz
+#define GATE_PITCH_MIN 60.0
+#define GATE_PITCH_MAX 400.0
+
+#define FORMANT_HISTORY_SIZE 1024
+#define SAMPLE_RING_FRAMES 16
+
+// Smoothed spectra handed out by get_spectrum: one published, one being written and
+// the rest for readers still holding older ones
+#define SPECTRUM_SLOTS 4
+// Shared-memory spectrogram, see SharedSpectrogram
+#define SPECTROGRAM_MAGIC "VRSPEC"
+#define SPECTROGRAM_VERSION 1
+#define SPECTROGRAM_HEADER_SIZE 64
+#define SPECTROGRAM_ROWS 512
+// Capture recordings, see CaptureRecorder
+#define RECORDING_MAGIC "VRREC"
+#define RECORDING_VERSION 1
+#define RECORDING_HEADER_SIZE 128
+#define RECORDING_SEGMENT_SECONDS 10.0
+#define RECORDING_SEGMENTS 6
+// Analysis steps the recorder's writer may fall behind before input is dropped
+#define RECORDING_BLOCKS 64
+
+#define WISDOM_FILE_ENV "FORMANT_WISDOM_FILE"
+
+// Timing histograms: TIMING_BUCKETS - 1 bounded buckets (see timingBucketBounds) and
+// one for everything slower
+#define TIMING_BUCKETS 16
+// Weight of the newest frame in the moving average of the analysis load
+#define LOAD_SMOOTHING 0.05
+
 // ---------------------------------------------------------------------------------
 // 
 // Structures and Types
 //
 // ---------------------------------------------------------------------------------
 
+struct AnalysisConfig {
+    double sampleRate = SAMPLE_RATE;
+    int frameSize = FRAMES_PER_BUFFER;
+    double freqStart = SPECTRO_FREQ_START;
+    double freqEnd = SPECTRO_FREQ_END;
+    int kernelRadius = RADIUS_OF_THE_KERNEL;
+    double standardDeviation = STANDARD_DEVIATION;
+    unsigned planRigor = FFTW_ESTIMATE;
+    std::string wisdomFile;  // empty: keep wisdom in memory only
+    // Keep every decimation-th sample after an anti-aliasing lowpass, the FFT then has
+    // frameSize / decimation points at the same bin spacing. 1 analyzes every sample.
+    int decimation = 1;
+    // Above 1, only the speech band is transformed, by a chirp-z transform of the frame
+    // at zoom times the FFT's frequency resolution. The kernel keeps its width in Hz.
+    int zoom = 1;
+    // Places each formant between bins with a parabola through its peak and neighbours
+    bool interpolate = false;
+    // Voice-activity gate, only frames that pass it are transformed and analyzed. It
+    // opens on a frame at least gateOpenDb loud (RMS, dBFS) with at most
+    // gateMaxZeroCrossings per second and, when gateMinHarmonicity > 0, at least that
+    // much normalized autocorrelation at a pitch lag. It closes after more than
+    // gateHangover frames in a row below gateCloseDb or above the zero-crossing limit.
+    bool gate = false;
+    double gateOpenDb = GATE_OPEN_DB;
+    double gateCloseDb = GATE_CLOSE_DB;
+    double gateMaxZeroCrossings = GATE_MAX_ZERO_CROSSINGS;
+    double gateMinHarmonicity = 0.0;
+    int gateHangover = GATE_HANGOVER_FRAMES;
+};
+
 struct FrequencyMagnitude {
     double frequency;
     double magnitude;
@@ -68,6 +172,130 @@ typedef struct {
 struct Formants {
     double f1;
     double f2;
+    double magnitude;
+};
+
+// Stream time of the sample at a given ring position, refreshed by every callback, and
+// when that callback ran on the steady clock, which every device and source shares
+struct SampleClock {
+    uint64_t position;
+    double time;
+    uint64_t receivedNs;
+};
+
+// Stages timed for every frame, in the order of StreamStats::stages
+enum TimingStage {
+    STAGE_CALLBACK,     // the PortAudio callback, not timed for file, buffer and generator sources
+    STAGE_DECIMATE,     // the decimation lowpass, when decimation > 1
+    STAGE_GATE,         // level, zero crossings and harmonicity of the voice-activity gate
+    STAGE_FFT,          // the FFT, or with zoom the chirp-z transform
+    STAGE_SMOOTHING,    // magnitude and Gaussian smoothing
+    STAGE_DERIVATIVE,
+    STAGE_PEAKS,        // peak picking and the choice of F1/F2
+    STAGE_CLASSIFY,     // the loaded vowel model, when there is one
+    STAGE_FRAME,        // everything the analysis thread does for one frame
+    STAGE_COUNT
+};
+
+extern const char* const timingStageNames[STAGE_COUNT];
+extern const double timingBucketBounds[TIMING_BUCKETS - 1];
+
+// Nanoseconds spent in each analyzer stage of one frame
+struct StageTimings {
+    uint64_t smoothing;
+    uint64_t derivative;
+    uint64_t peaks;
+    uint64_t transform;  // the chirp-z transform of a zoomed analysis
+};
+
+struct TimingSnapshot {
+    uint64_t count;
+    uint64_t totalNs;
+    uint64_t maxNs;
+    uint64_t buckets[TIMING_BUCKETS];
+    // Upper bound of the bucket holding quantile q, in microseconds (capped at the maximum)
+    double quantile(double q) const;
+};
+
+struct StreamStats {
+    uint64_t callbacks;
+    uint64_t overruns;
+    uint64_t droppedSamples;
+    uint64_t droppedFrames;
+    uint64_t frames;
+    uint64_t backlogSamples;
+    uint64_t inputOverflows;
+    uint64_t inputUnderflows;
+    uint64_t framesWithoutFormants;
+    uint64_t gatedFrames;
+    // Analysis time per frame over the time between frames (hop / sample rate): the
+    // moving average and the worst frame. Above 1 the analysis falls behind.
+    double load;
+    double peakLoad;
+    TimingSnapshot stages[STAGE_COUNT];
+};
+
+// One analyzed buffer as published to Python, f1 = f2 = 0 when no formants were found.
+// vowel indexes the labels of the loaded VowelClassifier, -1 without a model or formants.
+// level is the RMS of the frame in dBFS, voiced whether the gate let it through (always
+// true without a gate).
+struct FormantFrame {
+    double f1;
+    double f2;
+    double magnitude;
+    double time;
+    uint64_t index;
+    int32_t vowel;
+    float confidence;
+    float level;
+    bool voiced;
+    // Input channel the frame was analyzed from, see AudioSource::input_channels
+    uint16_t channel;
+};
+
+// A frame drained from a DetectorGroup, tagged with the position of its detector
+struct GroupFrame {
+    int32_t detector;
+    double f1;
+    double f2;
+    double magnitude;
+    double time;
+    // The stream time on the steady clock, in seconds. Stream times of different devices
+    // come from unrelated clocks, this one orders the frames of a group.
+    double received;
+    uint64_t index;
+    int32_t vowel;
+    float confidence;
+    float level;
+    bool voiced;
+};
+
+// The last vowel the analysis thread decided on, and the classifier that decided it
+struct VowelDecision {
+    uint64_t model;
+    int32_t vowel;
+    double confidence;
+    double time;
+};
+
+// One DetectorGroup member: an input device and the channel to analyze on it
+struct GroupInput {
+    int device;
+    int channel;
+};
+
+// One PortAudio device as its host reported it, see audioDevices
+struct AudioDevice {
+    int index;
+    std::string name;
+    std::string hostApi;
+    int maxInputChannels;
+    int maxOutputChannels;
+    double defaultSampleRate;
+    double defaultLowInputLatency;
+    double defaultHighInputLatency;
+    bool defaultInput;
+    bool defaultOutput;
 };
 
 // ---------------------------------------------------------------------------------
@@ -76,31 +304,748 @@ struct Formants {
 //
 // ---------------------------------------------------------------------------------
 
+// Single writer, any number of readers. A reader retries while the writer is in the
+// middle of a store, so it never sees half of an old value and half of a new one.
+template <typename T>
+class SeqLock {
+private:
+    std::atomic<unsigned> sequence{0};
+    T value{};
+public:
+    void store(const T& newValue) {
+        unsigned seq = sequence.load(std::memory_order_relaxed);
+        sequence.store(seq + 1, std::memory_order_relaxed);
+        std::atomic_thread_fence(std::memory_order_release);
+        value = newValue;
+        sequence.store(seq + 2, std::memory_order_release);
+    }
+
+    T load() const {
+        T result;
+        unsigned before, after;
+        do {
+            before = sequence.load(std::memory_order_acquire);
+            result = value;
+            std::atomic_thread_fence(std::memory_order_acquire);
+            after = sequence.load(std::memory_order_relaxed);
+        } while (before != after || (before & 1));
+        return result;
+    }
+
+    bool empty() const {
+        return sequence.load(std::memory_order_acquire) == 0;
+    }
+};
+
+// Durations recorded by one thread, read by any. Relaxed counters: a snapshot taken
+// while a duration is recorded may miss that one duration.
+class TimingHistogram {
+private:
+    std::atomic<uint64_t> buckets[TIMING_BUCKETS];
+    std::atomic<uint64_t> count{0};
+    std::atomic<uint64_t> totalNs{0};
+    std::atomic<uint64_t> maxNs{0};
+public:
+    TimingHistogram();
+    void record(uint64_t ns);
+    TimingSnapshot snapshot() const;
+};
+
+// Single-producer/single-consumer history of analyzed frames. The audio thread pushes,
+// the Python side drains; when the consumer falls behind new frames are dropped and
+// counted rather than blocking the producer.
+class FormantRing {
+private:
+    std::vector<FormantFrame> frames;
+    std::atomic<uint64_t> head{0};
+    std::atomic<uint64_t> tail{0};
+    std::atomic<uint64_t> dropped{0};
+    SeqLock<FormantFrame> latestFrame;
+public:
+    explicit FormantRing(size_t capacity = FORMANT_HISTORY_SIZE);
+    void push(const FormantFrame& frame);
+    size_t available() const;
+    size_t drain(FormantFrame* out, size_t maxFrames);
+    bool latest(FormantFrame& frame) const;
+    uint64_t dropped_frames() const;
+};
+
+// Single-producer/single-consumer sample buffer between the audio callback and the
+// analysis worker. A block is written completely or not at all.
+// Positions count frames of one sample per channel. Channels are kept apart, so a
+// writer deinterleaves once and the reader gets each channel contiguous.
+class SampleRing {
+private:
+    size_t capacity;
+    int channels = 1;
+    std::vector<float> samples;
+    std::atomic<uint64_t> head{0};
+    std::atomic<uint64_t> tail{0};
+public:
+    explicit SampleRing(size_t capacity);
+    // Frame i of channel c is data[i * stride + offsets[c]], offsets default to c
+    bool write(const float* data, size_t count, size_t stride = 1, const int* offsets = NULL);
+    // Channel c goes to out + c * channelStride, channelStride defaults to count
+    size_t read(float* out, size_t count, size_t channelStride = 0);
+    size_t available() const;
+    uint64_t written() const;
+    int channel_count() const;
+    void reset(int channels = 1);
+};
+
+// Wakes consumers when new frames are in the history. Backed by an eventfd (a pipe
+// outside Linux) so the audio thread only does one non-blocking write, never takes a
+// lock, and an asyncio loop can watch the same descriptor with add_reader.
+class FrameNotifier {
+private:
+    int readFd;
+    int writeFd;
+public:
+    FrameNotifier();
+    ~FrameNotifier();
+    FrameNotifier(const FrameNotifier&) = delete;
+    FrameNotifier& operator=(const FrameNotifier&) = delete;
+    void notify();
+    void clear();
+    bool wait(double timeoutSeconds);
+    int fd() const;
+};
+
 class Formant {
 private:
-    Formants formants;
+    SeqLock<Formants> formants;
 public:
     void set_formants(double f1, double f2);
     std::vector<double> get_formants();
 };
 
+// The smoothed spectrum of the last analyzed frame, lent to readers without a copy.
+// The analysis thread writes into a slot that is neither published nor held by a
+// reader and then publishes it. A reader pins the published slot until it releases
+// it, so a spectrum never changes while someone looks at it. When every other slot is
+// held the new spectrum is not published.
+class SpectrumBuffer {
+private:
+    size_t bins;
+    std::vector<double> data;
+    std::atomic<int> front{-1};
+    std::atomic<int> readers[SPECTRUM_SLOTS];
+    uint64_t frames[SPECTRUM_SLOTS];
+    int writing = -1;
+public:
+    explicit SpectrumBuffer(size_t bins);
+    size_t size() const;
+    // Writer: a free slot to fill, or NULL when readers hold all of them
+    double* begin_write();
+    void publish(uint64_t frame);
+    // Reader: pins the published slot, -1 before the first spectrum
+    int acquire();
+    void release(int slot);
+    const double* slot_data(int slot) const;
+    uint64_t slot_frame(int slot) const;
+};
+
+// Header of a shared-memory spectrogram, followed by capacity rows of rowSize bytes:
+// the frame's stream time (double), its index (uint64) and bins float32 magnitudes.
+// Row k is at (k % capacity). The writer fills a row, then increments rows, so a
+// reader copies rows, reads rows again and keeps those with k > rows - capacity.
+struct SpectrogramHeader {
+    char magic[8];
+    uint32_t version;
+    uint32_t bins;
+    uint32_t capacity;
+    uint32_t rowSize;
+    double sampleRate;
+    double firstHz;       // frequency of the first bin
+    double binHz;         // spacing of the bins
+    std::atomic<uint64_t> rows;
+};
+
+// Rolling spectrogram in POSIX shared memory (shm_open), which other processes map
+// read-only. The segment is removed when the spectrogram is destroyed, readers that
+// still have it mapped keep their mapping.
+class SharedSpectrogram {
+private:
+    std::string name;
+    SpectrogramHeader* header;
+    unsigned char* rows;
+    size_t mappedSize;
+    ino_t inode;
+public:
+    SharedSpectrogram(const std::string& name, size_t bins, size_t capacity,
+                      double sampleRate, double firstHz, double binHz);
+    ~SharedSpectrogram();
+    SharedSpectrogram(const SharedSpectrogram&) = delete;
+    SharedSpectrogram& operator=(const SharedSpectrogram&) = delete;
+    // magnitudes NULL writes a row of zeros (a frame without a spectrum)
+    void write(double time, uint64_t index, const double* magnitudes);
+    const std::string& get_name() const;
+};
+
+// Header of a capture segment file, followed by sampleCapacity float32 input samples
+// from RECORDING_HEADER_SIZE and frameCapacity FormantFrame records (frameRecordSize
+// bytes each) from framesOffset. The samples are contiguous: sample k is stream sample
+// firstSample + k, at startTime + k / sampleRate. samples and frames count what has
+// been written, complete is set once the segment is closed.
+struct RecordingHeader {
+    char magic[8];
+    uint32_t version;
+    uint32_t frameRecordSize;
+    double sampleRate;
+    uint32_t frameSize;
+    uint32_t decimation;
+    uint32_t hop;
+    std::atomic<uint32_t> complete;
+    uint64_t segment;
+    uint64_t firstSample;
+    double startTime;
+    uint64_t sampleCapacity;
+    uint64_t frameCapacity;
+    uint64_t framesOffset;
+    std::atomic<uint64_t> samples;
+    std::atomic<uint64_t> frames;
+};
+
+struct RecorderStats {
+    uint64_t segments;        // segment files opened
+    uint64_t samples;
+    uint64_t frames;
+    uint64_t droppedSamples;  // the writer fell behind the analysis thread
+    uint64_t droppedFrames;
+    uint64_t gaps;            // segments started early because input was missing
+};
+
+// Records a detector's input and frames into a directory of segment files
+// (segment-000001.vrrec, ...) for replay with RecordingSource. The analysis thread
+// hands every step (the block it read and the frame it analyzed) over through a
+// lock-free ring. With live input it never waits: when the writer falls behind, the
+// step is dropped and the next segment starts after the gap. Free-running sources
+// wait for room instead, like they wait for the frame history. A writer thread
+// copies the steps into preallocated, memory-mapped segments of segmentSeconds
+// each, keeping the newest maxSegments (0 keeps all), and rewrites index.json
+// (start time, first sample and counts of every segment kept) whenever a segment is
+// opened or closed.
+class CaptureRecorder {
+private:
+    struct Block {
+        uint64_t position;
+        double time;
+        size_t count;
+        FormantFrame frame;
+    };
+    // A closed segment, as listed in the index
+    struct SegmentInfo {
+        uint64_t number;
+        uint64_t firstSample;
+        double startTime;
+        uint64_t samples;
+        uint64_t frames;
+    };
+    std::string directory;
+    AnalysisConfig config;
+    size_t segmentSamples;
+    size_t maxSegments;
+    std::atomic<int> hop;
+
+    // Producer side, filled by the analysis thread
+    std::vector<float> blockSamples;
+    std::vector<Block> blocks;
+    std::atomic<uint64_t> blockHead{0};
+    std::atomic<uint64_t> blockTail{0};
+    FrameNotifier wake;
+
+    // Writer side
+    std::thread writer;
+    std::atomic<bool> running{false};
+    RecordingHeader* segment = NULL;
+    size_t segmentSize = 0;
+    uint64_t nextSample = 0;
+    std::deque<SegmentInfo> closed;
+    bool failing = false;
+    std::atomic<uint64_t> segmentNumber{0};
+    std::atomic<uint64_t> samplesWritten{0};
+    std::atomic<uint64_t> framesWritten{0};
+    std::atomic<uint64_t> droppedSamples{0};
+    std::atomic<uint64_t> droppedFrames{0};
+    std::atomic<uint64_t> gaps{0};
+    void write_loop();
+    bool write_pending();
+    void write_block(const Block& block, const float* data);
+    void write_frame(const FormantFrame& frame);
+    void report(const std::exception* error);
+    void open_segment(uint64_t position, double time);
+    void close_segment();
+    void write_index();
+    std::string segment_path(uint64_t number) const;
+public:
+    CaptureRecorder(const std::string& directory, const AnalysisConfig& config, int hop,
+                    double segmentSeconds = RECORDING_SEGMENT_SECONDS, size_t maxSegments = RECORDING_SEGMENTS);
+    ~CaptureRecorder();
+    CaptureRecorder(const CaptureRecorder&) = delete;
+    CaptureRecorder& operator=(const CaptureRecorder&) = delete;
+    // Analysis thread: the count input samples (at most frameSize) read for a frame,
+    // starting at stream sample position and stream time time, and the frame
+    void add(const float* data, size_t count, uint64_t position, double time, const FormantFrame& frame);
+    bool has_room() const;
+    void set_hop(int hop);
+    // Writes what is left, closes the last segment and stops the writer
+    void close();
+    RecorderStats get_stats() const;
+    const std::string& get_directory() const;
+};
+
+// Lowpass and downsample by an integer factor. The windowed-sinc lowpass is only
+// evaluated at the kept samples (the polyphase form of decimation), and its history
+// carries over from block to block, so a stream decimated block by block equals the
+// whole signal decimated at once (decimateSignal). Causal: output m is the filter
+// centred (taps - 1) / 2 samples before input sample m * factor.
+class Decimator {
+private:
+    int factor;
+    std::vector<float> taps;
+    std::vector<float> buffer;
+public:
+    Decimator(const AnalysisConfig& config);
+    void reset();
+    // count must be a multiple of the factor and at most frameSize, writes count / factor samples
+    void process(const float* in, size_t count, float* out);
+};
+
+// What the voice-activity gate measured on one frame
+struct GateMeasure {
+    double level;          // RMS in dBFS
+    double zeroCrossings;  // per second
+    double harmonicity;    // peak normalized autocorrelation over pitch lags, 0 when not measured
+};
+
+// Voice-activity gate with hysteresis, fed the time-domain frames in order. Cheap
+// measures first: the harmonicity (an autocorrelation over the pitch lags, computed
+// with two FFTs of twice the frame size) is only computed when enabled and level and
+// zero crossings passed.
+class VoiceGate {
+private:
+    AnalysisConfig config;
+    std::vector<double> energies;
+    int minLag;
+    int maxLag;
+    bool open;
+    int failed;
+    // Autocorrelation, only allocated when the harmonicity is used
+    fftw_plan plan;
+    double* spectrum;
+    double* correlation;
+public:
+    explicit VoiceGate(const AnalysisConfig& config);
+    ~VoiceGate();
+    VoiceGate(const VoiceGate&) = delete;
+    VoiceGate& operator=(const VoiceGate&) = delete;
+    // Measures the frame (frameSize samples) and returns whether it is analyzed
+    bool update(const float* frame, GateMeasure& measure);
+    void reset();
+};
+
+// Magnitudes of a real frame at bins frequencies, spacing Hz apart from start Hz. The
+// DTFT at those points is a convolution with a chirp (Bluestein), done with two complex
+// FFTs of a fast size at least frameSize + bins - 1, however fine the spacing.
+class ChirpZ {
+private:
+    int frameSize;
+    int bins;
+    int size;
+    fftw_plan forward;
+    fftw_plan backward;
+    fftw_complex* premultiply;   // the frame's modulation and chirp
+    fftw_complex* chirpSpectrum; // transform of the conjugate chirp, scaled by 1 / size
+    fftw_complex* work;
+public:
+    ChirpZ(int frameSize, double sampleRate, double start, double spacing, int bins,
+           unsigned rigor, const std::string& wisdomFile);
+    ~ChirpZ();
+    ChirpZ(const ChirpZ&) = delete;
+    ChirpZ& operator=(const ChirpZ&) = delete;
+    // frame holds frameSize samples, magnitudes receives bins values
+    void transform(const double* frame, double* magnitudes);
+};
+
+// Runs the smoothing and peak-picking chain of the stream callback on an FFTW
+// half-complex spectrum, or with zoom on the frame itself. The scratch buffers are
+// allocated once in the constructor, so one analyzer can be reused for any number of
+// frames (one per thread).
+class FormantAnalyzer {
+private:
+    AnalysisConfig config;
+    int startIndex;
+    int spectralSize;
+    int halfSize;
+    // Bin i is at gridStart + i * gridSpacing Hz. Without zoom or interpolation the bins
+    // keep their historical labels, rounded to the Hz, and a peak is labelled with the
+    // bin before it.
+    double gridStart;
+    double gridSpacing;
+    bool labelled;
+    int radius;
+    std::unique_ptr<ChirpZ> chirpZ;
+    std::vector<double> kernel;
+    std::vector<double> absolouteResult;
+    std::vector<double> smoothed;
+    std::vector<double> firstDif;
+    std::vector<FrequencyMagnitude> speechPeaks;
+    int numSpeechPeaks;
+    // Candidate peaks in the speech band, and the bins they depend on
+    int firstPeak;
+    int lastPeak;
+    int firstBin;
+    int lastBin;
+public:
+    explicit FormantAnalyzer(const AnalysisConfig& config);
+    // timings, when given, receives the time spent in each stage
+    bool analyze(const double* spectrum, Formants& result, StageTimings* timings = NULL);
+    // With zoom, analyzes the frame (frameSize samples) instead of its spectrum
+    bool analyze_frame(const double* frame, Formants& result, StageTimings* timings = NULL);
+    bool zoomed() const;
+    // The smoothed magnitudes of the speech band from the last analyze()
+    const double* band() const;
+    int band_size() const;
+    double band_frequency(int bin) const;
+    double band_spacing() const;
+private:
+    bool find_formants(Formants& result, StageTimings* timings, uint64_t start);
+};
+
+// Everything the callback touches is allocated here, once per stream, so the audio
+// thread never allocates, locks or does I/O. It only copies samples into the ring
+// and wakes the analysis worker, which does the FFT and peak picking.
 struct CallbackState {
-    streamCallbackData* spectroData;
-    Formant* formant;
+    SampleRing* samples;
+    FrameNotifier* sampleNotifier;
+    FrameNotifier* spaceNotifier;
+    SeqLock<SampleClock>* clock;
+    // Samples per interleaved input frame, and the offsets of the analyzed channels in it
+    int channelCount;
+    std::vector<int> channels;
+    // Set by free-running sources, which wait for room in the ring and history
+    // instead of dropping samples or frames
+    bool backpressure;
+    std::atomic<bool> finished{false};
+    std::atomic<uint64_t> callbacks{0};
+    std::atomic<uint64_t> overruns{0};
+    std::atomic<uint64_t> droppedSamples{0};
+    std::atomic<uint64_t> inputOverflows{0};
+    std::atomic<uint64_t> inputUnderflows{0};
+    TimingHistogram callbackTime;
+};
+
+// Where a detector's samples come from. A source writes blocks of mono samples to the
+// callback state, the same way the PortAudio callback does, so every source feeds the
+// same ring, analysis thread and frame history. A source that runs out sets finished.
+class AudioSource {
+public:
+    virtual ~AudioSource() = default;
+    virtual void start(CallbackState* state, const AnalysisConfig& config, int framesPerBuffer) = 0;
+    virtual void stop() = 0;
+    virtual std::string error() const;
+    // The channels analyzed, in the order the source writes them to the ring
+    virtual std::vector<int> input_channels() const;
+};
+
+// Live input from one or more channels of a PortAudio device, in one stream
+class PortAudioSource : public AudioSource {
+private:
+    int device;
+    std::vector<int> channels;
+    PaStream* stream = NULL;
+public:
+    explicit PortAudioSource(int device, int channel = 0);
+    PortAudioSource(int device, const std::vector<int>& channels);
+    ~PortAudioSource();
+    void start(CallbackState* state, const AnalysisConfig& config, int framesPerBuffer) override;
+    void stop() override;
+    std::vector<int> input_channels() const override;
+    int get_device() const;
+    int get_channel() const;
+};
+
+// Keeps PortAudio initialized while it is open, so that detectors created and destroyed
+// meanwhile do not each run Pa_Initialize, which probes every host and device
+class AudioSession {
+private:
+    bool open;
+public:
+    AudioSession();
+    ~AudioSession();
+    AudioSession(const AudioSession&) = delete;
+    AudioSession& operator=(const AudioSession&) = delete;
+    void close();
+    bool is_open() const;
+    std::vector<AudioDevice> devices(bool refresh = false) const;
+};
+
+// Base of the sources that are not driven by an audio device: a feeder thread pulls
+// blocks with read_block() and writes them to the ring. Paced sources deliver them at
+// the sample rate and drop on overrun like a device; free-running ones wait for room
+// instead and go as fast as the analysis thread does. Stream time counts samples from
+// the start of the source.
+class FeederSource : public AudioSource {
+private:
+    bool realtime;
+    std::thread feeder;
+    std::atomic<bool> running{false};
+    CallbackState* state = NULL;
+    double sampleRate = SAMPLE_RATE;
+    int blockSize = FRAMES_PER_BUFFER;
+    int blockChannels = 1;
+    mutable std::mutex errorMutex;
+    std::string lastError;
+    void feed_loop();
+protected:
+    // open() rewinds to the first sample, read_block() returns 0 at the end. Blocks
+    // interleave one sample of every input channel per frame.
+    virtual void open(const AnalysisConfig& config) = 0;
+    virtual size_t read_block(float* out, size_t maxFrames) = 0;
+    virtual void close();
+    void fail(const std::string& message);
+    // Stream time of the first sample after open()
+    virtual double start_time() const;
+public:
+    explicit FeederSource(bool realtime);
+    void start(CallbackState* state, const AnalysisConfig& config, int framesPerBuffer) override;
+    void stop() override;
+    std::string error() const override;
+    bool is_realtime() const;
+};
+
+// A WAV file (PCM 8/16/24/32 bit or float) or raw native-endian float32 samples,
+// read a block at a time. "auto" tells the two apart by the RIFF header.
+class FileSource : public FeederSource {
+private:
+    std::string path;
+    std::string format;
+    int channels;
+    std::vector<int> channelList;
+    FILE* file = NULL;
+    int formatTag = 3;
+    int bytesPerSample = 4;
+    int fileChannels = 1;
+    uint64_t remainingBytes = 0;
+    std::vector<unsigned char> raw;
+protected:
+    void open(const AnalysisConfig& config) override;
+    size_t read_block(float* out, size_t maxFrames) override;
+    void close() override;
+public:
+    FileSource(const std::string& path, const std::string& format = "auto", int channels = 1, int channel = 0, bool realtime = false);
+    FileSource(const std::string& path, const std::string& format, int channels, const std::vector<int>& channelList, bool realtime);
+    ~FileSource();
+    std::vector<int> input_channels() const override;
+    const std::string& get_path() const;
+};
+
+// Samples already in memory, copied once when the source is created
+class BufferSource : public FeederSource {
+private:
+    std::vector<float> samples;
+    size_t position = 0;
+protected:
+    void open(const AnalysisConfig& config) override;
+    size_t read_block(float* out, size_t maxSamples) override;
+public:
+    BufferSource(const float* samples, size_t count, bool realtime = false);
+    ~BufferSource();
+    size_t size() const;
+};
+
+// Replays the segments of a CaptureRecorder directory, mapped read-only, from the
+// first segment reaching past start to end (seconds of stream time, NaN for the
+// whole recording). Replay starts on a frame boundary of the recording and frame
+// times continue from the recorded time of its first sample, so a replay with the
+// recorded hop reproduces the recorded frames (with decimation, all but the first
+// when it starts later than the recording). Gaps between segments are skipped.
+class RecordingSource : public FeederSource {
+private:
+    struct Segment {
+        const RecordingHeader* header;
+        size_t size;
+        uint64_t begin;
+        uint64_t end;
+    };
+    std::string directory;
+    double start;
+    double end;
+    std::vector<Segment> segments;
+    size_t current = 0;
+    uint64_t position = 0;
+    double firstTime = 0.0;
+protected:
+    void open(const AnalysisConfig& config) override;
+    size_t read_block(float* out, size_t maxSamples) override;
+    void close() override;
+    double start_time() const override;
+public:
+    RecordingSource(const std::string& directory, double start = NAN, double end = NAN, bool realtime = false);
+    ~RecordingSource();
+    const std::string& get_directory() const;
+};
+
+#ifdef FORMANT_ALLOCATION_CHECK
+// Test mode (cmake -DFORMANT_ALLOCATION_CHECK=ON): counts heap allocations made
+// while a scope is alive on the current thread. streamCallback opens one per call.
+struct AllocationCheckScope {
+    AllocationCheckScope();
+    ~AllocationCheckScope();
+};
+
+std::vector<long> allocation_check_stats();
+#endif
+
+// A vowel classifier reduced to plain arrays, so the analysis thread labels every frame
+// without Python. Centroid and Gaussian models score each class as
+// offset - (x - mean)' P (x - mean) / 2 with P the inverse covariance (the identity over
+// the pooled variance for centroids); the confidence is the softmax of the scores. Grid
+// models look the answer up in a table of cells over F1 x F2, clamped to the edges.
+// Immutable once built, detectors share one with a shared_ptr.
+class VowelClassifier {
+private:
+    std::string kind;
+    std::vector<std::string> labels;
+    uint64_t id;
+    std::vector<double> means;
+    std::vector<double> precisions;
+    std::vector<double> offsets;
+    double minHz = 0.0;
+    double cellHz = 0.0;
+    int cells = 0;
+    std::vector<uint8_t> grid;
+    std::vector<float> gridConfidences;
+    VowelClassifier(const std::string& kind, const std::vector<std::string>& labels);
+public:
+    static std::shared_ptr<VowelClassifier> centroid(const std::vector<std::string>& labels,
+                                                     const std::vector<double>& means, double variance);
+    static std::shared_ptr<VowelClassifier> gaussian(const std::vector<std::string>& labels,
+                                                     const std::vector<double>& means,
+                                                     const std::vector<double>& precisions,
+                                                     const std::vector<double>& offsets);
+    static std::shared_ptr<VowelClassifier> lookup_grid(const std::vector<std::string>& labels,
+                                                        const std::vector<uint8_t>& grid,
+                                                        const std::vector<float>& confidences,
+                                                        int cells, double minHz, double cellHz);
+    // Index into get_labels() or -1 when there are no formants (f1 or f2 not positive)
+    int classify(double f1, double f2, double& confidence) const;
+    const std::string& get_kind() const;
+    const std::vector<std::string>& get_labels() const;
+    uint64_t get_id() const;
 };
 
 class streamClass {
 private:
-    PaError err;
-    PaStream* stream;
+    std::shared_ptr<AudioSource> source;
+    AnalysisConfig config;
+    streamCallbackData spectroData;
     Formant formant;
-    CallbackState* cbState;
+    FormantRing history;
+    FrameNotifier notifier;
+    std::atomic<bool> streaming{false};
+    std::unique_ptr<CallbackState> cbState;
+
+    // Analysis worker, fed by the callback through the sample ring
+    FormantAnalyzer analyzer;
+    SampleRing samples;
+    // One of each per analyzed channel, the FFT of every channel runs as one plan.
+    // The first channel is the primary one: get_formants, get_vowel, the spectrum
+    // and recordings follow it.
+    std::vector<Decimator> decimators;
+    std::vector<std::unique_ptr<VoiceGate>> gates;
+    std::vector<int> channelNumbers;
+    FrameNotifier sampleNotifier;
+    FrameNotifier spaceNotifier;
+    SeqLock<SampleClock> clock;
+    std::thread analysisThread;
+    std::atomic<bool> analysisRunning{false};
+    std::atomic<uint64_t> frameIndex{0};
+    int hop;
+
+    // Read by the analysis thread for every frame, swapped with std::atomic_store
+    std::shared_ptr<const VowelClassifier> classifier;
+    SeqLock<VowelDecision> vowel;
+
+    // Smoothed spectra for get_spectrum, and the optional shared-memory spectrogram
+    std::shared_ptr<SpectrumBuffer> spectrum;
+    std::shared_ptr<SharedSpectrogram> spectrogram;
+    // Optional capture of the input and frames, see start_recording
+    std::shared_ptr<CaptureRecorder> recorder;
+
+    // Instrumentation, written by the analysis thread
+    TimingHistogram stageTimes[STAGE_COUNT];
+    std::atomic<uint64_t> framesWithoutFormants{0};
+    std::atomic<uint64_t> gatedFrames{0};
+    std::atomic<double> load{0.0};
+    std::atomic<double> peakLoad{0.0};
+
+    // Periodic stats file, see start_stats_dump
+    std::thread dumpThread;
+    std::mutex dumpMutex;
+    std::condition_variable dumpWake;
+    bool dumpRunning = false;
+    void dump_loop(std::string path, double interval, std::string format, std::string name);
+    void analysis_loop();
+    void stop_analysis();
+    void set_channels(const std::vector<int>& channels);
 public:
-    streamClass();
-    void start_stream(int deviceInput = 4);
+    explicit streamClass(const AnalysisConfig& config = AnalysisConfig());
+    ~streamClass();
+    streamClass(const streamClass&) = delete;
+    streamClass& operator=(const streamClass&) = delete;
+    void start_stream(int deviceInput = 4, std::optional<int> hop = std::nullopt, int channel = 0);
+    void start_stream(std::shared_ptr<AudioSource> source, std::optional<int> hop = std::nullopt);
     void stop_stream();
     void print_devices();
     std::vector<double> get_formants();
+    size_t drain(FormantFrame* out, size_t maxFrames);
+    size_t pending_frames() const;
+    bool latest(FormantFrame& frame) const;
+    // Seconds to add to a stream time for the steady-clock time its samples arrived at
+    double receive_offset() const;
+    bool wait_for_frames(double timeoutSeconds);
+    bool is_streaming() const;
+    int notify_fd() const;
+    void clear_notification();
+    StreamStats get_stats() const;
+    const AnalysisConfig& get_config() const;
+    void load_model(std::shared_ptr<const VowelClassifier> model);
+    std::shared_ptr<const VowelClassifier> get_model() const;
+    bool get_vowel(VowelDecision& decision) const;
+    std::string format_stats(const std::string& format, const std::string& name = "") const;
+    void start_stats_dump(const std::string& path, double interval, const std::string& format, const std::string& name = "");
+    void stop_stats_dump();
+    std::shared_ptr<SpectrumBuffer> get_spectrum() const;
+    std::vector<double> spectrum_frequencies() const;
+    void start_spectrogram(const std::string& name, size_t capacity = SPECTROGRAM_ROWS);
+    void stop_spectrogram();
+    std::string spectrogram_name() const;
+    void start_recording(const std::string& directory, double segmentSeconds = RECORDING_SEGMENT_SECONDS,
+                         size_t maxSegments = RECORDING_SEGMENTS);
+    void stop_recording();
+    std::shared_ptr<CaptureRecorder> get_recorder() const;
+};
+
+// Runs one detector per input. Each detector has its own callback and analysis thread,
+// so the inputs are analyzed in parallel on separate cores; their frames are drained
+// together, ordered by the time their samples arrived.
+class DetectorGroup {
+private:
+    std::vector<GroupInput> inputs;
+    std::vector<std::unique_ptr<streamClass>> detectors;
+    std::vector<FormantFrame> scratch;
+public:
+    DetectorGroup(const std::vector<GroupInput>& inputs, const AnalysisConfig& config);
+    void start(std::optional<int> hop = std::nullopt);
+    void stop();
+    size_t size() const;
+    streamClass& detector(size_t i);
+    const GroupInput& input(size_t i) const;
+    size_t pending_frames() const;
+    std::vector<GroupFrame> drain();
+    bool wait_for_frames(double timeoutSeconds);
+    void load_model(std::shared_ptr<const VowelClassifier> model);
 };
 
 // ---------------------------------------------------------------------------------
@@ -111,12 +1056,37 @@ public:
 
 // Helper functions
 void checkError(PaError err);
+void acquirePortAudio();
+void releasePortAudio();
+std::vector<AudioDevice> audioDevices(bool refresh = false);
 inline float max(float a, float b);
 inline float min(float a, float b);
 inline bool isPositive(double a);
 inline int clamp(int value, int min, int max);
-double G(int x);
-std::vector<double> computeKernelFilter();
+double G(int x, double standardDeviation);
+std::vector<double> computeKernelFilter(int radius, double standardDeviation);
+void validateConfig(const AnalysisConfig& config);
+AnalysisConfig analyzedConfig(const AnalysisConfig& config);
+std::vector<float> decimationFilter(int factor, double sampleRate);
+std::vector<float> decimateSignal(const float* samples, size_t numSamples, const AnalysisConfig& config);
+std::mutex& fftwPlannerMutex();
+
+// FFTW plan cache
+std::string defaultWisdomFile();
+unsigned planRigorFromName(const std::string& name);
+std::string planRigorName(unsigned rigor);
+fftw_plan cachedR2HCPlan(int n, int howmany, unsigned rigor, const std::string& wisdomFile);
+fftw_plan cachedDFTPlan(int n, int sign, unsigned rigor, const std::string& wisdomFile);
+int fastTransformSize(int minimum);
+
+// Stats export
+std::string statsToJson(const StreamStats& stats);
+std::string statsToPrometheus(const StreamStats& stats, const std::string& name);
+void writeFileAtomically(const std::string& path, const std::string& contents);
+
+// Offline analysis
+size_t extractFrameCount(size_t numSamples, int hop, int frameSize);
+void extractFormants(const float* samples, size_t numSamples, int hop, int numThreads, const AnalysisConfig& config, double* result);
 
 // Callback function
 int streamCallback(
@@ -41,10 +41,14 @@ class CMakeBuild(build_ext):
   # your setup script
   build_flag = os.environ.get("DEBUG_BUILD", "0")
   cfg = "Debug" if build_flag == "1" else "Release"
+  # export ALLOCATION_CHECK=1 to build the test mode that counts heap
+  # allocations made inside the stream callback
+  allocation_check = os.environ.get("ALLOCATION_CHECK", "0")
   cmake_args = [
    f"-DCMAKE_LIBRARY_OUTPUT_DIRECTORY={extdir}",
    f"-DPYTHON_EXECUTABLE={sys.executable}",
    f"-DCMAKE_BUILD_TYPE={cfg}",
+   f"-DFORMANT_ALLOCATION_CHECK={'ON' if allocation_check == '1' else 'OFF'}",
   ]
   os.makedirs(self.build_temp, exist_ok=True)
   subprocess.check_call(
@@ -65,7 +69,7 @@ setup(
  long_description="A Python module for real-time formant frequency detection from audio input using FFT analysis and peak detection algorithms.",
  license="MIT",
  url="https://github.com/tickymaster/VRecog",
- packages=find_packages(exclude=[]),
+ packages=find_packages(exclude=["benchmarks", "benchmarks.*"]),
  package_data={"formant_detector": ["./../VERSION"]},
  install_requires=[
      "numpy",
@@ -2,24 +2,811 @@
 
 #include <pybind11/pybind11.h>
 #include <pybind11/stl.h>
+#include <pybind11/numpy.h>
+#include <pybind11/functional.h>
 
 #include "formant_module.h"
 
 namespace py = pybind11;
 
+// Keyword arguments of the AnalysisConfig, shared by every constructor taking one
+#define CONFIG_ARGS \
+    py::arg("sample_rate") = SAMPLE_RATE, py::arg("frame_size") = FRAMES_PER_BUFFER, \
+    py::arg("freq_start") = SPECTRO_FREQ_START, py::arg("freq_end") = SPECTRO_FREQ_END, \
+    py::arg("kernel_radius") = RADIUS_OF_THE_KERNEL, py::arg("sigma") = STANDARD_DEVIATION, \
+    py::arg("planning") = "estimate", py::arg("wisdom_file") = py::none(), py::arg("decimation") = 1, \
+    py::arg("zoom") = 1, py::arg("interpolate") = false, py::arg("gate") = py::none()
+
+typedef py::array_t<float, py::array::c_style | py::array::forcecast> SampleArray;
+
+// Every frame analyzed since the previous call, as a structured array with the
+// fields of FormantFrame: f1, f2, magnitude, time, index, vowel, confidence, level,
+// voiced and channel
+static py::array_t<FormantFrame> drain(streamClass& detector) {
+    py::array_t<FormantFrame> frames(detector.pending_frames());
+    size_t count = detector.drain(frames.mutable_data(), frames.size());
+    frames.resize({(py::ssize_t)count});
+    return frames;
+}
+
+// The channels of a source: one channel number, or a sequence of them
+static std::vector<int> channel_list(py::object channel) {
+    if (py::isinstance<py::int_>(channel))
+        return {channel.cast<int>()};
+    return channel.cast<std::vector<int>>();
+}
+
+static py::object frame_scalar(const FormantFrame& frame) {
+    return py::array_t<FormantFrame>(1, &frame)[py::int_(0)];
+}
+
+// The most recent frame as a structured scalar, None before the first frame
+static py::object latest(const streamClass& detector) {
+    FormantFrame frame;
+    if (!detector.latest(frame))
+        return py::none();
+    return frame_scalar(frame);
+}
+
+// The smoothed spectrum of the last analyzed frame, as a read-only view of the
+// detector's buffer. The view pins its slot, the detector writes later spectra to
+// other slots until the array is released. None before the first voiced frame.
+static py::object get_spectrum(const streamClass& detector) {
+    std::shared_ptr<SpectrumBuffer> buffer = detector.get_spectrum();
+    int slot = buffer->acquire();
+    if (slot < 0)
+        return py::none();
+
+    // The capsule keeps the buffer alive even if the detector goes away first
+    auto* pin = new std::pair<std::shared_ptr<SpectrumBuffer>, int>(buffer, slot);
+    py::capsule owner(pin, [](void* p) {
+        auto* pin = static_cast<std::pair<std::shared_ptr<SpectrumBuffer>, int>*>(p);
+        pin->first->release(pin->second);
+        delete pin;
+    });
+    py::array_t<double> view({(py::ssize_t)buffer->size()}, {(py::ssize_t)sizeof(double)},
+                             buffer->slot_data(slot), owner);
+    py::detail::array_proxy(view.ptr())->flags &= ~py::detail::npy_api::NPY_ARRAY_WRITEABLE_;
+    return std::move(view);
+}
+
+// Runs waitFor(slice) with the GIL released until it succeeds, the timeout (None:
+// forever) expires or running() turns false. Waits in short slices so Ctrl+C still works.
+static bool wait_with_signals(py::object timeout, const std::function<bool(double)>& waitFor,
+                              const std::function<bool()>& running) {
+    const double slice = 0.2;
+    double remaining = timeout.is_none() ? -1.0 : timeout.cast<double>();
+
+    while (true) {
+        double wait = remaining < 0 ? slice : std::min(remaining, slice);
+        bool ready;
+        {
+            py::gil_scoped_release release;
+            ready = waitFor(wait);
+        }
+        if (ready)
+            return true;
+        if (PyErr_CheckSignals() != 0)
+            throw py::error_already_set();
+        if (!running())
+            return false;
+        if (remaining >= 0) {
+            remaining -= wait;
+            if (remaining <= 0)
+                return false;
+        }
+    }
+}
+
+// Blocks until the next frame arrives and returns it, None on timeout or once the
+// stream has stopped
+static py::object wait_next(streamClass& detector, py::object timeout) {
+    bool ready = wait_with_signals(
+        timeout,
+        [&detector](double wait) { return detector.wait_for_frames(wait); },
+        [&detector]() { return detector.is_streaming(); });
+    if (!ready)
+        return py::none();
+
+    FormantFrame frame;
+    detector.drain(&frame, 1);
+    return frame_scalar(frame);
+}
+
+// Async iterator returned by FormantDetector.frames(). Frames are drained in batches;
+// when none are pending, __anext__ returns a future completed by an add_reader
+// callback on the detector's notification descriptor.
+class AsyncFrameIterator {
+private:
+    py::object owner;
+    streamClass& detector;
+    py::array_t<FormantFrame> batch;
+    size_t position = 0;
+
+    bool next_frame(FormantFrame& frame) {
+        if (position >= (size_t)batch.size()) {
+            batch = drain(detector);
+            position = 0;
+        }
+        if (position >= (size_t)batch.size())
+            return false;
+        frame = batch.data()[position++];
+        return true;
+    }
+
+    // Completes future with the next frame or StopAsyncIteration, false if still waiting
+    bool resolve(py::object future) {
+        FormantFrame frame;
+        if (next_frame(frame)) {
+            future.attr("set_result")(frame_scalar(frame));
+            return true;
+        }
+        if (!detector.is_streaming()) {
+            future.attr("set_exception")(py::reinterpret_borrow<py::object>(PyExc_StopAsyncIteration));
+            return true;
+        }
+        return false;
+    }
+
+public:
+    explicit AsyncFrameIterator(py::object detectorObject)
+        : owner(detectorObject), detector(detectorObject.cast<streamClass&>()), batch(0) {}
+
+    static py::object anext(py::object self) {
+        AsyncFrameIterator& it = self.cast<AsyncFrameIterator&>();
+        py::object loop = py::module_::import("asyncio").attr("get_running_loop")();
+        py::object future = loop.attr("create_future")();
+        if (it.resolve(future))
+            return future;
+
+        // The callback holds self so the iterator outlives any pending wait
+        int fd = it.detector.notify_fd();
+        py::object onReadable = py::cpp_function([self, loop, future, fd]() {
+            AsyncFrameIterator& it = self.cast<AsyncFrameIterator&>();
+            it.detector.clear_notification();
+            if (future.attr("done")().cast<bool>() || it.resolve(future))
+                loop.attr("remove_reader")(fd);
+        });
+        loop.attr("add_reader")(fd, onReadable);
+        future.attr("add_done_callback")(py::cpp_function([loop, fd](py::object) {
+            loop.attr("remove_reader")(fd);
+        }));
+        return future;
+    }
+};
+
+// Pulls chunks of samples from a Python iterable on the feeder thread, holding the GIL
+// only while it calls into Python. A new iterator is taken from the iterable on every start.
+class GeneratorSource : public FeederSource {
+private:
+    py::object iterable;
+    py::object iterator;
+    std::vector<float> chunk;
+    size_t position = 0;
+
+protected:
+    void open(const AnalysisConfig&) override {
+        py::gil_scoped_acquire gil;
+        iterator = py::iter(iterable);
+        chunk.clear();
+        position = 0;
+    }
+
+    size_t read_block(float* out, size_t maxSamples) override {
+        size_t count = 0;
+        while (count < maxSamples) {
+            if (position == chunk.size()) {
+                py::gil_scoped_acquire gil;
+                try {
+                    PyObject* item = PyIter_Next(iterator.ptr());
+                    if (item == NULL) {
+                        if (PyErr_Occurred())
+                            throw py::error_already_set();
+                        break;
+                    }
+                    SampleArray samples(py::reinterpret_steal<py::object>(item));
+                    chunk.assign(samples.data(), samples.data() + samples.size());
+                    position = 0;
+                } catch (const std::exception& e) {
+                    fail(e.what());
+                    break;
+                }
+                continue;
+            }
+            size_t take = std::min(maxSamples - count, chunk.size() - position);
+            std::copy(chunk.begin() + position, chunk.begin() + position + take, out + count);
+            position += take;
+            count += take;
+        }
+        return count;
+    }
+
+    void close() override {
+        py::gil_scoped_acquire gil;
+        iterator = py::object();
+    }
+
+public:
+    GeneratorSource(py::iterable iterable, bool realtime) : FeederSource(realtime), iterable(iterable) {}
+
+    ~GeneratorSource() {
+        stop();
+    }
+
+    // The feeder needs the GIL to finish its current chunk, so never join it holding the GIL
+    void stop() override {
+        if (PyGILState_Check()) {
+            py::gil_scoped_release release;
+            FeederSource::stop();
+        } else {
+            FeederSource::stop();
+        }
+    }
+};
+
+// gate=None or False leaves the voice-activity gate off, True turns it on with the
+// defaults and a dict turns it on with some of them replaced
+static void apply_gate(AnalysisConfig& config, py::handle gate) {
+    if (gate.is_none())
+        return;
+    if (py::isinstance<py::bool_>(gate)) {
+        config.gate = gate.cast<bool>();
+        return;
+    }
+    if (!py::isinstance<py::dict>(gate))
+        throw std::invalid_argument("gate must be None, a bool or a dict of settings");
+    config.gate = true;
+    for (auto item : gate.cast<py::dict>()) {
+        std::string key = py::str(item.first);
+        if (key == "open_db")
+            config.gateOpenDb = item.second.cast<double>();
+        else if (key == "close_db")
+            config.gateCloseDb = item.second.cast<double>();
+        else if (key == "max_zero_crossings")
+            config.gateMaxZeroCrossings = item.second.cast<double>();
+        else if (key == "harmonicity")
+            config.gateMinHarmonicity = item.second.cast<double>();
+        else if (key == "hangover")
+            config.gateHangover = item.second.cast<int>();
+        else
+            throw std::invalid_argument("Unknown gate setting '" + key + "', expected open_db, close_db, "
+                                        "max_zero_crossings, harmonicity or hangover");
+    }
+}
+
+// Builds the AnalysisConfig from CONFIG_ARGS. Wisdom is only written to a file that is
+// given, or named by $FORMANT_WISDOM_FILE; wisdom_file=None or "" keeps it in memory.
+static AnalysisConfig make_config(double sample_rate, int frame_size, double freq_start, double freq_end,
+                                  int kernel_radius, double sigma, const std::string& planning,
+                                  std::optional<std::string> wisdom_file, int decimation,
+                                  int zoom, bool interpolate, py::object gate) {
+    AnalysisConfig config;
+    config.sampleRate = sample_rate;
+    config.frameSize = frame_size;
+    config.freqStart = freq_start;
+    config.freqEnd = freq_end;
+    config.kernelRadius = kernel_radius;
+    config.standardDeviation = sigma;
+    config.planRigor = planRigorFromName(planning);
+    const char* environment = getenv(WISDOM_FILE_ENV);
+    config.wisdomFile = wisdom_file.value_or(environment != NULL ? environment : "");
+    config.decimation = decimation;
+    config.zoom = zoom;
+    config.interpolate = interpolate;
+    apply_gate(config, gate);
+    validateConfig(config);
+    return config;
+}
+
+static py::dict config_dict(const AnalysisConfig& config) {
+    py::dict result;
+    result["sample_rate"] = config.sampleRate;
+    result["frame_size"] = config.frameSize;
+    result["freq_start"] = config.freqStart;
+    result["freq_end"] = config.freqEnd;
+    result["kernel_radius"] = config.kernelRadius;
+    result["sigma"] = config.standardDeviation;
+    result["planning"] = planRigorName(config.planRigor);
+    result["wisdom_file"] = config.wisdomFile;
+    result["decimation"] = config.decimation;
+    result["zoom"] = config.zoom;
+    result["interpolate"] = config.interpolate;
+    if (config.gate) {
+        py::dict gate;
+        gate["open_db"] = config.gateOpenDb;
+        gate["close_db"] = config.gateCloseDb;
+        gate["max_zero_crossings"] = config.gateMaxZeroCrossings;
+        gate["harmonicity"] = config.gateMinHarmonicity;
+        gate["hangover"] = config.gateHangover;
+        result["gate"] = gate;
+    } else {
+        result["gate"] = py::none();
+    }
+    return result;
+}
+
+static py::dict get_config(const streamClass& detector) {
+    return config_dict(detector.get_config());
+}
+
+// The settings a detector created with CONFIG_ARGS would analyze with, without creating one
+static py::dict analysis_config(double sample_rate, int frame_size, double freq_start, double freq_end,
+                                int kernel_radius, double sigma, const std::string& planning,
+                                std::optional<std::string> wisdom_file, int decimation,
+                                int zoom, bool interpolate, py::object gate) {
+    AnalysisConfig config = make_config(sample_rate, frame_size, freq_start, freq_end,
+                                        kernel_radius, sigma, planning, wisdom_file, decimation,
+                                        zoom, interpolate, gate);
+    validateConfig(config);
+    return config_dict(config);
+}
+
+// Offline formant extraction over a mono float32 signal, one row [F1, F2] per frame
+static py::array_t<double> extract(SampleArray samples, std::optional<int> hop, int threads,
+                                   double sample_rate, int frame_size, double freq_start, double freq_end,
+                                   int kernel_radius, double sigma, const std::string& planning,
+                                   std::optional<std::string> wisdom_file, int decimation,
+                                   int zoom, bool interpolate, py::object gate) {
+    AnalysisConfig config = make_config(sample_rate, frame_size, freq_start, freq_end,
+                                        kernel_radius, sigma, planning, wisdom_file, decimation,
+                                        zoom, interpolate, gate);
+    int frameHop = hop.value_or(config.frameSize);
+    if (samples.ndim() != 1)
+        throw std::invalid_argument("samples must be a one-dimensional array");
+    if (frameHop <= 0)
+        throw std::invalid_argument("hop must be a positive number of samples");
+    if (frameHop % config.decimation != 0)
+        throw std::invalid_argument("hop must be a multiple of decimation");
+
+    size_t numSamples = samples.shape(0);
+    size_t numFrames = extractFrameCount(numSamples, frameHop, config.frameSize);
+    py::array_t<double> result({(py::ssize_t)numFrames, (py::ssize_t)2});
+
+    const float* in = samples.data();
+    double* out = result.mutable_data();
+    {
+        py::gil_scoped_release release;
+        extractFormants(in, numSamples, frameHop, threads, config, out);
+    }
+    return result;
+}
+
+// Inputs are device indices or (device, channel) pairs
+static std::vector<GroupInput> group_inputs(py::iterable inputs) {
+    std::vector<GroupInput> result;
+    for (py::handle item : inputs) {
+        if (py::isinstance<py::tuple>(item)) {
+            auto pair = item.cast<std::pair<int, int>>();
+            result.push_back({pair.first, pair.second});
+        } else {
+            result.push_back({item.cast<int>(), 0});
+        }
+    }
+    return result;
+}
+
+static py::array_t<GroupFrame> group_drain(DetectorGroup& group) {
+    std::vector<GroupFrame> frames = group.drain();
+    return py::array_t<GroupFrame>(frames.size(), frames.data());
+}
+
+static bool group_wait(DetectorGroup& group, py::object timeout) {
+    return wait_with_signals(
+        timeout,
+        [&group](double wait) { return group.wait_for_frames(wait); },
+        [&group]() {
+            for (size_t i = 0; i < group.size(); i++)
+                if (group.detector(i).is_streaming())
+                    return true;
+            return false;
+        });
+}
+
+// Vowel labels of the loaded model, empty without one
+static std::vector<std::string> vowel_labels(const streamClass& detector) {
+    std::shared_ptr<const VowelClassifier> model = detector.get_model();
+    return model ? model->get_labels() : std::vector<std::string>();
+}
+
+// (label, confidence) of the last vowel recognized by the loaded model, None before the first
+static py::object get_vowel(const streamClass& detector) {
+    VowelDecision decision;
+    std::shared_ptr<const VowelClassifier> model = detector.get_model();
+    if (!detector.get_vowel(decision) || model == nullptr || decision.model != model->get_id())
+        return py::none();
+    return py::make_tuple(model->get_labels()[decision.vowel], decision.confidence);
+}
+
+static std::vector<double> flat_doubles(py::array_t<double, py::array::c_style | py::array::forcecast> values) {
+    return std::vector<double>(values.data(), values.data() + values.size());
+}
+
+static py::dict get_stats(const streamClass& detector) {
+    StreamStats stats = detector.get_stats();
+    py::dict result;
+    result["callbacks"] = stats.callbacks;
+    result["overruns"] = stats.overruns;
+    result["dropped_samples"] = stats.droppedSamples;
+    result["dropped_frames"] = stats.droppedFrames;
+    result["frames"] = stats.frames;
+    result["backlog_samples"] = stats.backlogSamples;
+    result["input_overflows"] = stats.inputOverflows;
+    result["input_underflows"] = stats.inputUnderflows;
+    result["frames_without_formants"] = stats.framesWithoutFormants;
+    result["gated_frames"] = stats.gatedFrames;
+    result["load"] = stats.load;
+    result["peak_load"] = stats.peakLoad;
+
+    py::dict stages;
+    for (int stage = 0; stage < STAGE_COUNT; stage++) {
+        const TimingSnapshot& t = stats.stages[stage];
+        py::dict timing;
+        timing["count"] = t.count;
+        timing["mean_us"] = t.count ? t.totalNs / 1000.0 / t.count : 0.0;
+        timing["p50_us"] = t.quantile(0.5);
+        timing["p99_us"] = t.quantile(0.99);
+        timing["max_us"] = t.maxNs / 1000.0;
+        timing["buckets"] = std::vector<uint64_t>(t.buckets, t.buckets + TIMING_BUCKETS);
+        stages[timingStageNames[stage]] = timing;
+    }
+    result["stages"] = stages;
+    return result;
+}
+
+// Counters of a recording, None without one
+static py::object recording_stats(std::shared_ptr<CaptureRecorder> recorder) {
+    if (recorder == nullptr)
+        return py::none();
+    RecorderStats stats = recorder->get_stats();
+    py::dict result;
+    result["directory"] = recorder->get_directory();
+    result["segments"] = stats.segments;
+    result["samples"] = stats.samples;
+    result["frames"] = stats.frames;
+    result["dropped_samples"] = stats.droppedSamples;
+    result["dropped_frames"] = stats.droppedFrames;
+    result["gaps"] = stats.gaps;
+    return std::move(result);
+}
+
+// Devices as a list of dicts, probing the hosts without the GIL
+static py::list audio_devices(bool refresh) {
+    std::vector<AudioDevice> devices;
+    {
+        py::gil_scoped_release release;
+        devices = audioDevices(refresh);
+    }
+    py::list result;
+    for (const AudioDevice& device : devices) {
+        py::dict entry;
+        entry["index"] = device.index;
+        entry["name"] = device.name;
+        entry["host_api"] = device.hostApi;
+        entry["max_input_channels"] = device.maxInputChannels;
+        entry["max_output_channels"] = device.maxOutputChannels;
+        entry["default_sample_rate"] = device.defaultSampleRate;
+        entry["default_low_input_latency"] = device.defaultLowInputLatency;
+        entry["default_high_input_latency"] = device.defaultHighInputLatency;
+        entry["default_input"] = device.defaultInput;
+        entry["default_output"] = device.defaultOutput;
+        result.append(entry);
+    }
+    return result;
+}
+
 PYBIND11_MODULE(formant_detector, m) {
     m.doc() = "Formant detection module";
 
+    PYBIND11_NUMPY_DTYPE(FormantFrame, f1, f2, magnitude, time, index, vowel, confidence, level, voiced, channel);
+    PYBIND11_NUMPY_DTYPE(GroupFrame, detector, f1, f2, magnitude, time, received, index, vowel, confidence, level, voiced);
+
+    py::class_<AsyncFrameIterator>(m, "AsyncFrameIterator")
+        .def("__aiter__", [](py::object self) { return self; })
+        .def("__anext__", &AsyncFrameIterator::anext);
+
+    m.def("extract", &extract,
+          "Extract formants from recorded samples, returns an (n_frames, 2) array of [F1, F2] "
+          "(zeros where no formants were found). hop defaults to frame_size, threads=0 uses all cores",
+          py::arg("samples"), py::arg("hop") = py::none(), py::arg("threads") = 1, CONFIG_ARGS);
+
+    m.def("analysis_config", &analysis_config,
+          "The analysis parameters of a detector created with these arguments, as "
+          "FormantDetector.get_config() returns them, without creating one (or PortAudio)",
+          CONFIG_ARGS);
+
+    m.attr("TIMING_BUCKETS_US") = std::vector<double>(timingBucketBounds, timingBucketBounds + TIMING_BUCKETS - 1);
+
+    m.def("default_wisdom_file", &defaultWisdomFile,
+          "The usual place for FFTW wisdom, to pass as wisdom_file ($FORMANT_WISDOM_FILE overrides it)");
+
+#ifdef FORMANT_ALLOCATION_CHECK
+    m.def("allocation_check_stats", &allocation_check_stats,
+          "Test mode only: [callbacks run, heap allocations made inside them]");
+#endif
+
+    m.def("audio_devices", &audio_devices,
+          "Every PortAudio device as a dict (index, name, host_api, max_input_channels, "
+          "max_output_channels, default_sample_rate, default_low_input_latency, "
+          "default_high_input_latency, default_input, default_output). Listed once per process; "
+          "refresh=True probes the hosts again, which fails while a stream is open",
+          py::arg("refresh") = false);
+
+    py::class_<AudioSession>(m, "AudioSession",
+        "Keeps PortAudio initialized until close(), so detectors created meanwhile skip its "
+        "start-up and device probing")
+        .def(py::init<>())
+        .def("close", &AudioSession::close,
+             "Release PortAudio, it terminates once no detector uses it either")
+        .def_property_readonly("is_open", &AudioSession::is_open)
+        .def("devices", [](const AudioSession&, bool refresh) { return audio_devices(refresh); },
+             "Same as audio_devices()", py::arg("refresh") = false)
+        .def("__enter__", [](py::object self) { return self; })
+        .def("__exit__", [](AudioSession& session, py::args) { session.close(); });
+
+    py::class_<AudioSource, std::shared_ptr<AudioSource>>(m, "AudioSource",
+        "Base class of the sources FormantDetector.start_stream(source=...) accepts");
+
+    py::class_<PortAudioSource, AudioSource, std::shared_ptr<PortAudioSource>>(m, "PortAudioSource")
+        .def(py::init([](int device, py::object channel) {
+                 return std::make_shared<PortAudioSource>(device, channel_list(channel));
+             }),
+             "Live input from one channel of a PortAudio device, or from a list of channels "
+             "analyzed together in one stream",
+             py::arg("device"), py::arg("channel") = 0)
+        .def_property_readonly("device", &PortAudioSource::get_device)
+        .def_property_readonly("channel", &PortAudioSource::get_channel)
+        .def_property_readonly("channels", &PortAudioSource::input_channels);
+
+    py::class_<FileSource, AudioSource, std::shared_ptr<FileSource>>(m, "FileSource")
+        .def(py::init([](const std::string& path, const std::string& format, int channels,
+                         py::object channel, bool realtime) {
+                 return std::make_shared<FileSource>(path, format, channels, channel_list(channel), realtime);
+             }),
+             "Replay a WAV file (PCM or float, at the detector's sample rate) or raw float32 "
+             "samples with the given number of interleaved channels. format is 'auto', 'wav' or "
+             "'raw'. channel is one channel or a list analyzed together. realtime=False analyzes "
+             "as fast as possible without dropping anything",
+             py::arg("path"), py::arg("format") = "auto", py::arg("channels") = 1,
+             py::arg("channel") = 0, py::arg("realtime") = false)
+        .def_property_readonly("channels", &FileSource::input_channels)
+        .def_property_readonly("path", &FileSource::get_path)
+        .def_property_readonly("realtime", &FileSource::is_realtime);
+
+    py::class_<BufferSource, AudioSource, std::shared_ptr<BufferSource>>(m, "BufferSource")
+        .def(py::init([](SampleArray samples, bool realtime) {
+                 if (samples.ndim() != 1)
+                     throw std::invalid_argument("samples must be a one-dimensional array");
+                 return std::make_shared<BufferSource>(samples.data(), samples.size(), realtime);
+             }),
+             "Replay a mono float32 signal held in memory (copied once)",
+             py::arg("samples"), py::arg("realtime") = false)
+        .def("__len__", &BufferSource::size)
+        .def_property_readonly("realtime", &BufferSource::is_realtime);
+
+    py::class_<RecordingSource, AudioSource, std::shared_ptr<RecordingSource>>(m, "RecordingSource")
+        .def(py::init([](const std::string& directory, std::optional<double> start, std::optional<double> end,
+                         bool realtime) {
+                 return std::make_shared<RecordingSource>(directory, start.value_or(NAN), end.value_or(NAN), realtime);
+             }),
+             "Replay the input recorded by FormantDetector.start_recording into directory, from start to "
+             "end (stream time in seconds, None for the whole recording). Frame times are the recorded ones",
+             py::arg("directory"), py::arg("start") = py::none(), py::arg("end") = py::none(),
+             py::arg("realtime") = false)
+        .def_property_readonly("directory", &RecordingSource::get_directory)
+        .def_property_readonly("realtime", &RecordingSource::is_realtime);
+
+    py::class_<GeneratorSource, AudioSource, std::shared_ptr<GeneratorSource>>(m, "GeneratorSource")
+        .def(py::init<py::iterable, bool>(),
+             "Analyze chunks of mono samples yielded by an iterable (arrays or sequences of any length)",
+             py::arg("chunks"), py::arg("realtime") = false)
+        .def_property_readonly("realtime", &GeneratorSource::is_realtime);
+
+    py::class_<VowelClassifier, std::shared_ptr<VowelClassifier>>(m, "VowelClassifier",
+        "A vowel model compiled for the analysis thread, see FormantDetector.load_model")
+        .def_static("centroid", [](const std::vector<std::string>& labels, py::array_t<double> means, double variance) {
+                 return VowelClassifier::centroid(labels, flat_doubles(means), variance);
+             },
+             "Nearest class mean: means is (n_labels, 2) [F1, F2], variance the pooled variance in Hz^2",
+             py::arg("labels"), py::arg("means"), py::arg("variance"))
+        .def_static("gaussian", [](const std::vector<std::string>& labels, py::array_t<double> means,
+                                   py::array_t<double> precisions, py::array_t<double> offsets) {
+                 return VowelClassifier::gaussian(labels, flat_doubles(means), flat_doubles(precisions),
+                                                  flat_doubles(offsets));
+             },
+             "One Gaussian per label: means (n_labels, 2), precisions (inverse covariances, "
+             "n_labels x 2 x 2) and offsets (log prior - log det(covariance) / 2 per label)",
+             py::arg("labels"), py::arg("means"), py::arg("precisions"), py::arg("offsets"))
+        .def_static("grid", [](const std::vector<std::string>& labels,
+                               py::array_t<uint8_t, py::array::c_style | py::array::forcecast> grid,
+                               py::array_t<float, py::array::c_style | py::array::forcecast> confidences,
+                               double min_hz, double cell_hz) {
+                 if (grid.ndim() != 2 || grid.shape(0) != grid.shape(1))
+                     throw std::invalid_argument("grid must be a square (cells, cells) array");
+                 return VowelClassifier::lookup_grid(
+                     labels, std::vector<uint8_t>(grid.data(), grid.data() + grid.size()),
+                     std::vector<float>(confidences.data(), confidences.data() + confidences.size()),
+                     (int)grid.shape(0), min_hz, cell_hz);
+             },
+             "Lookup table: grid[i, j] is the label index of F1 cell i and F2 cell j, each cell_hz "
+             "wide from min_hz, with its confidence in confidences",
+             py::arg("labels"), py::arg("grid"), py::arg("confidences"), py::arg("min_hz"), py::arg("cell_hz"))
+        .def("classify", [](const VowelClassifier& model, double f1, double f2) -> py::tuple {
+                 double confidence;
+                 int label = model.classify(f1, f2, confidence);
+                 if (label < 0)
+                     return py::make_tuple(py::none(), 0.0);
+                 return py::make_tuple(model.get_labels()[label], confidence);
+             },
+             "(label, confidence) of one [F1, F2] pair, (None, 0.0) without formants",
+             py::arg("f1"), py::arg("f2"))
+        .def_property_readonly("kind", &VowelClassifier::get_kind)
+        .def_property_readonly("labels", &VowelClassifier::get_labels);
+
     // Expose only the main streamClass API
     py::class_<streamClass>(m, "FormantDetector")
-        .def(py::init<>(), "Initialize the formant detector")
-        .def("start_stream", &streamClass::start_stream, 
-             "Start audio stream for formant detection",
-             py::arg("deviceInput") = 4)
+        .def(py::init([](double sample_rate, int frame_size, double freq_start, double freq_end,
+                         int kernel_radius, double sigma, const std::string& planning,
+                         std::optional<std::string> wisdom_file, int decimation,
+                         int zoom, bool interpolate, py::object gate) {
+                 return new streamClass(make_config(sample_rate, frame_size, freq_start, freq_end,
+                                                    kernel_radius, sigma, planning, wisdom_file, decimation,
+                                                    zoom, interpolate, gate));
+             }),
+             "Initialize the formant detector. planning is the FFTW rigor ('estimate', 'measure', "
+             "'patient', 'exhaustive'); measured plans are cached in wisdom_file across runs, "
+             "when one is given",
+             CONFIG_ARGS)
+        .def("start_stream", [](streamClass& self, int deviceInput, std::optional<int> hop, int channel,
+                                std::shared_ptr<AudioSource> source, py::object channels) {
+                 if (source)
+                     self.start_stream(source, hop);
+                 else if (channels.is_none())
+                     self.start_stream(deviceInput, hop, channel);
+                 else {
+                     // A count means the first channels of the device
+                     std::vector<int> list;
+                     if (py::isinstance<py::int_>(channels))
+                         for (int c = 0; c < channels.cast<int>(); c++)
+                             list.push_back(c);
+                     else
+                         list = channels.cast<std::vector<int>>();
+                     self.start_stream(std::make_shared<PortAudioSource>(deviceInput, list), hop);
+                 }
+             },
+             "Start audio stream for formant detection, analyzing a frame every hop samples "
+             "(defaults to frame_size) of the given input channel, or of source when one is given "
+             "(PortAudioSource, FileSource, BufferSource, GeneratorSource or RecordingSource). "
+             "channels (a count of first channels or a list) analyzes several channels of the "
+             "device in one stream, every frame is then reported per channel",
+             py::arg("deviceInput") = 4, py::arg("hop") = py::none(), py::arg("channel") = 0,
+             py::arg("source") = py::none(), py::arg("channels") = py::none())
         .def("stop_stream", &streamClass::stop_stream, 
-             "Stop the audio stream")
+             "Stop the audio stream. Raises RuntimeError if the source failed while running")
+        .def("is_streaming", &streamClass::is_streaming,
+             "True until stop_stream, or until a file or buffer source has been fully analyzed")
         .def("print_devices", &streamClass::print_devices, 
-             "Print available audio devices")
+             "Print available audio devices, see audio_devices() for them as data")
         .def("get_formants", &streamClass::get_formants, 
-             "Get the latest detected formant frequencies as a list [F1, F2]");
+             "Get the latest detected formant frequencies as a list [F1, F2]")
+        .def("drain", &drain,
+             "Get every frame analyzed since the last call as a structured array "
+             "(f1, f2, magnitude, time, index, vowel, confidence, level, voiced, channel), f1 = f2 = 0 "
+             "when no formants were found. Several channels give a frame each per index")
+        .def("latest", &latest,
+             "Get the most recent frame (same fields as drain), or None")
+        .def("notify_fd", &streamClass::notify_fd,
+             "File descriptor that turns readable when frames arrive or the stream ends, for "
+             "select() or an event loop's add_reader; reset it with clear_notification()")
+        .def("clear_notification", &streamClass::clear_notification,
+             "Reset notify_fd() to not readable")
+        .def("wait_next", &wait_next,
+             "Block until the next frame arrives and return it, None on timeout or after stop_stream",
+             py::arg("timeout") = py::none())
+        .def("get_config", &get_config,
+             "The analysis parameters this detector was created with")
+        .def("get_stats", &get_stats,
+             "Pipeline counters: callbacks, overruns and dropped_samples (analysis fell behind "
+             "capture), dropped_frames (drain fell behind analysis), frames, backlog_samples, "
+             "input_overflows/input_underflows (reported by the audio host), frames_without_formants, "
+             "gated_frames (skipped by the voice-activity gate), "
+             "load/peak_load (analysis time per frame over the hop period, moving average and worst) "
+             "and per-stage timings under stages (count, mean/p50/p99/max in microseconds and "
+             "counts per TIMING_BUCKETS_US bucket, the last one unbounded)")
+        .def("format_stats", &streamClass::format_stats,
+             "get_stats() as 'prometheus' text or 'json', name becomes a detector label in Prometheus",
+             py::arg("format") = "prometheus", py::arg("name") = "")
+        .def("start_stats_dump", &streamClass::start_stats_dump,
+             "Rewrite path with format_stats(format, name) every interval seconds, from a background "
+             "thread and atomically (for example for node_exporter's textfile collector)",
+             py::arg("path"), py::arg("interval") = 10.0, py::arg("format") = "prometheus", py::arg("name") = "")
+        .def("stop_stats_dump", &streamClass::stop_stats_dump,
+             "Stop the stats dump after writing the file a last time")
+        .def("get_spectrum", &get_spectrum,
+             "Smoothed magnitude spectrum of the speech band from the last frame with formant analysis, "
+             "as a read-only NumPy view without a copy (None before the first). Release or copy() "
+             "views you keep: while held, each pins one of a few buffers")
+        .def("spectrum_frequencies", [](const streamClass& detector) {
+                 return py::array_t<double>(py::cast(detector.spectrum_frequencies()));
+             },
+             "Frequency in Hz of every get_spectrum() bin")
+        .def("start_spectrogram", &streamClass::start_spectrogram,
+             "Also write every frame's spectrum to a rolling spectrogram of rows frames in POSIX "
+             "shared memory (/dev/shm/name), for other processes to map read-only",
+             py::arg("name"), py::arg("rows") = SPECTROGRAM_ROWS)
+        .def("stop_spectrogram", &streamClass::stop_spectrogram,
+             "Stop writing the spectrogram and remove its shared memory")
+        .def_property_readonly("spectrogram_name", &streamClass::spectrogram_name,
+             "Shared memory name of the running spectrogram, empty when there is none")
+        .def("start_recording", &streamClass::start_recording,
+             "Record the input and frames into rotating, memory-mapped segment files of segment_seconds "
+             "in directory, keeping the newest segments (0 keeps all), from a background thread. "
+             "Replay them with RecordingSource",
+             py::arg("directory"), py::arg("segment_seconds") = RECORDING_SEGMENT_SECONDS,
+             py::arg("segments") = RECORDING_SEGMENTS)
+        .def("stop_recording", [](streamClass& detector) {
+                 std::shared_ptr<CaptureRecorder> recorder = detector.get_recorder();
+                 detector.stop_recording();
+                 return recording_stats(recorder);
+             },
+             "Write what is left and close the recording, returns its final recording_stats()")
+        .def("recording_stats", [](const streamClass& detector) { return recording_stats(detector.get_recorder()); },
+             "Counters of the running recording (directory, segments, samples, frames, dropped_samples, "
+             "dropped_frames, gaps), None when there is none")
+        .def("frames", [](py::object self) { return AsyncFrameIterator(self); },
+             "Async iterator over every frame: async for frame in detector.frames()")
+        .def("load_model", [](streamClass& detector, std::shared_ptr<VowelClassifier> model) {
+                 detector.load_model(model);
+             },
+             "Classify every following frame with a VowelClassifier on the analysis thread, "
+             "None stops. Frames carry the label index in vowel (-1 for none) and its confidence",
+             py::arg("model"))
+        .def("get_model", [](const streamClass& detector) {
+                 return std::const_pointer_cast<VowelClassifier>(detector.get_model());
+             },
+             "The loaded VowelClassifier, or None")
+        .def_property_readonly("vowel_labels", &vowel_labels,
+             "Labels of the loaded model, frames['vowel'] indexes them")
+        .def("get_vowel", &get_vowel,
+             "(label, confidence) of the last vowel recognized by the loaded model, or None");
+
+    py::class_<DetectorGroup>(m, "DetectorGroup")
+        .def(py::init([](py::iterable inputs, double sample_rate, int frame_size, double freq_start,
+                         double freq_end, int kernel_radius, double sigma, const std::string& planning,
+                         std::optional<std::string> wisdom_file, int decimation,
+                         int zoom, bool interpolate, py::object gate) {
+                 return new DetectorGroup(group_inputs(inputs),
+                                          make_config(sample_rate, frame_size, freq_start, freq_end,
+                                                      kernel_radius, sigma, planning, wisdom_file, decimation,
+                                                      zoom, interpolate, gate));
+             }),
+             "One detector per input, given as a device index or a (device, channel) pair. "
+             "Takes the same analysis parameters as FormantDetector",
+             py::arg("inputs"), CONFIG_ARGS)
+        .def("start", &DetectorGroup::start,
+             "Start every input, analyzing a frame every hop samples (defaults to frame_size)",
+             py::arg("hop") = py::none())
+        .def("stop", &DetectorGroup::stop,
+             "Stop every input")
+        .def("__len__", &DetectorGroup::size)
+        .def("__getitem__", &DetectorGroup::detector, py::return_value_policy::reference_internal,
+             "The FormantDetector analyzing input i")
+        .def("drain", &group_drain,
+             "Get every frame of every input since the last call as one structured array "
+             "(detector, f1, f2, magnitude, time, received, index, vowel, confidence, level, voiced) "
+             "ordered by received, the arrival time on the steady clock")
+        .def("wait", &group_wait,
+             "Block until any input has new frames. False on timeout or when nothing is running",
+             py::arg("timeout") = py::none())
+        .def("load_model", [](DetectorGroup& group, std::shared_ptr<VowelClassifier> model) {
+                 group.load_model(model);
+             },
+             "Load one VowelClassifier into every input, None stops classifying",
+             py::arg("model"))
+        .def("get_stats", [](DetectorGroup& group) {
+                 py::list stats;
+                 for (size_t i = 0; i < group.size(); i++)
+                     stats.append(get_stats(group.detector(i)));
+                 return stats;
+             },
+             "get_stats() of every input, in input order");
 }
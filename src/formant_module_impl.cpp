@@ -12,7 +12,20 @@
 //
 // ---------------------------------------------------------------------------------
 
-static streamCallbackData* spectroData;
+// Pa_Initialize/Pa_Terminate are process-wide, detectors share one initialization
+static std::mutex portAudioMutex;
+static int portAudioUsers = 0;
+// Streams open on any PortAudioSource, devices cannot be probed again meanwhile
+static int portAudioStreams = 0;
+// Devices listed by audioDevices, kept until it is asked to refresh them
+static std::vector<AudioDevice> deviceCache;
+static bool deviceCacheValid = false;
+
+#ifdef FORMANT_ALLOCATION_CHECK
+static thread_local bool allocationCheckActive = false;
+static std::atomic<long> checkedCallbacks(0);
+static std::atomic<long> callbackAllocations(0);
+#endif
 
 // ---------------------------------------------------------------------------------
 // 
@@ -22,309 +35,3549 @@ static streamCallbackData* spectroData;
 
 // Formant class implementation
 void Formant::set_formants(double f1, double f2) {
-    formants.f1 = f1;
-    formants.f2 = f2;
+    formants.store({f1, f2, 0.0});
 }
 
 std::vector<double> Formant::get_formants() {
-    return {formants.f1, formants.f2};
+    Formants latest = formants.load();
+    return {latest.f1, latest.f2};
 }
 
-void checkError(PaError err) {
-		if (err != paNoError)
-		{
-				printf("Port audio error: %s\n", Pa_GetErrorText(err));
-				exit(EXIT_FAILURE);
-		}
+// FormantRing class implementation
+FormantRing::FormantRing(size_t capacity) : frames(capacity) {
 }
 
-inline float max(float a, float b) {
-		return a > b ? a : b;
+void FormantRing::push(const FormantFrame& frame) {
+	latestFrame.store(frame);
+
+	uint64_t h = head.load(std::memory_order_relaxed);
+	if (h - tail.load(std::memory_order_acquire) >= frames.size())
+	{
+		dropped.fetch_add(1, std::memory_order_relaxed);
+		return;
+	}
+	frames[h % frames.size()] = frame;
+	head.store(h + 1, std::memory_order_release);
 }
 
-inline float min(float a, float b) {
-		return a < b ? a : b;
+size_t FormantRing::available() const {
+	return head.load(std::memory_order_acquire) - tail.load(std::memory_order_relaxed);
 }
 
-inline bool isPositive(double a) {
-		return a >= 0 ? true : false;
+size_t FormantRing::drain(FormantFrame* out, size_t maxFrames) {
+	uint64_t t = tail.load(std::memory_order_relaxed);
+	size_t count = std::min((size_t)(head.load(std::memory_order_acquire) - t), maxFrames);
+	for (size_t i = 0; i < count; i++)
+	{
+		out[i] = frames[(t + i) % frames.size()];
+	}
+	tail.store(t + count, std::memory_order_release);
+	return count;
 }
 
-inline int clamp(int value, int min, int max) {
-		return std::max(min, std::min(value, max));
+bool FormantRing::latest(FormantFrame& frame) const {
+	if (latestFrame.empty())
+	{
+		return false;
+	}
+	frame = latestFrame.load();
+	return true;
 }
 
-double G(int x) {
-		return std::exp((-(x * x)) / (2 * (STANDARD_DEVIATION * STANDARD_DEVIATION)));
+uint64_t FormantRing::dropped_frames() const {
+	return dropped.load(std::memory_order_relaxed);
 }
 
-std::vector<double> computeKernelFilter() {
-		int kernel_size = 2 * RADIUS_OF_THE_KERNEL + 1;
-		std::vector<double> kernel(kernel_size);
-		double sum = 0.0;
+// SampleRing class implementation
+SampleRing::SampleRing(size_t capacity) : capacity(capacity), samples(capacity) {
+}
 
-		for (int i = -RADIUS_OF_THE_KERNEL; i <= RADIUS_OF_THE_KERNEL; i++)
+bool SampleRing::write(const float* data, size_t count, size_t stride, const int* offsets) {
+	uint64_t h = head.load(std::memory_order_relaxed);
+	if (h + count - tail.load(std::memory_order_acquire) > capacity)
+	{
+		return false;
+	}
+	for (int c = 0; c < channels; c++)
+	{
+		const float* in = data + (offsets != NULL ? offsets[c] : c);
+		float* channel = samples.data() + (size_t)c * capacity;
+		for (size_t i = 0; i < count; i++)
 		{
-				double value = G(i);
-				kernel[i + RADIUS_OF_THE_KERNEL] = value;
-				sum += value;
-		};
+			channel[(h + i) % capacity] = in[i * stride];
+		}
+	}
+	head.store(h + count, std::memory_order_release);
+	return true;
+}
 
-		for (auto& val : kernel)
+size_t SampleRing::read(float* out, size_t count, size_t channelStride) {
+	uint64_t t = tail.load(std::memory_order_relaxed);
+	count = std::min((size_t)(head.load(std::memory_order_acquire) - t), count);
+	if (channelStride == 0)
+	{
+		channelStride = count;
+	}
+	for (int c = 0; c < channels; c++)
+	{
+		const float* channel = samples.data() + (size_t)c * capacity;
+		for (size_t i = 0; i < count; i++)
 		{
-				val /= sum;
+			out[c * channelStride + i] = channel[(t + i) % capacity];
 		}
+	}
+	tail.store(t + count, std::memory_order_release);
+	return count;
+}
 
-		return kernel;
+size_t SampleRing::available() const {
+	return head.load(std::memory_order_acquire) - tail.load(std::memory_order_relaxed);
 }
 
+uint64_t SampleRing::written() const {
+	return head.load(std::memory_order_relaxed);
+}
 
-// ---------------------------------------------------------------------------------
-// 
-// Callback function
-//
-// ---------------------------------------------------------------------------------
+int SampleRing::channel_count() const {
+	return channels;
+}
 
+// Only valid while neither side is running
+void SampleRing::reset(int channels) {
+	if (channels != this->channels)
+	{
+		this->channels = channels;
+		samples.assign(capacity * channels, 0.0f);
+	}
+	head = 0;
+	tail = 0;
+}
 
-int streamCallback(
-		const void* inputBuffer,
-		void* outputBuffer,
-		unsigned long framesPerBuffer,
-		const PaStreamCallbackTimeInfo* timeInfo,
-		PaStreamCallbackFlags statusFlags,
-		void* userData
-) {
-		float* in = (float*)inputBuffer;
-		(void)outputBuffer;
-		CallbackState* cb = (CallbackState*)userData;
-		streamCallbackData* callbackData = cb->spectroData;
-		Formant* formant = cb->formant;
+// FrameNotifier class implementation
+FrameNotifier::FrameNotifier() {
+#ifdef __linux__
+	readFd = eventfd(0, EFD_NONBLOCK | EFD_CLOEXEC);
+	writeFd = readFd;
+	if (readFd < 0)
+	{
+		throw std::runtime_error("Could not create the frame notification eventfd");
+	}
+#else
+	int fds[2];
+	if (pipe(fds) != 0)
+	{
+		throw std::runtime_error("Could not create the frame notification pipe");
+	}
+	readFd = fds[0];
+	writeFd = fds[1];
+	for (int fd : fds)
+	{
+		fcntl(fd, F_SETFL, fcntl(fd, F_GETFL) | O_NONBLOCK);
+		fcntl(fd, F_SETFD, FD_CLOEXEC);
+	}
+#endif
+}
 
-		for (size_t i = 0; i < framesPerBuffer; i++)
-		{
-				callbackData->in[i] = in[i * NUM_CHANNELS];
-		}
+FrameNotifier::~FrameNotifier() {
+	close(readFd);
+	if (writeFd != readFd)
+	{
+		close(writeFd);
+	}
+}
+
+// A full pipe or saturated eventfd already means "readable", so a failed write is fine
+void FrameNotifier::notify() {
+#ifdef __linux__
+	uint64_t one = 1;
+	ssize_t written = write(writeFd, &one, sizeof(one));
+#else
+	char one = 1;
+	ssize_t written = write(writeFd, &one, sizeof(one));
+#endif
+	(void)written;
+}
+
+void FrameNotifier::clear() {
+	char buffer[64];
+	while (read(readFd, buffer, sizeof(buffer)) > 0)
+	{
+	}
+}
 
-		fftw_execute(callbackData->p);
+bool FrameNotifier::wait(double timeoutSeconds) {
+	struct pollfd pfd = {readFd, POLLIN, 0};
+	int timeoutMs = timeoutSeconds < 0 ? -1 : (int)std::ceil(timeoutSeconds * 1000.0);
+	if (poll(&pfd, 1, timeoutMs) <= 0)
+	{
+		return false;
+	}
+	clear();
+	return true;
+}
 
-		// SpectroData->out is now filled with the FFT results
-		// Initialise an array absolouteResult
-		
-		int halfSize = callbackData->startIndex + callbackData->spectralSize;
+int FrameNotifier::fd() const {
+	return readFd;
+}
 
-		std::vector<double> absolouteResult;
-		absolouteResult.resize(halfSize);
+// TimingHistogram class implementation
+const char* const timingStageNames[STAGE_COUNT] = {
+	"callback", "decimate", "gate", "fft", "smoothing", "derivative", "peaks", "classify", "frame"
+};
 
-		std::vector<double> kernel = computeKernelFilter();
+// Microseconds, roughly three buckets per decade from 1 us to 50 ms
+const double timingBucketBounds[TIMING_BUCKETS - 1] = {
+	1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000, 20000, 50000
+};
 
-		std::vector<double> smoothed;
-		smoothed.resize(halfSize,0);
+static inline uint64_t monotonicNs() {
+	return std::chrono::duration_cast<std::chrono::nanoseconds>(
+		std::chrono::steady_clock::now().time_since_epoch()).count();
+}
 
-		std::vector<double> firstDif; // basically the first derivative
-		firstDif.resize(halfSize-1);
+TimingHistogram::TimingHistogram() {
+	for (auto& bucket : buckets)
+	{
+		bucket.store(0, std::memory_order_relaxed);
+	}
+}
 
-		std::vector<double> secondDif; // basically the second derivative
-		secondDif.resize(halfSize - 2);
+void TimingHistogram::record(uint64_t ns) {
+	int bucket = 0;
+	while (bucket < TIMING_BUCKETS - 1 && ns > timingBucketBounds[bucket] * 1000.0)
+	{
+		bucket++;
+	}
+	buckets[bucket].fetch_add(1, std::memory_order_relaxed);
+	count.fetch_add(1, std::memory_order_relaxed);
+	totalNs.fetch_add(ns, std::memory_order_relaxed);
+	if (ns > maxNs.load(std::memory_order_relaxed))
+	{
+		maxNs.store(ns, std::memory_order_relaxed);
+	}
+}
 
-		std::vector<FrequencyMagnitude> aproxPeakValeyFreq;
+TimingSnapshot TimingHistogram::snapshot() const {
+	TimingSnapshot result;
+	result.count = count.load(std::memory_order_relaxed);
+	result.totalNs = totalNs.load(std::memory_order_relaxed);
+	result.maxNs = maxNs.load(std::memory_order_relaxed);
+	for (int i = 0; i < TIMING_BUCKETS; i++)
+	{
+		result.buckets[i] = buckets[i].load(std::memory_order_relaxed);
+	}
+	return result;
+}
 
-		for (size_t i = 0; i < halfSize; i++)
+double TimingSnapshot::quantile(double q) const {
+	double maxUs = maxNs / 1000.0;
+	uint64_t total = 0;
+	for (int i = 0; i < TIMING_BUCKETS; i++)
+	{
+		total += buckets[i];
+	}
+	uint64_t seen = 0;
+	for (int i = 0; i < TIMING_BUCKETS - 1; i++)
+	{
+		seen += buckets[i];
+		if (total > 0 && seen >= q * total)
 		{
-				absolouteResult[i] = abs(spectroData->out[i]);
+			return std::min(timingBucketBounds[i], maxUs);
 		}
+	}
+	return maxUs;
+}
 
-		for (size_t i = 0; i < smoothed.size(); i++)
+void checkError(PaError err) {
+		if (err != paNoError)
 		{
-				for (int j = -RADIUS_OF_THE_KERNEL; j <= RADIUS_OF_THE_KERNEL; j++)
-				{
-						smoothed[i] += kernel[j + RADIUS_OF_THE_KERNEL] * absolouteResult[clamp(i + j, 0, halfSize-1)];
-				}
+				throw std::runtime_error(std::string("Port audio error: ") + Pa_GetErrorText(err));
 		}
+}
 
-		for (size_t i = 0; i < halfSize-1; i++)
+void acquirePortAudio() {
+		std::lock_guard<std::mutex> lock(portAudioMutex);
+		if (portAudioUsers == 0)
 		{
-				firstDif[i] = smoothed[i + 1] - smoothed[i];
+				checkError(Pa_Initialize());
 		}
+		portAudioUsers++;
+}
 
-		for (size_t i = 0; i < halfSize - 2; i++)
+void releasePortAudio() {
+		std::lock_guard<std::mutex> lock(portAudioMutex);
+		if (--portAudioUsers == 0)
 		{
-				secondDif[i] = firstDif[i + 1] - firstDif[i];
+				Pa_Terminate();
 		}
+}
 
-
-		bool currentPositive;
-		bool nextPositive;
-
-		for (size_t i = 0; i < halfSize - 2; i++)
+// The devices of every host, listed once and then served from the cache. PortAudio
+// only probes the hosts in Pa_Initialize, so refresh initializes it again to find
+// devices plugged in or removed since; it cannot while a stream is open.
+std::vector<AudioDevice> audioDevices(bool refresh) {
+		std::lock_guard<std::mutex> lock(portAudioMutex);
+		if (refresh)
 		{
-				currentPositive = isPositive(firstDif[i]);
-				nextPositive = isPositive(firstDif[i + 1]);
-
-				if (currentPositive != nextPositive)
+				if (portAudioStreams > 0)
 				{
-						FrequencyMagnitude freqmag;
-						freqmag.frequency = std::round((SAMPLE_RATE / FRAMES_PER_BUFFER) * (i + callbackData->startIndex + 0.5));
-						freqmag.magnitude = smoothed[i];
-						secondDif[i] < 0 ? freqmag.isMaxima = true : freqmag.isMaxima = false;
-						aproxPeakValeyFreq.push_back(freqmag);
+						throw std::runtime_error("Audio devices cannot be refreshed while a stream is open");
 				}
-		}
-
-		std::vector<FrequencyMagnitude> speechPeaks;
-
-		for (auto& f : aproxPeakValeyFreq)
-		{
-				if (f.isMaxima && f.frequency >= 300 && f.frequency <= 3200)
+				if (portAudioUsers > 0)
 				{
-						speechPeaks.push_back(f);
+						Pa_Terminate();
+						checkError(Pa_Initialize());
 				}
+				deviceCacheValid = false;
 		}
-
-		double maxMag = 0.0;
-		for (auto& f : speechPeaks)
+		if (deviceCacheValid)
 		{
-				maxMag = max(maxMag, f.magnitude);
+				return deviceCache;
 		}
 
-		std::vector<FrequencyMagnitude> strongPeaks;
-
-		for (auto& f : speechPeaks)
+		// Nothing holds PortAudio, initialize it just for the listing
+		bool temporary = portAudioUsers == 0;
+		if (temporary)
+		{
+				checkError(Pa_Initialize());
+		}
+		std::vector<AudioDevice> devices;
+		int count = Pa_GetDeviceCount();
+		PaDeviceIndex defaultInput = Pa_GetDefaultInputDevice();
+		PaDeviceIndex defaultOutput = Pa_GetDefaultOutputDevice();
+		for (int i = 0; i < count; i++)
 		{
-				if (f.magnitude > 0.7 * maxMag)
+				const PaDeviceInfo* info = Pa_GetDeviceInfo(i);
+				if (info == NULL)
 				{
-						strongPeaks.push_back(f);
+						continue;
 				}
+				const PaHostApiInfo* host = Pa_GetHostApiInfo(info->hostApi);
+				devices.push_back({i, info->name, host != NULL ? host->name : "",
+				                   info->maxInputChannels, info->maxOutputChannels, info->defaultSampleRate,
+				                   info->defaultLowInputLatency, info->defaultHighInputLatency,
+				                   i == defaultInput, i == defaultOutput});
 		}
+		if (temporary)
+		{
+				Pa_Terminate();
+		}
+		checkError(count < 0 ? (PaError)count : paNoError);
 
-		std::sort(strongPeaks.begin(), strongPeaks.end(), [](const FrequencyMagnitude& a, const FrequencyMagnitude& b) {
-				return a.frequency > b.frequency;
-		});
+		deviceCache = devices;
+		deviceCacheValid = true;
+		return devices;
+}
+
+inline float max(float a, float b) {
+		return a > b ? a : b;
+}
+
+inline float min(float a, float b) {
+		return a < b ? a : b;
+}
 
-		// for (auto& peak : strongPeaks)
-		//{
-		//		std::cout << "Strong peak at: Freq: " << peak.frequency << " Magnitude: " << peak.magnitude << '\n';
-		//}
+inline bool isPositive(double a) {
+		return a >= 0 ? true : false;
+}
+
+inline int clamp(int value, int min, int max) {
+		return std::max(min, std::min(value, max));
+}
+
+double G(int x, double standardDeviation) {
+		return std::exp((-(x * x)) / (2 * (standardDeviation * standardDeviation)));
+}
+
+std::vector<double> computeKernelFilter(int radius, double standardDeviation) {
+		int kernel_size = 2 * radius + 1;
+		std::vector<double> kernel(kernel_size);
+		double sum = 0.0;
+
+		for (int i = -radius; i <= radius; i++)
+		{
+				double value = G(i, standardDeviation);
+				kernel[i + radius] = value;
+				sum += value;
+		};
 
-		if (strongPeaks.size() >= 2) {
-				double f1 = std::min(strongPeaks[0].frequency, strongPeaks[1].frequency);
-				double f2 = std::max(strongPeaks[0].frequency, strongPeaks[1].frequency);
-				std::cout << "Detected: F1=" << f1 << " Hz, F2=" << f2 << " Hz" << '\n';
-				formant->set_formants(f1,f2);
+		for (auto& val : kernel)
+		{
+				val /= sum;
 		}
 
-		// can call formant.get_formants() to get the formants - can be used to pass into the python file
+		return kernel;
+}
 
-		std::cout << "EOB \n";
+void validateConfig(const AnalysisConfig& config) {
+	if (!(config.sampleRate > 0))
+	{
+		throw std::invalid_argument("sample_rate must be positive");
+	}
+	if (config.frameSize < 64)
+	{
+		throw std::invalid_argument("frame_size must be at least 64 samples");
+	}
+	if (!(config.freqStart >= 0 && config.freqStart < config.freqEnd))
+	{
+		throw std::invalid_argument("freq_start must be non-negative and below freq_end");
+	}
+	if (config.freqStart >= config.sampleRate / 2)
+	{
+		throw std::invalid_argument("freq_start must be below the Nyquist frequency");
+	}
+	if (config.kernelRadius < 0)
+	{
+		throw std::invalid_argument("kernel_radius must not be negative");
+	}
+	if (!(config.standardDeviation > 0))
+	{
+		throw std::invalid_argument("sigma must be positive");
+	}
+	if (config.decimation < 1)
+	{
+		throw std::invalid_argument("decimation must be at least 1");
+	}
+	if (config.frameSize % config.decimation != 0 || config.frameSize / config.decimation < 64)
+	{
+		throw std::invalid_argument("frame_size must be a multiple of decimation, of at least 64 decimated samples");
+	}
+	if (config.decimation > 1 && config.sampleRate / config.decimation <= 2.0 * SPEECH_FREQ_END)
+	{
+		throw std::invalid_argument("decimation must keep the sample rate above twice the speech band ("
+			+ std::to_string(2 * SPEECH_FREQ_END) + " Hz)");
+	}
+	if (config.freqStart >= config.sampleRate / config.decimation / 2)
+	{
+		throw std::invalid_argument("freq_start must be below the Nyquist frequency after decimation");
+	}
+	if (!(config.gateCloseDb <= config.gateOpenDb))
+	{
+		throw std::invalid_argument("The gate must close at or below the level it opens at");
+	}
+	if (!(config.gateMaxZeroCrossings > 0))
+	{
+		throw std::invalid_argument("The gate's zero-crossing limit must be positive");
+	}
+	if (!(config.gateMinHarmonicity >= 0 && config.gateMinHarmonicity < 1))
+	{
+		throw std::invalid_argument("The gate's harmonicity must be between 0 and 1");
+	}
+	if (config.gateHangover < 0)
+	{
+		throw std::invalid_argument("The gate's hangover can not be negative");
+	}
+	if (config.zoom < 1 || config.zoom > MAX_ZOOM)
+	{
+		throw std::invalid_argument("zoom must be between 1 and " + std::to_string(MAX_ZOOM));
+	}
+}
 
-		fflush(stdout);
+// What the FFT and the analyzer see: the decimated rate and frame length
+AnalysisConfig analyzedConfig(const AnalysisConfig& config) {
+	AnalysisConfig analyzed = config;
+	analyzed.sampleRate = config.sampleRate / config.decimation;
+	analyzed.frameSize = config.frameSize / config.decimation;
+	analyzed.decimation = 1;
+	return analyzed;
+}
 
-		return 0;
+// Blackman-windowed sinc with its cutoff at the decimated Nyquist frequency, long enough
+// that nothing folds into the speech band: frequencies up to (rate - SPEECH_FREQ_END)
+// alias above SPEECH_FREQ_END, so only those beyond it need the full attenuation (~74 dB)
+std::vector<float> decimationFilter(int factor, double sampleRate) {
+	if (factor == 1)
+	{
+		return {1.0f};
+	}
+	double transition = sampleRate / factor - 2.0 * SPEECH_FREQ_END;
+	int length = (int)std::ceil(5.5 * sampleRate / transition) | 1;
+	double cutoff = 0.5 / factor;
+	double middle = (length - 1) / 2.0;
+
+	std::vector<double> h(length);
+	double sum = 0.0;
+	for (int k = 0; k < length; k++)
+	{
+		double x = k - middle;
+		double sinc = x == 0 ? 2.0 * cutoff : std::sin(2.0 * M_PI * cutoff * x) / (M_PI * x);
+		double window = 0.42 - 0.5 * std::cos(2.0 * M_PI * k / (length - 1)) + 0.08 * std::cos(4.0 * M_PI * k / (length - 1));
+		h[k] = sinc * window;
+		sum += h[k];
+	}
+	std::vector<float> taps(length);
+	for (int k = 0; k < length; k++)
+	{
+		taps[k] = (float)(h[k] / sum);
+	}
+	return taps;
 }
 
-// ---------------------------------------------------------------------------------
-// 
-// API - streamClass Implementation
-//
-// ---------------------------------------------------------------------------------
+// One output sample: the symmetric taps against the taps.size() inputs from window on
+static inline float firDot(const float* window, const float* taps, size_t length) {
+	float sum = 0.0f;
+	for (size_t k = 0; k < length; k++)
+	{
+		sum += taps[k] * window[k];
+	}
+	return sum;
+}
 
-streamClass::streamClass() {
-    this->err = Pa_Initialize();
-    checkError(err);
+// Decimates a whole signal the way a Decimator does block by block, from silence
+std::vector<float> decimateSignal(const float* samples, size_t numSamples, const AnalysisConfig& config) {
+	std::vector<float> taps = decimationFilter(config.decimation, config.sampleRate);
+	size_t history = taps.size() - 1;
+	std::vector<float> padded(history + numSamples, 0.0f);
+	std::copy(samples, samples + numSamples, padded.begin() + history);
 
-	spectroData = (streamCallbackData*)malloc(sizeof(streamCallbackData));
-	spectroData->in = (double*)malloc(sizeof(double) * FRAMES_PER_BUFFER);
-	spectroData->out = (double*)malloc(sizeof(double) * FRAMES_PER_BUFFER);
-	if (spectroData->in == NULL || spectroData->out == NULL)
+	std::vector<float> decimated(numSamples / config.decimation);
+	for (size_t m = 0; m < decimated.size(); m++)
 	{
-		printf("Could not allocate specto data\n");
-		exit(EXIT_FAILURE);
+		decimated[m] = firDot(padded.data() + m * config.decimation, taps.data(), taps.size());
 	}
-	spectroData->p = fftw_plan_r2r_1d(
-		FRAMES_PER_BUFFER,
-		spectroData->in,
-		spectroData->out,
-		FFTW_R2HC,
-		FFTW_ESTIMATE
-	);
-	double sampleRatio = FRAMES_PER_BUFFER / SAMPLE_RATE;
-	spectroData->startIndex = std::ceil(sampleRatio * SPECTRO_FREQ_START);
-	spectroData->spectralSize = min(
-		std::ceil(sampleRatio * SPECTRO_FREQ_END),
-		FRAMES_PER_BUFFER/2.0) 
-		- spectroData->startIndex;
+	return decimated;
+}
 
-	cbState = new CallbackState{spectroData, &formant};
+// Decimator class implementation
+Decimator::Decimator(const AnalysisConfig& config)
+	: factor(config.decimation), taps(decimationFilter(config.decimation, config.sampleRate)),
+	  buffer(taps.size() - 1 + config.frameSize, 0.0f) {
 }
 
-void streamClass::start_stream(int deviceInput) {
-	PaStreamParameters inputParameters;
+void Decimator::reset() {
+	std::fill(buffer.begin(), buffer.end(), 0.0f);
+}
 
-	memset(&inputParameters, 0, sizeof(inputParameters));
-	inputParameters.channelCount = NUM_CHANNELS;
-	inputParameters.device = deviceInput;
-	inputParameters.hostApiSpecificStreamInfo = NULL;
-	inputParameters.sampleFormat = paFloat32;
-	inputParameters.suggestedLatency = Pa_GetDeviceInfo(deviceInput)->defaultLowInputLatency;
+void Decimator::process(const float* in, size_t count, float* out) {
+	size_t history = taps.size() - 1;
+	std::copy(in, in + count, buffer.begin() + history);
+	for (size_t m = 0; m < count / factor; m++)
+	{
+		out[m] = firDot(buffer.data() + m * factor, taps.data(), taps.size());
+	}
+	std::copy(buffer.begin() + count, buffer.begin() + count + history, buffer.begin());
+}
 
-	err = Pa_OpenStream(
-		&stream,
-		&inputParameters,
-		NULL,
-		SAMPLE_RATE,
-		FRAMES_PER_BUFFER,
-		paNoFlag,
-		streamCallback,
-		cbState
-	);
+// VoiceGate class implementation
+VoiceGate::VoiceGate(const AnalysisConfig& config)
+	: config(config), energies(config.frameSize + 1), open(false), failed(0),
+	  plan(NULL), spectrum(NULL), correlation(NULL) {
+	minLag = std::max(1, (int)std::floor(config.sampleRate / GATE_PITCH_MAX));
+	maxLag = std::min(config.frameSize / 2, (int)std::ceil(config.sampleRate / GATE_PITCH_MIN));
+	if (config.gate && config.gateMinHarmonicity > 0)
+	{
+		// Zero-padded to twice the frame, so the circular correlation is the linear one
+		spectrum = fftw_alloc_real(2 * config.frameSize);
+		correlation = fftw_alloc_real(2 * config.frameSize);
+		if (spectrum == NULL || correlation == NULL)
+		{
+			fftw_free(spectrum);
+			fftw_free(correlation);
+			throw std::bad_alloc();
+		}
+		plan = cachedR2HCPlan(2 * config.frameSize, 1, config.planRigor, config.wisdomFile);
+	}
+}
 
-        checkError(err);
+VoiceGate::~VoiceGate() {
+	fftw_free(spectrum);
+	fftw_free(correlation);
+}
 
-        err = Pa_StartStream(stream);
-        checkError(err);
+void VoiceGate::reset() {
+	open = false;
+	failed = 0;
 }
 
-void streamClass::stop_stream() {
-    err = Pa_CloseStream(stream);
-	checkError(err);
+bool VoiceGate::update(const float* frame, GateMeasure& measure) {
+	const int n = config.frameSize;
+	// energies[i] is the energy of the first i samples
+	int crossings = 0;
+	energies[0] = 0.0;
+	for (int i = 0; i < n; i++)
+	{
+		energies[i + 1] = energies[i] + (double)frame[i] * frame[i];
+		if (i > 0 && (frame[i] >= 0.0f) != (frame[i - 1] >= 0.0f))
+		{
+			crossings++;
+		}
+	}
+	double energy = energies[n];
+	measure.level = 10.0 * std::log10(std::max(energy / n, 1e-20));
+	measure.zeroCrossings = crossings * config.sampleRate / n;
+	measure.harmonicity = 0.0;
+	if (!config.gate)
+	{
+		return true;
+	}
 
-	err = Pa_Terminate();
-	checkError(err);
+	bool loudEnough = measure.level >= (open ? config.gateCloseDb : config.gateOpenDb);
+	bool voiced = loudEnough && measure.zeroCrossings <= config.gateMaxZeroCrossings;
+	if (voiced && config.gateMinHarmonicity > 0)
+	{
+		// The power spectrum is real and even, so transforming it forward again gives
+		// the autocorrelation times the transform size
+		const int size = 2 * n;
+		std::copy(frame, frame + n, spectrum);
+		std::fill(spectrum + n, spectrum + size, 0.0);
+		fftw_execute_r2r(plan, spectrum, correlation);
+		spectrum[0] = correlation[0] * correlation[0];
+		spectrum[n] = correlation[n] * correlation[n];
+		for (int k = 1; k < n; k++)
+		{
+			spectrum[k] = correlation[k] * correlation[k] + correlation[size - k] * correlation[size - k];
+			spectrum[size - k] = spectrum[k];
+		}
+		fftw_execute_r2r(plan, spectrum, correlation);
+
+		// Normalized over the samples that overlap at every lag
+		for (int lag = minLag; lag <= maxLag; lag++)
+		{
+			double product = correlation[lag] / size;
+			double head = energies[n - lag];
+			double tail = energy - energies[lag];
+			if (head > 0 && tail > 0)
+			{
+				measure.harmonicity = std::max(measure.harmonicity, product / std::sqrt(head * tail));
+			}
+		}
+		voiced = measure.harmonicity >= config.gateMinHarmonicity;
+	}
 
-	fftw_destroy_plan(spectroData->p);
-	fftw_free(spectroData->in);
-	fftw_free(spectroData->out);
-	free(spectroData);
+	if (voiced)
+	{
+		open = true;
+		failed = 0;
+	}
+	else if (open && ++failed > config.gateHangover)
+	{
+		open = false;
+	}
+	return open;
 }
 
-void streamClass::print_devices() {
-	int numDevices = Pa_GetDeviceCount();
-	printf("Number of devices %d\n", numDevices);
+// FFTW planning is not thread-safe, and extract() plans with the GIL released
+std::mutex& fftwPlannerMutex() {
+	static std::mutex plannerMutex;
+	return plannerMutex;
+}
 
-	if (numDevices < 0)
+// ---------------------------------------------------------------------------------
+// 
+// FFTW plan cache
+//
+// ---------------------------------------------------------------------------------
+
+// $FORMANT_WISDOM_FILE, else the user cache directory
+std::string defaultWisdomFile() {
+	const char* path = getenv(WISDOM_FILE_ENV);
+	if (path != NULL)
+	{
+		return path;
+	}
+	const char* cache = getenv("XDG_CACHE_HOME");
+	if (cache != NULL && cache[0] != '\0')
 	{
-		printf("Error getting device count!");
-		exit(EXIT_FAILURE);
+		return std::string(cache) + "/formant_detector/fftw_wisdom";
 	}
-	else if (numDevices == 0)
+	const char* home = getenv("HOME");
+	if (home != NULL && home[0] != '\0')
 	{
-		printf("No available audio devices on this machine!");
-		exit(EXIT_SUCCESS);
+		return std::string(home) + "/.cache/formant_detector/fftw_wisdom";
 	}
+	return "";
+}
 
-	const PaDeviceInfo* deviceInfo;
-	for (size_t i = 0; i < numDevices; i++)
+unsigned planRigorFromName(const std::string& name) {
+	if (name == "estimate") return FFTW_ESTIMATE;
+	if (name == "measure") return FFTW_MEASURE;
+	if (name == "patient") return FFTW_PATIENT;
+	if (name == "exhaustive") return FFTW_EXHAUSTIVE;
+	throw std::invalid_argument("planning must be one of 'estimate', 'measure', 'patient' or 'exhaustive'");
+}
+
+std::string planRigorName(unsigned rigor) {
+	if (rigor == FFTW_MEASURE) return "measure";
+	if (rigor == FFTW_PATIENT) return "patient";
+	if (rigor == FFTW_EXHAUSTIVE) return "exhaustive";
+	return "estimate";
+}
+
+static void makeParentDirectories(const std::string& path) {
+	for (size_t slash = path.find('/', 1); slash != std::string::npos; slash = path.find('/', slash + 1))
 	{
-		deviceInfo = Pa_GetDeviceInfo(i);
-		printf("Device %d:\n", (int)i);
-		printf("   name: %s\n", deviceInfo->name);
-		printf("   maxInputChannels: %d\n", deviceInfo->maxInputChannels);
-		printf("   maxOutputChannels: %d\n", deviceInfo->maxOutputChannels);
-		printf("   defaultSampleRate: %f\n", deviceInfo->defaultSampleRate);
+		mkdir(path.substr(0, slash).c_str(), 0755);
 	}
 }
 
-std::vector<double> streamClass::get_formants() {
-	return formant.get_formants();
+// Plans are shared by every detector and extract() call with the same shape and rigor,
+// and executed on the caller's own buffers with fftw_execute_r2r or fftw_execute_dft.
+// They live until the process exits. Measured plans are first looked up in the wisdom
+// file; new wisdom is written back (through a temporary file) so the next process skips
+// the measurement. The key leaves out the wisdom file: a plan measured once is good for
+// every caller. create plans on scratch buffers with the flags it is given.
+template <typename Create>
+static fftw_plan cachedPlan(int sign, int n, int howmany, unsigned rigor, const std::string& wisdomFile,
+                            Create create) {
+	static std::map<std::tuple<int, int, int, unsigned>, fftw_plan> plans;
+	static std::map<std::string, bool> importedWisdom;
+
+	std::lock_guard<std::mutex> lock(fftwPlannerMutex());
+	auto key = std::make_tuple(sign, n, howmany, rigor);
+	auto cached = plans.find(key);
+	if (cached != plans.end())
+	{
+		return cached->second;
+	}
+
+	bool persist = rigor != FFTW_ESTIMATE && !wisdomFile.empty();
+	if (persist && !importedWisdom[wisdomFile])
+	{
+		fftw_import_wisdom_from_filename(wisdomFile.c_str());
+		importedWisdom[wisdomFile] = true;
+	}
+
+	fftw_plan plan = NULL;
+	if (persist)
+	{
+		plan = create(rigor | FFTW_WISDOM_ONLY);
+	}
+	bool newWisdom = plan == NULL;
+	if (plan == NULL)
+	{
+		plan = create(rigor);
+	}
+	if (persist && (newWisdom || access(wisdomFile.c_str(), F_OK) != 0))
+	{
+		std::string temporary = wisdomFile + ".tmp" + std::to_string(getpid());
+		makeParentDirectories(wisdomFile);
+		if (fftw_export_wisdom_to_filename(temporary.c_str()))
+		{
+			rename(temporary.c_str(), wisdomFile.c_str());
+		}
+	}
+
+	if (plan == NULL)
+	{
+		throw std::runtime_error("FFTW could not create a plan");
+	}
+	plans[key] = plan;
+	return plan;
+}
+
+fftw_plan cachedR2HCPlan(int n, int howmany, unsigned rigor, const std::string& wisdomFile) {
+	return cachedPlan(0, n, howmany, rigor, wisdomFile, [n, howmany](unsigned flags) {
+		// Planning may overwrite the arrays, so it runs on scratch buffers
+		const fftw_r2r_kind kind = FFTW_R2HC;
+		double* in = fftw_alloc_real((size_t)n * howmany);
+		double* out = fftw_alloc_real((size_t)n * howmany);
+		if (in == NULL || out == NULL)
+		{
+			fftw_free(in);
+			fftw_free(out);
+			throw std::bad_alloc();
+		}
+		int size = n;
+		fftw_plan plan = fftw_plan_many_r2r(1, &size, howmany, in, NULL, 1, n, out, NULL, 1, n, &kind, flags);
+		fftw_free(in);
+		fftw_free(out);
+		return plan;
+	});
+}
+
+// A complex in-place transform, sign FFTW_FORWARD or FFTW_BACKWARD
+fftw_plan cachedDFTPlan(int n, int sign, unsigned rigor, const std::string& wisdomFile) {
+	return cachedPlan(sign, n, 1, rigor, wisdomFile, [n, sign](unsigned flags) {
+		fftw_complex* data = fftw_alloc_complex(n);
+		if (data == NULL)
+		{
+			throw std::bad_alloc();
+		}
+		fftw_plan plan = fftw_plan_dft_1d(n, data, data, sign, flags);
+		fftw_free(data);
+		return plan;
+	});
+}
+
+// The smallest size at least minimum with no prime factor above 7, which FFTW
+// transforms about as fast as the next power of two
+int fastTransformSize(int minimum) {
+	int best = 1;
+	while (best < minimum)
+	{
+		best *= 2;
+	}
+	for (long p7 = 1; p7 < best; p7 *= 7)
+	{
+		for (long p5 = p7; p5 < best; p5 *= 5)
+		{
+			for (long p3 = p5; p3 < best; p3 *= 3)
+			{
+				long size = p3;
+				while (size < minimum)
+				{
+					size *= 2;
+				}
+				best = std::min(best, (int)size);
+			}
+		}
+	}
+	return best;
+}
+
+// ---------------------------------------------------------------------------------
+// 
+// ChirpZ - Implementation
+//
+// ---------------------------------------------------------------------------------
+
+// X(start + k * spacing) = sum x[j] e^(-i 2pi (start + k spacing) j / rate). With
+// jk = (j^2 + k^2 - (k - j)^2) / 2 this is a unit-modulus chirp of k times the convolution
+// of x[j] e^(-i 2pi start j / rate) c(j) with the conjugate chirp, c(m) = e^(-i pi spacing
+// m^2 / rate). Only magnitudes are returned, so the chirp of k is left out.
+ChirpZ::ChirpZ(int frameSize, double sampleRate, double start, double spacing, int bins,
+               unsigned rigor, const std::string& wisdomFile)
+	: frameSize(frameSize), bins(bins), size(fastTransformSize(frameSize + bins - 1))
+{
+	forward = cachedDFTPlan(size, FFTW_FORWARD, rigor, wisdomFile);
+	backward = cachedDFTPlan(size, FFTW_BACKWARD, rigor, wisdomFile);
+	premultiply = fftw_alloc_complex(frameSize);
+	chirpSpectrum = fftw_alloc_complex(size);
+	work = fftw_alloc_complex(size);
+	if (premultiply == NULL || chirpSpectrum == NULL || work == NULL)
+	{
+		fftw_free(premultiply);
+		fftw_free(chirpSpectrum);
+		fftw_free(work);
+		throw std::bad_alloc();
+	}
+
+	// Phases are reduced to turns first, m^2 gets large
+	auto chirpTurns = [sampleRate, spacing](long m) {
+		return std::fmod(0.5 * spacing * (double)(m * m) / sampleRate, 1.0);
+	};
+	for (int j = 0; j < frameSize; j++)
+	{
+		double turns = chirpTurns(j) + std::fmod(start * j / sampleRate, 1.0);
+		premultiply[j][0] = std::cos(2.0 * M_PI * turns);
+		premultiply[j][1] = -std::sin(2.0 * M_PI * turns);
+	}
+	std::fill(&chirpSpectrum[0][0], &chirpSpectrum[0][0] + 2 * (size_t)size, 0.0);
+	for (int m = 0; m < bins; m++)
+	{
+		chirpSpectrum[m][0] = std::cos(2.0 * M_PI * chirpTurns(m));
+		chirpSpectrum[m][1] = std::sin(2.0 * M_PI * chirpTurns(m));
+	}
+	// The convolution reaches back frameSize - 1 samples, wrapped to the end
+	for (int m = 1; m < frameSize; m++)
+	{
+		chirpSpectrum[size - m][0] = std::cos(2.0 * M_PI * chirpTurns(m));
+		chirpSpectrum[size - m][1] = std::sin(2.0 * M_PI * chirpTurns(m));
+	}
+	fftw_execute_dft(forward, chirpSpectrum, chirpSpectrum);
+	for (int m = 0; m < size; m++)
+	{
+		chirpSpectrum[m][0] /= size;
+		chirpSpectrum[m][1] /= size;
+	}
+}
+
+ChirpZ::~ChirpZ() {
+	fftw_free(premultiply);
+	fftw_free(chirpSpectrum);
+	fftw_free(work);
+}
+
+void ChirpZ::transform(const double* frame, double* magnitudes) {
+	for (int j = 0; j < frameSize; j++)
+	{
+		work[j][0] = frame[j] * premultiply[j][0];
+		work[j][1] = frame[j] * premultiply[j][1];
+	}
+	std::fill(&work[frameSize][0], &work[0][0] + 2 * (size_t)size, 0.0);
+	fftw_execute_dft(forward, work, work);
+	for (int m = 0; m < size; m++)
+	{
+		double re = work[m][0] * chirpSpectrum[m][0] - work[m][1] * chirpSpectrum[m][1];
+		double im = work[m][0] * chirpSpectrum[m][1] + work[m][1] * chirpSpectrum[m][0];
+		work[m][0] = re;
+		work[m][1] = im;
+	}
+	fftw_execute_dft(backward, work, work);
+	for (int k = 0; k < bins; k++)
+	{
+		magnitudes[k] = std::hypot(work[k][0], work[k][1]);
+	}
+}
+
+// ---------------------------------------------------------------------------------
+// 
+// FormantAnalyzer - Implementation
+//
+// ---------------------------------------------------------------------------------
+
+FormantAnalyzer::FormantAnalyzer(const AnalysisConfig& config) : config(config) {
+	double sampleRatio = config.frameSize / config.sampleRate;
+	startIndex = std::ceil(sampleRatio * config.freqStart);
+	spectralSize = std::min(
+		std::ceil(sampleRatio * config.freqEnd),
+		config.frameSize/2.0)
+		- startIndex;
+	halfSize = startIndex + spectralSize;
+
+	labelled = config.zoom == 1 && !config.interpolate;
+	gridSpacing = config.sampleRate / config.frameSize;
+	gridStart = labelled ? gridSpacing * (startIndex + 0.5) : 0.0;
+	radius = config.kernelRadius;
+	double deviation = config.standardDeviation;
+	if (config.zoom > 1)
+	{
+		// Only the speech band and the bins its peaks are smoothed from, at the finer spacing
+		gridSpacing /= config.zoom;
+		radius *= config.zoom;
+		deviation *= config.zoom;
+		double margin = (radius + 2) * gridSpacing;
+		gridStart = std::max({0.0, config.freqStart, SPEECH_FREQ_START - margin});
+		double end = std::min({config.freqEnd, SPEECH_FREQ_END + margin, config.sampleRate / 2});
+		halfSize = std::max(3, (int)std::floor((end - gridStart) / gridSpacing) + 1);
+		chirpZ = std::make_unique<ChirpZ>(config.frameSize, config.sampleRate, gridStart, gridSpacing, halfSize,
+		                                  config.planRigor, config.wisdomFile);
+	}
+
+	kernel = computeKernelFilter(radius, deviation);
+	absolouteResult.resize(halfSize);
+	smoothed.resize(halfSize);
+	firstDif.resize(halfSize - 1);
+	speechPeaks.resize(halfSize);
+	numSpeechPeaks = 0;
+
+	// Peaks are only kept between SPEECH_FREQ_START and SPEECH_FREQ_END, so only the
+	// bins that can become such a peak, and their neighbours within the kernel, are
+	// computed. Same results as computing every bin, a fraction of the work. A peak
+	// found at i lies at bin i + 1, within half a bin once interpolated.
+	firstPeak = halfSize - 2;
+	lastPeak = -1;
+	for (int i = 0; i < halfSize - 2; i++)
+	{
+		bool inBand;
+		if (labelled)
+		{
+			double frequency = std::round(gridStart + i * gridSpacing);
+			inBand = frequency >= SPEECH_FREQ_START && frequency <= SPEECH_FREQ_END;
+		}
+		else
+		{
+			double frequency = gridStart + (i + 1) * gridSpacing;
+			inBand = frequency >= SPEECH_FREQ_START - gridSpacing / 2 && frequency <= SPEECH_FREQ_END + gridSpacing / 2;
+		}
+		if (inBand)
+		{
+			firstPeak = std::min(firstPeak, i);
+			lastPeak = i;
+		}
+	}
+	// A peak at i compares smoothed[i..i+2], each smoothed bin reads radius bins around it
+	firstBin = std::max(0, firstPeak - radius);
+	lastBin = std::min(halfSize - 1, lastPeak + 2 + radius);
+}
+
+bool FormantAnalyzer::analyze(const double* spectrum, Formants& result, StageTimings* timings) {
+	uint64_t start = timings != NULL ? monotonicNs() : 0;
+	if (labelled)
+	{
+		for (int i = firstBin; i <= lastBin; i++)
+		{
+			absolouteResult[i] = std::abs(spectrum[i]);
+		}
+	}
+	else
+	{
+		// Half-complex: the real part of bin i at i, its imaginary part at frameSize - i
+		for (int i = firstBin; i <= lastBin; i++)
+		{
+			absolouteResult[i] = i == 0 ? std::abs(spectrum[0]) : std::hypot(spectrum[i], spectrum[config.frameSize - i]);
+		}
+	}
+	if (timings != NULL)
+	{
+		timings->transform = 0;
+	}
+	return find_formants(result, timings, start);
+}
+
+bool FormantAnalyzer::analyze_frame(const double* frame, Formants& result, StageTimings* timings) {
+	uint64_t start = timings != NULL ? monotonicNs() : 0;
+	chirpZ->transform(frame, absolouteResult.data());
+	uint64_t transformedAt = timings != NULL ? monotonicNs() : 0;
+	if (timings != NULL)
+	{
+		timings->transform = transformedAt - start;
+	}
+	return find_formants(result, timings, transformedAt);
+}
+
+bool FormantAnalyzer::zoomed() const {
+	return chirpZ != nullptr;
+}
+
+bool FormantAnalyzer::find_formants(Formants& result, StageTimings* timings, uint64_t start) {
+	int lastSmoothed = std::min(halfSize - 1, lastPeak + 2);
+	for (int i = firstPeak; i <= lastSmoothed; i++)
+	{
+		double value = 0.0;
+		for (int j = -radius; j <= radius; j++)
+		{
+			value += kernel[j + radius] * absolouteResult[clamp(i + j, 0, halfSize-1)];
+		}
+		smoothed[i] = value;
+	}
+	uint64_t smoothedAt = timings != NULL ? monotonicNs() : 0;
+
+	for (int i = firstPeak; i < lastSmoothed; i++)
+	{
+		firstDif[i] = smoothed[i + 1] - smoothed[i];
+	}
+	uint64_t derivedAt = timings != NULL ? monotonicNs() : 0;
+
+	// A sign change of the first derivative with a negative second derivative is a maximum
+	numSpeechPeaks = 0;
+	double maxMag = 0.0;
+	for (int i = firstPeak; i <= lastPeak; i++)
+	{
+		if (isPositive(firstDif[i]) == isPositive(firstDif[i + 1]) || firstDif[i + 1] - firstDif[i] >= 0)
+		{
+			continue;
+		}
+
+		double frequency;
+		double magnitude;
+		if (labelled)
+		{
+			frequency = std::round(gridStart + i * gridSpacing);
+			magnitude = smoothed[i];
+		}
+		else
+		{
+			// The vertex of the parabola through the maximum at i + 1 and its neighbours
+			double left = smoothed[i];
+			double middle = smoothed[i + 1];
+			double right = smoothed[i + 2];
+			double curvature = left - 2.0 * middle + right;
+			double offset = config.interpolate && curvature < 0 ? 0.5 * (left - right) / curvature : 0.0;
+			frequency = gridStart + (i + 1 + offset) * gridSpacing;
+			magnitude = middle - 0.25 * (left - right) * offset;
+		}
+		if (frequency >= SPEECH_FREQ_START && frequency <= SPEECH_FREQ_END)
+		{
+			speechPeaks[numSpeechPeaks++] = {frequency, magnitude, true};
+			maxMag = std::max(maxMag, magnitude);
+		}
+	}
+
+	// The two highest strong peaks, same as sorting by frequency and taking the first two
+	double highest = -1.0;
+	double secondHighest = -1.0;
+	for (int p = 0; p < numSpeechPeaks; p++)
+	{
+		const FrequencyMagnitude& f = speechPeaks[p];
+		if (f.magnitude <= STRONG_PEAK_RATIO * maxMag)
+		{
+			continue;
+		}
+		if (f.frequency > highest)
+		{
+			secondHighest = highest;
+			highest = f.frequency;
+		}
+		else if (f.frequency > secondHighest)
+		{
+			secondHighest = f.frequency;
+		}
+	}
+
+	if (timings != NULL)
+	{
+		timings->smoothing = smoothedAt - start;
+		timings->derivative = derivedAt - smoothedAt;
+		timings->peaks = monotonicNs() - derivedAt;
+	}
+	if (secondHighest < 0)
+	{
+		return false;
+	}
+
+	result.f1 = secondHighest;
+	result.f2 = highest;
+	result.magnitude = maxMag;
+	return true;
+}
+
+const double* FormantAnalyzer::band() const {
+	return smoothed.data() + std::min(firstPeak, lastPeak + 1);
+}
+
+int FormantAnalyzer::band_size() const {
+	return std::max(0, lastPeak - firstPeak + 1);
+}
+
+// Without the rounding applied to the formants
+double FormantAnalyzer::band_frequency(int bin) const {
+	return gridStart + (firstPeak + bin) * gridSpacing;
+}
+
+double FormantAnalyzer::band_spacing() const {
+	return gridSpacing;
+}
+
+
+// ---------------------------------------------------------------------------------
+// 
+// Callback function
+//
+// ---------------------------------------------------------------------------------
+
+
+int streamCallback(
+		const void* inputBuffer,
+		void* outputBuffer,
+		unsigned long framesPerBuffer,
+		const PaStreamCallbackTimeInfo* timeInfo,
+		PaStreamCallbackFlags statusFlags,
+		void* userData
+) {
+#ifdef FORMANT_ALLOCATION_CHECK
+		AllocationCheckScope allocationCheck;
+#endif
+		uint64_t start = monotonicNs();
+		float* in = (float*)inputBuffer;
+		(void)outputBuffer;
+		CallbackState* cb = (CallbackState*)userData;
+		cb->callbacks.fetch_add(1, std::memory_order_relaxed);
+
+		// The host lost input before this callback, independent of our own overruns
+		if (statusFlags & paInputOverflow)
+		{
+				cb->inputOverflows.fetch_add(1, std::memory_order_relaxed);
+		}
+		if (statusFlags & paInputUnderflow)
+		{
+				cb->inputUnderflows.fetch_add(1, std::memory_order_relaxed);
+		}
+
+		// Only hand the samples over, the analysis worker does the DSP
+		uint64_t position = cb->samples->written();
+		if (!cb->samples->write(in, framesPerBuffer, cb->channelCount, cb->channels.data()))
+		{
+				cb->overruns.fetch_add(1, std::memory_order_relaxed);
+				cb->droppedSamples.fetch_add(framesPerBuffer, std::memory_order_relaxed);
+		}
+		else
+		{
+				cb->clock->store({position, timeInfo != NULL ? timeInfo->inputBufferAdcTime : 0.0, start});
+				cb->sampleNotifier->notify();
+		}
+
+		cb->callbackTime.record(monotonicNs() - start);
+		return paContinue;
+}
+
+// ---------------------------------------------------------------------------------
+// 
+// Allocation check (test mode)
+//
+// ---------------------------------------------------------------------------------
+
+#ifdef FORMANT_ALLOCATION_CHECK
+AllocationCheckScope::AllocationCheckScope() {
+	allocationCheckActive = true;
+	checkedCallbacks++;
+}
+
+AllocationCheckScope::~AllocationCheckScope() {
+	allocationCheckActive = false;
+}
+
+std::vector<long> allocation_check_stats() {
+	return {checkedCallbacks.load(), callbackAllocations.load()};
+}
+
+// Replacing the global operators only affects this module, pybind11 builds it with
+// hidden visibility. operator new[] and delete[] forward to these by default.
+void* operator new(std::size_t size) {
+	if (allocationCheckActive)
+	{
+		callbackAllocations++;
+	}
+	void* p = malloc(size ? size : 1);
+	if (p == NULL)
+	{
+		throw std::bad_alloc();
+	}
+	return p;
+}
+
+void operator delete(void* p) noexcept {
+	free(p);
+}
+
+void operator delete(void* p, std::size_t) noexcept {
+	free(p);
+}
+#endif
+
+// ---------------------------------------------------------------------------------
+// 
+// Stats export
+//
+// ---------------------------------------------------------------------------------
+
+static void appendf(std::string& out, const char* format, ...) __attribute__((format(printf, 2, 3)));
+
+static void appendf(std::string& out, const char* format, ...) {
+	char buffer[256];
+	va_list args;
+	va_start(args, format);
+	int length = vsnprintf(buffer, sizeof(buffer), format, args);
+	va_end(args);
+	out.append(buffer, std::min<size_t>(std::max(length, 0), sizeof(buffer) - 1));
+}
+
+static const std::pair<const char*, uint64_t StreamStats::*> statsCounters[] = {
+	{"callbacks", &StreamStats::callbacks},
+	{"overruns", &StreamStats::overruns},
+	{"dropped_samples", &StreamStats::droppedSamples},
+	{"dropped_frames", &StreamStats::droppedFrames},
+	{"frames", &StreamStats::frames},
+	{"input_overflows", &StreamStats::inputOverflows},
+	{"input_underflows", &StreamStats::inputUnderflows},
+	{"frames_without_formants", &StreamStats::framesWithoutFormants},
+	{"gated_frames", &StreamStats::gatedFrames},
+};
+
+// Same keys as FormantDetector.get_stats(), stage durations in microseconds
+std::string statsToJson(const StreamStats& stats) {
+	std::string out = "{";
+	for (const auto& counter : statsCounters)
+	{
+		appendf(out, "\"%s\": %llu, ", counter.first, (unsigned long long)(stats.*counter.second));
+	}
+	appendf(out, "\"backlog_samples\": %llu, \"load\": %.6f, \"peak_load\": %.6f, \"stages\": {",
+	        (unsigned long long)stats.backlogSamples, stats.load, stats.peakLoad);
+	for (int stage = 0; stage < STAGE_COUNT; stage++)
+	{
+		const TimingSnapshot& t = stats.stages[stage];
+		appendf(out, "%s\"%s\": {\"count\": %llu, \"mean_us\": %.3f, \"p50_us\": %.3f, \"p99_us\": %.3f, "
+		        "\"max_us\": %.3f, \"buckets\": [",
+		        stage ? ", " : "", timingStageNames[stage], (unsigned long long)t.count,
+		        t.count ? t.totalNs / 1000.0 / t.count : 0.0, t.quantile(0.5), t.quantile(0.99), t.maxNs / 1000.0);
+		for (int i = 0; i < TIMING_BUCKETS; i++)
+		{
+			appendf(out, "%s%llu", i ? ", " : "", (unsigned long long)t.buckets[i]);
+		}
+		out += "]}";
+	}
+	out += "}}\n";
+	return out;
+}
+
+// Prometheus text exposition format, for example for node_exporter's textfile collector
+// Label values escape backslashes, double quotes and line feeds, as the text format requires
+static std::string prometheusLabelValue(const std::string& value) {
+	std::string escaped;
+	for (char c : value)
+	{
+		if (c == '\\' || c == '"')
+		{
+			escaped += '\\';
+			escaped += c;
+		}
+		else if (c == '\n')
+		{
+			escaped += "\\n";
+		}
+		else
+		{
+			escaped += c;
+		}
+	}
+	return escaped;
+}
+
+std::string statsToPrometheus(const StreamStats& stats, const std::string& name) {
+	std::string label = name.empty() ? "" : "detector=\"" + prometheusLabelValue(name) + "\"";
+	std::string labels = label.empty() ? "" : "{" + label + "}";
+	std::string out;
+	for (const auto& counter : statsCounters)
+	{
+		appendf(out, "# TYPE formant_%s_total counter\n", counter.first);
+		out += "formant_" + std::string(counter.first) + "_total" + labels;
+		appendf(out, " %llu\n", (unsigned long long)(stats.*counter.second));
+	}
+	out += "# TYPE formant_backlog_samples gauge\nformant_backlog_samples" + labels;
+	appendf(out, " %llu\n", (unsigned long long)stats.backlogSamples);
+	out += "# TYPE formant_load gauge\nformant_load" + labels;
+	appendf(out, " %.6f\n", stats.load);
+	out += "# TYPE formant_peak_load gauge\nformant_peak_load" + labels;
+	appendf(out, " %.6f\n", stats.peakLoad);
+
+	out += "# TYPE formant_stage_seconds histogram\n";
+	std::string prefix = label.empty() ? "" : label + ",";
+	for (int stage = 0; stage < STAGE_COUNT; stage++)
+	{
+		const TimingSnapshot& t = stats.stages[stage];
+		std::string stageLabel = prefix + "stage=\"" + timingStageNames[stage] + "\"";
+		uint64_t cumulative = 0;
+		for (int i = 0; i < TIMING_BUCKETS; i++)
+		{
+			cumulative += t.buckets[i];
+			out += "formant_stage_seconds_bucket{" + stageLabel + ",le=\"";
+			if (i < TIMING_BUCKETS - 1)
+			{
+				appendf(out, "%g", timingBucketBounds[i] / 1e6);
+			}
+			else
+			{
+				out += "+Inf";
+			}
+			appendf(out, "\"} %llu\n", (unsigned long long)cumulative);
+		}
+		out += "formant_stage_seconds_sum{" + stageLabel + "}";
+		appendf(out, " %.9f\n", t.totalNs / 1e9);
+		out += "formant_stage_seconds_count{" + stageLabel + "}";
+		appendf(out, " %llu\n", (unsigned long long)t.count);
+	}
+	return out;
+}
+
+// Readers never see a half-written file: write a temporary file next to it, then rename
+void writeFileAtomically(const std::string& path, const std::string& contents) {
+	std::string temporary = path + ".tmp" + std::to_string(getpid());
+	FILE* file = fopen(temporary.c_str(), "w");
+	if (file == NULL)
+	{
+		throw std::runtime_error("Could not write " + temporary + ": " + strerror(errno));
+	}
+	bool written = fwrite(contents.data(), 1, contents.size(), file) == contents.size();
+	written = (fclose(file) == 0) && written;
+	if (!written || rename(temporary.c_str(), path.c_str()) != 0)
+	{
+		std::string error = strerror(errno);
+		remove(temporary.c_str());
+		throw std::runtime_error("Could not write " + path + ": " + error);
+	}
+}
+
+// ---------------------------------------------------------------------------------
+// 
+// Spectrum sharing
+//
+// ---------------------------------------------------------------------------------
+
+// SpectrumBuffer class implementation
+SpectrumBuffer::SpectrumBuffer(size_t bins) : bins(bins), data(bins * SPECTRUM_SLOTS, 0.0) {
+	for (int slot = 0; slot < SPECTRUM_SLOTS; slot++)
+	{
+		readers[slot] = 0;
+		frames[slot] = 0;
+	}
+}
+
+size_t SpectrumBuffer::size() const {
+	return bins;
+}
+
+double* SpectrumBuffer::begin_write() {
+	int published = front.load();
+	writing = -1;
+	for (int slot = 0; slot < SPECTRUM_SLOTS; slot++)
+	{
+		if (slot != published && readers[slot].load() == 0)
+		{
+			writing = slot;
+			return data.data() + slot * bins;
+		}
+	}
+	return NULL;
+}
+
+void SpectrumBuffer::publish(uint64_t frame) {
+	if (writing < 0)
+	{
+		return;
+	}
+	frames[writing] = frame;
+	front.store(writing);
+	writing = -1;
+}
+
+// The writer only picks slots that are not published, so a slot that is still the
+// published one after the reader registered cannot be written until it is released
+int SpectrumBuffer::acquire() {
+	while (true)
+	{
+		int slot = front.load();
+		if (slot < 0)
+		{
+			return -1;
+		}
+		readers[slot].fetch_add(1);
+		if (front.load() == slot)
+		{
+			return slot;
+		}
+		readers[slot].fetch_sub(1);
+	}
+}
+
+void SpectrumBuffer::release(int slot) {
+	readers[slot].fetch_sub(1);
+}
+
+const double* SpectrumBuffer::slot_data(int slot) const {
+	return data.data() + slot * bins;
+}
+
+uint64_t SpectrumBuffer::slot_frame(int slot) const {
+	return frames[slot];
+}
+
+// SharedSpectrogram class implementation
+static_assert(sizeof(SpectrogramHeader) <= SPECTROGRAM_HEADER_SIZE, "SpectrogramHeader outgrew its space");
+static_assert(std::atomic<uint64_t>::is_always_lock_free, "the row counter is shared between processes");
+
+SharedSpectrogram::SharedSpectrogram(const std::string& name, size_t bins, size_t capacity,
+                                     double sampleRate, double firstHz, double binHz)
+	: name(name.empty() || name[0] != '/' ? "/" + name : name) {
+	if (this->name.size() < 2 || this->name.find('/', 1) != std::string::npos)
+	{
+		throw std::invalid_argument("A shared memory name is one path component, like 'vrecog-spectrogram'");
+	}
+	if (capacity < 2)
+	{
+		throw std::invalid_argument("A spectrogram needs at least 2 rows");
+	}
+	size_t rowSize = (2 * sizeof(uint64_t) + bins * sizeof(float) + 7) / 8 * 8;
+	mappedSize = SPECTROGRAM_HEADER_SIZE + capacity * rowSize;
+
+	// Replaces a segment left behind by a process that did not stop its spectrogram
+	shm_unlink(this->name.c_str());
+	int fd = shm_open(this->name.c_str(), O_CREAT | O_EXCL | O_RDWR, 0644);
+	if (fd < 0)
+	{
+		throw std::runtime_error("Could not create shared memory " + this->name + ": " + strerror(errno));
+	}
+	void* mapped = MAP_FAILED;
+	if (ftruncate(fd, mappedSize) == 0)
+	{
+		mapped = mmap(NULL, mappedSize, PROT_READ | PROT_WRITE, MAP_SHARED, fd, 0);
+	}
+	std::string error = strerror(errno);
+	struct stat info;
+	fstat(fd, &info);
+	inode = info.st_ino;
+	close(fd);
+	if (mapped == MAP_FAILED)
+	{
+		shm_unlink(this->name.c_str());
+		throw std::runtime_error("Could not map shared memory " + this->name + ": " + error);
+	}
+
+	// The segment starts zeroed, rows stays 0 until the header is complete
+	header = new (mapped) SpectrogramHeader();
+	rows = static_cast<unsigned char*>(mapped) + SPECTROGRAM_HEADER_SIZE;
+	std::memcpy(header->magic, SPECTROGRAM_MAGIC, sizeof(SPECTROGRAM_MAGIC));
+	header->version = SPECTROGRAM_VERSION;
+	header->bins = bins;
+	header->capacity = capacity;
+	header->rowSize = rowSize;
+	header->sampleRate = sampleRate;
+	header->firstHz = firstHz;
+	header->binHz = binHz;
+	header->rows.store(0, std::memory_order_release);
+}
+
+// Only removes the name while it still refers to this segment, a newer spectrogram
+// may have taken it over
+SharedSpectrogram::~SharedSpectrogram() {
+	munmap(header, mappedSize);
+	int fd = shm_open(name.c_str(), O_RDONLY, 0);
+	if (fd >= 0)
+	{
+		struct stat info;
+		bool ours = fstat(fd, &info) == 0 && info.st_ino == inode;
+		close(fd);
+		if (ours)
+		{
+			shm_unlink(name.c_str());
+		}
+	}
+}
+
+void SharedSpectrogram::write(double time, uint64_t index, const double* magnitudes) {
+	uint64_t count = header->rows.load(std::memory_order_relaxed);
+	unsigned char* row = rows + (count % header->capacity) * header->rowSize;
+	std::memcpy(row, &time, sizeof(time));
+	std::memcpy(row + sizeof(time), &index, sizeof(index));
+	float* values = reinterpret_cast<float*>(row + sizeof(time) + sizeof(index));
+	for (uint32_t bin = 0; bin < header->bins; bin++)
+	{
+		values[bin] = magnitudes != NULL ? (float)magnitudes[bin] : 0.0f;
+	}
+	header->rows.store(count + 1, std::memory_order_release);
+}
+
+const std::string& SharedSpectrogram::get_name() const {
+	return name;
+}
+
+// ---------------------------------------------------------------------------------
+// 
+// Capture recording
+//
+// ---------------------------------------------------------------------------------
+
+// CaptureRecorder class implementation
+static_assert(sizeof(RecordingHeader) <= RECORDING_HEADER_SIZE, "RecordingHeader outgrew its space");
+
+CaptureRecorder::CaptureRecorder(const std::string& directory, const AnalysisConfig& config, int hop,
+                                 double segmentSeconds, size_t maxSegments)
+	: directory(directory), config(config), maxSegments(maxSegments), hop(hop),
+	  blockSamples((size_t)RECORDING_BLOCKS * config.frameSize), blocks(RECORDING_BLOCKS) {
+	if (directory.empty())
+	{
+		throw std::invalid_argument("A recording needs a directory");
+	}
+	if (!(segmentSeconds * config.sampleRate >= config.frameSize))
+	{
+		throw std::invalid_argument("A segment must hold at least frame_size samples");
+	}
+	segmentSamples = (size_t)std::llround(segmentSeconds * config.sampleRate);
+
+	makeParentDirectories(directory + "/");
+	struct stat info;
+	if (stat(directory.c_str(), &info) != 0 || !S_ISDIR(info.st_mode))
+	{
+		throw std::runtime_error("Could not create the recording directory " + directory);
+	}
+	if (access((directory + "/index.json").c_str(), F_OK) == 0)
+	{
+		throw std::invalid_argument(directory + " already holds a recording");
+	}
+	write_index();
+
+	running = true;
+	writer = std::thread(&CaptureRecorder::write_loop, this);
+}
+
+CaptureRecorder::~CaptureRecorder() {
+	close();
+}
+
+// Never waits: a step that does not fit is dropped, the writer sees the gap
+void CaptureRecorder::add(const float* data, size_t count, uint64_t position, double time, const FormantFrame& frame) {
+	uint64_t h = blockHead.load(std::memory_order_relaxed);
+	if (h - blockTail.load(std::memory_order_acquire) >= blocks.size())
+	{
+		droppedSamples.fetch_add(count, std::memory_order_relaxed);
+		droppedFrames.fetch_add(1, std::memory_order_relaxed);
+		return;
+	}
+	size_t slot = h % blocks.size();
+	std::copy(data, data + count, blockSamples.data() + slot * config.frameSize);
+	blocks[slot] = {position, time, count, frame};
+	blockHead.store(h + 1, std::memory_order_release);
+	wake.notify();
+}
+
+// Always after close(), nothing would make room any more
+bool CaptureRecorder::has_room() const {
+	return !running || blockHead.load(std::memory_order_relaxed) - blockTail.load(std::memory_order_acquire) < blocks.size();
+}
+
+// Applies to the segments opened from now on, a new stream always starts one
+void CaptureRecorder::set_hop(int hop) {
+	this->hop = hop;
+}
+
+void CaptureRecorder::close() {
+	if (!running.exchange(false))
+	{
+		return;
+	}
+	wake.notify();
+	writer.join();
+}
+
+void CaptureRecorder::write_loop() {
+	while (true)
+	{
+		// Whatever was handed over before close() is still written
+		bool stopping = !running;
+		bool wrote = write_pending();
+		if (stopping)
+		{
+			break;
+		}
+		if (!wrote)
+		{
+			wake.wait(0.1);
+		}
+	}
+	try
+	{
+		close_segment();
+	}
+	catch (const std::exception& e)
+	{
+		report(&e);
+	}
+}
+
+bool CaptureRecorder::write_pending() {
+	bool wrote = false;
+	uint64_t t = blockTail.load(std::memory_order_relaxed);
+	for (; t != blockHead.load(std::memory_order_acquire); t++)
+	{
+		// The frame goes to the segment holding the end of its samples
+		const Block& block = blocks[t % blocks.size()];
+		uint64_t before = samplesWritten.load(std::memory_order_relaxed);
+		try
+		{
+			write_block(block, blockSamples.data() + (t % blocks.size()) * config.frameSize);
+			write_frame(block.frame);
+			report(NULL);
+		}
+		catch (const std::exception& e)
+		{
+			droppedSamples.fetch_add(block.count - (samplesWritten.load(std::memory_order_relaxed) - before),
+			                         std::memory_order_relaxed);
+			droppedFrames.fetch_add(1, std::memory_order_relaxed);
+			report(&e);
+		}
+		blockTail.store(t + 1, std::memory_order_release);
+		wrote = true;
+	}
+	return wrote;
+}
+
+// A block continuing the samples of the open segment is appended, spilling into a new
+// segment when it is full. Anything else (dropped input, a new stream) starts a new one.
+void CaptureRecorder::write_block(const Block& block, const float* data) {
+	if (segment != NULL && block.position != nextSample)
+	{
+		gaps.fetch_add(1, std::memory_order_relaxed);
+		close_segment();
+	}
+	nextSample = block.position;
+	size_t done = 0;
+	while (done < block.count)
+	{
+		if (segment != NULL && segment->samples.load(std::memory_order_relaxed) == segment->sampleCapacity)
+		{
+			close_segment();
+		}
+		if (segment == NULL)
+		{
+			open_segment(nextSample, block.time + done / config.sampleRate);
+		}
+		uint64_t used = segment->samples.load(std::memory_order_relaxed);
+		size_t count = std::min((uint64_t)(block.count - done), segment->sampleCapacity - used);
+		float* out = reinterpret_cast<float*>(reinterpret_cast<unsigned char*>(segment) + RECORDING_HEADER_SIZE);
+		std::copy(data + done, data + done + count, out + used);
+		segment->samples.store(used + count, std::memory_order_release);
+		done += count;
+		nextSample += count;
+		samplesWritten.fetch_add(count, std::memory_order_relaxed);
+	}
+}
+
+// Only after write_block, which leaves a segment open
+void CaptureRecorder::write_frame(const FormantFrame& frame) {
+	if (segment->frames.load(std::memory_order_relaxed) == segment->frameCapacity)
+	{
+		double time = segment->startTime + segment->samples.load(std::memory_order_relaxed) / config.sampleRate;
+		close_segment();
+		open_segment(nextSample, time);
+	}
+	uint64_t used = segment->frames.load(std::memory_order_relaxed);
+	unsigned char* out = reinterpret_cast<unsigned char*>(segment) + segment->framesOffset;
+	std::memcpy(out + used * sizeof(FormantFrame), &frame, sizeof(FormantFrame));
+	segment->frames.store(used + 1, std::memory_order_release);
+	framesWritten.fetch_add(1, std::memory_order_relaxed);
+}
+
+// The whole file is allocated up front, so a full disk fails here and not with a
+// SIGBUS on a later page fault. The oldest segments beyond maxSegments are removed.
+void CaptureRecorder::open_segment(uint64_t position, double time) {
+	int frameHop = hop.load();
+	uint64_t frameCapacity = segmentSamples / frameHop + 2;
+	size_t framesOffset = (RECORDING_HEADER_SIZE + segmentSamples * sizeof(float) + 63) / 64 * 64;
+	size_t size = framesOffset + frameCapacity * sizeof(FormantFrame);
+	uint64_t number = segmentNumber.load() + 1;
+	std::string path = segment_path(number);
+
+	int fd = ::open(path.c_str(), O_RDWR | O_CREAT | O_TRUNC, 0644);
+	if (fd < 0)
+	{
+		throw std::runtime_error("Could not create " + path + ": " + strerror(errno));
+	}
+#ifdef __linux__
+	int reserved = posix_fallocate(fd, 0, size);
+#else
+	int reserved = ftruncate(fd, size) == 0 ? 0 : errno;
+#endif
+	void* mapped = MAP_FAILED;
+	if (reserved == 0)
+	{
+		mapped = mmap(NULL, size, PROT_READ | PROT_WRITE, MAP_SHARED, fd, 0);
+	}
+	std::string error = strerror(reserved != 0 ? reserved : errno);
+	::close(fd);
+	if (mapped == MAP_FAILED)
+	{
+		unlink(path.c_str());
+		throw std::runtime_error("Could not map " + path + ": " + error);
+	}
+
+	segment = new (mapped) RecordingHeader();
+	segmentSize = size;
+	std::memcpy(segment->magic, RECORDING_MAGIC, sizeof(RECORDING_MAGIC));
+	segment->version = RECORDING_VERSION;
+	segment->frameRecordSize = sizeof(FormantFrame);
+	segment->sampleRate = config.sampleRate;
+	segment->frameSize = config.frameSize;
+	segment->decimation = config.decimation;
+	segment->hop = frameHop;
+	segment->segment = number;
+	segment->firstSample = position;
+	segment->startTime = time;
+	segment->sampleCapacity = segmentSamples;
+	segment->frameCapacity = frameCapacity;
+	segment->framesOffset = framesOffset;
+	segmentNumber = number;
+
+	while (maxSegments > 0 && closed.size() + 1 > maxSegments)
+	{
+		unlink(segment_path(closed.front().number).c_str());
+		closed.pop_front();
+	}
+	write_index();
+}
+
+void CaptureRecorder::close_segment() {
+	if (segment == NULL)
+	{
+		return;
+	}
+	closed.push_back({segment->segment, segment->firstSample, segment->startTime,
+	                  segment->samples.load(), segment->frames.load()});
+	segment->complete.store(1, std::memory_order_release);
+	// Written back by the kernel in the background, the writer never waits for the disk
+	msync(segment, segmentSize, MS_ASYNC);
+	munmap(segment, segmentSize);
+	segment = NULL;
+	write_index();
+}
+
+// index.json: the segments kept, oldest first, with the stream time and sample they
+// start at. The open segment is listed with the counts it had when it was opened.
+void CaptureRecorder::write_index() {
+	std::string out;
+	appendf(out, "{\"version\": %d, \"sample_rate\": %.17g, \"frame_size\": %d, \"decimation\": %d, \"segments\": [",
+	        RECORDING_VERSION, config.sampleRate, config.frameSize, config.decimation);
+	std::vector<std::pair<SegmentInfo, bool>> listed;
+	for (const SegmentInfo& info : closed)
+	{
+		listed.push_back({info, true});
+	}
+	if (segment != NULL)
+	{
+		listed.push_back({{segment->segment, segment->firstSample, segment->startTime,
+		                   segment->samples.load(), segment->frames.load()}, false});
+	}
+	for (size_t i = 0; i < listed.size(); i++)
+	{
+		const SegmentInfo& info = listed[i].first;
+		appendf(out, "%s\n  {\"file\": \"segment-%06llu.vrrec\", \"segment\": %llu, \"first_sample\": %llu, "
+		        "\"start_time\": %.17g, \"end_time\": %.17g, \"samples\": %llu, \"frames\": %llu, \"complete\": %s}",
+		        i > 0 ? "," : "", (unsigned long long)info.number, (unsigned long long)info.number,
+		        (unsigned long long)info.firstSample, info.startTime, info.startTime + info.samples / config.sampleRate,
+		        (unsigned long long)info.samples, (unsigned long long)info.frames, listed[i].second ? "true" : "false");
+	}
+	out += "\n]}\n";
+	writeFileAtomically(directory + "/index.json", out);
+}
+
+std::string CaptureRecorder::segment_path(uint64_t number) const {
+	char name[32];
+	snprintf(name, sizeof(name), "/segment-%06llu.vrrec", (unsigned long long)number);
+	return directory + name;
+}
+
+// Errors are printed when they start, not for every block while they last
+void CaptureRecorder::report(const std::exception* error) {
+	if (error != NULL && !failing)
+	{
+		fprintf(stderr, "formant_detector: recording to %s failed: %s\n", directory.c_str(), error->what());
+	}
+	failing = error != NULL;
+}
+
+RecorderStats CaptureRecorder::get_stats() const {
+	RecorderStats stats;
+	stats.segments = segmentNumber.load(std::memory_order_relaxed);
+	stats.samples = samplesWritten.load(std::memory_order_relaxed);
+	stats.frames = framesWritten.load(std::memory_order_relaxed);
+	stats.droppedSamples = droppedSamples.load(std::memory_order_relaxed);
+	stats.droppedFrames = droppedFrames.load(std::memory_order_relaxed);
+	stats.gaps = gaps.load(std::memory_order_relaxed);
+	return stats;
+}
+
+const std::string& CaptureRecorder::get_directory() const {
+	return directory;
+}
+
+// ---------------------------------------------------------------------------------
+// 
+// Offline analysis
+//
+// ---------------------------------------------------------------------------------
+
+size_t extractFrameCount(size_t numSamples, int hop, int frameSize) {
+	if (hop <= 0 || numSamples < (size_t)frameSize)
+	{
+		return 0;
+	}
+	return (numSamples - frameSize) / hop + 1;
+}
+
+// Frames are transformed EXTRACT_BATCH_FRAMES at a time with one batched plan. Worker
+// threads share the plan through fftw_execute_r2r, each with its own buffers and
+// analyzer, and write straight into result (numFrames x 2, zero when no formants).
+// Inputs shorter than a batch use the single-frame plan instead of padding the batch.
+// With decimation the whole signal is decimated first and analyzed at the lower rate,
+// frame k still starts at sample k * hop of the input. With the gate, the frames are
+// gated in order first and only those it lets through are transformed.
+void extractFormants(const float* samples, size_t numSamples, int hop, int numThreads, const AnalysisConfig& config, double* result) {
+	size_t numFrames = extractFrameCount(numSamples, hop, config.frameSize);
+	if (numFrames == 0)
+	{
+		return;
+	}
+	if (config.decimation > 1)
+	{
+		if (hop % config.decimation != 0)
+		{
+			throw std::invalid_argument("hop must be a multiple of decimation");
+		}
+		std::vector<float> decimated = decimateSignal(samples, numSamples, config);
+		extractFormants(decimated.data(), decimated.size(), hop / config.decimation, numThreads,
+		                analyzedConfig(config), result);
+		return;
+	}
+
+	std::vector<size_t> frames;
+	frames.reserve(numFrames);
+	VoiceGate gate(config);
+	for (size_t k = 0; k < numFrames; k++)
+	{
+		GateMeasure measure;
+		if (!config.gate || gate.update(samples + k * hop, measure))
+		{
+			frames.push_back(k);
+		}
+		else
+		{
+			result[2 * k] = 0.0;
+			result[2 * k + 1] = 0.0;
+		}
+	}
+	if (frames.empty())
+	{
+		return;
+	}
+
+	const size_t batchFrames = frames.size() < EXTRACT_BATCH_FRAMES ? 1 : EXTRACT_BATCH_FRAMES;
+	size_t numBatches = (frames.size() + batchFrames - 1) / batchFrames;
+	if (numThreads <= 0)
+	{
+		numThreads = std::max(1u, std::thread::hardware_concurrency());
+	}
+	numThreads = std::min((size_t)numThreads, numBatches);
+
+	const int n = config.frameSize;
+	const bool zoomed = config.zoom > 1;
+	fftw_plan plan = zoomed ? NULL : cachedR2HCPlan(n, (int)batchFrames, config.planRigor, config.wisdomFile);
+	std::vector<double*> inBuffers(numThreads);
+	std::vector<double*> outBuffers(numThreads);
+	for (int t = 0; t < numThreads; t++)
+	{
+		inBuffers[t] = fftw_alloc_real(batchFrames * n);
+		outBuffers[t] = fftw_alloc_real(batchFrames * n);
+		if (inBuffers[t] == NULL || outBuffers[t] == NULL)
+		{
+			for (int u = 0; u <= t; u++)
+			{
+				fftw_free(inBuffers[u]);
+				fftw_free(outBuffers[u]);
+			}
+			throw std::bad_alloc();
+		}
+	}
+
+	std::atomic<size_t> nextBatch(0);
+	auto worker = [&](int t) {
+		FormantAnalyzer analyzer(config);
+		double* in = inBuffers[t];
+		double* out = outBuffers[t];
+
+		for (size_t batch = nextBatch++; batch < numBatches; batch = nextBatch++)
+		{
+			size_t first = batch * batchFrames;
+			size_t count = std::min(batchFrames, frames.size() - first);
+
+			for (size_t k = 0; k < count; k++)
+			{
+				const float* frame = samples + frames[first + k] * hop;
+				std::copy(frame, frame + n, in + k * n);
+			}
+			std::fill(in + count * n, in + batchFrames * n, 0.0);
+
+			if (!zoomed)
+			{
+				fftw_execute_r2r(plan, in, out);
+			}
+
+			for (size_t k = 0; k < count; k++)
+			{
+				Formants formants = {0.0, 0.0, 0.0};
+				if (zoomed)
+				{
+					analyzer.analyze_frame(in + k * n, formants);
+				}
+				else
+				{
+					analyzer.analyze(out + k * n, formants);
+				}
+				result[2 * frames[first + k]] = formants.f1;
+				result[2 * frames[first + k] + 1] = formants.f2;
+			}
+		}
+	};
+
+	std::vector<std::thread> workers;
+	for (int t = 1; t < numThreads; t++)
+	{
+		workers.emplace_back(worker, t);
+	}
+	worker(0);
+	for (auto& w : workers)
+	{
+		w.join();
+	}
+
+	for (int t = 0; t < numThreads; t++)
+	{
+		fftw_free(inBuffers[t]);
+		fftw_free(outBuffers[t]);
+	}
+}
+
+// ---------------------------------------------------------------------------------
+// 
+// Audio sources
+//
+// ---------------------------------------------------------------------------------
+
+std::string AudioSource::error() const {
+	return std::string();
+}
+
+std::vector<int> AudioSource::input_channels() const {
+	return {0};
+}
+
+// Channels analyzed together in one stream: distinct, and few enough for the history
+static void validateChannels(const std::vector<int>& channels) {
+	if (channels.empty())
+	{
+		throw std::invalid_argument("At least one channel is required");
+	}
+	if (channels.size() > MAX_STREAM_CHANNELS)
+	{
+		throw std::invalid_argument("At most " + std::to_string(MAX_STREAM_CHANNELS) + " channels can be analyzed in one stream");
+	}
+	for (size_t i = 0; i < channels.size(); i++)
+	{
+		if (channels[i] < 0 || channels[i] > UINT16_MAX)
+		{
+			throw std::invalid_argument("channel must not be negative");
+		}
+		if (std::find(channels.begin(), channels.begin() + i, channels[i]) != channels.begin() + i)
+		{
+			throw std::invalid_argument("Channel " + std::to_string(channels[i]) + " is listed twice");
+		}
+	}
+}
+
+// PortAudioSource class implementation
+PortAudioSource::PortAudioSource(int device, int channel) : PortAudioSource(device, std::vector<int>{channel}) {
+}
+
+PortAudioSource::PortAudioSource(int device, const std::vector<int>& channels) : device(device), channels(channels) {
+	validateChannels(channels);
+	acquirePortAudio();
+}
+
+PortAudioSource::~PortAudioSource() {
+	try
+	{
+		stop();
+	}
+	catch (const std::exception&)
+	{
+	}
+	releasePortAudio();
+}
+
+void PortAudioSource::start(CallbackState* state, const AnalysisConfig& config, int framesPerBuffer) {
+	if (stream != NULL)
+	{
+		throw std::runtime_error("The source is already in use");
+	}
+	// Devices are not probed again while the stream is being opened, see audioDevices
+	std::lock_guard<std::mutex> lock(portAudioMutex);
+	const PaDeviceInfo* deviceInfo = Pa_GetDeviceInfo(device);
+	if (deviceInfo == NULL)
+	{
+		throw std::invalid_argument("Invalid audio device " + std::to_string(device));
+	}
+	int highest = *std::max_element(channels.begin(), channels.end());
+	if (highest >= deviceInfo->maxInputChannels)
+	{
+		throw std::invalid_argument("Device " + std::to_string(device) + " has no input channel " + std::to_string(highest));
+	}
+
+	// Open enough channels to reach the requested ones, the callback picks them out
+	state->channelCount = std::max(NUM_CHANNELS, highest + 1);
+	state->channels = channels;
+	state->backpressure = false;
+
+	PaStreamParameters inputParameters;
+
+	memset(&inputParameters, 0, sizeof(inputParameters));
+	inputParameters.channelCount = state->channelCount;
+	inputParameters.device = device;
+	inputParameters.hostApiSpecificStreamInfo = NULL;
+	inputParameters.sampleFormat = paFloat32;
+	inputParameters.suggestedLatency = deviceInfo->defaultLowInputLatency;
+
+	PaError err = Pa_OpenStream(
+		&stream,
+		&inputParameters,
+		NULL,
+		config.sampleRate,
+		framesPerBuffer,
+		paNoFlag,
+		streamCallback,
+		state
+	);
+	if (err != paNoError)
+	{
+		stream = NULL;
+		checkError(err);
+	}
+
+	err = Pa_StartStream(stream);
+	if (err != paNoError)
+	{
+		Pa_CloseStream(stream);
+		stream = NULL;
+		checkError(err);
+	}
+	portAudioStreams++;
+}
+
+void PortAudioSource::stop() {
+	if (stream == NULL)
+	{
+		return;
+	}
+	PaError err = Pa_CloseStream(stream);
+	stream = NULL;
+	{
+		std::lock_guard<std::mutex> lock(portAudioMutex);
+		portAudioStreams--;
+	}
+	checkError(err);
+}
+
+// AudioSession class implementation
+AudioSession::AudioSession() : open(true) {
+	acquirePortAudio();
+}
+
+AudioSession::~AudioSession() {
+	close();
+}
+
+void AudioSession::close() {
+	if (open)
+	{
+		open = false;
+		releasePortAudio();
+	}
+}
+
+bool AudioSession::is_open() const {
+	return open;
+}
+
+std::vector<AudioDevice> AudioSession::devices(bool refresh) const {
+	return audioDevices(refresh);
+}
+
+std::vector<int> PortAudioSource::input_channels() const {
+	return channels;
+}
+
+int PortAudioSource::get_device() const {
+	return device;
+}
+
+int PortAudioSource::get_channel() const {
+	return channels[0];
+}
+
+// FeederSource class implementation
+FeederSource::FeederSource(bool realtime) : realtime(realtime) {
+}
+
+void FeederSource::start(CallbackState* state, const AnalysisConfig& config, int framesPerBuffer) {
+	if (running)
+	{
+		throw std::runtime_error("The source is already in use");
+	}
+	open(config);
+	{
+		std::lock_guard<std::mutex> lock(errorMutex);
+		lastError.clear();
+	}
+
+	this->state = state;
+	sampleRate = config.sampleRate;
+	// The block size only changes how samples are handed over, not the frames.
+	// Paced sources mimic a device callback, free-running ones move whole frames.
+	blockSize = realtime ? framesPerBuffer : config.frameSize;
+	blockChannels = (int)input_channels().size();
+	state->channelCount = blockChannels;
+	state->channels.clear();
+	state->backpressure = !realtime;
+
+	running = true;
+	feeder = std::thread(&FeederSource::feed_loop, this);
+}
+
+void FeederSource::stop() {
+	if (!running)
+	{
+		return;
+	}
+	running = false;
+	state->spaceNotifier->notify();
+	feeder.join();
+	close();
+}
+
+void FeederSource::close() {
+}
+
+void FeederSource::fail(const std::string& message) {
+	std::lock_guard<std::mutex> lock(errorMutex);
+	lastError = message;
+}
+
+std::string FeederSource::error() const {
+	std::lock_guard<std::mutex> lock(errorMutex);
+	return lastError;
+}
+
+bool FeederSource::is_realtime() const {
+	return realtime;
+}
+
+double FeederSource::start_time() const {
+	return 0.0;
+}
+
+void FeederSource::feed_loop() {
+	std::vector<float> block((size_t)blockSize * blockChannels);
+	uint64_t position = 0;
+	auto startTime = std::chrono::steady_clock::now();
+
+	while (running)
+	{
+		size_t count = read_block(block.data(), blockSize);
+		if (count == 0)
+		{
+			break;
+		}
+		position += count;
+		if (realtime)
+		{
+			// A device hands a block over once its last sample has been captured
+			std::this_thread::sleep_until(startTime + std::chrono::duration_cast<std::chrono::steady_clock::duration>(
+				std::chrono::duration<double>(position / sampleRate)));
+		}
+		state->callbacks.fetch_add(1, std::memory_order_relaxed);
+
+		uint64_t ringPosition = state->samples->written();
+		bool written = state->samples->write(block.data(), count, blockChannels);
+		while (!written && !realtime && running)
+		{
+			state->spaceNotifier->wait(0.1);
+			written = state->samples->write(block.data(), count, blockChannels);
+		}
+		if (!written)
+		{
+			state->overruns.fetch_add(1, std::memory_order_relaxed);
+			state->droppedSamples.fetch_add(count, std::memory_order_relaxed);
+			continue;
+		}
+
+		state->clock->store({ringPosition, start_time() + (position - count) / sampleRate, monotonicNs()});
+		state->sampleNotifier->notify();
+	}
+
+	state->finished = true;
+	state->sampleNotifier->notify();
+}
+
+// FileSource class implementation
+struct WavFormat {
+	int formatTag = 0;
+	int channels = 0;
+	int bytesPerSample = 0;
+	double sampleRate = 0.0;
+	uint64_t dataBytes = 0;
+};
+
+static uint32_t readLittleEndian(const unsigned char* bytes, int count) {
+	uint32_t value = 0;
+	for (int i = count - 1; i >= 0; i--)
+	{
+		value = (value << 8) | bytes[i];
+	}
+	return value;
+}
+
+// Walks the RIFF chunks after the "WAVE" tag up to "data", leaving the file at the first sample
+static WavFormat readWavHeader(FILE* file, const std::string& path) {
+	WavFormat wav;
+	bool haveFormat = false;
+	unsigned char chunk[8];
+
+	while (fread(chunk, 1, sizeof(chunk), file) == sizeof(chunk))
+	{
+		uint32_t size = readLittleEndian(chunk + 4, 4);
+		if (memcmp(chunk, "fmt ", 4) == 0)
+		{
+			unsigned char fmt[40] = {0};
+			size_t length = std::min((size_t)size, sizeof(fmt));
+			if (size < 16 || fread(fmt, 1, length, file) != length)
+			{
+				break;
+			}
+			wav.formatTag = readLittleEndian(fmt, 2);
+			wav.channels = readLittleEndian(fmt + 2, 2);
+			wav.sampleRate = readLittleEndian(fmt + 4, 4);
+			wav.bytesPerSample = readLittleEndian(fmt + 14, 2) / 8;
+			if (wav.formatTag == 0xFFFE && size >= 26)
+			{
+				// WAVE_FORMAT_EXTENSIBLE, the sub-format GUID starts with the actual tag
+				wav.formatTag = readLittleEndian(fmt + 24, 2);
+			}
+			haveFormat = true;
+			fseek(file, (long)(size - length + (size & 1)), SEEK_CUR);
+		}
+		else if (memcmp(chunk, "data", 4) == 0)
+		{
+			if (!haveFormat)
+			{
+				break;
+			}
+			// Streamed recordings leave the size at its maximum, read those to the end
+			wav.dataBytes = size == 0xFFFFFFFF ? UINT64_MAX : size;
+			return wav;
+		}
+		else
+		{
+			fseek(file, (long)size + (size & 1), SEEK_CUR);
+		}
+	}
+	throw std::invalid_argument(path + " is not a valid WAV file");
+}
+
+static float decodeSample(const unsigned char* bytes, int formatTag, int bytesPerSample) {
+	if (formatTag == 3)
+	{
+		if (bytesPerSample == 8)
+		{
+			double value;
+			memcpy(&value, bytes, sizeof(value));
+			return (float)value;
+		}
+		float value;
+		memcpy(&value, bytes, sizeof(value));
+		return value;
+	}
+	switch (bytesPerSample)
+	{
+	case 1:
+		return (bytes[0] - 128) / 128.0f;
+	case 2:
+		return (int16_t)readLittleEndian(bytes, 2) / 32768.0f;
+	case 3:
+		return ((int32_t)(readLittleEndian(bytes, 3) << 8) >> 8) / 8388608.0f;
+	default:
+		return (int32_t)readLittleEndian(bytes, 4) / 2147483648.0f;
+	}
+}
+
+FileSource::FileSource(const std::string& path, const std::string& format, int channels, int channel, bool realtime)
+	: FileSource(path, format, channels, std::vector<int>{channel}, realtime) {
+}
+
+FileSource::FileSource(const std::string& path, const std::string& format, int channels, const std::vector<int>& channelList, bool realtime)
+	: FeederSource(realtime), path(path), format(format), channels(channels), channelList(channelList) {
+	if (format != "auto" && format != "wav" && format != "raw")
+	{
+		throw std::invalid_argument("Unknown file format '" + format + "', expected 'auto', 'wav' or 'raw'");
+	}
+	if (channels <= 0)
+	{
+		throw std::invalid_argument("channels must be a positive number");
+	}
+	validateChannels(channelList);
+}
+
+FileSource::~FileSource() {
+	stop();
+	close();
+}
+
+void FileSource::open(const AnalysisConfig& config) {
+	close();
+	file = fopen(path.c_str(), "rb");
+	if (file == NULL)
+	{
+		throw std::invalid_argument("Cannot open audio file " + path);
+	}
+
+	unsigned char header[12];
+	bool isWav = fread(header, 1, sizeof(header), file) == sizeof(header)
+		&& memcmp(header, "RIFF", 4) == 0 && memcmp(header + 8, "WAVE", 4) == 0;
+	try
+	{
+		if (format == "wav" || (format == "auto" && isWav))
+		{
+			if (!isWav)
+			{
+				throw std::invalid_argument(path + " is not a WAV file");
+			}
+			WavFormat wav = readWavHeader(file, path);
+			bool supported = (wav.formatTag == 1 && wav.bytesPerSample >= 1 && wav.bytesPerSample <= 4)
+				|| (wav.formatTag == 3 && (wav.bytesPerSample == 4 || wav.bytesPerSample == 8));
+			if (!supported || wav.channels <= 0)
+			{
+				throw std::invalid_argument(path + " uses an unsupported WAV encoding");
+			}
+			if (wav.sampleRate != config.sampleRate)
+			{
+				throw std::invalid_argument(path + " is sampled at " + std::to_string((int)wav.sampleRate)
+					+ " Hz, the detector expects " + std::to_string((int)config.sampleRate) + " Hz");
+			}
+			formatTag = wav.formatTag;
+			bytesPerSample = wav.bytesPerSample;
+			fileChannels = wav.channels;
+			remainingBytes = wav.dataBytes;
+		}
+		else
+		{
+			// Raw captures are float32 at the detector's sample rate
+			fseek(file, 0, SEEK_SET);
+			formatTag = 3;
+			bytesPerSample = 4;
+			fileChannels = channels;
+			remainingBytes = UINT64_MAX;
+		}
+		int highest = *std::max_element(channelList.begin(), channelList.end());
+		if (highest >= fileChannels)
+		{
+			throw std::invalid_argument(path + " has no channel " + std::to_string(highest));
+		}
+	}
+	catch (...)
+	{
+		close();
+		throw;
+	}
+}
+
+size_t FileSource::read_block(float* out, size_t maxFrames) {
+	size_t frameBytes = (size_t)bytesPerSample * fileChannels;
+	size_t wanted = std::min((uint64_t)maxFrames, remainingBytes / frameBytes);
+	raw.resize(wanted * frameBytes);
+
+	size_t count = fread(raw.data(), frameBytes, wanted, file);
+	remainingBytes -= count * frameBytes;
+	if (count < wanted && ferror(file))
+	{
+		fail("Error reading " + path);
+	}
+
+	const size_t k = channelList.size();
+	for (size_t i = 0; i < count; i++)
+	{
+		for (size_t c = 0; c < k; c++)
+		{
+			out[i * k + c] = decodeSample(raw.data() + i * frameBytes + (size_t)channelList[c] * bytesPerSample,
+			                              formatTag, bytesPerSample);
+		}
+	}
+	return count;
+}
+
+std::vector<int> FileSource::input_channels() const {
+	return channelList;
+}
+
+void FileSource::close() {
+	if (file != NULL)
+	{
+		fclose(file);
+		file = NULL;
+	}
+}
+
+const std::string& FileSource::get_path() const {
+	return path;
+}
+
+// BufferSource class implementation
+BufferSource::BufferSource(const float* samples, size_t count, bool realtime)
+	: FeederSource(realtime), samples(samples, samples + count) {
+}
+
+BufferSource::~BufferSource() {
+	stop();
+}
+
+void BufferSource::open(const AnalysisConfig& config) {
+	(void)config;
+	position = 0;
+}
+
+size_t BufferSource::read_block(float* out, size_t maxSamples) {
+	size_t count = std::min(maxSamples, samples.size() - position);
+	std::copy(samples.begin() + position, samples.begin() + position + count, out);
+	position += count;
+	return count;
+}
+
+size_t BufferSource::size() const {
+	return samples.size();
+}
+
+// RecordingSource class implementation
+RecordingSource::RecordingSource(const std::string& directory, double start, double end, bool realtime)
+	: FeederSource(realtime), directory(directory), start(start), end(end) {
+	if (!std::isnan(start) && !std::isnan(end) && !(end > start))
+	{
+		throw std::invalid_argument("end must be after start");
+	}
+}
+
+RecordingSource::~RecordingSource() {
+	stop();
+	close();
+}
+
+// Sample of a segment at a stream time, clamped to the samples it holds
+static uint64_t recordedSampleAt(const RecordingHeader* header, uint64_t count, double time) {
+	double offset = std::ceil((time - header->startTime) * header->sampleRate - 1e-6);
+	return (uint64_t)std::min(std::max(offset, 0.0), (double)count);
+}
+
+void RecordingSource::open(const AnalysisConfig& config) {
+	close();
+	DIR* dir = opendir(directory.c_str());
+	if (dir == NULL)
+	{
+		throw std::invalid_argument("Cannot open recording " + directory);
+	}
+	std::vector<std::string> paths;
+	while (struct dirent* entry = readdir(dir))
+	{
+		std::string name = entry->d_name;
+		if (name.rfind("segment-", 0) == 0 && name.size() > 14 && name.compare(name.size() - 6, 6, ".vrrec") == 0)
+		{
+			paths.push_back(directory + "/" + name);
+		}
+	}
+	closedir(dir);
+
+	try
+	{
+		for (const std::string& path : paths)
+		{
+			int fd = ::open(path.c_str(), O_RDONLY);
+			struct stat info;
+			if (fd < 0 || fstat(fd, &info) != 0 || (size_t)info.st_size < RECORDING_HEADER_SIZE)
+			{
+				// Removed by the recorder's rotation since the directory was listed
+				if (fd >= 0)
+				{
+					::close(fd);
+				}
+				continue;
+			}
+			void* mapped = mmap(NULL, info.st_size, PROT_READ, MAP_SHARED, fd, 0);
+			::close(fd);
+			if (mapped == MAP_FAILED)
+			{
+				throw std::runtime_error("Could not map " + path + ": " + strerror(errno));
+			}
+			const RecordingHeader* header = static_cast<const RecordingHeader*>(mapped);
+			segments.push_back({header, (size_t)info.st_size, 0, header->samples.load(std::memory_order_acquire)});
+			if (memcmp(header->magic, RECORDING_MAGIC, sizeof(RECORDING_MAGIC)) != 0 || header->version != RECORDING_VERSION)
+			{
+				throw std::invalid_argument(path + " is not a capture segment (version "
+				                            + std::to_string(RECORDING_VERSION) + ")");
+			}
+			if (header->sampleRate != config.sampleRate)
+			{
+				throw std::invalid_argument(path + " is sampled at " + std::to_string((int)header->sampleRate)
+					+ " Hz, the detector expects " + std::to_string((int)config.sampleRate) + " Hz");
+			}
+		}
+		std::sort(segments.begin(), segments.end(), [](const Segment& a, const Segment& b) {
+			return a.header->segment < b.header->segment;
+		});
+
+		// Keep what overlaps [start, end), the first part starting on a frame boundary
+		std::vector<Segment> kept;
+		for (Segment& segment : segments)
+		{
+			const RecordingHeader* header = segment.header;
+			if (!std::isnan(end))
+			{
+				segment.end = recordedSampleAt(header, segment.end, end);
+			}
+			if (!std::isnan(start))
+			{
+				segment.begin = recordedSampleAt(header, segment.end, start);
+			}
+			if (kept.empty())
+			{
+				uint64_t first = header->firstSample + segment.begin;
+				segment.begin += (header->hop - first % header->hop) % header->hop;
+			}
+			if (segment.begin < segment.end)
+			{
+				kept.push_back(segment);
+			}
+			else
+			{
+				munmap(const_cast<RecordingHeader*>(header), segment.size);
+			}
+		}
+		segments = kept;
+	}
+	catch (...)
+	{
+		close();
+		throw;
+	}
+
+	current = 0;
+	position = segments.empty() ? 0 : segments[0].begin;
+	firstTime = segments.empty() ? 0.0 : segments[0].header->startTime + position / segments[0].header->sampleRate;
+}
+
+size_t RecordingSource::read_block(float* out, size_t maxSamples) {
+	size_t count = 0;
+	while (count < maxSamples && current < segments.size())
+	{
+		const Segment& segment = segments[current];
+		const float* samples = reinterpret_cast<const float*>(
+			reinterpret_cast<const unsigned char*>(segment.header) + RECORDING_HEADER_SIZE);
+		size_t length = std::min((uint64_t)(maxSamples - count), segment.end - position);
+		std::copy(samples + position, samples + position + length, out + count);
+		count += length;
+		position += length;
+		if (position == segment.end && ++current < segments.size())
+		{
+			position = segments[current].begin;
+		}
+	}
+	return count;
+}
+
+void RecordingSource::close() {
+	for (const Segment& segment : segments)
+	{
+		munmap(const_cast<RecordingHeader*>(segment.header), segment.size);
+	}
+	segments.clear();
+}
+
+double RecordingSource::start_time() const {
+	return firstTime;
+}
+
+const std::string& RecordingSource::get_directory() const {
+	return directory;
+}
+
+// ---------------------------------------------------------------------------------
+// 
+// Vowel classifier
+//
+// ---------------------------------------------------------------------------------
+
+// Frames remember which classifier labelled them by this id, a swapped model never
+// reinterprets a decision of the previous one
+static std::atomic<uint64_t> nextClassifierId(1);
+
+VowelClassifier::VowelClassifier(const std::string& kind, const std::vector<std::string>& labels)
+	: kind(kind), labels(labels), id(nextClassifierId++) {
+	if (labels.empty() || labels.size() > 255)
+	{
+		throw std::invalid_argument("A vowel model needs between 1 and 255 labels");
+	}
+}
+
+std::shared_ptr<VowelClassifier> VowelClassifier::centroid(const std::vector<std::string>& labels,
+                                                           const std::vector<double>& means, double variance) {
+	if (!(variance > 0))
+	{
+		throw std::invalid_argument("variance must be positive");
+	}
+	std::vector<double> precisions;
+	for (size_t k = 0; k < labels.size(); k++)
+	{
+		precisions.insert(precisions.end(), {1.0 / variance, 0.0, 0.0, 1.0 / variance});
+	}
+	auto model = gaussian(labels, means, precisions, std::vector<double>(labels.size(), 0.0));
+	model->kind = "centroid";
+	return model;
+}
+
+std::shared_ptr<VowelClassifier> VowelClassifier::gaussian(const std::vector<std::string>& labels,
+                                                           const std::vector<double>& means,
+                                                           const std::vector<double>& precisions,
+                                                           const std::vector<double>& offsets) {
+	std::shared_ptr<VowelClassifier> model(new VowelClassifier("gaussian", labels));
+	size_t k = labels.size();
+	if (means.size() != 2 * k || precisions.size() != 4 * k || offsets.size() != k)
+	{
+		throw std::invalid_argument("Expected a [F1, F2] mean, a 2x2 precision and an offset per label");
+	}
+	model->means = means;
+	model->precisions = precisions;
+	model->offsets = offsets;
+	return model;
+}
+
+std::shared_ptr<VowelClassifier> VowelClassifier::lookup_grid(const std::vector<std::string>& labels,
+                                                              const std::vector<uint8_t>& grid,
+                                                              const std::vector<float>& confidences,
+                                                              int cells, double minHz, double cellHz) {
+	std::shared_ptr<VowelClassifier> model(new VowelClassifier("grid", labels));
+	if (cells <= 0 || grid.size() != (size_t)cells * cells || confidences.size() != grid.size())
+	{
+		throw std::invalid_argument("Expected cells x cells labels and confidences");
+	}
+	if (!(cellHz > 0))
+	{
+		throw std::invalid_argument("cell_hz must be positive");
+	}
+	for (uint8_t label : grid)
+	{
+		if (label >= labels.size())
+		{
+			throw std::invalid_argument("The grid refers to a label that does not exist");
+		}
+	}
+	model->grid = grid;
+	model->gridConfidences = confidences;
+	model->cells = cells;
+	model->minHz = minHz;
+	model->cellHz = cellHz;
+	return model;
+}
+
+// Two passes over the classes, the best score and then the softmax denominator, so
+// classifying needs no scratch memory
+int VowelClassifier::classify(double f1, double f2, double& confidence) const {
+	confidence = 0.0;
+	if (!(f1 > 0.0) || !(f2 > 0.0))
+	{
+		return -1;
+	}
+
+	if (!grid.empty())
+	{
+		int row = clamp((int)std::floor((f1 - minHz) / cellHz), 0, cells - 1);
+		int column = clamp((int)std::floor((f2 - minHz) / cellHz), 0, cells - 1);
+		size_t cell = (size_t)row * cells + column;
+		confidence = gridConfidences[cell];
+		return grid[cell];
+	}
+
+	auto score = [&](size_t k) {
+		double d1 = f1 - means[2 * k];
+		double d2 = f2 - means[2 * k + 1];
+		const double* p = &precisions[4 * k];
+		return offsets[k] - 0.5 * (d1 * (p[0] * d1 + p[1] * d2) + d2 * (p[2] * d1 + p[3] * d2));
+	};
+	int best = 0;
+	double bestScore = score(0);
+	for (size_t k = 1; k < labels.size(); k++)
+	{
+		double s = score(k);
+		if (s > bestScore)
+		{
+			best = (int)k;
+			bestScore = s;
+		}
+	}
+	double total = 0.0;
+	for (size_t k = 0; k < labels.size(); k++)
+	{
+		total += std::exp(score(k) - bestScore);
+	}
+	confidence = 1.0 / total;
+	return best;
+}
+
+const std::string& VowelClassifier::get_kind() const {
+	return kind;
+}
+
+const std::vector<std::string>& VowelClassifier::get_labels() const {
+	return labels;
+}
+
+uint64_t VowelClassifier::get_id() const {
+	return id;
+}
+
+// ---------------------------------------------------------------------------------
+// 
+// API - streamClass Implementation
+//
+// ---------------------------------------------------------------------------------
+
+streamClass::streamClass(const AnalysisConfig& config)
+	: config((validateConfig(config), config)),
+	  analyzer(analyzedConfig(config)),
+	  samples((size_t)SAMPLE_RING_FRAMES * config.frameSize) {
+	spectroData.in = NULL;
+	spectroData.out = NULL;
+	set_channels({0});
+	const int n = config.frameSize / config.decimation;
+	double sampleRatio = config.frameSize / config.sampleRate;
+	spectroData.startIndex = std::ceil(sampleRatio * config.freqStart);
+	spectroData.spectralSize = std::min(
+		std::ceil(sampleRatio * config.freqEnd),
+		n/2.0) 
+		- spectroData.startIndex;
+
+	spectrum = std::make_shared<SpectrumBuffer>(analyzer.band_size());
+
+	cbState = std::make_unique<CallbackState>();
+	cbState->samples = &samples;
+	cbState->sampleNotifier = &sampleNotifier;
+	cbState->spaceNotifier = &spaceNotifier;
+	cbState->clock = &clock;
+	cbState->channelCount = NUM_CHANNELS;
+	cbState->backpressure = false;
+	hop = config.frameSize;
+
+	acquirePortAudio();
+}
+
+streamClass::~streamClass() {
+	stop_stats_dump();
+	if (source != nullptr)
+	{
+		try
+		{
+			stop_stream();
+		}
+		catch (const std::exception&)
+		{
+		}
+	}
+	stop_recording();
+	releasePortAudio();
+
+	fftw_free(spectroData.in);
+	fftw_free(spectroData.out);
+}
+
+void streamClass::start_stream(int deviceInput, std::optional<int> hop, int channel) {
+	start_stream(std::make_shared<PortAudioSource>(deviceInput, channel), hop);
+}
+
+// Sizes the per-channel analysis state for the channels of the next source. The FFT
+// of every channel is one plan over adjacent frames (fftw_plan_many_r2r); the plan is
+// shared with other detectors and executed on our buffers with fftw_execute_r2r.
+void streamClass::set_channels(const std::vector<int>& channels) {
+	const size_t k = channels.size();
+	if (k != gates.size())
+	{
+		// The FFT runs on the decimated frame, a zoomed analysis has its own transform
+		const int n = config.frameSize / config.decimation;
+		fftw_plan plan = analyzer.zoomed() ? NULL : cachedR2HCPlan(n, (int)k, config.planRigor, config.wisdomFile);
+		double* in = fftw_alloc_real((size_t)n * k);
+		double* out = fftw_alloc_real((size_t)n * k);
+		if (in == NULL || out == NULL)
+		{
+			fftw_free(in);
+			fftw_free(out);
+			throw std::bad_alloc();
+		}
+		fftw_free(spectroData.in);
+		fftw_free(spectroData.out);
+		spectroData.in = in;
+		spectroData.out = out;
+		spectroData.p = plan;
+
+		decimators.assign(k, Decimator(config));
+		gates.clear();
+		for (size_t c = 0; c < k; c++)
+		{
+			gates.push_back(std::make_unique<VoiceGate>(analyzedConfig(config)));
+		}
+	}
+	channelNumbers = channels;
+}
+
+void streamClass::start_stream(std::shared_ptr<AudioSource> source, std::optional<int> hop) {
+	if (source == nullptr)
+	{
+		throw std::invalid_argument("A source is required");
+	}
+	int frameHop = hop.value_or(config.frameSize);
+	if (frameHop <= 0 || frameHop > config.frameSize)
+	{
+		throw std::invalid_argument("hop must be between 1 and frame_size samples");
+	}
+	if (frameHop % config.decimation != 0)
+	{
+		throw std::invalid_argument("hop must be a multiple of decimation");
+	}
+	if (this->source != nullptr)
+	{
+		if (streaming)
+		{
+			throw std::runtime_error("The stream is already running");
+		}
+		// The previous source ran out, collect its threads before starting over
+		try
+		{
+			stop_stream();
+		}
+		catch (const std::exception&)
+		{
+		}
+	}
+	std::vector<int> channels = source->input_channels();
+	validateChannels(channels);
+	set_channels(channels);
+	this->hop = frameHop;
+	std::shared_ptr<CaptureRecorder> capture = std::atomic_load(&recorder);
+	if (capture != nullptr)
+	{
+		capture->set_hop(frameHop);
+	}
+
+	samples.reset((int)channels.size());
+	cbState->finished = false;
+	analysisRunning = true;
+	analysisThread = std::thread(&streamClass::analysis_loop, this);
+	streaming = true;
+
+	try
+	{
+		source->start(cbState.get(), config, this->hop);
+	}
+	catch (...)
+	{
+		stop_analysis();
+		throw;
+	}
+	this->source = source;
+}
+
+void streamClass::stop_stream() {
+	if (source == nullptr)
+	{
+		return;
+	}
+	std::shared_ptr<AudioSource> stopped = std::move(source);
+	source = nullptr;
+
+	std::exception_ptr failure;
+	try
+	{
+		stopped->stop();
+	}
+	catch (...)
+	{
+		failure = std::current_exception();
+	}
+	stop_analysis();
+
+	if (failure)
+	{
+		std::rethrow_exception(failure);
+	}
+	std::string error = stopped->error();
+	if (!error.empty())
+	{
+		throw std::runtime_error(error);
+	}
+}
+
+void streamClass::stop_analysis() {
+	// Let the worker finish the complete frames still in the ring
+	analysisRunning = false;
+	sampleNotifier.notify();
+	analysisThread.join();
+}
+
+// Sliding STFT over the sample ring: the first frame waits for frame_size
+// samples, every following one for hop new samples. Exits once stopped or once the
+// source has finished, after analyzing every complete frame left in the ring.
+// With decimation the window holds decimated samples: every step reads need *
+// decimation input samples and decimates them into the window.
+// Every channel has its own window, one after the other, and every step publishes a
+// frame per channel, all with the same index and time.
+void streamClass::analysis_loop() {
+	const int factor = config.decimation;
+	const int n = config.frameSize / factor;
+	const int step = hop / factor;
+	const int channels = (int)channelNumbers.size();
+	std::vector<float> windows((size_t)n * channels);
+	std::vector<float> input(factor > 1 ? (size_t)config.frameSize * channels : 0);
+	std::vector<GateMeasure> measures(channels);
+	std::vector<char> voiced(channels);
+	std::vector<Formants> formants(channels);
+	std::vector<FormantFrame> frames(channels);
+	int filled = 0;
+	uint64_t frameStart = 0;
+	uint64_t consumed = 0;
+	for (int c = 0; c < channels; c++)
+	{
+		decimators[c].reset();
+		gates[c]->reset();
+	}
+
+	while (true)
+	{
+		int need = filled < n ? n - filled : step;
+		if (samples.available() < (size_t)need * factor)
+		{
+			if (!analysisRunning || cbState->finished)
+			{
+				// Check again, the last block may have landed after the first check
+				if (samples.available() < (size_t)need * factor)
+				{
+					break;
+				}
+				continue;
+			}
+			sampleNotifier.wait(0.1);
+			continue;
+		}
+
+		uint64_t frameStartNs = monotonicNs();
+		std::shared_ptr<CaptureRecorder> capture = std::atomic_load(&recorder);
+		if (filled == n)
+		{
+			for (int c = 0; c < channels; c++)
+			{
+				float* window = windows.data() + (size_t)c * n;
+				std::copy(window + step, window + n, window);
+			}
+			filled -= step;
+			frameStart += hop;
+		}
+		if (factor > 1)
+		{
+			samples.read(input.data(), need * factor, config.frameSize);
+			if (cbState->backpressure)
+			{
+				spaceNotifier.notify();
+			}
+			uint64_t decimateStart = monotonicNs();
+			for (int c = 0; c < channels; c++)
+			{
+				decimators[c].process(input.data() + (size_t)c * config.frameSize, need * factor,
+				                      windows.data() + (size_t)c * n + filled);
+			}
+			stageTimes[STAGE_DECIMATE].record(monotonicNs() - decimateStart);
+		}
+		else
+		{
+			samples.read(windows.data() + filled, need, n);
+			if (cbState->backpressure)
+			{
+				spaceNotifier.notify();
+			}
+		}
+		// Handed to the recorder with the frame, neither buffer changes before then.
+		// Recordings hold the primary channel.
+		const float* read = factor > 1 ? input.data() : windows.data() + filled;
+		uint64_t readPosition = consumed;
+		consumed += (uint64_t)need * factor;
+		filled += need;
+
+		bool anyVoiced = false;
+		for (int c = 0; c < channels; c++)
+		{
+			uint64_t gateStart = monotonicNs();
+			voiced[c] = gates[c]->update(windows.data() + (size_t)c * n, measures[c]);
+			if (config.gate)
+			{
+				stageTimes[STAGE_GATE].record(monotonicNs() - gateStart);
+			}
+			anyVoiced = anyVoiced || voiced[c];
+		}
+
+		// Silent or unvoiced frames are published without a transform. The channels
+		// share one transform, a silent channel in it is left at zero.
+		if (anyVoiced)
+		{
+			for (int c = 0; c < channels; c++)
+			{
+				const float* window = windows.data() + (size_t)c * n;
+				double* in = spectroData.in + (size_t)c * n;
+				if (voiced[c])
+				{
+					std::copy(window, window + n, in);
+				}
+				else
+				{
+					std::fill(in, in + n, 0.0);
+				}
+			}
+			if (!analyzer.zoomed())
+			{
+				uint64_t fftStart = monotonicNs();
+				fftw_execute_r2r(spectroData.p, spectroData.in, spectroData.out);
+				stageTimes[STAGE_FFT].record(monotonicNs() - fftStart);
+			}
+		}
+
+		SampleClock anchor = clock.load();
+		const uint64_t index = frameIndex++;
+		const double time = anchor.time + ((double)frameStart - (double)anchor.position) / config.sampleRate;
+		std::shared_ptr<const VowelClassifier> model = anyVoiced ? std::atomic_load(&classifier) : nullptr;
+		std::shared_ptr<SharedSpectrogram> shared = std::atomic_load(&spectrogram);
+		for (int c = 0; c < channels; c++)
+		{
+			formants[c] = {0.0, 0.0, 0.0};
+			if (voiced[c])
+			{
+				StageTimings timings;
+				bool found = analyzer.zoomed()
+					? analyzer.analyze_frame(spectroData.in + (size_t)c * n, formants[c], &timings)
+					: analyzer.analyze(spectroData.out + (size_t)c * n, formants[c], &timings);
+				if (found)
+				{
+					if (c == 0)
+					{
+						formant.set_formants(formants[c].f1, formants[c].f2);
+					}
+				}
+				else
+				{
+					framesWithoutFormants.fetch_add(1, std::memory_order_relaxed);
+				}
+				if (analyzer.zoomed())
+				{
+					stageTimes[STAGE_FFT].record(timings.transform);
+				}
+				stageTimes[STAGE_SMOOTHING].record(timings.smoothing);
+				stageTimes[STAGE_DERIVATIVE].record(timings.derivative);
+				stageTimes[STAGE_PEAKS].record(timings.peaks);
+			}
+			else
+			{
+				gatedFrames.fetch_add(1, std::memory_order_relaxed);
+			}
+
+			FormantFrame& frame = frames[c];
+			frame.f1 = formants[c].f1;
+			frame.f2 = formants[c].f2;
+			frame.magnitude = formants[c].magnitude;
+			frame.time = time;
+			frame.index = index;
+			frame.vowel = -1;
+			frame.confidence = 0.0f;
+			frame.level = (float)measures[c].level;
+			frame.voiced = voiced[c];
+			frame.channel = (uint16_t)channelNumbers[c];
+
+			// The analyzer's band still holds this channel's spectrum
+			if (c == 0)
+			{
+				if (voiced[c])
+				{
+					double* slot = spectrum->begin_write();
+					if (slot != NULL)
+					{
+						std::copy(analyzer.band(), analyzer.band() + spectrum->size(), slot);
+						spectrum->publish(frame.index);
+					}
+				}
+				if (shared != nullptr)
+				{
+					shared->write(frame.time, frame.index, voiced[c] ? analyzer.band() : NULL);
+				}
+			}
+
+			if (model != nullptr && voiced[c])
+			{
+				uint64_t classifyStart = monotonicNs();
+				double confidence;
+				frame.vowel = model->classify(frame.f1, frame.f2, confidence);
+				frame.confidence = (float)confidence;
+				if (frame.vowel >= 0 && c == 0)
+				{
+					vowel.store({model->get_id(), frame.vowel, confidence, frame.time});
+				}
+				stageTimes[STAGE_CLASSIFY].record(monotonicNs() - classifyStart);
+			}
+		}
+
+		// Waiting for the consumer below is not work, the frame is timed up to here
+		uint64_t frameNs = monotonicNs() - frameStartNs;
+		stageTimes[STAGE_FRAME].record(frameNs);
+		double frameLoad = frameNs / (1e9 * hop / config.sampleRate);
+		load.store(load.load(std::memory_order_relaxed) * (1.0 - LOAD_SMOOTHING) + frameLoad * LOAD_SMOOTHING,
+		           std::memory_order_relaxed);
+		if (frameLoad > peakLoad.load(std::memory_order_relaxed))
+		{
+			peakLoad.store(frameLoad, std::memory_order_relaxed);
+		}
+
+		// A free-running source waits for the consumer and the recorder instead of losing frames
+		while (cbState->backpressure && analysisRunning
+		       && (history.available() + channels > FORMANT_HISTORY_SIZE || (capture != nullptr && !capture->has_room())))
+		{
+			std::this_thread::sleep_for(std::chrono::milliseconds(1));
+		}
+		for (const FormantFrame& frame : frames)
+		{
+			history.push(frame);
+		}
+		notifier.notify();
+		if (capture != nullptr)
+		{
+			capture->add(read, (size_t)need * factor, readPosition,
+			             anchor.time + ((double)readPosition - (double)anchor.position) / config.sampleRate, frames[0]);
+		}
+	}
+
+	// Wake anyone blocked in wait_for_frames or an async iterator so they see the end
+	streaming = false;
+	notifier.notify();
+}
+
+void streamClass::print_devices() {
+	std::vector<AudioDevice> devices = audioDevices();
+	printf("Number of devices %d\n", (int)devices.size());
+
+	if (devices.empty())
+	{
+		printf("No available audio devices on this machine!\n");
+	}
+	for (const AudioDevice& device : devices)
+	{
+		printf("Device %d:\n", device.index);
+		printf("   name: %s\n", device.name.c_str());
+		printf("   hostApi: %s\n", device.hostApi.c_str());
+		printf("   maxInputChannels: %d\n", device.maxInputChannels);
+		printf("   maxOutputChannels: %d\n", device.maxOutputChannels);
+		printf("   defaultSampleRate: %f\n", device.defaultSampleRate);
+	}
+	fflush(stdout);
+}
+
+std::vector<double> streamClass::get_formants() {
+	return formant.get_formants();
+}
+
+size_t streamClass::drain(FormantFrame* out, size_t maxFrames) {
+	return history.drain(out, maxFrames);
+}
+
+size_t streamClass::pending_frames() const {
+	return history.available();
+}
+
+bool streamClass::latest(FormantFrame& frame) const {
+	return history.latest(frame);
+}
+
+// From the last callback: its buffer's stream time arrived at receivedNs. The offset
+// drifts with the device clock, so it is only read when frames are drained.
+double streamClass::receive_offset() const {
+	SampleClock anchor = clock.load();
+	return anchor.receivedNs * 1e-9 - anchor.time;
+}
+
+// Blocks until at least one undrained frame is available. Returns false on timeout
+// (negative waits forever) or when the stream is not running.
+bool streamClass::wait_for_frames(double timeoutSeconds) {
+	auto deadline = std::chrono::steady_clock::now() + std::chrono::duration<double>(timeoutSeconds);
+	while (history.available() == 0)
+	{
+		if (!streaming)
+		{
+			return false;
+		}
+
+		double remaining = -1.0;
+		if (timeoutSeconds >= 0)
+		{
+			remaining = std::chrono::duration<double>(deadline - std::chrono::steady_clock::now()).count();
+			if (remaining <= 0)
+			{
+				return false;
+			}
+		}
+		notifier.wait(remaining);
+	}
+	return true;
+}
+
+bool streamClass::is_streaming() const {
+	return streaming;
+}
+
+int streamClass::notify_fd() const {
+	return notifier.fd();
+}
+
+void streamClass::clear_notification() {
+	notifier.clear();
+}
+
+const AnalysisConfig& streamClass::get_config() const {
+	return config;
+}
+
+// Takes effect from the next analyzed frame, nullptr stops labelling frames
+void streamClass::load_model(std::shared_ptr<const VowelClassifier> model) {
+	std::atomic_store(&classifier, model);
+}
+
+std::shared_ptr<const VowelClassifier> streamClass::get_model() const {
+	return std::atomic_load(&classifier);
+}
+
+// The last vowel recognized by the loaded model, false if it has not recognized any yet
+bool streamClass::get_vowel(VowelDecision& decision) const {
+	std::shared_ptr<const VowelClassifier> model = get_model();
+	if (model == nullptr || vowel.empty())
+	{
+		return false;
+	}
+	decision = vowel.load();
+	return decision.model == model->get_id();
+}
+
+StreamStats streamClass::get_stats() const {
+	StreamStats stats;
+	stats.callbacks = cbState->callbacks.load();
+	stats.overruns = cbState->overruns.load();
+	stats.droppedSamples = cbState->droppedSamples.load();
+	stats.droppedFrames = history.dropped_frames();
+	stats.frames = frameIndex.load();
+	stats.backlogSamples = samples.available();
+	stats.inputOverflows = cbState->inputOverflows.load();
+	stats.inputUnderflows = cbState->inputUnderflows.load();
+	stats.framesWithoutFormants = framesWithoutFormants.load();
+	stats.gatedFrames = gatedFrames.load();
+	stats.load = load.load();
+	stats.peakLoad = peakLoad.load();
+	stats.stages[STAGE_CALLBACK] = cbState->callbackTime.snapshot();
+	for (int stage = STAGE_CALLBACK + 1; stage < STAGE_COUNT; stage++)
+	{
+		stats.stages[stage] = stageTimes[stage].snapshot();
+	}
+	return stats;
+}
+
+std::shared_ptr<SpectrumBuffer> streamClass::get_spectrum() const {
+	return spectrum;
+}
+
+std::vector<double> streamClass::spectrum_frequencies() const {
+	std::vector<double> frequencies(analyzer.band_size());
+	for (size_t bin = 0; bin < frequencies.size(); bin++)
+	{
+		frequencies[bin] = analyzer.band_frequency(bin);
+	}
+	return frequencies;
+}
+
+// Every following frame also goes to a spectrogram in shared memory, replacing the
+// one written so far. Frames the gate skipped are rows of zeros.
+void streamClass::start_spectrogram(const std::string& name, size_t capacity) {
+	AnalysisConfig analyzed = analyzedConfig(config);
+	auto shared = std::make_shared<SharedSpectrogram>(name, analyzer.band_size(), capacity, analyzed.sampleRate,
+	                                                  analyzer.band_frequency(0), analyzer.band_spacing());
+	std::atomic_store(&spectrogram, shared);
+}
+
+void streamClass::stop_spectrogram() {
+	std::atomic_store(&spectrogram, std::shared_ptr<SharedSpectrogram>());
+}
+
+std::string streamClass::spectrogram_name() const {
+	std::shared_ptr<SharedSpectrogram> shared = std::atomic_load(&spectrogram);
+	return shared != nullptr ? shared->get_name() : "";
+}
+
+// Records the input and frames of every following frame into directory, see
+// CaptureRecorder. Replaces a recording already running.
+void streamClass::start_recording(const std::string& directory, double segmentSeconds, size_t maxSegments) {
+	stop_recording();
+	auto capture = std::make_shared<CaptureRecorder>(directory, config, hop, segmentSeconds, maxSegments);
+	std::atomic_store(&recorder, capture);
+}
+
+// The analysis thread may hold on to the recorder for one more frame, which then
+// goes nowhere: the writer has already stopped
+void streamClass::stop_recording() {
+	std::shared_ptr<CaptureRecorder> capture = std::atomic_exchange(&recorder, std::shared_ptr<CaptureRecorder>());
+	if (capture != nullptr)
+	{
+		capture->close();
+	}
+}
+
+std::shared_ptr<CaptureRecorder> streamClass::get_recorder() const {
+	return std::atomic_load(&recorder);
+}
+
+// "json" or "prometheus" text of get_stats(), name labels the Prometheus series
+std::string streamClass::format_stats(const std::string& format, const std::string& name) const {
+	if (format == "json")
+	{
+		return statsToJson(get_stats());
+	}
+	if (format == "prometheus")
+	{
+		return statsToPrometheus(get_stats(), name);
+	}
+	throw std::invalid_argument("Unknown stats format '" + format + "', expected 'json' or 'prometheus'");
+}
+
+// Rewrites path every interval seconds until stop_stats_dump, and once more on stop
+void streamClass::start_stats_dump(const std::string& path, double interval, const std::string& format, const std::string& name) {
+	if (!(interval > 0))
+	{
+		throw std::invalid_argument("interval must be positive");
+	}
+	format_stats(format, name);
+	stop_stats_dump();
+	writeFileAtomically(path, format_stats(format, name));
+	{
+		std::lock_guard<std::mutex> lock(dumpMutex);
+		dumpRunning = true;
+	}
+	dumpThread = std::thread(&streamClass::dump_loop, this, path, interval, format, name);
+}
+
+void streamClass::stop_stats_dump() {
+	{
+		std::lock_guard<std::mutex> lock(dumpMutex);
+		if (!dumpRunning)
+		{
+			return;
+		}
+		dumpRunning = false;
+	}
+	dumpWake.notify_all();
+	dumpThread.join();
+}
+
+void streamClass::dump_loop(std::string path, double interval, std::string format, std::string name) {
+	std::unique_lock<std::mutex> lock(dumpMutex);
+	while (true)
+	{
+		bool stopped = dumpWake.wait_for(lock, std::chrono::duration<double>(interval), [this] { return !dumpRunning; });
+		lock.unlock();
+		try
+		{
+			writeFileAtomically(path, format_stats(format, name));
+		}
+		catch (const std::exception& e)
+		{
+			// Keep trying, the directory may come back (a full disk, a remount)
+			fprintf(stderr, "formant_detector: could not write stats to %s: %s\n", path.c_str(), e.what());
+		}
+		lock.lock();
+		if (stopped)
+		{
+			return;
+		}
+	}
+}
+
+// ---------------------------------------------------------------------------------
+// 
+// API - DetectorGroup Implementation
+//
+// ---------------------------------------------------------------------------------
+
+DetectorGroup::DetectorGroup(const std::vector<GroupInput>& inputs, const AnalysisConfig& config)
+	: inputs(inputs) {
+	if (inputs.empty())
+	{
+		throw std::invalid_argument("A detector group needs at least one input");
+	}
+	for (size_t i = 0; i < inputs.size(); i++)
+	{
+		detectors.emplace_back(new streamClass(config));
+	}
+}
+
+// All or nothing: if one input fails to start, the ones already started are stopped
+void DetectorGroup::start(std::optional<int> hop) {
+	for (size_t i = 0; i < detectors.size(); i++)
+	{
+		try
+		{
+			detectors[i]->start_stream(inputs[i].device, hop, inputs[i].channel);
+		}
+		catch (...)
+		{
+			stop();
+			throw;
+		}
+	}
+}
+
+void DetectorGroup::stop() {
+	for (auto& d : detectors)
+	{
+		d->stop_stream();
+	}
+}
+
+size_t DetectorGroup::size() const {
+	return detectors.size();
+}
+
+streamClass& DetectorGroup::detector(size_t i) {
+	if (i >= detectors.size())
+	{
+		throw std::out_of_range("No detector " + std::to_string(i) + " in the group");
+	}
+	return *detectors[i];
+}
+
+const GroupInput& DetectorGroup::input(size_t i) const {
+	return inputs.at(i);
+}
+
+size_t DetectorGroup::pending_frames() const {
+	size_t pending = 0;
+	for (auto& d : detectors)
+	{
+		pending += d->pending_frames();
+	}
+	return pending;
+}
+
+std::vector<GroupFrame> DetectorGroup::drain() {
+	std::vector<GroupFrame> frames;
+	for (size_t i = 0; i < detectors.size(); i++)
+	{
+		scratch.resize(detectors[i]->pending_frames());
+		size_t count = detectors[i]->drain(scratch.data(), scratch.size());
+		double offset = detectors[i]->receive_offset();
+		for (size_t k = 0; k < count; k++)
+		{
+			const FormantFrame& f = scratch[k];
+			frames.push_back({(int32_t)i, f.f1, f.f2, f.magnitude, f.time, f.time + offset, f.index, f.vowel,
+			                  f.confidence, f.level, f.voiced});
+		}
+	}
+	std::stable_sort(frames.begin(), frames.end(), [](const GroupFrame& a, const GroupFrame& b) {
+		return a.received < b.received;
+	});
+	return frames;
+}
+
+void DetectorGroup::load_model(std::shared_ptr<const VowelClassifier> model) {
+	for (auto& d : detectors)
+	{
+		d->load_model(model);
+	}
+}
+
+// poll() on every detector's notification descriptor at once
+bool DetectorGroup::wait_for_frames(double timeoutSeconds) {
+	std::vector<struct pollfd> fds;
+	for (auto& d : detectors)
+	{
+		fds.push_back({d->notify_fd(), POLLIN, 0});
+	}
+
+	auto deadline = std::chrono::steady_clock::now() + std::chrono::duration<double>(timeoutSeconds);
+	while (pending_frames() == 0)
+	{
+		bool anyStreaming = false;
+		for (auto& d : detectors)
+		{
+			anyStreaming = anyStreaming || d->is_streaming();
+		}
+		if (!anyStreaming)
+		{
+			return false;
+		}
+
+		int timeoutMs = -1;
+		if (timeoutSeconds >= 0)
+		{
+			double remaining = std::chrono::duration<double>(deadline - std::chrono::steady_clock::now()).count();
+			if (remaining <= 0)
+			{
+				return false;
+			}
+			timeoutMs = (int)std::ceil(remaining * 1000.0);
+		}
+		if (poll(fds.data(), fds.size(), timeoutMs) > 0)
+		{
+			for (auto& d : detectors)
+			{
+				d->clear_notification();
+			}
+		}
+	}
+	return true;
 }
 
 // ---------------------------------------------------------------------------------
@@ -0,0 +1,709 @@
+#!/usr/bin/env python3
+"""
+Tests of the vowel classification helpers in app/
+"""
+import os
+import struct
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "app"))
+
+# Typical F1/F2 per vowel, the training examples are spread around them
+VOWEL_CENTERS = {'A': (730, 1090), 'E': (530, 1840), 'I': (300, 2290), 'O': (570, 840), 'U': (320, 870)}
+
+
+def make_training_data(per_vowel=40, seed=0):
+    import numpy as np
+
+    rng = np.random.default_rng(seed)
+    features = []
+    labels = []
+    for vowel, (f1, f2) in VOWEL_CENTERS.items():
+        features.extend(rng.normal((f1, f2), (f1 * 0.05, f2 * 0.05), size=(per_vowel, 2)).tolist())
+        labels.extend([vowel] * per_vowel)
+    return features, labels
+
+
+def test_cached_model():
+    try:
+        import numpy as np
+        import classification
+    except ImportError as e:
+        print(f"✗ Failed to import classification: {e}")
+        return
+
+    features, labels = make_training_data()
+    classification.clear_vowel_training_data(6)
+    assert classification.likelyhood_vowel([700, 1100]) == "Not enough training data"
+
+    for vowel in VOWEL_CENTERS:
+        classification.training_store.extend([f for f, l in zip(features, labels) if l == vowel], vowel)
+    classification.vowel_model.invalidate()
+
+    # Fitted once, then reused for every prediction
+    fits = classification.vowel_model.fits
+    for vowel, center in VOWEL_CENTERS.items():
+        predicted, confidence = classification.likelyhood_vowel(list(center))
+        assert predicted == vowel and 0 < confidence <= 1
+    assert classification.vowel_model.fits == fits + 1
+
+    # Batched prediction over drained frames agrees with frame by frame prediction
+    frames = np.zeros(5, dtype=[('f1', 'f8'), ('f2', 'f8'), ('magnitude', 'f8'), ('time', 'f8'), ('index', 'u8')])
+    frames['f1'], frames['f2'] = np.array(list(VOWEL_CENTERS.values()), dtype=float).T
+    predicted, confidences = classification.predict_many(frames)
+    assert list(predicted) == list(VOWEL_CENTERS)
+    assert len(confidences) == 5
+    assert classification.vowel_model.fits == fits + 1
+
+    # Clearing invalidates the model
+    classification.clear_vowel_training_data(3)
+    predicted, _ = classification.likelyhood_vowel(list(VOWEL_CENTERS['I']))
+    assert predicted != 'I'
+    assert classification.vowel_model.fits == fits + 2
+
+    classification.clear_vowel_training_data(6)
+    print("✓ Vowel model is fitted once per change of the training data")
+
+
+def test_classifier_backends():
+    try:
+        import numpy as np
+        import vowel_models
+    except ImportError as e:
+        print(f"✗ Failed to import vowel_models: {e}")
+        return
+
+    features, labels = make_training_data()
+    queries, expected = make_training_data(per_vowel=10, seed=1)
+
+    for name in vowel_models.BACKENDS:
+        backend = vowel_models.make_backend(name).fit(np.array(features), np.array(labels))
+        probabilities = backend.predict_proba(np.array(queries))
+        assert probabilities.shape == (len(queries), 5)
+        assert np.allclose(probabilities.sum(axis=1), 1.0)
+        accuracy = backend.score(np.array(queries), np.array(expected))
+        assert accuracy > 0.9, f"{name}: {accuracy}"
+
+    # Switching backends refits on the next prediction
+    model = vowel_models.VowelModel(lambda: (features, labels), backend="centroid")
+    predicted, confidences = model.predict_many(queries)
+    assert len(predicted) == len(queries) and (confidences <= 1).all()
+    model.set_backend("gaussian")
+    assert not model.is_fitted()
+    assert model.predict(VOWEL_CENTERS['O'])[0] == 'O'
+    assert model.fits == 2
+
+    try:
+        vowel_models.make_backend("svm")
+        assert False, "unknown backends should be rejected"
+    except ValueError:
+        pass
+    print(f"✓ Backends {', '.join(vowel_models.BACKENDS)} classify batches of frames")
+
+
+def test_training_store():
+    import tempfile
+
+    try:
+        import numpy as np
+        import training_store
+    except ImportError as e:
+        print(f"✗ Failed to import training_store: {e}")
+        return
+
+    features, labels = make_training_data(per_vowel=700)
+    store = training_store.TrainingStore(capacity=16)
+    for vowel in VOWEL_CENTERS:
+        store.extend([f for f, l in zip(features, labels) if l == vowel], vowel, session=7)
+    assert len(store) == 3500 and store.counts()['I'] == 700
+    assert (store.label_names()[:700] == 'A').all() and (store.sessions == 7).all()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "training.vrt")
+        store.save(path)
+        header = training_store.read_header(path)
+        assert header["count"] == 3500 and header["label_counts"]["U"] == 700
+
+        # Loading maps the file, the columns are views of the mapping
+        loaded = training_store.TrainingStore.load(path)
+        assert isinstance(loaded.records, np.memmap)
+        assert np.array_equal(loaded.features(), store.features())
+
+        # Appending to the file only writes the new records and the header
+        loaded.append(500, 1500, 'E', session=8)
+        loaded.append_to_file(path, start=3500)
+        header = training_store.read_header(path)
+        assert header["count"] == 3501 and header["label_counts"]["E"] == 701
+        assert training_store.TrainingStore.load(path, mmap=False).sessions[-1] == 8
+
+        # CSV in the format of the original training data files
+        csv = os.path.join(tmp, "training.txt")
+        loaded.export_csv(csv)
+        imported = training_store.TrainingStore.import_csv(csv)
+        assert imported.counts() == loaded.counts()
+        assert np.allclose(np.sort(imported.f1), np.sort(loaded.f1))
+
+    assert store.clear('A') == 700 and store.count('A') == 0 and len(store) == 2800
+    assert store.clear() == 2800 and len(store) == 0
+    print("✓ Training store saves, maps, appends and converts to CSV")
+
+
+def test_training_files():
+    import tempfile
+
+    try:
+        import classification
+        import training_store
+    except ImportError as e:
+        print(f"✗ Failed to import classification: {e}")
+        return
+
+    features, labels = make_training_data(per_vowel=10)
+    data_path = classification.training_data_path
+    with tempfile.TemporaryDirectory() as tmp:
+        classification.training_data_path = lambda filename: os.path.join(tmp, filename)
+        try:
+            # Data saved before the binary store is found by the default load
+            classification.clear_vowel_training_data(6)
+            for vowel in VOWEL_CENTERS:
+                classification.training_store.extend([f for f, l in zip(features, labels) if l == vowel], vowel)
+            classification.training_store.export_csv(os.path.join(tmp, classification.LEGACY_TRAINING_FILE))
+            classification.clear_vowel_training_data(6)
+            classification.load_training_data()
+            assert classification.training_store.counts() == {vowel: 10 for vowel in VOWEL_CENTERS}
+
+            # Saved to the binary store from then on
+            classification.save_training_data()
+            assert os.path.exists(os.path.join(tmp, classification.TRAINING_FILE))
+            classification.clear_vowel_training_data(6)
+            classification.load_training_data()
+            assert len(classification.training_store) == 50
+
+            # Examples collected after loading are appended, the loaded ones are not rewritten
+            store_path = os.path.join(tmp, classification.TRAINING_FILE)
+            size = os.path.getsize(store_path)
+            classification.training_store.extend([[700, 1100]] * 10, 'A')
+            classification.save_training_data()
+            assert os.path.getsize(store_path) == size + 10 * training_store.RECORD_DTYPE.itemsize
+            assert training_store.read_header(store_path)["count"] == 60
+
+            # After clearing, the file is written again in full
+            classification.clear_vowel_training_data(1)
+            classification.save_training_data()
+            assert training_store.read_header(store_path)["count"] == 40
+            classification.load_training_data()
+            assert classification.training_store.counts()['A'] == 0
+        finally:
+            classification.training_data_path = data_path
+            classification.clear_vowel_training_data(6)
+    print("✓ Training data of earlier versions loads, new examples are appended")
+
+
+def test_evaluation():
+    try:
+        import numpy as np
+        import evaluation
+        import vowel_models
+    except ImportError as e:
+        print(f"✗ Failed to import evaluation: {e}")
+        return
+
+    features, labels = make_training_data(per_vowel=60)
+    features, labels = np.array(features), np.array(labels)
+    speakers = np.arange(len(labels)) % 6
+
+    # Stratified folds have the same share of every vowel, speaker folds never split a speaker
+    folds = evaluation.make_folds(labels, 5)
+    assert sorted(np.concatenate(folds).tolist()) == list(range(len(labels)))
+    assert all((np.unique(labels[test], return_counts=True)[1] == 12).all() for test in folds)
+    for test in evaluation.make_folds(labels, 3, "speaker", speakers):
+        assert not set(speakers[test]) & set(np.delete(speakers, test))
+
+    report = evaluation.evaluate(features, labels, workers=1)
+    assert report["examples"] == 300 and report["classes"] == list(VOWEL_CENTERS)
+    by_name = {result["name"]: result for result in report["results"]}
+    assert set(by_name) == {"knn n_neighbors=1", "knn n_neighbors=3", "knn n_neighbors=5",
+                            "knn n_neighbors=7", "centroid", "gaussian"}
+    for result in report["results"]:
+        assert result["confusion"].sum() == 300 and result["accuracy"] > 0.9
+        assert set(result["recall"]) == set(VOWEL_CENTERS)
+
+    # The shared neighbour lookup agrees with fitting every k on its own
+    for k in (1, 5):
+        correct = 0
+        for test in folds:
+            train = np.setdiff1d(np.arange(len(labels)), test)
+            model = vowel_models.make_backend("knn", n_neighbors=k).fit(features[train], labels[train])
+            correct += np.sum(model.predict(features[test]) == labels[test])
+        assert by_name[f"knn n_neighbors={k}"]["accuracy"] == correct / len(labels)
+
+    # A process pool gives the same report
+    pooled = evaluation.evaluate(features, labels, candidates=[("knn", {"n_neighbors": 3}), ("gaussian", {})],
+                                 strategy="speaker", groups=speakers, folds=3, workers=2)
+    serial = evaluation.evaluate(features, labels, candidates=[("knn", {"n_neighbors": 3}), ("gaussian", {})],
+                                 strategy="speaker", groups=speakers, folds=3, workers=1)
+    assert pooled["workers"] == 2
+    for a, b in zip(pooled["results"], serial["results"]):
+        assert a["name"] == b["name"] and (a["confusion"] == b["confusion"]).all()
+    assert "Confusion matrix" in evaluation.format_report(serial)
+    print(f"✓ Evaluation of {len(report['results'])} candidates in {report['seconds'] * 1e3:.0f} ms")
+
+
+def test_lookup_table():
+    import subprocess
+    import tempfile
+
+    try:
+        import numpy as np
+        import vowel_models
+    except ImportError as e:
+        print(f"✗ Failed to import vowel_models: {e}")
+        return
+
+    features, labels = make_training_data()
+    queries = np.random.default_rng(2).uniform(300, 3200, size=(2000, 2))
+
+    for name in vowel_models.BACKENDS:
+        backend = vowel_models.make_backend(name).fit(np.array(features), np.array(labels))
+        table = vowel_models.LookupTable.compile(backend)
+        assert table.labels.shape == (290, 290) and table.max_hz == 3200
+
+        # Only cells cut by a decision boundary can disagree with the model
+        predicted, confidences = table.predict_many(queries)
+        expected = backend.predict(queries)
+        assert np.mean(predicted == expected) > 0.98, name
+        assert ((confidences > 0) & (confidences <= 1)).all()
+
+    # Out of range and missing formants take the nearest cell
+    predicted, _ = table.predict_many([[0, 0], [5000, 5000], list(VOWEL_CENTERS['I'])])
+    assert len(predicted) == 3 and predicted[2] == 'I'
+
+    # The model predicts from its table until the training data changes
+    model = vowel_models.VowelModel(lambda: (features, labels), backend="centroid")
+    table = model.compile_table()
+    fits = model.fits
+    assert model.predict(VOWEL_CENTERS['E'])[0] == 'E' and model.fits == fits
+    model.invalidate()
+    assert model.table is None
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "vowels.table.npz")
+        table.save(path)
+        loaded = vowel_models.LookupTable.load(path)
+        assert loaded.backend == "centroid" and loaded.examples == len(features)
+        assert np.array_equal(loaded.labels, table.labels) and list(loaded.classes) == list(table.classes)
+
+        # A saved table classifies without scikit-learn
+        script = ("import sys; import vowel_models; "
+                  f"table = vowel_models.LookupTable.load({path!r}); "
+                  "print(table.predict([730, 1090])[0], 'sklearn' in sys.modules)")
+        app_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "app")
+        output = subprocess.run([sys.executable, "-c", script], cwd=app_dir, capture_output=True,
+                                text=True, check=True).stdout.split()
+        assert output == ['A', 'False']
+    print("✓ Lookup table classifies like the model it was compiled from")
+
+
+def test_native_classifier():
+    try:
+        import numpy as np
+        import formant_detector
+        import vowel_models
+    except ImportError as e:
+        print(f"✗ Failed to import formant_detector: {e}")
+        return
+
+    features, labels = make_training_data()
+    queries = np.random.default_rng(3).uniform(300, 3200, size=(500, 2))
+
+    # Same decisions and confidences on the analysis thread as in Python
+    for name in vowel_models.BACKENDS:
+        model = vowel_models.VowelModel(lambda: (features, labels), backend=name)
+        native = model.native_model()
+        assert native.labels == list(VOWEL_CENTERS)
+        # knn has no closed form, it is loaded as its lookup table
+        reference = model.compile_table() if name == "knn" else model
+        expected, confidences = reference.predict_many(queries)
+        decisions = [native.classify(f1, f2) for f1, f2 in queries]
+        assert [label for label, _ in decisions] == list(expected), name
+        assert np.allclose([confidence for _, confidence in decisions], confidences, atol=1e-5), name
+    assert native.classify(0, 0) == (None, 0.0)
+
+    # Frames come out of the detector labelled, with no Python in the loop
+    centre = VOWEL_CENTERS['A']
+    times = np.arange(44100 * 2) / 44100.0
+    samples = (np.sin(2 * np.pi * centre[0] * times) + 0.8 * np.sin(2 * np.pi * centre[1] * times)).astype(np.float32)
+    detected = formant_detector.extract(samples)
+    model = vowel_models.VowelModel(lambda: (features, labels), backend="gaussian")
+
+    detector = formant_detector.FormantDetector()
+    detector.load_model(model.native_model())
+    assert detector.vowel_labels == list(VOWEL_CENTERS)
+    detector.start_stream(source=formant_detector.BufferSource(samples))
+    frames = []
+    while (frame := detector.wait_next(timeout=5.0)) is not None:
+        frames.append(frame)
+        frames.extend(detector.drain())
+    detector.stop_stream()
+    frames = np.array(frames)
+
+    assert np.array_equal(np.column_stack((frames['f1'], frames['f2'])), detected)
+    found = frames['f1'] > 0
+    expected, confidences = model.predict_many(detected[found])
+    assert list(np.array(detector.vowel_labels)[frames['vowel'][found]]) == list(expected)
+    assert np.allclose(frames['confidence'][found], confidences, atol=1e-5)
+    assert (frames['vowel'][~found] == -1).all()
+    label, confidence = detector.get_vowel()
+    assert label == expected[-1] and abs(confidence - confidences[-1]) < 1e-6
+
+    # A new model hides the decisions of the previous one
+    detector.load_model(None)
+    assert detector.get_vowel() is None and detector.vowel_labels == []
+    print("✓ Detector labels frames with the native vowel classifier")
+
+
+def test_formant_service():
+    try:
+        import asyncio
+        import json
+        import tempfile
+        import numpy as np
+        import formant_detector
+        import formant_service
+        import vowel_models
+    except ImportError as e:
+        print(f"✗ Failed to import formant_detector: {e}")
+        return
+
+    times = np.arange(3 * 44100) / 44100.0
+    samples = (0.5 * np.sin(2 * np.pi * 700 * times) + 0.4 * np.sin(2 * np.pi * 1200 * times)).astype(np.float32)
+    expected = formant_detector.extract(samples, hop=1024)
+
+    async def read_lines(reader):
+        return [json.loads(line) async for line in reader]
+
+    async def read_messages(reader):
+        messages = []
+        while True:
+            try:
+                header = await reader.readexactly(formant_service.MESSAGE_HEADER.size)
+            except asyncio.IncompleteReadError:
+                return messages
+            size, kind = formant_service.MESSAGE_HEADER.unpack(header)
+            messages.append((kind, await reader.readexactly(size)))
+
+    async def serve(path):
+        detector = formant_detector.FormantDetector()
+        service = formant_service.FormantService(detector)
+        host, port = await service.listen_tcp(port=0)
+        await service.listen_unix(path, protocol="binary")
+        # The writers are kept, a client's connection closes with them
+        json_reader, json_writer = await asyncio.open_connection(host, port)
+        binary_reader, binary_writer = await asyncio.open_unix_connection(path)
+        json_client = asyncio.ensure_future(read_lines(json_reader))
+        binary_client = asyncio.ensure_future(read_messages(binary_reader))
+        while len(service.subscribers) < 2:
+            await asyncio.sleep(0.01)
+        detector.start_stream(source=formant_detector.BufferSource(samples), hop=1024)
+        await service.run()
+        detector.stop_stream()
+        lines, messages = await json_client, await binary_client
+        json_writer.close()
+        binary_writer.close()
+        return service.stats(), lines, messages
+
+    with tempfile.TemporaryDirectory() as directory:
+        stats, lines, messages = asyncio.run(serve(os.path.join(directory, "service.sock")))
+
+    # Every client gets every frame, whatever the transport
+    assert stats["frames"] == len(expected) and stats["dropped"] == 0
+    assert lines[0]["type"] == "hello" and lines[0]["config"]["frame_size"] == 4096
+    frames = [line for line in lines if line["type"] == "frame"]
+    assert np.array_equal([[frame["f1"], frame["f2"]] for frame in frames], expected)
+    assert messages[0][0] == formant_service.HELLO
+    records = np.concatenate([np.frombuffer(body, dtype=formant_service.WIRE_DTYPE)
+                              for kind, body in messages if kind == formant_service.FRAMES])
+    assert np.array_equal(np.column_stack((records['f1'], records['f2'])), expected)
+    assert np.array_equal(records['index'], np.arange(len(expected)))
+
+    # A slow client loses the oldest frames, or all but the newest when conflating
+    def batch(start, count):
+        frames = np.zeros(count, dtype=formant_detector.FormantDetector().drain().dtype)
+        frames['index'] = np.arange(start, start + count)
+        frames['vowel'] = -1
+        return formant_service.Batch(frames, [])
+
+    async def backlog(policy):
+        subscriber = formant_service.Subscriber(None, "json", 10, policy)
+        for start in range(0, 24, 4):
+            subscriber.push(batch(start, 4))
+        pending, dropped = subscriber.pending, subscriber.dropped
+        return pending, dropped, [json.loads(line) for line in subscriber.take().splitlines()]
+
+    pending, dropped, sent = asyncio.run(backlog("drop"))
+    assert (pending, dropped) == (8, 16)
+    assert sent[0] == {"type": "dropped", "frames": 16}
+    assert [message["index"] for message in sent[1:]] == list(range(16, 24))
+    pending, dropped, sent = asyncio.run(backlog("conflate"))
+    assert (pending, dropped) == (1, 23) and [message["index"] for message in sent[1:]] == [23]
+
+    # Vowel events only when the recognized vowel changes, after the labels of a new model
+    features, labels = make_training_data()
+    detector = formant_detector.FormantDetector()
+    detector.load_model(vowel_models.VowelModel(lambda: (features, labels), backend="centroid").native_model())
+
+    async def vowels():
+        service = formant_service.FormantService(detector)
+        subscriber = formant_service.Subscriber(None, "json", 10, "drop")
+        service.subscribers.add(subscriber)
+        frames = batch(0, 6).frames
+        frames['vowel'] = [0, 0, -1, 0, 2, 2]
+        service.publish(frames)
+        return [json.loads(line) for line in subscriber.take().splitlines()]
+
+    events = [message for message in asyncio.run(vowels()) if message["type"] != "frame"]
+    assert events[0] == {"type": "labels", "labels": list(VOWEL_CENTERS)}
+    assert [(event["index"], event["vowel"]) for event in events[1:]] == [(0, 'A'), (4, 'I')]
+
+    # A client far behind keeps the newest labels, and the newest vowel recognized with them
+    def vowel_event(index, vowel):
+        return {"type": "vowel", "time": index / 10, "index": index, "vowel": "AEIOU"[vowel],
+                "vowel_index": vowel, "confidence": 1.0}
+
+    async def slow_client(protocol):
+        subscriber = formant_service.Subscriber(None, protocol, 10, "drop")
+        subscriber.push(batch(0, 4), [{"type": "labels", "labels": list("AEIOU")}, vowel_event(0, 0)])
+        for start in range(4, 80, 4):
+            subscriber.push(batch(start, 4), [vowel_event(start, start // 4 % 5)])
+        return list(subscriber.events), subscriber.take()
+
+    events, sent = asyncio.run(slow_client("json"))
+    assert len(events) <= 10 and events[0]["type"] == "labels" and events[-1]["index"] == 76
+    sent = [json.loads(line) for line in sent.splitlines()]
+    assert sent[1] == {"type": "labels", "labels": list("AEIOU")}
+    assert [event["index"] for event in sent if event["type"] == "vowel"][-1] == 76
+    _, sent = asyncio.run(slow_client("binary"))
+    kinds = []
+    while sent:
+        size, kind = formant_service.MESSAGE_HEADER.unpack_from(sent)
+        kinds.append(kind)
+        sent = sent[formant_service.MESSAGE_HEADER.size + size:]
+    assert kinds[:3] == [formant_service.DROPPED, formant_service.LABELS, formant_service.VOWEL]
+
+    # WebSocket clients: handshake, server frames, ping and close
+    async def read_frame(reader):
+        first, length = await reader.readexactly(2)
+        if length == 126:
+            length, = struct.unpack("!H", await reader.readexactly(2))
+        elif length == 127:
+            length, = struct.unpack("!Q", await reader.readexactly(8))
+        return first, await reader.readexactly(length)
+
+    def client_frame(opcode, payload):
+        mask = b"\x01\x02\x03\x04"
+        masked = bytes(b ^ mask[i % 4] for i, b in enumerate(payload))
+        return struct.pack("!BB", 0x80 | opcode, 0x80 | len(payload)) + mask + masked
+
+    async def websocket_client(host, port):
+        reader, writer = await asyncio.open_connection(host, port)
+        writer.write(b"GET /formants HTTP/1.1\r\nHost: localhost\r\nUpgrade: websocket\r\n"
+                     b"Connection: Upgrade\r\nSec-WebSocket-Key: dGhlIHNhbXBsZSBub25jZQ==\r\n"
+                     b"Sec-WebSocket-Version: 13\r\n\r\n")
+        response = (await reader.readuntil(b"\r\n\r\n")).decode()
+        return reader, writer, response
+
+    async def websocket():
+        detector = formant_detector.FormantDetector()
+        service = formant_service.FormantService(detector)
+        host, port = await service.listen_websocket(port=0)
+        reader, writer, response = await websocket_client(host, port)
+        writer.write(client_frame(0x9, b"ping"))
+        closing_reader, closing_writer, _ = await websocket_client(host, port)
+        hello = await read_frame(closing_reader)
+        closing_writer.write(client_frame(0x8, struct.pack("!H", 1000) + b"bye"))
+        closed = await read_frame(closing_reader)
+        eof = await closing_reader.read()
+        while len(service.subscribers) != 1:
+            await asyncio.sleep(0.01)
+        detector.start_stream(source=formant_detector.BufferSource(samples), hop=1024)
+        await service.run()
+        detector.stop_stream()
+        frames = []
+        while True:
+            try:
+                frames.append(await read_frame(reader))
+            except asyncio.IncompleteReadError:
+                break
+        writer.close()
+        closing_writer.close()
+        return response, frames, hello, closed, eof
+
+    response, frames, hello, closed, eof = asyncio.run(websocket())
+    assert response.startswith("HTTP/1.1 101 ")
+    assert "Sec-WebSocket-Accept: s3pPLMBiTxaQ9kYGzzhZRbK+xOo=\r\n" in response
+    assert (0x8A, b"ping") in frames
+    text = b"".join(payload for first, payload in frames if first == 0x81)
+    lines = [json.loads(line) for line in text.decode().splitlines()]
+    assert lines[0]["type"] == "hello"
+    frames = [line for line in lines if line["type"] == "frame"]
+    assert np.array_equal([[frame["f1"], frame["f2"]] for frame in frames], expected)
+    assert hello[0] == 0x81 and json.loads(hello[1])["type"] == "hello"
+    assert closed == (0x88, struct.pack("!H", 1000)) and eof == b""
+
+    try:
+        formant_service.FormantService(None, policy="newest")
+        assert False, "Unknown policy accepted"
+    except ValueError:
+        pass
+    print("✓ Service fans frames out to every client")
+
+
+def test_audio_session():
+    try:
+        import numpy as np
+        import formant_detector
+        import audio_session
+        import vowel_models
+    except ImportError as e:
+        print(f"✗ Failed to import formant_detector: {e}")
+        return
+
+    times = np.arange(44100) / 44100.0
+    samples = (0.5 * np.sin(2 * np.pi * 700 * times) + 0.4 * np.sin(2 * np.pi * 1200 * times)).astype(np.float32)
+    features, labels = make_training_data()
+    model = vowel_models.VowelModel(lambda: (features, labels), backend="centroid").native_model()
+
+    with audio_session.AudioSession() as session:
+        assert session.devices() == formant_detector.audio_devices()
+        assert all(device["max_input_channels"] > 0 for device in session.input_devices())
+
+        with session.detector(gate=False) as detector:
+            detector.load_model(model)
+            detector.start_stream(source=formant_detector.BufferSource(samples))
+            assert detector.wait_next(timeout=5.0) is not None
+
+        # Handed back stopped, without its model or frames, and lent again for the same settings
+        assert session.idle_detectors() == 1
+        with session.detector(gate=False) as again:
+            assert again is detector
+            assert not again.is_streaming() and again.get_model() is None and len(again.drain()) == 0
+            with session.detector(gate=True) as other:
+                assert other is not detector
+        assert session.idle_detectors() == 2
+
+        # A stream failing to stop still unloads and drains, without hiding the block's error
+        class FailingDetector:
+            def __init__(self):
+                self.calls = []
+
+            def stop_stream(self):
+                raise RuntimeError("stop failed")
+
+            def load_model(self, model):
+                self.calls.append(("load_model", model))
+
+            def drain(self):
+                self.calls.append(("drain",))
+
+        failing = FailingDetector()
+        session._idle[(("frame_size", 1024),)] = [failing]
+        try:
+            with session.detector(frame_size=1024):
+                raise KeyError("body")
+        except KeyError:
+            pass
+        # Not kept, so it is lent again only when put back
+        assert session.idle_detectors() == 2
+        session._idle[(("frame_size", 1024),)] = [failing]
+        try:
+            with session.detector(frame_size=1024):
+                pass
+            assert False, "Release error hidden"
+        except RuntimeError:
+            pass
+        assert failing.calls == [("load_model", None), ("drain",)] * 2
+        assert session.idle_detectors() == 2
+
+        audio_session.close_session()
+        assert audio_session.get_session() is audio_session.get_session()
+        audio_session.close_session()
+    assert not session.is_open
+    print("✓ Session keeps devices and detectors between uses")
+
+
+def test_ingest():
+    try:
+        import tempfile
+        import wave
+        import numpy as np
+        import formant_detector
+        import ingest
+    except ImportError as e:
+        print(f"✗ Failed to import formant_detector: {e}")
+        return
+
+    times = np.arange(44100) / 44100.0
+
+    def write(path, f1, f2, rate=44100):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        signal = 0.5 * np.sin(2 * np.pi * f1 * times) + 0.4 * np.sin(2 * np.pi * f2 * times)
+        with wave.open(path, "wb") as f:
+            f.setnchannels(1)
+            f.setsampwidth(2)
+            f.setframerate(rate)
+            f.writeframes((signal * 32767).astype("<i2").tobytes())
+
+    with tempfile.TemporaryDirectory() as directory:
+        corpus = os.path.join(directory, "corpus")
+        cache = os.path.join(directory, "cache")
+        for i in range(3):
+            write(os.path.join(corpus, "A", f"a{i}.wav"), 700 + 20 * i, 1100)
+            write(os.path.join(corpus, "e", "speaker1", f"e{i}.wav"), 500, 1800 + 20 * i)
+        write(os.path.join(corpus, "I", "wrong_rate.wav"), 300, 2300, rate=16000)
+        write(os.path.join(corpus, "noise", "n.wav"), 300, 2300)
+
+        # WAV decoding matches the detector's FileSource scaling
+        def voiced(path):
+            with open(path, "rb") as f:
+                rate, samples = ingest.read_wav(f.read())
+            assert rate == 44100 and samples.dtype == np.float32 and len(samples) == len(times)
+            formants = formant_detector.extract(samples, gate=True)
+            return formants[(formants[:, 0] > 0) & (formants[:, 1] > 0)]
+
+        expected = np.concatenate([voiced(os.path.join(corpus, "A", f"a{i}.wav")) for i in range(3)])
+
+        store, report = ingest.ingest(corpus, workers=2, cache_directory=cache)
+        assert (report["files"], report["analyzed"], report["cached"]) == (7, 6, 0)
+        assert list(report["failed"]) == [os.path.join(corpus, "I", "wrong_rate.wav")]
+        assert report["skipped"] == [os.path.join(corpus, "noise")]
+        assert store.counts()["A"] == len(expected) > 0 and store.counts()["E"] > 0
+        assert np.allclose(store.features("A"), expected, atol=1e-3)
+        assert set(store.sessions[store.labels == 1]) == {0}
+        assert len(set(store.sessions[store.labels == 2])) == 1 and store.sessions[store.labels == 2][0] != 0
+
+        # Only new or changed files are analyzed again, a copy is found by its content
+        again, report = ingest.ingest(corpus, workers=1, cache_directory=cache)
+        assert (report["analyzed"], report["cached"]) == (0, 6)
+        assert np.array_equal(again.features(), store.features())
+        write(os.path.join(corpus, "A", "a3.wav"), 760, 1100)
+        write(os.path.join(corpus, "O", "copy.wav"), 700, 1100)
+        _, report = ingest.ingest(corpus, workers=1, cache_directory=cache)
+        assert (report["analyzed"], report["cached"]) == (1, 7)
+
+        # Other parameters are cached separately
+        _, report = ingest.ingest(corpus, workers=1, cache_directory=cache, hop=2048)
+        assert report["analyzed"] == 7
+    print("✓ Corpus ingestion analyzes each file once per set of parameters")
+
+
+if __name__ == "__main__":
+    test_cached_model()
+    test_classifier_backends()
+    test_training_store()
+    test_training_files()
+    test_evaluation()
+    test_lookup_table()
+    test_native_classifier()
+    test_formant_service()
+    test_audio_session()
+    test_ingest()
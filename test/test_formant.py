@@ -33,5 +33,894 @@ def test_formant_detector():
     except Exception as e:
         print(f"✗ Error during testing: {e}")
 
+def test_extract():
+    try:
+        import formant_detector
+        import numpy as np
+    except ImportError as e:
+        print(f"✗ Failed to import formant_detector: {e}")
+        return
+
+    # Two seconds of a two-tone signal standing in for a recorded vowel
+    t = np.arange(2 * 44100) / 44100.0
+    samples = (0.5 * np.sin(2 * np.pi * 700 * t) + 0.4 * np.sin(2 * np.pi * 1200 * t)).astype(np.float32)
+
+    formants = formant_detector.extract(samples, hop=1024)
+    assert formants.shape == ((len(samples) - 4096) // 1024 + 1, 2)
+    assert (formants[:, 0] <= formants[:, 1]).all()
+    assert (formants > 0).any()
+    print(f"✓ Extracted {len(formants)} frames offline")
+
+    # Threads split the work by frame batches, results must not change
+    assert (formant_detector.extract(samples, hop=1024, threads=4) == formants).all()
+
+    # Too short for a single frame
+    assert formant_detector.extract(samples[:100]).shape == (0, 2)
+
+    try:
+        formant_detector.extract(samples, hop=0)
+        assert False, "hop=0 should be rejected"
+    except ValueError:
+        pass
+
+def test_analysis_config():
+    import os
+    import tempfile
+
+    try:
+        import formant_detector
+        import numpy as np
+    except ImportError as e:
+        print(f"✗ Failed to import formant_detector: {e}")
+        return
+
+    with tempfile.TemporaryDirectory() as tmp:
+        wisdom_file = os.path.join(tmp, "wisdom", "fftw_wisdom")
+        detector = formant_detector.FormantDetector(sample_rate=16000, frame_size=1024,
+                                                    planning="measure", wisdom_file=wisdom_file)
+        config = detector.get_config()
+        assert config['sample_rate'] == 16000 and config['frame_size'] == 1024
+        assert config['planning'] == "measure"
+        assert formant_detector.FormantDetector(**config).get_config() == config
+
+        # Measured plans are persisted for the next process
+        assert os.path.exists(wisdom_file)
+
+        t = np.arange(16000) / 16000.0
+        samples = np.sin(2 * np.pi * 700 * t).astype(np.float32)
+        formants = formant_detector.extract(samples, sample_rate=16000, frame_size=1024,
+                                            planning="estimate", wisdom_file="")
+        assert formants.shape == ((16000 - 1024) // 1024 + 1, 2)
+
+    # Plain detectors estimate their plans and write no wisdom
+    if "FORMANT_WISDOM_FILE" not in os.environ:
+        config = formant_detector.analysis_config()
+        assert config['planning'] == "estimate" and config['wisdom_file'] == ""
+
+    for bad in ({"sample_rate": 0}, {"frame_size": 8}, {"freq_start": 500, "freq_end": 100},
+                {"sigma": 0}, {"planning": "fast"}):
+        try:
+            formant_detector.FormantDetector(**bad)
+            assert False, f"{bad} should be rejected"
+        except ValueError:
+            pass
+    print("✓ Analysis parameters are configurable at runtime")
+
+def test_frame_history():
+    import os
+    import time
+
+    try:
+        import formant_detector
+    except ImportError as e:
+        print(f"✗ Failed to import formant_detector: {e}")
+        return
+
+    detector = formant_detector.FormantDetector()
+    assert detector.latest() is None
+    frames = detector.drain()
+    assert len(frames) == 0
+    assert frames.dtype.names == ('f1', 'f2', 'magnitude', 'time', 'index', 'vowel', 'confidence', 'level', 'voiced', 'channel')
+    assert detector.get_vowel() is None and detector.vowel_labels == []
+
+    device = os.environ.get("FORMANT_TEST_DEVICE")
+    if device is None:
+        print("Skipping live frame history check (set FORMANT_TEST_DEVICE)")
+        return
+
+    detector.start_stream(int(device))
+    time.sleep(0.5)
+    first = detector.drain()
+    time.sleep(0.5)
+    second = detector.drain()
+    detector.stop_stream()
+
+    # Consecutive drains hand over every frame exactly once, in order
+    indices = list(first['index']) + list(second['index'])
+    assert indices == list(range(len(indices)))
+    assert (second['time'][1:] > second['time'][:-1]).all()
+    assert detector.latest()['index'] == indices[-1]
+    print(f"✓ Drained {len(indices)} consecutive frames")
+
+def test_frame_events():
+    import asyncio
+    import os
+    import time
+
+    try:
+        import formant_detector
+    except ImportError as e:
+        print(f"✗ Failed to import formant_detector: {e}")
+        return
+
+    # Without a running stream there is nothing to wait for
+    detector = formant_detector.FormantDetector()
+    start = time.monotonic()
+    assert detector.wait_next(timeout=0.05) is None
+    assert time.monotonic() - start < 1.0
+
+    device = os.environ.get("FORMANT_TEST_DEVICE")
+    if device is None:
+        print("Skipping live frame event check (set FORMANT_TEST_DEVICE)")
+        return
+
+    detector.start_stream(int(device))
+    first = detector.wait_next(timeout=2.0)
+    assert first is not None
+
+    async def collect():
+        loop = asyncio.get_running_loop()
+        loop.call_later(0.5, detector.stop_stream)
+        return [frame['index'] async for frame in detector.frames()]
+
+    # The async iterator picks up right after the frame wait_next returned
+    indices = asyncio.run(collect())
+    assert indices == list(range(first['index'] + 1, first['index'] + 1 + len(indices)))
+    print(f"✓ Received {len(indices) + 1} frames without polling")
+
+def test_overlapping_hop():
+    import os
+    import time
+
+    try:
+        import formant_detector
+    except ImportError as e:
+        print(f"✗ Failed to import formant_detector: {e}")
+        return
+
+    detector = formant_detector.FormantDetector()
+    for hop in (0, 4097):
+        try:
+            detector.start_stream(0, hop=hop)
+            assert False, f"hop={hop} should be rejected"
+        except ValueError:
+            pass
+
+    device = os.environ.get("FORMANT_TEST_DEVICE")
+    if device is None:
+        print("Skipping live hop check (set FORMANT_TEST_DEVICE)")
+        return
+
+    detector.start_stream(int(device), hop=512)
+    time.sleep(1.0)
+    detector.stop_stream()
+
+    # A 512 sample hop gives about 86 frames per second instead of about 11
+    frames = detector.drain()
+    stats = detector.get_stats()
+    assert len(frames) > 40
+    assert stats['frames'] == len(frames) + stats['dropped_frames']
+    assert stats['overruns'] == 0 and stats['dropped_samples'] == 0
+    print(f"✓ {len(frames)} overlapping frames in one second")
+
+def test_detector_group():
+    import os
+    import time
+
+    try:
+        import formant_detector
+    except ImportError as e:
+        print(f"✗ Failed to import formant_detector: {e}")
+        return
+
+    # Detectors no longer share state, a failing or discarded one leaves the others alone
+    detector = formant_detector.FormantDetector()
+    other = formant_detector.FormantDetector()
+    try:
+        other.start_stream(100000)
+        assert False, "an unknown device should be rejected"
+    except ValueError:
+        pass
+    del other
+    assert len(detector.drain()) == 0
+
+    try:
+        formant_detector.DetectorGroup([])
+        assert False, "an empty group should be rejected"
+    except ValueError:
+        pass
+
+    device = os.environ.get("FORMANT_TEST_DEVICE")
+    if device is None:
+        print("Skipping live detector group check (set FORMANT_TEST_DEVICE)")
+        return
+
+    group = formant_detector.DetectorGroup([int(device), int(device)])
+    assert len(group) == 2
+    group.start(hop=1024)
+    assert group.wait(timeout=2.0)
+    time.sleep(0.5)
+    group.stop()
+
+    frames = group.drain()
+    assert set(frames['detector']) == {0, 1}
+    assert (frames['received'][1:] >= frames['received'][:-1]).all()
+    # Each detector's own frames keep their stream-time order
+    for i in range(2):
+        own = frames[frames['detector'] == i]
+        assert (own['time'][1:] > own['time'][:-1]).all()
+    assert abs(frames['received'][-1] - time.monotonic()) < 5.0
+    assert [stats['frames'] for stats in group.get_stats()] == \
+        [int((frames['detector'] == i).sum()) for i in range(2)]
+    print(f"✓ {len(frames)} frames from 2 detectors running side by side")
+
+def test_audio_sources():
+    import os
+    import tempfile
+    import wave
+
+    try:
+        import formant_detector
+        import numpy as np
+    except ImportError as e:
+        print(f"✗ Failed to import formant_detector: {e}")
+        return
+
+    t = np.arange(3 * 44100) / 44100.0
+    samples = (0.5 * np.sin(2 * np.pi * 700 * t) + 0.4 * np.sin(2 * np.pi * 1200 * t)).astype(np.float32)
+
+    def replay(source):
+        detector = formant_detector.FormantDetector()
+        detector.start_stream(source=source, hop=1024)
+        frames = []
+        frame = detector.wait_next(timeout=5.0)
+        while frame is not None:
+            frames.append(frame)
+            frames.extend(detector.drain())
+            frame = detector.wait_next(timeout=5.0)
+        detector.stop_stream()
+        return detector, np.array([[frame['f1'], frame['f2']] for frame in frames])
+
+    # Free-running sources go through the live pipeline losslessly, so they
+    # must find exactly what offline extraction finds
+    expected = formant_detector.extract(samples, hop=1024)
+    detector, found = replay(formant_detector.BufferSource(samples))
+    assert (found == expected).all()
+    assert not detector.is_streaming()
+    assert detector.get_stats()['dropped_frames'] == 0
+
+    chunks = (samples[i:i + 1000] for i in range(0, len(samples), 1000))
+    _, found = replay(formant_detector.GeneratorSource(chunks))
+    assert (found == expected).all()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        # Stereo 16 bit WAV with the signal on the right channel
+        path = os.path.join(tmp, "capture.wav")
+        pcm = (samples * 32767).astype("<i2")
+        with wave.open(path, "wb") as wav:
+            wav.setnchannels(2)
+            wav.setsampwidth(2)
+            wav.setframerate(44100)
+            wav.writeframes(np.stack([np.zeros_like(pcm), pcm], axis=1).tobytes())
+        _, found = replay(formant_detector.FileSource(path, channel=1))
+        assert (found == formant_detector.extract(pcm / np.float32(32768), hop=1024)).all()
+
+        raw = os.path.join(tmp, "capture.f32")
+        samples.tofile(raw)
+        _, found = replay(formant_detector.FileSource(raw, format="raw"))
+        assert (found == expected).all()
+
+        try:
+            formant_detector.FormantDetector(sample_rate=16000).start_stream(
+                source=formant_detector.FileSource(path))
+            assert False, "a sample rate mismatch should be rejected"
+        except ValueError:
+            pass
+
+    def failing():
+        yield samples[:10000]
+        raise KeyError("broken capture")
+
+    detector = formant_detector.FormantDetector()
+    detector.start_stream(source=formant_detector.GeneratorSource(failing()))
+    while detector.wait_next(timeout=5.0) is not None:
+        pass
+    try:
+        detector.stop_stream()
+        assert False, "the generator's error should be raised"
+    except RuntimeError:
+        pass
+    print(f"✓ {len(expected)} frames replayed from buffer, generator, WAV and raw sources")
+
+def test_multichannel():
+    import os
+    import tempfile
+
+    try:
+        import formant_detector
+        import numpy as np
+    except ImportError as e:
+        print(f"✗ Failed to import formant_detector: {e}")
+        return
+
+    t = np.arange(3 * 44100) / 44100.0
+    tones = [(700, 1200), (300, 2300), (500, 1800)]
+    channels = np.stack([0.5 * np.sin(2 * np.pi * f1 * t) + 0.4 * np.sin(2 * np.pi * f2 * t)
+                         for f1, f2 in tones], axis=1).astype(np.float32)
+    channels[:, 1] = 0.0
+
+    def analyze(source, **config):
+        detector = formant_detector.FormantDetector(**config)
+        detector.start_stream(source=source, hop=1024)
+        frames = []
+        while (frame := detector.wait_next(timeout=5.0)) is not None:
+            frames.append(frame)
+            frames.extend(detector.drain())
+        detector.stop_stream()
+        return detector, np.array(frames, dtype=detector.drain().dtype)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        raw = os.path.join(tmp, "room.f32")
+        channels.tofile(raw)
+
+        # One frame per channel and step, each what extraction finds on that channel alone
+        detector, frames = analyze(formant_detector.FileSource(raw, format="raw", channels=3, channel=[2, 0, 1]))
+        assert list(frames['channel'][:3]) == [2, 0, 1]
+        assert (frames['index'].reshape(-1, 3) == frames['index'][::3, None]).all()
+        assert (frames['time'].reshape(-1, 3) == frames['time'][::3, None]).all()
+        for channel in (2, 0, 1):
+            found = frames[frames['channel'] == channel]
+            reference = formant_detector.extract(channels[:, channel].copy(), hop=1024)
+            assert np.allclose(np.column_stack((found['f1'], found['f2'])), reference)
+        primary = frames[frames['channel'] == 2]
+        last = primary[primary['f1'] > 0][-1]
+        assert detector.get_formants() == [last['f1'], last['f2']]
+        assert detector.get_stats()['dropped_frames'] == 0
+
+        # A silent channel is gated on its own
+        _, frames = analyze(formant_detector.FileSource(raw, format="raw", channels=3, channel=[0, 1]), gate=True)
+        assert frames[frames['channel'] == 0]['voiced'].any()
+        assert not frames[frames['channel'] == 1]['voiced'].any()
+
+        for channel in ([0, 0], [], [3]):
+            try:
+                formant_detector.FormantDetector().start_stream(
+                    source=formant_detector.FileSource(raw, format="raw", channels=3, channel=channel))
+                assert False, f"channels {channel} accepted"
+            except ValueError:
+                pass
+
+    device = os.environ.get("FORMANT_TEST_DEVICE")
+    if device is None:
+        print("Skipping live multichannel check (set FORMANT_TEST_DEVICE)")
+        return
+
+    detector = formant_detector.FormantDetector()
+    for channels, numbers in ((4, [0, 1, 2, 3]), ([3, 1], [3, 1])):
+        detector.start_stream(int(device), channels=channels)
+        frames = []
+        while len(frames) < 4 * len(numbers):
+            frame = detector.wait_next(timeout=2.0)
+            assert frame is not None
+            frames.append(frame)
+            frames.extend(detector.drain())
+        detector.stop_stream()
+        frames = np.array(frames, dtype=detector.drain().dtype)
+        assert list(frames['channel'][:len(numbers)]) == numbers
+        assert (np.bincount(frames['index'] - frames['index'][0])[:-1] == len(numbers)).all()
+    print("✓ Channels analyzed together in one stream")
+
+def test_decimation():
+    try:
+        import formant_detector
+        import numpy as np
+    except ImportError as e:
+        print(f"✗ Failed to import formant_detector: {e}")
+        return
+
+    t = np.arange(3 * 44100) / 44100.0
+    samples = (0.5 * np.sin(2 * np.pi * 700 * t) + 0.4 * np.sin(2 * np.pi * 1200 * t)).astype(np.float32)
+
+    # Same frames and bin spacing at a quarter of the FFT size
+    full = formant_detector.extract(samples, hop=1024)
+    decimated = formant_detector.extract(samples, hop=1024, decimation=4)
+    assert decimated.shape == full.shape
+    detected = decimated[:, 0] > 0
+    assert detected.any()
+    assert (np.abs(decimated[detected] - [700, 1200]) < 30).all()
+
+    # A 10 kHz tone would fold to 1025 Hz at 11025 Hz, the lowpass removes it first
+    noisy = samples + (0.5 * np.sin(2 * np.pi * 10000 * t)).astype(np.float32)
+    assert (formant_detector.extract(noisy, hop=1024, decimation=4) == decimated).all()
+
+    # The stream decimates block by block and must match the offline run
+    detector = formant_detector.FormantDetector(decimation=4)
+    assert detector.get_config()['decimation'] == 4
+    detector.start_stream(source=formant_detector.BufferSource(samples), hop=1024)
+    frames = []
+    frame = detector.wait_next(timeout=5.0)
+    while frame is not None:
+        frames.append(frame)
+        frames.extend(detector.drain())
+        frame = detector.wait_next(timeout=5.0)
+    detector.stop_stream()
+    assert (np.array([[frame['f1'], frame['f2']] for frame in frames]) == decimated).all()
+    assert detector.get_stats()['stages']['decimate']['count'] == len(frames)
+
+    for bad in ({"decimation": 0}, {"decimation": 3}, {"decimation": 8}):
+        try:
+            formant_detector.FormantDetector(**bad)
+            assert False, f"{bad} should be rejected"
+        except ValueError:
+            pass
+    for run in (lambda: formant_detector.extract(samples, hop=1022, decimation=4),
+                lambda: formant_detector.FormantDetector(decimation=4).start_stream(
+                    source=formant_detector.BufferSource(samples), hop=1022)):
+        try:
+            run()
+            assert False, "a hop that is not a multiple of decimation should be rejected"
+        except ValueError:
+            pass
+    print(f"✓ {len(frames)} frames analyzed at a quarter of the sample rate")
+
+def test_zoom():
+    try:
+        import formant_detector
+        import numpy as np
+    except ImportError as e:
+        print(f"✗ Failed to import formant_detector: {e}")
+        return
+
+    t = np.arange(3 * 44100) / 44100.0
+    tones = [712.3, 1234.5]
+    samples = (0.5 * np.sin(2 * np.pi * tones[0] * t) + 0.4 * np.sin(2 * np.pi * tones[1] * t + 1)).astype(np.float32)
+
+    def error(**config):
+        formants = formant_detector.extract(samples, hop=1024, **config)
+        detected = formants[formants[:, 0] > 0]
+        # Magnitudes of the complex bins find the tones in every frame
+        assert len(detected) == len(formants) or not config
+        return np.abs(detected - tones).max()
+
+    # Bins are 10.8 Hz apart: between bins, then finer bins, then both
+    assert error() > 5
+    assert error(interpolate=True) < 5
+    assert error(zoom=4) < 2
+    assert error(zoom=8, interpolate=True) < 0.2
+    assert error(zoom=8, interpolate=True, decimation=4) < 0.2
+
+    # The stream analyzes the same frames without an FFT plan of its own
+    detector = formant_detector.FormantDetector(zoom=8, interpolate=True)
+    assert detector.get_config()['zoom'] == 8 and detector.get_config()['interpolate']
+    detector.start_stream(source=formant_detector.BufferSource(samples), hop=1024)
+    frames = []
+    while (frame := detector.wait_next(timeout=5.0)) is not None:
+        frames.append(frame)
+        frames.extend(detector.drain())
+    detector.stop_stream()
+    expected = formant_detector.extract(samples, hop=1024, zoom=8, interpolate=True)
+    assert (np.array([[frame['f1'], frame['f2']] for frame in frames]) == expected).all()
+    frequencies = detector.spectrum_frequencies()
+    assert np.allclose(np.diff(frequencies), 44100 / 4096 / 8)
+    assert abs(frequencies[0] - 300) < 2 and abs(frequencies[-1] - 3200) < 2
+
+    for bad in (0, 65):
+        try:
+            formant_detector.FormantDetector(zoom=bad)
+            assert False, f"zoom={bad} should be rejected"
+        except ValueError:
+            pass
+    print(f"✓ Formants within {error(zoom=8, interpolate=True):.3f} Hz of the tones")
+
+def test_voice_gate():
+    try:
+        import formant_detector
+        import numpy as np
+    except ImportError as e:
+        print(f"✗ Failed to import formant_detector: {e}")
+        return
+
+    # Quiet room noise (-60 dBFS), a two-tone "vowel", loud hiss, room noise again
+    rng = np.random.default_rng(0)
+    t = np.arange(2 * 44100) / 44100.0
+    tones = 0.5 * np.sin(2 * np.pi * 700 * t) + 0.4 * np.sin(2 * np.pi * 1200 * t)
+    parts = [rng.normal(0, 0.001, 44100), tones, rng.normal(0, 0.1, 44100), rng.normal(0, 0.001, 44100)]
+    samples = np.concatenate(parts).astype(np.float32)
+    bounds = np.cumsum([0] + [len(part) for part in parts]) // 1024
+
+    ungated = formant_detector.extract(samples, hop=1024)
+    gated = formant_detector.extract(samples, hop=1024, gate=True)
+    assert (ungated[:bounds[1]] > 0).any()
+    voice = slice(bounds[1] + 4, bounds[2] - 4)
+    assert (gated[voice] == ungated[voice]).all()
+    assert (gated[:bounds[1] - 4] == 0).all() and (gated[bounds[2] + 4:] == 0).all()
+
+    # The harmonicity tells hiss from voice without a zero-crossing limit
+    periodic = formant_detector.extract(samples, hop=1024,
+                                        gate={"harmonicity": 0.5, "max_zero_crossings": 1e9})
+    assert (periodic[voice] == ungated[voice]).all()
+    assert (periodic[bounds[2] + 4:bounds[3] - 4] == 0).all()
+
+    detector = formant_detector.FormantDetector(gate={"open_db": -40, "hangover": 0})
+    assert detector.get_config()['gate']['open_db'] == -40
+    assert formant_detector.FormantDetector().get_config()['gate'] is None
+    detector.start_stream(source=formant_detector.BufferSource(samples), hop=1024)
+    frames = []
+    frame = detector.wait_next(timeout=5.0)
+    while frame is not None:
+        frames.append(frame)
+        frames.extend(detector.drain())
+        frame = detector.wait_next(timeout=5.0)
+    detector.stop_stream()
+    frames = np.array(frames)
+    expected = formant_detector.extract(samples, hop=1024, gate={"open_db": -40, "hangover": 0})
+    assert (np.column_stack((frames['f1'], frames['f2'])) == expected).all()
+    assert frames['voiced'][voice].all() and not frames['voiced'][:bounds[1] - 4].any()
+    assert abs(frames['level'][5] + 60) < 1 and frames['level'][voice].min() > -10
+    assert detector.get_stats()['gated_frames'] == np.count_nonzero(~frames['voiced'])
+
+    for bad in ({"open_db": -60, "close_db": -50}, {"harmonicity": 1.5}, {"hangover": -1},
+                {"threshold": 3}, "on"):
+        try:
+            formant_detector.FormantDetector(gate=bad)
+            assert False, f"gate={bad!r} should be rejected"
+        except ValueError:
+            pass
+    print(f"✓ {np.count_nonzero(frames['voiced'])} of {len(frames)} frames let through by the gate")
+
+def test_spectrum():
+    import os
+    import sys
+
+    try:
+        import formant_detector
+        import numpy as np
+    except ImportError as e:
+        print(f"✗ Failed to import formant_detector: {e}")
+        return
+
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "app"))
+    from spectrogram_view import SpectrogramReader
+
+    t = np.arange(2 * 44100) / 44100.0
+    samples = (0.5 * np.sin(2 * np.pi * 700 * t) + 0.4 * np.sin(2 * np.pi * 1200 * t)).astype(np.float32)
+
+    def run(detector, frames):
+        detector.start_stream(source=formant_detector.BufferSource(samples[:frames * 1024 + 3072]), hop=1024)
+        while detector.wait_next(timeout=5.0) is not None:
+            detector.drain()
+        detector.stop_stream()
+
+    detector = formant_detector.FormantDetector()
+    assert detector.get_spectrum() is None
+    frequencies = detector.spectrum_frequencies()
+    assert 300 <= frequencies[0] < frequencies[-1] <= 3200
+
+    name = f"vrecog-test-{os.getpid()}"
+    detector.start_spectrogram(name, rows=16)
+    assert detector.spectrogram_name == "/" + name
+    run(detector, 10)
+    spectrum = detector.get_spectrum()
+    assert not spectrum.flags.writeable and spectrum.shape == frequencies.shape
+    assert abs(frequencies[np.argmax(spectrum)] - 700) < 30
+
+    # A view pins its buffer: later frames never change it
+    kept = spectrum.copy()
+    run(detector, 20)
+    assert (spectrum == kept).all()
+    del spectrum
+
+    with SpectrogramReader(name) as reader:
+        times, indices, magnitudes = reader.latest()
+        assert reader.rows_written() == 30 and len(indices) == 15
+        assert (indices == np.arange(15, 30)).all() and (np.diff(times) > 0).all()
+        assert np.allclose(reader.frequencies, frequencies)
+        assert np.allclose(magnitudes[-1], detector.get_spectrum(), rtol=1e-6)
+
+    detector.stop_spectrogram()
+    assert not os.path.exists(os.path.join("/dev/shm", name))
+
+    # Any other file is refused, and not left mapped
+    import spectrogram_view
+    import tempfile
+    with tempfile.TemporaryDirectory() as directory:
+        with open(os.path.join(directory, "junk"), "wb") as f:
+            f.write(os.urandom(256))
+        shm_dir, spectrogram_view.SHM_DIR = spectrogram_view.SHM_DIR, directory
+        try:
+            SpectrogramReader("junk")
+            assert False, "Junk file read as a spectrogram"
+        except ValueError:
+            pass
+        finally:
+            spectrogram_view.SHM_DIR = shm_dir
+    print(f"✓ {len(frequencies)}-bin spectrum shared without copies")
+
+def test_recording():
+    import json
+    import os
+    import sys
+    import tempfile
+
+    try:
+        import formant_detector
+        import numpy as np
+    except ImportError as e:
+        print(f"✗ Failed to import formant_detector: {e}")
+        return
+
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "app"))
+    from recording import Recording, replay
+
+    t = np.arange(int(3.5 * 44100)) / 44100.0
+    samples = (0.5 * np.sin(2 * np.pi * 700 * t) + 0.4 * np.sin(2 * np.pi * 1200 * t)).astype(np.float32)
+
+    def run(detector, source):
+        detector.start_stream(source=source, hop=1024)
+        frames = []
+        while (frame := detector.wait_next(timeout=5.0)) is not None:
+            frames.append(frame)
+            frames.extend(detector.drain())
+        detector.stop_stream()
+        return np.array(frames)
+
+    def same_frames(a, b):
+        # Times are rounded from whichever clock anchor the analysis thread read
+        return (np.array_equal(a['f1'], b['f1']) and np.array_equal(a['f2'], b['f2'])
+                and np.allclose(a['time'], b['time'], rtol=0, atol=1e-9))
+
+    with tempfile.TemporaryDirectory() as tmp:
+        directory = os.path.join(tmp, "capture")
+        detector = formant_detector.FormantDetector()
+        assert detector.recording_stats() is None
+        detector.start_recording(directory, segment_seconds=1.0, segments=0)
+        frames = run(detector, formant_detector.BufferSource(samples))
+        assert detector.recording_stats()["directory"] == directory
+        stats = detector.stop_recording()
+        assert stats["frames"] == len(frames) and stats["dropped_samples"] == 0 and stats["gaps"] == 0
+
+        # Segments of one second, every frame next to the end of its samples
+        with open(os.path.join(directory, "index.json")) as f:
+            index = json.load(f)
+        assert [entry["first_sample"] for entry in index["segments"]] == [0, 44100, 88200, 132300]
+        assert all(entry["complete"] for entry in index["segments"])
+        recording = Recording(directory)
+        start, recorded = recording.samples()
+        read = 4096 + (len(frames) - 1) * 1024
+        assert start == 0.0 and np.array_equal(recorded, samples[:read])
+        assert np.array_equal(recording.frames(), frames)
+        for segment in recording.segments:
+            ends = np.rint((segment.frames['time'] - segment.start_time) * 44100) + 4096
+            assert ((ends > 0) & (ends <= len(segment.samples))).all()
+
+        # Replay gives back the recorded frames, from the start or from any time
+        replayed = run(formant_detector.FormantDetector(), formant_detector.RecordingSource(directory))
+        assert same_frames(replayed, frames)
+        recorded_part, replayed_part = replay(recording, start=1.5, end=2.5)
+        assert replayed_part['time'][0] >= 1.5 and len(replayed_part) > 0
+        assert same_frames(replayed_part, recorded_part)
+        assert recording.segment_at(1.5).first_sample == 44100 and recording.segment_at(10.0) is None
+
+        # Rotation keeps the newest segments, a new stream starts a new one
+        rotating = os.path.join(tmp, "rotating")
+        detector.start_recording(rotating, segment_seconds=1.0, segments=2)
+        run(detector, formant_detector.BufferSource(samples))
+        run(detector, formant_detector.BufferSource(samples[:44100]))
+        stats = detector.stop_recording()
+        assert stats["segments"] == 5 and stats["gaps"] == 1
+        assert sorted(name for name in os.listdir(rotating) if name.endswith(".vrrec")) == \
+            ["segment-000004.vrrec", "segment-000005.vrrec"]
+        assert [segment.first_sample for segment in Recording(rotating).segments] == [132300, 0]
+
+        try:
+            detector.start_recording(directory)
+            assert False, "A second recording into the same directory was accepted"
+        except ValueError:
+            pass
+    print(f"✓ {len(frames)} frames recorded and replayed")
+
+def test_audio_session():
+    import os
+
+    try:
+        import formant_detector
+    except ImportError as e:
+        print(f"✗ Failed to import formant_detector: {e}")
+        return
+
+    keys = {'index', 'name', 'host_api', 'max_input_channels', 'max_output_channels', 'default_sample_rate',
+            'default_low_input_latency', 'default_high_input_latency', 'default_input', 'default_output'}
+    devices = formant_detector.audio_devices()
+    assert all(set(device) == keys for device in devices)
+    assert [device['index'] for device in devices] == sorted({device['index'] for device in devices})
+
+    # Listed once, served from the cache until refreshed
+    with formant_detector.AudioSession() as session:
+        assert session.is_open
+        assert session.devices() == devices
+        refreshed = session.devices(refresh=True)
+        assert [device['name'] for device in refreshed] == [device['name'] for device in devices]
+        detector = formant_detector.FormantDetector()
+        del detector
+    assert not session.is_open
+    session.close()
+    print(f"✓ Listed {len(devices)} audio devices")
+
+    device = os.environ.get("FORMANT_TEST_DEVICE")
+    if device is None:
+        print("Skipping live device refresh check (set FORMANT_TEST_DEVICE)")
+        return
+
+    detector = formant_detector.FormantDetector()
+    detector.start_stream(int(device))
+    try:
+        formant_detector.audio_devices(refresh=True)
+        assert False, "devices were probed again while a stream was open"
+    except RuntimeError:
+        pass
+    assert formant_detector.audio_devices() == refreshed
+    detector.stop_stream()
+    formant_detector.audio_devices(refresh=True)
+
+    # The same detector streams again after a refresh
+    detector.start_stream(int(device))
+    assert detector.wait_next(timeout=2.0) is not None
+    detector.stop_stream()
+    print("✓ Devices refresh once no stream is open")
+
+def test_benchmarks():
+    import json
+    import os
+    import sys
+    import tempfile
+
+    try:
+        import formant_detector
+        import numpy as np
+    except ImportError as e:
+        print(f"✗ Failed to import formant_detector: {e}")
+        return
+
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+    from benchmarks import synth
+    from benchmarks.__main__ import main
+
+    # The synthesizer's strongest formant region must be where the detector looks
+    samples = synth.synthesize_vowel('A', duration=1.0, seed=1)
+    assert samples.dtype == np.float32 and len(samples) == 44100
+    formants = formant_detector.extract(samples, hop=1024)
+    detected = formants[formants[:, 0] > 0]
+    assert len(detected) > 0
+    assert abs(np.median(detected[:, 0]) - synth.VOWEL_FORMANTS['A'][0]) < 150
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "results.json")
+        main(["--quick", "--skip-classifier", "--output", path])
+        with open(path) as f:
+            results = json.load(f)
+    assert results["live"]["frames"] == results["offline"][0]["frames"]
+    assert results["live"]["dropped_frames"] == 0
+    assert results["frame_latency"]["p99_us"] >= results["frame_latency"]["p50_us"]
+    print(f"✓ Benchmarks ran, {results['offline'][0]['frames_per_second']:.0f} frames/s offline")
+
+def test_stats():
+    import json
+    import os
+    import tempfile
+    import time
+
+    try:
+        import formant_detector
+        import numpy as np
+    except ImportError as e:
+        print(f"✗ Failed to import formant_detector: {e}")
+        return
+
+    t = np.arange(2 * 44100) / 44100.0
+    samples = (0.5 * np.sin(2 * np.pi * 700 * t) + 0.4 * np.sin(2 * np.pi * 1200 * t)).astype(np.float32)
+    samples[44100:] = 0  # one second without formants
+
+    detector = formant_detector.FormantDetector()
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "formant.prom")
+        detector.start_stats_dump(path, interval=0.05, name="test")
+        detector.start_stream(source=formant_detector.BufferSource(samples), hop=1024)
+        frames = []
+        while detector.wait_next(timeout=5.0) is not None:
+            frames.append(None)
+            frames.extend(detector.drain())
+        detector.stop_stream()
+        time.sleep(0.1)
+        detector.stop_stats_dump()
+
+        stats = detector.get_stats()
+        found = formant_detector.extract(samples, hop=1024)
+        assert stats['frames'] == len(frames) == len(found)
+        assert stats['frames_without_formants'] == np.sum(found[:, 0] == 0) > 0
+        assert stats['input_overflows'] == stats['input_underflows'] == 0
+        assert 0 < stats['load'] <= stats['peak_load']
+
+        # Every analyzed frame is timed in every analyzer stage, the classifier only with a model
+        buckets = len(formant_detector.TIMING_BUCKETS_US) + 1
+        for stage in ('fft', 'smoothing', 'derivative', 'peaks', 'frame'):
+            timing = stats['stages'][stage]
+            assert timing['count'] == len(frames) and sum(timing['buckets']) == len(frames)
+            assert len(timing['buckets']) == buckets
+            assert 0 < timing['mean_us'] <= timing['max_us'] and timing['p50_us'] <= timing['p99_us']
+        assert stats['stages']['classify']['count'] == 0
+
+        with open(path) as f:
+            text = f.read()
+        assert f'formant_frames_total{{detector="test"}} {len(frames)}' in text
+        assert f'formant_stage_seconds_count{{detector="test",stage="fft"}} {len(frames)}' in text
+        assert 'formant_stage_seconds_bucket{detector="test",stage="frame",le="+Inf"}' in text
+
+    # Label values are escaped, so any device name gives a parseable line
+    text = detector.format_stats("prometheus", name='mic "2"\\left\nchannel')
+    assert 'formant_frames_total{detector="mic \\"2\\"\\\\left\\nchannel"} ' in text
+    assert all(line.startswith(("#", "formant_")) for line in text.splitlines())
+
+    exported = json.loads(detector.format_stats("json"))
+    assert exported['frames'] == len(frames) and exported['stages']['peaks']['count'] == len(frames)
+    try:
+        detector.format_stats("xml")
+        assert False, "unknown formats should be rejected"
+    except ValueError:
+        pass
+    print(f"✓ Stats of {len(frames)} frames, analysis load {stats['load']:.4f}")
+
+def test_callback_allocations():
+    """Needs a build with ALLOCATION_CHECK=1 and FORMANT_TEST_DEVICE set to an input device"""
+    import os
+    import time
+
+    try:
+        import formant_detector
+    except ImportError as e:
+        print(f"✗ Failed to import formant_detector: {e}")
+        return
+
+    device = os.environ.get("FORMANT_TEST_DEVICE")
+    if not hasattr(formant_detector, "allocation_check_stats") or device is None:
+        print("Skipping allocation check (build with ALLOCATION_CHECK=1, set FORMANT_TEST_DEVICE)")
+        return
+
+    detector = formant_detector.FormantDetector()
+    detector.start_stream(int(device))
+    time.sleep(0.5)
+    detector.stop_stream()
+
+    callbacks, allocations = formant_detector.allocation_check_stats()
+    assert callbacks > 0
+    assert allocations == 0, f"{allocations} heap allocations inside {callbacks} callbacks"
+    print(f"✓ {callbacks} callbacks without heap allocations")
+
 if __name__ == "__main__":
     test_formant_detector()
+    test_extract()
+    test_analysis_config()
+    test_frame_history()
+    test_frame_events()
+    test_overlapping_hop()
+    test_detector_group()
+    test_audio_sources()
+    test_multichannel()
+    test_decimation()
+    test_zoom()
+    test_voice_gate()
+    test_spectrum()
+    test_recording()
+    test_audio_session()
+    test_benchmarks()
+    test_stats()
+    test_callback_allocations()